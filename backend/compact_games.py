@@ -0,0 +1,151 @@
+"""
+既存ゲームドキュメントの圧縮ジョブ。
+
+- 埋め込みの gameLog 配列を games/{id}/logs サブコレクションへ移し、recentLog/logSeq に置き換える
+  （gameLog を残したまま追記されたエントリがあれば、配列の後ろの連番に振り直す）
+- 毎ターン全文プロンプトを保存していた chatHistory を、ターン差分の conversation に置き換える
+
+使い方:
+    python compact_games.py                # chatHistory / gameLog を持つ全ゲームを圧縮
+    python compact_games.py GAME_ID ...    # 指定したゲームのみ
+    python compact_games.py --dry-run      # 書き込みせずにサイズだけ表示
+"""
+import argparse
+from datetime import datetime
+from typing import List, Optional
+
+import firebase_admin
+from dotenv import load_dotenv
+from firebase_admin import credentials, firestore
+
+from conversation import conversation_from_log
+from game_log import LOG_COLLECTION, RECENT_LOG_SIZE, log_doc_id
+
+# Firestoreのバッチ書き込み上限
+BATCH_LIMIT = 500
+
+
+def estimate_value_size(value) -> int:
+    """Firestoreのストレージサイズ計算規則に沿って値のサイズを概算する"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, datetime)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(len(str(key).encode("utf-8")) + 1 + estimate_value_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_value_size(item) for item in value)
+    return len(str(value).encode("utf-8")) + 1
+
+
+def estimate_document_size(game_id: str, data: dict) -> int:
+    """ドキュメント名 + フィールド + 固定オーバーヘッド(32バイト)"""
+    name_size = len(f"games/{game_id}".encode("utf-8")) + 1
+    return name_size + estimate_value_size(data) + 32
+
+
+def compact_game_data(game_data: dict, appended_log: Optional[List[dict]] = None) -> tuple:
+    """
+    ゲームデータから圧縮後のフィールド更新と、移行すべきログエントリを計算する。
+    appended_log は gameLog を残したまま logs サブコレクションに追記済みのエントリ（連番順）。
+    戻り値: (updates, log_entries, stale_entries)
+      updates の値が None のフィールドは削除対象。stale_entries は振り直しで不要になった旧ドキュメント
+    """
+    updates = {}
+    log_entries = []
+    stale_entries = []
+    legacy_log = game_data.get("gameLog") or []
+
+    if legacy_log:
+        for seq, entry in enumerate(legacy_log, start=1):
+            log_entries.append(dict(entry, seq=seq))
+        # 配列が 1..N を使うので、追記済みのエントリは N+1 から順に振り直す
+        # （修正前のコードは logSeq=0 から振っていたため、配列の連番と重なっていることがある）
+        kept = []
+        for seq, entry in enumerate(appended_log or [], start=len(legacy_log) + 1):
+            if entry.get("seq") != seq:
+                stale_entries.append(entry)
+                log_entries.append(dict(entry, seq=seq))
+            kept.append(dict(entry, seq=seq))
+        updates["logSeq"] = len(legacy_log) + len(kept)
+        updates["recentLog"] = (log_entries[:len(legacy_log)] + kept)[-RECENT_LOG_SIZE:]
+        updates["gameLog"] = None
+
+    if "chatHistory" in game_data:
+        if not game_data.get("conversation"):
+            player_names = {uid: player.get("characterName") or uid for uid, player in game_data.get("players", {}).items()}
+            updates["conversation"] = conversation_from_log(legacy_log, player_names)
+        updates["chatHistory"] = None
+
+    return updates, log_entries, stale_entries
+
+
+def compact_game(db, game_ref, dry_run: bool = False) -> tuple:
+    """1ゲームを圧縮し、(圧縮前サイズ, 圧縮後サイズ) を返す"""
+    game_data = game_ref.get().to_dict() or {}
+    before = estimate_document_size(game_ref.id, game_data)
+    appended_log = []
+    if game_data.get("gameLog") and game_data.get("logSeq"):
+        appended_log = [doc.to_dict() for doc in game_ref.collection(LOG_COLLECTION).order_by("seq").stream()]
+    updates, log_entries, stale_entries = compact_game_data(game_data, appended_log)
+
+    compacted = {key: value for key, value in game_data.items() if updates.get(key, value) is not None}
+    compacted.update({key: value for key, value in updates.items() if value is not None})
+    after = estimate_document_size(game_ref.id, compacted)
+
+    if dry_run or not updates:
+        return before, after
+
+    # ログは先にサブコレクションへ書き込み、最後にゲームドキュメントを更新する
+    logs_ref = game_ref.collection(LOG_COLLECTION)
+    new_ids = {log_doc_id(entry.get("turn", 0), entry["seq"]) for entry in log_entries}
+    for start in range(0, len(log_entries), BATCH_LIMIT):
+        batch = db.batch()
+        for entry in log_entries[start:start + BATCH_LIMIT]:
+            batch.set(logs_ref.document(log_doc_id(entry.get("turn", 0), entry["seq"])), entry)
+        batch.commit()
+    # 振り直した旧ドキュメントのうち、新しいエントリで上書きされなかったものを消す
+    stale_ids = [doc_id for doc_id in (log_doc_id(entry.get("turn", 0), entry["seq"]) for entry in stale_entries) if doc_id not in new_ids]
+    for start in range(0, len(stale_ids), BATCH_LIMIT):
+        batch = db.batch()
+        for doc_id in stale_ids[start:start + BATCH_LIMIT]:
+            batch.delete(logs_ref.document(doc_id))
+        batch.commit()
+
+    game_ref.update({key: firestore.DELETE_FIELD if value is None else value for key, value in updates.items()})
+    return before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ゲームドキュメントの gameLog / chatHistory を圧縮する")
+    parser.add_argument("game_ids", nargs="*", help="対象のゲームID（省略時は全ゲーム）")
+    parser.add_argument("--dry-run", action="store_true", help="書き込みを行わずサイズのみ表示する")
+    args = parser.parse_args()
+
+    load_dotenv()
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.ApplicationDefault())
+    db = firestore.client()
+
+    if args.game_ids:
+        game_refs = [db.collection("games").document(game_id) for game_id in args.game_ids]
+    else:
+        game_refs = [doc.reference for doc in db.collection("games").stream()]
+
+    total_before = total_after = 0
+    for game_ref in game_refs:
+        before, after = compact_game(db, game_ref, dry_run=args.dry_run)
+        total_before += before
+        total_after += after
+        if before != after:
+            print(f"📦 {game_ref.id}: {before:,} bytes -> {after:,} bytes")
+
+    print(f"✅ 合計: {total_before:,} bytes -> {total_after:,} bytes{' (dry-run)' if args.dry_run else ''}")
+
+
+if __name__ == "__main__":
+    main()
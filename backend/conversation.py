@@ -0,0 +1,77 @@
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# GMとの会話はターンごとの差分（プレイヤー行動・ツール結果・ナレーション）だけを保存する。
+# 以前は毎ターン全文プロンプトを chatHistory に追記していたため、
+# プロンプトに含まれる過去ログの分だけ保存量がターン数の2乗で増えていた。
+
+CONVERSATION_RETENTION_TURNS = int(os.getenv("CONVERSATION_RETENTION_TURNS", "10"))
+
+
+def build_turn_delta(turn: int, player_actions: Dict[str, str], tool_results: List[dict], narration: str) -> dict:
+    """1ターン分の会話差分を作る"""
+    return {
+        "turn": turn,
+        "actions": dict(player_actions),
+        "tools": list(tool_results),
+        "narration": narration,
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+
+
+def append_turn_delta(conversation: Optional[List[dict]], delta: dict, retention_turns: int = CONVERSATION_RETENTION_TURNS,
+                      folded_through: int = 0) -> List[dict]:
+    """
+    差分を追加し、保持ターン数を超えた古い差分を捨てた新しいリストを返す。
+    捨てるのは要約に畳み込み済み（folded_through ターン以前）の差分だけで、
+    要約の更新が遅れている・失敗している間は保持ターン数を超えても残す（要約と逐語の両方から消えないように）。
+    """
+    updated = [entry for entry in (conversation or []) if entry.get("turn") != delta["turn"]]
+    updated.append(delta)
+    if retention_turns <= 0:
+        return updated
+    start = len(updated) - retention_turns
+    kept = [entry for index, entry in enumerate(updated) if index >= start or entry.get("turn", 0) > folded_through]
+    unfolded = sum(1 for entry in kept if entry.get("turn", 0) > folded_through)
+    if unfolded > retention_turns:
+        print(f"⚠️ あらすじに畳み込まれていないターンが{unfolded}件あります（保持ターン数 {retention_turns}）。要約の更新を確認してください")
+    return kept
+
+
+def conversation_from_log(game_log: List[dict], player_names: Dict[str, str], retention_turns: int = CONVERSATION_RETENTION_TURNS) -> List[dict]:
+    """
+    既存のゲームログから会話差分を再構築する（chatHistory からの移行用）。
+    GM応答が記録されたターンのみを対象にする。
+    """
+    turns: Dict[int, dict] = {}
+    for log in game_log:
+        turn = log.get("turn", 0)
+        delta = turns.setdefault(turn, {"turn": turn, "actions": {}, "tools": [], "narration": None, "timestamp": None})
+        log_type = log.get("type")
+        if log_type == "player_action":
+            player_id = log.get("playerId")
+            delta["actions"][player_names.get(player_id, player_id)] = log.get("content", "")
+        elif log_type == "dice_roll" and log.get("playerId") == "GM":
+            delta["tools"].append({"name": "roll_dice", "result": log.get("content", "")})
+        elif log_type == "gm_response":
+            delta["narration"] = log.get("content", "")
+            timestamp = log.get("timestamp")
+            delta["timestamp"] = timestamp.isoformat() if hasattr(timestamp, "isoformat") else timestamp
+
+    completed = [turns[turn] for turn in sorted(turns) if turns[turn]["narration"] is not None]
+    return completed[-retention_turns:] if retention_turns > 0 else completed
+
+
+def format_conversation(conversation: List[dict]) -> str:
+    """会話差分をプロンプト用のテキストに整形する"""
+    lines = []
+    for delta in conversation:
+        lines.append(f"## ターン{delta.get('turn')}")
+        for name, action in (delta.get("actions") or {}).items():
+            lines.append(f"- {name}: {action}")
+        for tool in delta.get("tools") or []:
+            lines.append(f"- [{tool.get('name')}] {tool.get('result')}")
+        if delta.get("narration"):
+            lines.append(f"GM: {delta['narration']}")
+    return "\n".join(lines)
@@ -16,6 +16,13 @@ if [ ! -f "Dockerfile" ]; then
     exit 1
 fi
 
+# GM応答の解析がコーパスを期待どおりに解析できるか確認（失敗したらデプロイしない）
+echo "🧪 Checking GM output parser..."
+if ! python3 gm_output.py --check; then
+    echo "❌ Error: GM output parser check failed."
+    exit 1
+fi
+
 # Google Cloud設定
 echo "📋 Setting up Google Cloud configuration..."
 gcloud config set project $PROJECT_ID
@@ -0,0 +1,353 @@
+import hashlib
+import os
+import random
+import re
+import secrets
+import time
+import unicodedata
+from typing import Callable, List, Optional
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    print("⚠️ numpy ライブラリが利用できません。ダイスは純Pythonで振ります（pip install numpy で高速化）。")
+
+# ダイス式の解析とロール。
+# 「2d6+dex」「4d6kh3」「1d20 adv」「exploding d6」「1d8+3」のような式を解析し、
+# ダイスの項ごとに出目をまとめて（numpyがあればベクトル化して）振る。
+# 乱数はゲームごとのシードとターン・ロール番号から作るため、同じターンを再実行しても出目は変わらない。
+
+# ゲームごとのシードの元になる秘密値。ゲームドキュメントはクライアントから読めるため、シードはドキュメントに置かない。
+# 未設定の場合はプロセスごとにランダムに決める（同じプロセス内でのみ再現できる）
+DICE_SEED_SECRET = os.getenv("DICE_SEED_SECRET") or secrets.token_hex(16)
+
+MAX_DICE = 1000  # 1項あたりのダイス数の上限
+MAX_SIDES = 1000
+MAX_TERMS = 10
+MAX_EXPLOSIONS = 20  # 爆発ダイスの振り足し回数の上限（1個あたり）
+MAX_BATCH = 1_000_000  # モンテカルロで一度に振る回数の上限
+
+ABILITY_NAMES = ("strength", "dexterity", "constitution", "intelligence", "wisdom", "charisma")
+ABILITY_ALIASES = {
+    "str": "strength", "dex": "dexterity", "con": "constitution",
+    "int": "intelligence", "wis": "wisdom", "cha": "charisma",
+    "筋力": "strength", "敏捷": "dexterity", "敏捷力": "dexterity", "耐久": "constitution", "耐久力": "constitution",
+    "知力": "intelligence", "判断": "wisdom", "判断力": "wisdom", "魅力": "charisma",
+    **{name: name for name in ABILITY_NAMES},
+}
+
+_ADVANTAGE_WORDS = {"adv": "advantage", "advantage": "advantage", "有利": "advantage",
+                    "dis": "disadvantage", "disadvantage": "disadvantage", "不利": "disadvantage"}
+_EXPLODING_WORDS = {"exploding", "explode", "爆発"}
+_WORD_PATTERN = re.compile(r"[a-z]+|[^\x00-\x7f]+")
+_TERM_PATTERN = re.compile(r"\s*([+-])?\s*(?:(\d*)d(\d+)(!)?(?:(kh|kl|k|dh|dl)(\d+))?|(\d+)|([a-z]+|[^\x00-\x7f\s+-]+))")
+
+
+class DiceError(ValueError):
+    """ダイス式が不正（HTTP 400 やツールのエラー応答として返す）"""
+
+
+class DiceTerm:
+    """NdS の1項（保持・除外の指定と爆発の有無を含む）"""
+    __slots__ = ("count", "sides", "sign", "keep", "keep_count", "explode")
+
+    def __init__(self, count: int, sides: int, sign: int = 1, keep: str = "", keep_count: int = 0, explode: bool = False):
+        self.count = count
+        self.sides = sides
+        self.sign = sign
+        self.keep = keep  # "" / "h"（大きい順に保持）/ "l"（小さい順に保持）
+        self.keep_count = keep_count
+        self.explode = explode
+
+    def __str__(self) -> str:
+        text = f"{self.count}d{self.sides}" + ("!" if self.explode else "")
+        if self.keep:
+            text += f"k{self.keep}{self.keep_count}"
+        return text
+
+
+class DiceExpression:
+    """解析済みのダイス式。ダイスの項、固定値、能力値修正からなる"""
+
+    def __init__(self, terms: List[DiceTerm], constant: int = 0, abilities: Optional[List[tuple]] = None, advantage: str = ""):
+        self.terms = terms
+        self.constant = constant
+        self.abilities = abilities or []  # (符号, 能力値名)
+        self.advantage = advantage
+
+    def __str__(self) -> str:
+        parts = []
+        for term in self.terms:
+            parts.append(("-" if term.sign < 0 else "+") + str(term))
+        for sign, ability in self.abilities:
+            parts.append(("-" if sign < 0 else "+") + ability)
+        if self.constant:
+            parts.append(f"{self.constant:+d}")
+        text = "".join(parts).lstrip("+") or "0"
+        if self.advantage:
+            text += f" ({self.advantage})"
+        return text
+
+    def modifier(self, ability_modifier: Optional[Callable[[str], int]] = None) -> int:
+        """固定値と能力値修正の合計（ability_modifier が無ければ能力値修正は0）"""
+        total = self.constant
+        if ability_modifier:
+            total += sum(sign * ability_modifier(ability) for sign, ability in self.abilities)
+        return total
+
+
+def parse_dice_expression(text: str) -> DiceExpression:
+    """ダイス式を解析する。不正な式は DiceError"""
+    normalized = unicodedata.normalize("NFKC", text or "").lower().strip()
+    if not normalized:
+        raise DiceError("ダイス式が空です。")
+
+    # 式全体にかかるキーワード（有利・不利、爆発）を先に取り除く
+    advantage = ""
+    explode_all = False
+    def strip_keyword(match):
+        nonlocal advantage, explode_all
+        word = match.group(0)
+        if word in _ADVANTAGE_WORDS:
+            if advantage and advantage != _ADVANTAGE_WORDS[word]:
+                raise DiceError("有利と不利は同時に指定できません。")
+            advantage = _ADVANTAGE_WORDS[word]
+            return " "
+        if word in _EXPLODING_WORDS:
+            explode_all = True
+            return " "
+        return word
+    normalized = _WORD_PATTERN.sub(strip_keyword, normalized)
+
+    terms: List[DiceTerm] = []
+    constant = 0
+    abilities = []
+    position = 0
+    normalized = normalized.strip()
+    while position < len(normalized):
+        match = _TERM_PATTERN.match(normalized, position)
+        if not match or match.end() == position:
+            raise DiceError(f"ダイス式を解釈できません: '{text}'")
+        if position > 0 and not match.group(1):
+            raise DiceError(f"項の間には + か - が必要です: '{text}'")
+        sign = -1 if match.group(1) == "-" else 1
+        count_text, sides_text, bang, keep_op, keep_text, number_text, word = match.group(2, 3, 4, 5, 6, 7, 8)
+        if sides_text is not None:
+            count = int(count_text) if count_text else 1
+            sides = int(sides_text)
+            if not (1 <= count <= MAX_DICE):
+                raise DiceError(f"ダイスの数は1〜{MAX_DICE}個にしてください。")
+            if not (1 <= sides <= MAX_SIDES):
+                raise DiceError(f"ダイスの面数は1〜{MAX_SIDES}にしてください。")
+            keep, keep_count = "", 0
+            if keep_op:
+                number = int(keep_text)
+                if keep_op in ("k", "kh", "kl"):
+                    keep, keep_count = ("l" if keep_op == "kl" else "h"), number
+                else:
+                    # 除外指定は保持指定に置き換える（dl1 = 大きい方から count-1 個を保持）
+                    keep, keep_count = ("h" if keep_op == "dl" else "l"), count - number
+                if not (0 < keep_count <= count):
+                    raise DiceError(f"保持するダイスの数が不正です: '{match.group(0).strip()}'")
+                if keep_count == count:
+                    keep, keep_count = "", 0
+            terms.append(DiceTerm(count, sides, sign, keep, keep_count, explode=bool(bang) or explode_all))
+        elif number_text is not None:
+            constant += sign * int(number_text)
+        else:
+            ability = ABILITY_ALIASES.get(word)
+            if ability is None:
+                raise DiceError(f"不明な能力値です: '{word}'")
+            abilities.append((sign, ability))
+        if len(terms) + len(abilities) > MAX_TERMS:
+            raise DiceError(f"項は{MAX_TERMS}個までにしてください。")
+        position = match.end()
+
+    if not terms:
+        raise DiceError(f"ダイスが含まれていません: '{text}'")
+    if advantage:
+        # 有利・不利は最初の1個のダイス（通常は1d20）を2個振って大きい方・小さい方を使う
+        target = next((term for term in terms if term.count == 1 and not term.keep), None)
+        if target is None:
+            raise DiceError("有利・不利は1個だけ振るダイス（1d20など）に指定してください。")
+        target.count = 2
+        target.keep, target.keep_count = ("h" if advantage == "advantage" else "l"), 1
+
+    return DiceExpression(terms, constant, abilities, advantage)
+
+
+def dice_rng(*seed_parts):
+    """シードの元（ゲームのシード、ターン、ロール番号など）から決定的な乱数生成器を作る"""
+    digest = hashlib.sha256("|".join(str(part) for part in seed_parts).encode("utf-8")).digest()
+    seed = int.from_bytes(digest[:16], "big")
+    if NUMPY_AVAILABLE:
+        return np.random.Generator(np.random.PCG64(seed))
+    return random.Random(seed)
+
+
+def game_dice_rng(game_id: str, *seed_parts):
+    """ゲームのダイス用の乱数生成器（同じゲーム・同じシードの元なら同じ出目になる）"""
+    return dice_rng(DICE_SEED_SECRET, game_id, *seed_parts)
+
+
+def _roll_faces_numpy(rng, term: DiceTerm, batch: int):
+    """(batch, count) の出目（爆発ダイスは振り足し分を合算）"""
+    faces = rng.integers(1, term.sides + 1, size=(batch, term.count), dtype=np.int64)
+    if term.explode and term.sides > 1:
+        live = faces == term.sides
+        for _ in range(MAX_EXPLOSIONS):
+            if not live.any():
+                break
+            extra = np.zeros_like(faces)
+            extra[live] = rng.integers(1, term.sides + 1, size=int(live.sum()), dtype=np.int64)
+            faces += extra
+            live &= extra == term.sides
+    return faces
+
+
+def _roll_faces_python(rng, term: DiceTerm) -> List[int]:
+    faces = []
+    for _ in range(term.count):
+        face = rng.randint(1, term.sides)
+        value = face
+        explosions = 0
+        while term.explode and term.sides > 1 and face == term.sides and explosions < MAX_EXPLOSIONS:
+            face = rng.randint(1, term.sides)
+            value += face
+            explosions += 1
+        faces.append(value)
+    return faces
+
+
+def _kept_indices(faces: List[int], term: DiceTerm) -> set:
+    if not term.keep:
+        return set(range(len(faces)))
+    order = sorted(range(len(faces)), key=lambda index: faces[index], reverse=(term.keep == "h"))
+    return set(order[:term.keep_count])
+
+
+def roll_expression(expression: DiceExpression, rng, ability_modifier: Optional[Callable[[str], int]] = None) -> dict:
+    """
+    式を1回振り、出目の内訳を返す。
+    rolls は全ダイスの出目（爆発は振り足し込み）、dropped は保持されなかった出目。
+    total はダイスの合計、final_total は固定値・能力値修正を足した値。
+    """
+    term_results = []
+    rolls: List[int] = []
+    dropped: List[int] = []
+    dice_total = 0
+    for term in expression.terms:
+        if NUMPY_AVAILABLE and isinstance(rng, np.random.Generator):
+            faces = _roll_faces_numpy(rng, term, 1)[0].tolist()
+        else:
+            faces = _roll_faces_python(rng, term)
+        kept = _kept_indices(faces, term)
+        subtotal = term.sign * sum(faces[index] for index in kept)
+        term_dropped = [face for index, face in enumerate(faces) if index not in kept]
+        term_results.append({"dice": str(term), "rolls": faces, "dropped": term_dropped, "subtotal": subtotal})
+        rolls.extend(faces)
+        dropped.extend(term_dropped)
+        dice_total += subtotal
+
+    modifier = expression.modifier(ability_modifier)
+    result = {
+        "expression": str(expression),
+        "rolls": rolls,
+        "total": dice_total,
+        "final_total": dice_total + modifier,
+    }
+    if len(expression.terms) > 1 or any(term.keep or term.explode for term in expression.terms):
+        result["terms"] = term_results
+    if dropped:
+        result["dropped"] = dropped
+    if modifier != 0:
+        result["modifier"] = modifier
+    if expression.abilities:
+        result["ability_used"] = ",".join(ability for _, ability in expression.abilities)
+    if expression.advantage:
+        result["advantage"] = expression.advantage
+    return result
+
+
+def roll_totals(expression: DiceExpression, rng, batch: int, modifier: int = 0):
+    """
+    式を batch 回まとめて振り、最終値の配列を返す（モンテカルロ用）。
+    numpy があれば項ごとに (batch, count) の出目を一度に生成し、保持指定は行ごとのソートで処理する。
+    """
+    if not (1 <= batch <= MAX_BATCH):
+        raise DiceError(f"ロール回数は1〜{MAX_BATCH}回にしてください。")
+    if NUMPY_AVAILABLE and isinstance(rng, np.random.Generator):
+        totals = np.full(batch, modifier, dtype=np.int64)
+        for term in expression.terms:
+            faces = _roll_faces_numpy(rng, term, batch)
+            if term.keep:
+                faces = np.sort(faces, axis=1)
+                faces = faces[:, -term.keep_count:] if term.keep == "h" else faces[:, :term.keep_count]
+            totals += term.sign * faces.sum(axis=1)
+        return totals
+    totals = []
+    for _ in range(batch):
+        total = modifier
+        for term in expression.terms:
+            faces = _roll_faces_python(rng, term)
+            total += term.sign * sum(faces[index] for index in _kept_indices(faces, term))
+        totals.append(total)
+    return totals
+
+
+def format_roll(result: dict, label: str = "") -> str:
+    """ゲームログに載せるダイスロールの表示"""
+    label_text = f" ({label})" if label else ""
+    dropped_text = f" 除外: {result['dropped']}" if result.get("dropped") else ""
+    ability_text = f" [{result['ability_used']} {result['modifier']:+d}]" if result.get("ability_used") and result.get("modifier") else ""
+    text = f"ダイスロール{label_text} ({result['expression']}{ability_text}): {result['rolls']}{dropped_text} (合計: {result['final_total']})"
+    if "dc" in result:
+        probability_text = f" 成功率{result['success_probability']:.0%}" if "success_probability" in result else ""
+        text += f" 目標値{result['dc']}: {'成功' if result['success'] else '失敗'}{probability_text}"
+    return text
+
+
+def _legacy_roll(num_dice: int, num_sides: int) -> int:
+    """従来の実装（random.randint を1個ずつ呼ぶ）。ベンチマークの比較用"""
+    return sum([random.randint(1, num_sides) for _ in range(num_dice)])
+
+
+def benchmark(repeat: int = 3) -> List[dict]:
+    """従来の実装との速度比較（python dice.py で実行）"""
+    cases = [("1d20", 100_000), ("2d6+3", 100_000), ("100d6", 10_000), ("1000d6", 1_000), ("4d6kh3", 100_000), ("1d20 adv", 100_000)]
+    results = []
+    for text, batch in cases:
+        expression = parse_dice_expression(text)
+        rng = dice_rng("benchmark", text)
+        legacy = None
+        if not expression.advantage and not any(term.keep for term in expression.terms):
+            term = expression.terms[0]
+            legacy = min(_time(lambda: [_legacy_roll(term.count, term.sides) for _ in range(batch)]) for _ in range(repeat))
+        single = min(_time(lambda: [roll_expression(expression, rng) for _ in range(min(batch, 10_000))]) for _ in range(repeat))
+        batched = min(_time(lambda: roll_totals(expression, rng, batch)) for _ in range(repeat))
+        results.append({
+            "expression": text,
+            "rolls": batch,
+            "legacy_us_per_roll": None if legacy is None else legacy / batch * 1e6,
+            "single_us_per_roll": single / min(batch, 10_000) * 1e6,
+            "batched_us_per_roll": batched / batch * 1e6,
+        })
+    return results
+
+
+def _time(func) -> float:
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    print(f"numpy: {'有効' if NUMPY_AVAILABLE else '無効'}")
+    print(f"{'expression':<12} {'rolls':>8} {'legacy µs':>10} {'single µs':>10} {'batched µs':>11} {'speedup':>8}")
+    for row in benchmark():
+        legacy = row["legacy_us_per_roll"]
+        speedup = f"{legacy / row['batched_us_per_roll']:.0f}x" if legacy else "-"
+        legacy_text = f"{legacy:.3f}" if legacy else "-"
+        print(f"{row['expression']:<12} {row['rolls']:>8} {legacy_text:>10} {row['single_us_per_roll']:>10.3f} {row['batched_us_per_roll']:>11.3f} {speedup:>8}")
@@ -0,0 +1,223 @@
+import functools
+import math
+import os
+import time
+from collections import defaultdict
+from typing import List, Optional
+
+from dice import NUMPY_AVAILABLE, MAX_EXPLOSIONS, DiceExpression, DiceTerm, dice_rng, parse_dice_expression, roll_totals
+
+if NUMPY_AVAILABLE:
+    import numpy as np
+
+# ダイス式の確率分布表。
+# 各項の出目の分布を畳み込みで厳密に計算し、「合計が X 以上になる確率」の表（生存関数）をキャッシュする。
+# 固定値・能力値修正は表を引く位置をずらすだけなので、同じダイス部分の式は修正値が違っても同じ表を使う。
+# 厳密計算が重すぎる式（巨大な爆発ダイスの保持指定など）はモンテカルロで近似する（exact: false）。
+
+DICE_TABLE_CACHE_SIZE = int(os.getenv("DICE_TABLE_CACHE_SIZE", "512"))
+MAX_EXACT_SUPPORT = 200_000  # 分布の取りうる値の数の上限
+MAX_KEEP_WORK = 2_000_000  # 保持指定のDPの計算量の上限（これを超えるとモンテカルロ）
+MONTE_CARLO_ROLLS = 200_000
+# モンテカルロで振るダイスの総数の上限（ダイスが多い式は回数を減らす。純Pythonではさらに少なくする）
+MONTE_CARLO_MAX_DICE = 20_000_000 if NUMPY_AVAILABLE else 500_000
+
+# 判定でよく使う目標値（一覧表として返す）
+DC_TABLE = (5, 10, 12, 15, 18, 20, 25, 30)
+
+# 起動時に計算しておく式
+COMMON_EXPRESSIONS = ("1d20", "2d20kh1", "2d20kl1", "1d4", "1d6", "1d8", "1d10", "1d12", "2d6", "3d6", "4d6kh3")
+
+
+class DiceDistribution:
+    """ダイス部分の合計の分布。survival[i] は合計が minimum + i 以上になる確率"""
+    __slots__ = ("expression", "minimum", "probabilities", "survival", "mean", "exact")
+
+    def __init__(self, expression: str, minimum: int, probabilities: List[float], exact: bool = True):
+        self.expression = expression
+        self.minimum = minimum
+        self.probabilities = probabilities
+        survival = [0.0] * (len(probabilities) + 1)
+        for index in range(len(probabilities) - 1, -1, -1):
+            survival[index] = survival[index + 1] + probabilities[index]
+        self.survival = [min(1.0, value) for value in survival]
+        self.mean = sum((minimum + index) * p for index, p in enumerate(probabilities))
+        self.exact = exact
+
+    @property
+    def maximum(self) -> int:
+        return self.minimum + len(self.probabilities) - 1
+
+    def probability_at_least(self, target: int) -> float:
+        """P(合計 ≥ target)"""
+        index = target - self.minimum
+        if index <= 0:
+            return 1.0
+        if index >= len(self.survival):
+            return 0.0
+        return self.survival[index]
+
+
+def _convolve(a: List[float], b: List[float]) -> List[float]:
+    if NUMPY_AVAILABLE:
+        return np.convolve(a, b).tolist()
+    result = [0.0] * (len(a) + len(b) - 1)
+    for i, pa in enumerate(a):
+        if pa:
+            for j, pb in enumerate(b):
+                result[i + j] += pa * pb
+    return result
+
+
+def _die_pmf(term: DiceTerm) -> tuple:
+    """1個のダイスの分布 (最小値, 確率のリスト)。爆発ダイスはロールと同じ上限まで振り足す"""
+    sides = term.sides
+    if not term.explode or sides == 1:
+        return 1, [1.0 / sides] * sides
+    probabilities = [0.0] * ((MAX_EXPLOSIONS + 1) * sides)
+    for depth in range(MAX_EXPLOSIONS + 1):
+        weight = (1.0 / sides) ** (depth + 1)
+        last_face = sides if depth == MAX_EXPLOSIONS else sides - 1
+        for face in range(1, last_face + 1):
+            probabilities[depth * sides + face - 1] = weight
+    while probabilities and probabilities[-1] == 0.0:
+        probabilities.pop()
+    return 1, probabilities
+
+
+def _sum_pmf(offset: int, probabilities: List[float], count: int) -> tuple:
+    """同じ分布のダイス count 個の合計（二乗を繰り返して畳み込む）"""
+    result_offset, result = 0, [1.0]
+    base_offset, base = offset, probabilities
+    while count:
+        if count & 1:
+            result_offset, result = result_offset + base_offset, _convolve(result, base)
+        count >>= 1
+        if count:
+            base_offset, base = base_offset * 2, _convolve(base, base)
+    return result_offset, result
+
+
+def _keep_pmf(offset: int, probabilities: List[float], count: int, keep_count: int, highest: bool) -> tuple:
+    """
+    count 個のうち大きい（小さい）方から keep_count 個の合計の分布。
+    出目を大きい順（小さい順）に見ていき、(割り当て済みのダイス数, 保持した合計) の状態を更新する。
+    """
+    values = [(offset + index, p) for index, p in enumerate(probabilities) if p > 0]
+    values.sort(reverse=highest)
+    states = {(0, 0): 1.0}
+    for value, p in values:
+        next_states = defaultdict(float)
+        for (assigned, kept_sum), weight in states.items():
+            remaining = count - assigned
+            keep_left = max(0, keep_count - assigned)
+            power = 1.0
+            for j in range(remaining + 1):
+                next_states[(assigned + j, kept_sum + min(j, keep_left) * value)] += weight * math.comb(remaining, j) * power
+                power *= p
+                if power == 0.0:
+                    break
+        states = next_states
+    totals = {kept_sum: weight for (assigned, kept_sum), weight in states.items() if assigned == count}
+    minimum = min(totals)
+    result = [0.0] * (max(totals) - minimum + 1)
+    for kept_sum, weight in totals.items():
+        result[kept_sum - minimum] = weight
+    return minimum, result
+
+
+def _term_pmf(term: DiceTerm) -> tuple:
+    offset, probabilities = _die_pmf(term)
+    if term.keep:
+        offset, probabilities = _keep_pmf(offset, probabilities, term.count, term.keep_count, term.keep == "h")
+    else:
+        offset, probabilities = _sum_pmf(offset, probabilities, term.count)
+    if term.sign < 0:
+        return -(offset + len(probabilities) - 1), probabilities[::-1]
+    return offset, probabilities
+
+
+def _exact_is_feasible(terms: List[DiceTerm]) -> bool:
+    support = 0
+    for term in terms:
+        faces = len(_die_pmf(term)[1])
+        if term.keep:
+            work = faces * (term.count + 1) ** 2 * (term.keep_count * faces + 1)
+            if work > MAX_KEEP_WORK:
+                return False
+            support += term.keep_count * faces
+        else:
+            support += term.count * faces
+    return support <= MAX_EXACT_SUPPORT
+
+
+def dice_key(expression: DiceExpression) -> str:
+    """ダイス部分（固定値・能力値を除く）の正規化した式。分布表のキャッシュキー"""
+    return "".join(("-" if term.sign < 0 else "+") + str(term) for term in expression.terms).lstrip("+")
+
+
+@functools.lru_cache(maxsize=DICE_TABLE_CACHE_SIZE)
+def _distribution(key: str) -> DiceDistribution:
+    terms = parse_dice_expression(key).terms
+    if not _exact_is_feasible(terms):
+        return _monte_carlo_distribution(key)
+    offset, probabilities = 0, [1.0]
+    for term in terms:
+        term_offset, term_probabilities = _term_pmf(term)
+        offset += term_offset
+        probabilities = _convolve(probabilities, term_probabilities)
+    return DiceDistribution(key, offset, probabilities)
+
+
+def _monte_carlo_distribution(key: str) -> DiceDistribution:
+    expression = parse_dice_expression(key)
+    dice_per_roll = sum(term.count for term in expression.terms)
+    rolls = max(1_000, min(MONTE_CARLO_ROLLS, MONTE_CARLO_MAX_DICE // dice_per_roll))
+    totals = roll_totals(expression, dice_rng("dice-odds", key), rolls)
+    if NUMPY_AVAILABLE:
+        minimum = int(totals.min())
+        probabilities = (np.bincount(totals - minimum) / len(totals)).tolist()
+    else:
+        minimum = min(totals)
+        counts = [0] * (max(totals) - minimum + 1)
+        for total in totals:
+            counts[total - minimum] += 1
+        probabilities = [count / len(totals) for count in counts]
+    return DiceDistribution(key, minimum, probabilities, exact=False)
+
+
+def distribution_for(expression: DiceExpression) -> DiceDistribution:
+    """式のダイス部分の分布（キャッシュ済みならそれを返す）"""
+    return _distribution(dice_key(expression))
+
+
+def success_probability(expression: DiceExpression, dc: int, modifier: int = 0) -> float:
+    """P(ダイスの合計 + modifier ≥ dc)"""
+    return distribution_for(expression).probability_at_least(dc - modifier)
+
+
+def odds_summary(expression: DiceExpression, modifier: int = 0, dc: Optional[int] = None) -> dict:
+    """APIとGMツールで返す成功率の情報"""
+    distribution = distribution_for(expression)
+    result = {
+        "expression": str(expression),
+        "modifier": modifier,
+        "min": distribution.minimum + modifier,
+        "max": distribution.maximum + modifier,
+        "mean": round(distribution.mean + modifier, 3),
+        "exact": distribution.exact,
+        "table": [{"dc": table_dc, "probability": round(distribution.probability_at_least(table_dc - modifier), 4)} for table_dc in DC_TABLE],
+    }
+    if dc is not None:
+        result["dc"] = dc
+        result["probability"] = round(distribution.probability_at_least(dc - modifier), 4)
+    return result
+
+
+def warm_probability_tables() -> float:
+    """よく使う式の分布表を計算しておく。所要時間（秒）を返す"""
+    started = time.perf_counter()
+    for text in COMMON_EXPRESSIONS:
+        distribution_for(parse_dice_expression(text))
+    return time.perf_counter() - started
+
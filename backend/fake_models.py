@@ -0,0 +1,462 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from model_registry import VeoHandle, model_registry
+from video_operations import VideoOperations, VideoOperationStatus
+
+# 負荷試験・プロファイリング用のフェイクモデルプロバイダー（MODEL_PROVIDER=fake）。
+# Gemini / Imagen / Veo と同じ呼び出し方に応えるが、課金されるAPIは一切呼ばない。
+# 応答内容と遅延は FAKE_SEED、プロンプト、同じプロンプトの呼び出し回数から決まるため、同じ順序の入力なら同じ結果になる。
+#
+# 遅延の指定（FAKE_LLM_LATENCY / FAKE_IMAGEN_LATENCY / FAKE_VEO_LATENCY、単位は秒）:
+#   "0.5"                 固定
+#   "uniform:0.5,2.0"     一様分布
+#   "normal:1.0,0.2"      正規分布（平均, 標準偏差）
+#   "lognormal:1.0,0.5"   対数正規分布（中央値, σ）
+
+FAKE_SEED = os.getenv("FAKE_SEED", "0")
+FAKE_LLM_LATENCY = os.getenv("FAKE_LLM_LATENCY", "lognormal:1.5,0.4")
+FAKE_IMAGEN_LATENCY = os.getenv("FAKE_IMAGEN_LATENCY", "lognormal:4.0,0.3")
+FAKE_VEO_LATENCY = os.getenv("FAKE_VEO_LATENCY", "lognormal:30.0,0.3")
+# 呼び出しごとに例外を送出する確率
+FAKE_ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0"))
+# GMターンで roll_dice を呼び出す確率
+FAKE_DICE_CALL_RATE = float(os.getenv("FAKE_DICE_CALL_RATE", "0.6"))
+# 最初の判定の結果を受けて、続けてダメージなどの2回目の roll_dice を呼び出す確率
+FAKE_FOLLOW_UP_DICE_RATE = float(os.getenv("FAKE_FOLLOW_UP_DICE_RATE", "0.3"))
+# GMターンで（未完了の）check_scenario_completion を呼び出す（ツールが無ければ目標を1つ達成と申告する）確率
+FAKE_COMPLETION_CHECK_RATE = float(os.getenv("FAKE_COMPLETION_CHECK_RATE", "0.2"))
+# このターン以降は全ての目標の達成を申告して（終了判定ツールがあれば is_completed=true で呼び出して）シナリオを終える
+FAKE_COMPLETE_AFTER_TURNS = int(os.getenv("FAKE_COMPLETE_AFTER_TURNS", "5"))
+# GMターンのJSONをコードブロックで囲む・前置きを付けるなど、軽微に崩して返す確率
+FAKE_MALFORMED_JSON_RATE = float(os.getenv("FAKE_MALFORMED_JSON_RATE", "0.1"))
+# ストリーミング応答の分割数
+FAKE_STREAM_CHUNKS = int(os.getenv("FAKE_STREAM_CHUNKS", "8"))
+
+# 1x1ピクセルの透過PNG
+FAKE_PNG_BYTES = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000b49444154789c6360000200000500017a5eab3f0000000049454e44ae426082"
+)
+
+_TURN_PATTERN = re.compile(r"現在ターン:\s*(\d+)\s*/\s*(\d+)")
+_OBJECTIVES_PATTERN = re.compile(r"主要目標:\s*(.*)")
+
+
+class InjectedProviderError(Exception):
+    """FAKE_ERROR_RATE により意図的に発生させたエラー"""
+
+
+class LatencyDistribution:
+    """遅延の分布指定を解釈し、乱数から待ち秒数を引く"""
+
+    def __init__(self, spec: str):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        if not params:
+            kind, params = "fixed", kind
+        self.kind = kind.strip()
+        self.params = [float(value) for value in params.split(",") if value.strip()]
+        if self.kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return max(0.0, self.params[0])
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(self.params[0], self.params[1]))
+        median, sigma = self.params
+        return rng.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+
+
+_occurrences: Counter = Counter()
+_occurrences_lock = threading.Lock()
+
+
+def _rng_for(*parts: Any) -> random.Random:
+    """
+    FAKE_SEED と入力から決まる乱数生成器（プロセスのハッシュシードに依存しない）。
+    同じ入力の何回目の呼び出しかも種に含めるため、注入エラー後の再試行は別の結果になる。
+    """
+    key = hashlib.sha256("\x1f".join([FAKE_SEED] + [str(part) for part in parts]).encode("utf-8")).hexdigest()
+    with _occurrences_lock:
+        occurrence = _occurrences[key]
+        _occurrences[key] += 1
+    digest = hashlib.sha256(f"{key}:{occurrence}".encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def _prompt_text(contents: Any) -> str:
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, (list, tuple)):
+        return "\n".join(_prompt_text(item) for item in contents)
+    try:
+        return str(getattr(contents, "text", "") or "")
+    except ValueError:
+        return ""  # 関数の実行結果など、テキストを持たないコンテンツ
+
+
+def _maybe_fail(rng: random.Random, kind: str):
+    if FAKE_ERROR_RATE > 0 and rng.random() < FAKE_ERROR_RATE:
+        raise InjectedProviderError(f"injected {kind} error")
+
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 2)
+
+
+# --- 応答オブジェクト（vertexai.generative_models の応答と同じ属性を持つ） ---
+
+class FakeFunctionCall:
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+
+class FakePart:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeContent:
+    def __init__(self, parts: List[FakePart], role: str = "model"):
+        self.parts = parts
+        self.role = role
+
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeCandidate:
+    def __init__(self, text: str = "", function_calls: Optional[List[FakeFunctionCall]] = None):
+        self.content = FakeContent([FakePart(text)] if text else [])
+        self.function_calls = function_calls or []
+
+    @property
+    def text(self) -> str:
+        return "".join(part.text for part in self.content.parts)
+
+
+class FakeResponse:
+    def __init__(self, text: str = "", function_calls: Optional[List[FakeFunctionCall]] = None, prompt_tokens: int = 0):
+        self.candidates = [FakeCandidate(text, function_calls)]
+        self.usage_metadata = FakeUsageMetadata(prompt_tokens, _estimate_tokens(text))
+
+    @property
+    def text(self) -> str:
+        return self.candidates[0].text
+
+
+# --- 応答内容の生成 ---
+
+def _fake_scenarios(rng: random.Random) -> str:
+    genres = ["ファンタジー", "SF", "現代ホラー"]
+    scenarios = []
+    for index, genre in enumerate(genres):
+        number = rng.randint(100, 999)
+        scenarios.append({
+            "title": f"{genre}の試練{number}",
+            "summary": f"負荷試験用の{genre}シナリオ{number}。仲間と協力して三つの目標を達成する。",
+            "endConditions": {
+                "primary_objectives": [f"目標{index + 1}-A", f"目標{index + 1}-B", f"目標{index + 1}-C"],
+                "success_criteria": ["全ての目標を達成"],
+                "failure_criteria": ["パーティ全滅"],
+                "completion_threshold": 0.75,
+                "max_turns": 30,
+            },
+        })
+    return json.dumps(scenarios, ensure_ascii=False)
+
+
+def _fake_narration(rng: random.Random, turn: Optional[int] = None) -> str:
+    places = ["古い遺跡", "霧深い森", "廃墟の研究所", "月明かりの街道", "地下水路"]
+    events = ["不気味な物音が響く", "隠された扉が見つかる", "敵の気配が近づく", "仲間の一人が手がかりを見つける"]
+    prefix = f"ターン{turn}。" if turn else ""
+    return f"{prefix}一行は{rng.choice(places)}に足を踏み入れた。{rng.choice(events)}。" * rng.randint(3, 6)
+
+
+def _gm_turn_json(rng: random.Random, turn: Optional[int], objectives: List[str]) -> str:
+    image_prompt = rng.choice([None, "a dark fantasy ruin at night, cinematic lighting"])
+    response = {"narration": _fake_narration(rng, turn), "imagePrompt": image_prompt, "achievedObjectives": [], "scenarioStatus": "ongoing"}
+    if turn and turn >= FAKE_COMPLETE_AFTER_TURNS:
+        response["achievedObjectives"] = objectives
+        response["scenarioStatus"] = "completed"
+    elif objectives and rng.random() < FAKE_COMPLETION_CHECK_RATE:
+        response["achievedObjectives"] = [rng.choice(objectives)]
+    return json.dumps(response, ensure_ascii=False)
+
+
+def _prompt_objectives(prompt: str) -> List[str]:
+    objectives_match = _OBJECTIVES_PATTERN.search(prompt)
+    objectives = objectives_match.group(1).strip() if objectives_match else ""
+    return [objective.strip() for objective in objectives.split(",") if objective.strip()]
+
+
+_FAKE_DICE_EXPRESSIONS = ("1d20", "1d20+dex", "1d20 adv", "2d6+3", "4d6kh3")
+
+
+def _scripted_function_calls(rng: random.Random, prompt: str, tools: List[str]) -> List[FakeFunctionCall]:
+    """GMプロンプトのターン番号から、呼び出す関数を決める"""
+    turn_match = _TURN_PATTERN.search(prompt)
+    if not turn_match:
+        return []
+    turn = int(turn_match.group(1))
+    objectives_match = _OBJECTIVES_PATTERN.search(prompt)
+    objectives = objectives_match.group(1).strip() if objectives_match else ""
+
+    calls = []
+    if rng.random() < FAKE_DICE_CALL_RATE:
+        calls.append(FakeFunctionCall("roll_dice", {"expression": rng.choice(_FAKE_DICE_EXPRESSIONS), "dc": rng.choice((10, 15, 20))}))
+    if "check_scenario_completion" not in tools:
+        return calls
+    if turn >= FAKE_COMPLETE_AFTER_TURNS:
+        calls.append(FakeFunctionCall("check_scenario_completion", {
+            "current_situation": "一行は全ての目標を達成した",
+            "completed_objectives": objectives,
+            "primary_objectives": objectives,
+            "completion_percentage": 100.0,
+            "is_completed": True,
+        }))
+    elif rng.random() < FAKE_COMPLETION_CHECK_RATE:
+        calls.append(FakeFunctionCall("check_scenario_completion", {
+            "current_situation": "探索は続いている",
+            "completed_objectives": "",
+            "primary_objectives": objectives,
+            "completion_percentage": round(100.0 * turn / max(FAKE_COMPLETE_AFTER_TURNS, 1), 1),
+            "is_completed": False,
+        }))
+    return calls
+
+
+def _split_chunks(text: str, count: int) -> List[str]:
+    size = max(1, math.ceil(len(text) / max(count, 1)))
+    return [text[index:index + size] for index in range(0, len(text), size)] or [""]
+
+
+# --- フェイクモデル ---
+
+class FakeGenerativeModel:
+    """vertexai.generative_models.GenerativeModel の代わり"""
+
+    def __init__(self, model_name: str, tools: Optional[list] = None, latency: str = FAKE_LLM_LATENCY):
+        self.model_name = model_name
+        self.tools = tools
+        self.latency = LatencyDistribution(latency)
+
+    def _respond(self, prompt: str, generation_config: Any = None) -> tuple:
+        rng = _rng_for(self.model_name, prompt)
+        _maybe_fail(rng, "gemini")
+        if hasattr(generation_config, "to_dict"):
+            generation_config = generation_config.to_dict()
+        mime_type = getattr(generation_config, "response_mime_type", None)
+        if mime_type is None and isinstance(generation_config, dict):
+            mime_type = generation_config.get("response_mime_type")
+        turn_match = _TURN_PATTERN.search(prompt)
+        if prompt.strip() == "ping":
+            text = "pong"
+        elif mime_type == "application/json" and turn_match:
+            text = _gm_turn_json(rng, int(turn_match.group(1)), _prompt_objectives(prompt))  # JSONモードでのGM応答
+        elif mime_type == "application/json" or "JSON配列形式" in prompt:
+            text = _fake_scenarios(rng)
+        else:
+            text = _fake_narration(rng)
+        return text, self.latency.sample(rng)
+
+    def generate_content(self, contents, generation_config=None, **kwargs) -> FakeResponse:
+        prompt = _prompt_text(contents)
+        text, delay = self._respond(prompt, generation_config)
+        time.sleep(delay)
+        return FakeResponse(text, prompt_tokens=_estimate_tokens(prompt))
+
+    async def generate_content_async(self, contents, generation_config=None, **kwargs) -> FakeResponse:
+        prompt = _prompt_text(contents)
+        text, delay = self._respond(prompt, generation_config)
+        await asyncio.sleep(delay)
+        return FakeResponse(text, prompt_tokens=_estimate_tokens(prompt))
+
+    def start_chat(self, **kwargs) -> "FakeChatSession":
+        return FakeChatSession(self)
+
+
+class FakeChatSession:
+    """
+    GMターンのチャットセッション。
+    最初のメッセージ（GMプロンプト）には台本どおりの関数呼び出しを返し、
+    最初の実行結果にはときどき2回目の roll_dice（ダメージなど）を返す。
+    関数の実行結果を受け取ったら {"narration", "imagePrompt", "achievedObjectives", "scenarioStatus"} のJSONを返す。
+    """
+
+    def __init__(self, model: FakeGenerativeModel):
+        self.model = model
+        self.history: List[Any] = []
+        self._turn: Optional[int] = None
+        self._prompt = ""
+
+    def _plan(self, content) -> tuple:
+        is_text = isinstance(content, str)
+        prompt = content if is_text else self._prompt
+        rng = _rng_for(self.model.model_name, "chat", prompt, len(self.history))
+        _maybe_fail(rng, "gemini chat")
+        function_calls = []
+        if is_text and not self.history:
+            self._prompt = prompt
+            turn_match = _TURN_PATTERN.search(prompt)
+            self._turn = int(turn_match.group(1)) if turn_match else None
+            if self.model.tools:
+                function_calls = _scripted_function_calls(rng, prompt, self.model.tools)
+        elif not is_text and len(self.history) == 1 and rng.random() < FAKE_FOLLOW_UP_DICE_RATE:
+            function_calls = [FakeFunctionCall("roll_dice", {"expression": "1d8+str"})]
+        if function_calls:
+            text = ""
+        elif is_text and self.history:
+            text = _fake_narration(rng, self._turn)  # 関数呼び出し後の追加要求
+        else:
+            text = _gm_turn_json(rng, self._turn, _prompt_objectives(self._prompt))
+            if rng.random() < FAKE_MALFORMED_JSON_RATE:
+                text = rng.choice(["```json\n{}\n```", "以下が応答です。\n{}", "{}\n以上です。"]).format(text)
+        self.history.append(content)
+        return text, function_calls, self.model.latency.sample(rng), _estimate_tokens(_prompt_text(content))
+
+    def send_message(self, content, stream: bool = False, **kwargs):
+        text, function_calls, delay, prompt_tokens = self._plan(content)
+        if not stream:
+            time.sleep(delay)
+            return FakeResponse(text, function_calls, prompt_tokens)
+        return self._stream(text, function_calls, delay, prompt_tokens)
+
+    def _stream(self, text: str, function_calls: List[FakeFunctionCall], delay: float, prompt_tokens: int):
+        if function_calls:
+            time.sleep(delay)
+            yield FakeResponse("", function_calls, prompt_tokens)
+            return
+        chunks = _split_chunks(text, FAKE_STREAM_CHUNKS)
+        for chunk in chunks:
+            time.sleep(delay / len(chunks))
+            response = FakeResponse(chunk, prompt_tokens=prompt_tokens)
+            # 本物と同じく、使用量は応答全体の累計を載せる
+            response.usage_metadata = FakeUsageMetadata(prompt_tokens, _estimate_tokens(text))
+            yield response
+
+
+class FakeGeneratedImage:
+    def __init__(self, image_bytes: bytes):
+        self._image_bytes = image_bytes
+
+
+class FakeImageGenerationResponse:
+    def __init__(self, images: List[FakeGeneratedImage]):
+        self.images = images
+
+
+class FakeImageGenerationModel:
+    """vertexai.preview.vision_models.ImageGenerationModel の代わり"""
+
+    def __init__(self, latency: str = FAKE_IMAGEN_LATENCY):
+        self.latency = LatencyDistribution(latency)
+
+    def generate_images(self, prompt: str, number_of_images: int = 1, **kwargs) -> FakeImageGenerationResponse:
+        rng = _rng_for("imagen", prompt)
+        _maybe_fail(rng, "imagen")
+        time.sleep(self.latency.sample(rng))
+        return FakeImageGenerationResponse([FakeGeneratedImage(FAKE_PNG_BYTES) for _ in range(number_of_images)])
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeStorageBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.public_url = f"https://storage.googleapis.com/{bucket.name}/{name}"
+
+    def upload_from_string(self, data: bytes, content_type: str = "application/octet-stream"):
+        with self.bucket._lock:
+            self.bucket.objects[self.name] = data
+
+    def make_public(self):
+        pass
+
+
+class FakeStorageBucket:
+    """google.cloud.storage の Bucket の代わり（アップロードした内容はメモリに保持する）"""
+
+    def __init__(self, name: str = "fake-trpg-images"):
+        self.name = name
+        self.objects: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+
+class FakeVideoResponse:
+    def __init__(self, uri: str):
+        self.uri = uri
+
+
+class FakeVideoModel:
+    """Veoの代わり。動画は生成せず、プロンプトから決まるダミーのURIを返す"""
+
+    def __init__(self, latency: str = FAKE_VEO_LATENCY):
+        self.latency = LatencyDistribution(latency)
+
+    def _generate(self, prompt: str) -> FakeVideoResponse:
+        rng = _rng_for("veo", prompt)
+        _maybe_fail(rng, "veo")
+        time.sleep(self.latency.sample(rng))
+        return FakeVideoResponse(f"gs://fake-veo/{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]}.mp4")
+
+    def generate_content(self, contents, generation_config=None, **kwargs) -> FakeVideoResponse:
+        return self._generate(_prompt_text(contents))
+
+    def generate_video(self, prompt: str, **kwargs) -> FakeVideoResponse:
+        return self._generate(prompt)
+
+
+class FakeVideoOperations(VideoOperations):
+    """
+    Veoの長時間実行オペレーションの代わり。
+    オペレーション名に出力先と完了予定時刻を埋め込むので状態を持たず、プロセスを再起動しても同じ名前で確認できる。
+    """
+
+    def __init__(self, model_name: str, latency: str = FAKE_VEO_LATENCY):
+        self.model_name = model_name
+        self.latency = LatencyDistribution(latency)
+
+    def submit(self, prompt: str, params: dict) -> str:
+        rng = _rng_for("veo", prompt)
+        _maybe_fail(rng, "veo")
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+        return f"fake-operations/{digest}/{time.time() + self.latency.sample(rng):.3f}"
+
+    def get(self, operation_name: str) -> VideoOperationStatus:
+        _, digest, ready_at = operation_name.split("/")
+        if time.time() < float(ready_at):
+            return VideoOperationStatus(False)
+        return VideoOperationStatus(True, uri=f"gs://fake-veo/{digest}.mp4")
+
+
+def register_fake_models(gemini_model_name: str, gemini_lite_model_name: str, veo_model_name: str = "veo-3.0-generate-001", completion_tool: bool = False):
+    """本番と同じ名前でフェイクモデルのファクトリをレジストリに登録する"""
+    tools = ["roll_dice", "check_dice_odds"] + (["check_scenario_completion"] if completion_tool else [])
+    model_registry.register("gemini", lambda: FakeGenerativeModel(gemini_model_name))
+    model_registry.register("gemini_tools", lambda: FakeGenerativeModel(gemini_model_name, tools=tools))
+    model_registry.register("gemini_lite", lambda: FakeGenerativeModel(gemini_lite_model_name))
+    model_registry.register("gemini_tools_lite", lambda: FakeGenerativeModel(gemini_lite_model_name, tools=tools))
+    model_registry.register("imagen", FakeImageGenerationModel)
+    model_registry.register("veo", lambda: VeoHandle(FakeVideoModel(), veo_model_name))
+    model_registry.register("veo_operations", lambda: FakeVideoOperations(veo_model_name))
@@ -0,0 +1,94 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from firebase_admin import firestore
+
+# ゲーム状態の変更を、バージョン付きの型付き差分イベントとして games/{gameId}/events に記録する。
+# 状態の更新とイベントの書き込みは同じトランザクションで行うため、
+# クライアントは最後に受け取ったバージョンから欠落なく再開できる。
+
+EVENT_COLLECTION = "events"
+
+# クライアントへ配信しないサーバー内部用のフィールド
+INTERNAL_FIELDS = {"logSeq", "recentLog", "eventVersion", "conversation", "historySummary", "chatHistory", "gameLog", "turnResolution", "usage", "usageBudget"}
+
+
+def event_doc_id(version: int) -> str:
+    return f"{version:010d}"
+
+
+def _sanitize(value):
+    """Firestoreのセンチネル値をクライアントに送れる値へ置き換える"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.utcnow()
+    if value is firestore.DELETE_FIELD:
+        return None
+    if isinstance(value, dict):
+        return {key: _sanitize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_sanitize(item) for item in value]
+    return value
+
+
+def log_appended_event(entry_data: dict) -> dict:
+    return {"type": "log_appended", "data": {"entry": entry_data}}
+
+
+def log_updated_event(seq: int, changes: dict) -> dict:
+    return {"type": "log_updated", "data": {"seq": seq, "changes": _sanitize(changes)}}
+
+
+def events_for_update(updates: Optional[dict]) -> List[dict]:
+    """ゲームドキュメントへの更新内容（ドット区切りのフィールドパス可）を型付きイベントに変換する"""
+    if not updates:
+        return []
+    players: Dict[str, dict] = {}
+    fields = {}
+    events = []
+    for path, value in updates.items():
+        top_level = path.split(".", 1)[0]
+        if top_level in INTERNAL_FIELDS:
+            continue
+        value = _sanitize(value)
+        if top_level == "players" and "." in path:
+            parts = path.split(".", 2)
+            player_event = players.setdefault(parts[1], {"playerId": parts[1], "changes": {}})
+            if len(parts) == 2:
+                player_event["player"] = value
+            else:
+                player_event["changes"][parts[2]] = value
+        elif path == "gameStatus":
+            events.append({"type": "status_changed", "data": {"gameStatus": value}})
+        else:
+            fields[path] = value
+    events.extend({"type": "player_updated", "data": data} for data in players.values())
+    if fields:
+        events.append({"type": "fields_updated", "data": {"fields": fields}})
+    return events
+
+
+def stage_game_events(txn, game_data: dict, events: List[dict]) -> dict:
+    """
+    トランザクション（GameTransaction）にイベントの書き込みを積み、
+    ゲームドキュメントに反映すべき eventVersion の更新を返す。
+    game_data は同じトランザクション内で読み取った eventVersion を含んでいる必要がある。
+    """
+    version = game_data.get("eventVersion", 0) or 0
+    if not events:
+        return {}
+    for event in events:
+        version += 1
+        txn.set_child(EVENT_COLLECTION, event_doc_id(version), {
+            "version": version,
+            "type": event["type"],
+            "data": event["data"],
+            "createdAt": datetime.utcnow(),
+        })
+    return {"eventVersion": version}
+
+
+def client_snapshot(game_id: str, game_data: dict) -> dict:
+    """差分配信の起点となる、クライアント向けのゲーム状態スナップショット"""
+    state = {key: _sanitize(value) for key, value in game_data.items() if key not in INTERNAL_FIELDS}
+    state["gameId"] = game_id
+    return {"version": game_data.get("eventVersion", 0) or 0, "state": state}
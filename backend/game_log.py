@@ -0,0 +1,75 @@
+import os
+from typing import Iterable, List, Optional
+
+from game_events import events_for_update, log_appended_event, log_updated_event, stage_game_events
+from models import GameLog
+
+# ゲームログは games/{gameId}/logs サブコレクションに1エントリ1ドキュメントで保存する。
+# ゲームドキュメント本体には連番カウンタ(logSeq)と直近N件の要約(recentLog)だけを持たせ、
+# ドキュメントサイズがセッションの長さに比例して増えないようにする。
+
+LOG_COLLECTION = "logs"
+RECENT_LOG_SIZE = int(os.getenv("RECENT_LOG_SIZE", "20"))
+LOG_PAGE_SIZE = 50
+MAX_LOG_PAGE_SIZE = 200
+
+
+def log_doc_id(turn: int, seq: int) -> str:
+    """ターン番号と連番からソート可能なドキュメントIDを作る"""
+    return f"{turn:06d}-{seq:08d}"
+
+
+def stage_log_entries(txn, game_data: dict, entries: Iterable[GameLog], extra_updates: Optional[dict] = None) -> dict:
+    """
+    トランザクション（GameTransaction）にログエントリと差分イベントの書き込みを積み、
+    ゲームドキュメントに反映すべき更新フィールド（extra_updates を含む）を返す。
+
+    game_data は同じトランザクション内で読み取った logSeq / recentLog / eventVersion / gameLog を含んでいる必要がある。
+    移行前の gameLog 配列が残っているゲームでは、配列の件数より後ろの連番から振る（配列は 1..N として読み続ける）。
+    """
+    seq = max(game_data.get("logSeq", 0) or 0, len(game_data.get("gameLog") or []))
+    recent_log = list(game_data.get("recentLog") or [])
+    events = []
+    for entry in entries:
+        seq += 1
+        entry_data = entry.model_dump()
+        entry_data["seq"] = seq
+        txn.set_child(LOG_COLLECTION, log_doc_id(entry.turn, seq), entry_data)
+        recent_log.append(entry_data)
+        events.append(log_appended_event(entry_data))
+    events.extend(events_for_update(extra_updates))
+
+    updates = {"logSeq": seq, "recentLog": recent_log[-RECENT_LOG_SIZE:]}
+    updates.update(stage_game_events(txn, game_data, events))
+    if extra_updates:
+        updates.update(extra_updates)
+    return updates
+
+
+def stage_log_patch(txn, game_data: dict, turn: int, seq: int, changes: dict) -> dict:
+    """
+    トランザクションに既存のログエントリの部分更新と log_updated イベントを積み、
+    ゲームドキュメントに反映すべき更新フィールド（recentLog 内の同じエントリを含む）を返す。
+
+    game_data は同じトランザクション内で読み取った recentLog / eventVersion を含んでいる必要がある。
+    """
+    txn.update_child(LOG_COLLECTION, log_doc_id(turn, seq), changes)
+    updates = {}
+    recent_log = list(game_data.get("recentLog") or [])
+    if any(entry.get("seq") == seq for entry in recent_log):
+        updates["recentLog"] = [dict(entry, **changes) if entry.get("seq") == seq else entry for entry in recent_log]
+    updates.update(stage_game_events(txn, game_data, [log_updated_event(seq, changes)]))
+    return updates
+
+
+def legacy_game_log(game_data: Optional[dict], after: Optional[int] = None, limit: Optional[int] = None) -> Optional[List[dict]]:
+    """
+    サブコレクション移行前のゲーム（gameLog配列を持つドキュメント）であれば、その配列を連番 1..N 付きで返す。
+    配列が無い（移行済みの）ゲームでは None を返す。
+    移行前に追記されたエントリはサブコレクションに N より後ろの連番で入っているので、呼び出し側で続けて読む。
+    """
+    if game_data is None or not game_data.get("gameLog"):
+        return None
+    legacy_log = [dict(entry, seq=index + 1) for index, entry in enumerate(game_data["gameLog"])]
+    start = after or 0
+    return legacy_log[start:start + limit] if limit else legacy_log[start:]
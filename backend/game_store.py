@@ -0,0 +1,528 @@
+import copy
+import os
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from game_events import events_for_update, stage_game_events
+from game_log import LOG_COLLECTION, legacy_game_log, stage_log_entries, stage_log_patch
+from models import GameLog
+
+# ゲームドキュメントとそのサブコレクション（logs / events）へのアクセスをまとめたリポジトリ層。
+# 本番はFirestore、負荷試験やプロファイリングでは同じトランザクションの意味論を持つインメモリ実装を使う。
+# 切り替えは GAME_STORE_BACKEND（firestore / memory）で行う。
+
+GAME_COLLECTION = "games"
+GAME_STORE_BACKEND = os.getenv("GAME_STORE_BACKEND", "firestore")
+
+# クエリ条件は (フィールド名, 演算子, 値) のタプルで表す
+Filter = Tuple[str, str, Any]
+
+
+class GameNotFoundError(Exception):
+    """存在しないゲームを更新しようとした"""
+
+
+class TransactionConflictError(Exception):
+    """競合が続き、トランザクションを規定回数内にコミットできなかった"""
+
+
+class GameTransaction:
+    """1つのゲームドキュメントに対するトランザクション。書き込みはコミット時にまとめて反映される"""
+
+    def get(self, field_paths: Optional[List[str]] = None) -> Optional[dict]:
+        raise NotImplementedError
+
+    def update(self, updates: dict):
+        """ドット区切りのフィールドパスでゲームドキュメントを部分更新する"""
+        raise NotImplementedError
+
+    def set_child(self, collection: str, doc_id: str, data: dict):
+        """サブコレクションのドキュメントを書き込む"""
+        raise NotImplementedError
+
+    def update_child(self, collection: str, doc_id: str, updates: dict):
+        """既存のサブコレクションのドキュメントを部分更新する"""
+        raise NotImplementedError
+
+
+class GameStore:
+    """ゲームの保存先の共通インターフェース"""
+
+    def __init__(self):
+        # Firestoreの課金単位に合わせた操作回数（負荷試験の集計用）
+        self._op_counts: Counter = Counter()
+        self._op_lock = threading.Lock()
+
+    def _count(self, op: str, amount: int = 1):
+        with self._op_lock:
+            self._op_counts[op] += amount
+
+    def op_counts(self) -> Dict[str, int]:
+        """
+        起動以降の操作回数を返す。
+        reads / writes はドキュメント単位（クエリは結果0件でも1読み取り）、
+        queries / transactions / transaction_retries / listener_reads は回数。
+        """
+        with self._op_lock:
+            return dict(self._op_counts)
+
+    def reset_op_counts(self):
+        with self._op_lock:
+            self._op_counts.clear()
+
+    def _count_query(self, result_count: int):
+        with self._op_lock:
+            self._op_counts["queries"] += 1
+            self._op_counts["reads"] += max(1, result_count)
+
+    def get(self, game_id: str, field_paths: Optional[List[str]] = None) -> Optional[dict]:
+        """ゲームドキュメントを返す（field_paths 指定時はそのフィールドだけ）。存在しなければ None"""
+        raise NotImplementedError
+
+    def create(self, game_data: dict) -> str:
+        raise NotImplementedError
+
+    def run_transaction(self, game_id: str, fn: Callable[[GameTransaction], Any]) -> Any:
+        """fn をトランザクション内で実行する。競合した場合は fn ごと再実行される"""
+        raise NotImplementedError
+
+    def query_children(self, game_id: str, collection: str, filters: Iterable[Filter] = (), order_by: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+        raise NotImplementedError
+
+    def find_by_room_id(self, room_id: str) -> List[Tuple[str, dict]]:
+        """ルームIDでゲームを検索し、(ゲームID, ゲームデータ) のリストを返す"""
+        raise NotImplementedError
+
+    def watch_children(self, game_id: str, collection: str, field: str, after: Any, callback: Callable[[List[dict]], None]) -> Callable[[], None]:
+        """
+        field が after より大きいサブコレクションのドキュメントを field の昇順で callback に渡し続ける。
+        既存の該当ドキュメントも最初に渡される。購読を止める関数を返す。
+        """
+        raise NotImplementedError
+
+    def watch_child(self, game_id: str, collection: str, doc_id: str, callback: Callable[[Optional[dict]], None]) -> Callable[[], None]:
+        """
+        サブコレクションの1つのドキュメントを購読し、作成・更新のたびにその内容を callback に渡す
+        （最初に現在の内容を、存在しなければ None を渡す）。購読を止める関数を返す。
+        """
+        raise NotImplementedError
+
+    # --- 以下は両実装で共通 ---
+
+    def update(self, game_id: str, updates: dict) -> dict:
+        """ゲームドキュメントを更新し、対応する差分イベントを同じトランザクションで記録する"""
+
+        def apply(txn: GameTransaction):
+            game_data = txn.get(["eventVersion"])
+            if game_data is None:
+                raise GameNotFoundError(game_id)
+            game_updates = dict(updates)
+            game_updates.update(stage_game_events(txn, game_data, events_for_update(updates)))
+            txn.update(game_updates)
+            return game_updates
+
+        return self.run_transaction(game_id, apply)
+
+    def append_log(self, game_id: str, entries: List[GameLog], extra_updates: Optional[dict] = None, precondition: Optional[Callable[[dict], None]] = None) -> dict:
+        """
+        ログエントリを追記し、必要ならゲームドキュメントの他のフィールドも同じトランザクションで更新する。
+        precondition はトランザクション内で読み取ったゲームデータを受け取り、書き込みを中止する場合は例外を送出する。
+        """
+
+        def apply(txn: GameTransaction):
+            game_data = txn.get(["logSeq", "recentLog", "eventVersion", "currentTurn", "turnResolution", "gameLog"])
+            if game_data is None:
+                raise GameNotFoundError(game_id)
+            if precondition:
+                precondition(game_data)
+            updates = stage_log_entries(txn, game_data, entries, extra_updates)
+            txn.update(updates)
+            return updates
+
+        return self.run_transaction(game_id, apply)
+
+    def patch_log(self, game_id: str, turn: int, seq: int, changes: dict) -> dict:
+        """
+        追記済みのログエントリ（と recentLog 内の同じエントリ）の一部フィールドを書き換え、
+        log_updated イベントを同じトランザクションで記録する。
+        """
+
+        def apply(txn: GameTransaction):
+            game_data = txn.get(["recentLog", "eventVersion"])
+            if game_data is None:
+                raise GameNotFoundError(game_id)
+            updates = stage_log_patch(txn, game_data, turn, seq, changes)
+            txn.update(updates)
+            return updates
+
+        return self.run_transaction(game_id, apply)
+
+    def load_log(self, game_id: str, game_data: Optional[dict] = None, after: Optional[int] = None, limit: Optional[int] = None) -> List[dict]:
+        """
+        ログを連番順に取得する。サブコレクション移行前のゲームはドキュメント内の配列を先に返し、
+        その後に移行前のまま追記されたサブコレクションのエントリを続ける。
+        """
+        legacy_log = legacy_game_log(game_data, after, limit)
+        if legacy_log is None:
+            filters = [("seq", ">", after)] if after is not None else []
+            return self.query_children(game_id, LOG_COLLECTION, filters, order_by="seq", limit=limit)
+        if limit and len(legacy_log) >= limit:
+            return legacy_log
+        newer = self.query_children(game_id, LOG_COLLECTION, [("seq", ">", max(after or 0, len(game_data["gameLog"])))],
+                                    order_by="seq", limit=limit - len(legacy_log) if limit else None)
+        return legacy_log + newer
+
+    def find_log(self, game_id: str, turn: int, log_type: str) -> Optional[dict]:
+        logs = self.query_children(game_id, LOG_COLLECTION, [("turn", "==", turn), ("type", "==", log_type)], limit=1)
+        return logs[0] if logs else None
+
+
+# --- Firestore実装 ---
+
+class FirestoreGameTransaction(GameTransaction):
+
+    def __init__(self, store: "FirestoreGameStore", transaction, game_ref):
+        self.store = store
+        self.transaction = transaction
+        self.game_ref = game_ref
+        self.write_count = 0
+
+    def get(self, field_paths: Optional[List[str]] = None) -> Optional[dict]:
+        self.store._count("reads")
+        snapshot = self.game_ref.get(field_paths=field_paths, transaction=self.transaction)
+        return (snapshot.to_dict() or {}) if snapshot.exists else None
+
+    def update(self, updates: dict):
+        self.write_count += 1
+        self.transaction.update(self.game_ref, updates)
+
+    def set_child(self, collection: str, doc_id: str, data: dict):
+        self.write_count += 1
+        self.transaction.set(self.game_ref.collection(collection).document(doc_id), data)
+
+    def update_child(self, collection: str, doc_id: str, updates: dict):
+        self.write_count += 1
+        self.transaction.update(self.game_ref.collection(collection).document(doc_id), updates)
+
+
+class FirestoreGameStore(GameStore):
+
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+        self.collection = db.collection(GAME_COLLECTION)
+
+    def get(self, game_id: str, field_paths: Optional[List[str]] = None) -> Optional[dict]:
+        self._count("reads")
+        snapshot = self.collection.document(game_id).get(field_paths=field_paths)
+        return (snapshot.to_dict() or {}) if snapshot.exists else None
+
+    def create(self, game_data: dict) -> str:
+        self._count("writes")
+        return self.collection.add(game_data)[1].id
+
+    def run_transaction(self, game_id: str, fn: Callable[[GameTransaction], Any]) -> Any:
+        game_ref = self.collection.document(game_id)
+        attempts = []
+
+        @firestore.transactional
+        def run_in_transaction(transaction):
+            txn = FirestoreGameTransaction(self, transaction, game_ref)
+            attempts.append(txn)
+            return fn(txn)
+
+        result = run_in_transaction(self.db.transaction())
+        # 書き込みはコミットされた最後の試行の分だけ数える
+        self._count("transactions")
+        self._count("transaction_retries", len(attempts) - 1)
+        self._count("writes", attempts[-1].write_count)
+        return result
+
+    def _children_query(self, game_id: str, collection: str, filters: Iterable[Filter], order_by: Optional[str]):
+        query = self.collection.document(game_id).collection(collection)
+        for field, op, value in filters:
+            query = query.where(filter=FieldFilter(field, op, value))
+        if order_by:
+            query = query.order_by(order_by)
+        return query
+
+    def query_children(self, game_id: str, collection: str, filters: Iterable[Filter] = (), order_by: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+        query = self._children_query(game_id, collection, filters, order_by)
+        if limit:
+            query = query.limit(limit)
+        docs = [doc.to_dict() for doc in query.stream()]
+        self._count_query(len(docs))
+        return docs
+
+    def find_by_room_id(self, room_id: str) -> List[Tuple[str, dict]]:
+        docs = self.collection.where(filter=FieldFilter('roomId', '==', room_id)).get()
+        self._count_query(len(docs))
+        return [(doc.id, doc.to_dict()) for doc in docs]
+
+    def watch_children(self, game_id: str, collection: str, field: str, after: Any, callback: Callable[[List[dict]], None]) -> Callable[[], None]:
+        def on_snapshot(docs, changes, read_time):
+            added = [change.document.to_dict() for change in changes if change.type.name == 'ADDED']
+            self._count("listener_reads", len(added))
+            if added:
+                callback(sorted(added, key=lambda data: data[field]))
+
+        watch = self._children_query(game_id, collection, [(field, ">", after)], field).on_snapshot(on_snapshot)
+        return watch.unsubscribe
+
+    def watch_child(self, game_id: str, collection: str, doc_id: str, callback: Callable[[Optional[dict]], None]) -> Callable[[], None]:
+        def on_snapshot(docs, changes, read_time):
+            self._count("listener_reads", len(docs))
+            for doc in docs:
+                callback(doc.to_dict() if doc.exists else None)
+
+        watch = self.collection.document(game_id).collection(collection).document(doc_id).on_snapshot(on_snapshot)
+        return watch.unsubscribe
+
+
+# --- インメモリ実装 ---
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+}
+
+
+def _resolve_sentinels(value):
+    """Firestoreのセンチネル値（SERVER_TIMESTAMP）を書き込み時点の値に置き換える"""
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, dict):
+        return {key: _resolve_sentinels(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve_sentinels(item) for item in value]
+    return copy.deepcopy(value)
+
+
+def _apply_update(data: dict, updates: dict):
+    """Firestoreの update と同じく、ドット区切りのパスで入れ子のフィールドを書き換える"""
+    for path, value in updates.items():
+        *parents, leaf = path.split(".")
+        target = data
+        for key in parents:
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            target = target[key]
+        if value is firestore.DELETE_FIELD:
+            target.pop(leaf, None)
+        elif isinstance(value, firestore.Increment):
+            target[leaf] = (target.get(leaf) or 0) + value.value
+        else:
+            target[leaf] = _resolve_sentinels(value)
+
+
+def _mask(data: dict, field_paths: Optional[List[str]]) -> dict:
+    if field_paths is None:
+        return copy.deepcopy(data)
+    masked = {}
+    for path in field_paths:
+        value = data
+        for key in path.split("."):
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            _apply_update(masked, {path: value})
+    return masked
+
+
+class _MemoryGame:
+    __slots__ = ("data", "version", "children")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.version = 1
+        self.children: Dict[str, Dict[str, dict]] = {}
+
+
+class InMemoryGameTransaction(GameTransaction):
+
+    def __init__(self, store: "InMemoryGameStore", game_id: str):
+        self.store = store
+        self.game_id = game_id
+        self.read_version: Optional[int] = None
+        self.writes: List[tuple] = []
+
+    def get(self, field_paths: Optional[List[str]] = None) -> Optional[dict]:
+        self.store._count("reads")
+        with self.store._lock:
+            game = self.store._games.get(self.game_id)
+            # 読み取った時点のバージョンをコミット時に検証する（存在しない場合は0）
+            self.read_version = game.version if game else 0
+            return _mask(game.data, field_paths) if game else None
+
+    def update(self, updates: dict):
+        self.writes.append(("update", updates))
+
+    def set_child(self, collection: str, doc_id: str, data: dict):
+        self.writes.append(("set_child", (collection, doc_id, copy.deepcopy(data))))
+
+    def update_child(self, collection: str, doc_id: str, updates: dict):
+        self.writes.append(("update_child", (collection, doc_id, updates)))
+
+
+class InMemoryGameStore(GameStore):
+    """
+    プロセス内のdictにゲームを保持する実装。
+    トランザクションは楽観的同時実行制御で、読み取り後にドキュメントが更新されていればFirestoreと同様に再実行する。
+    """
+
+    MAX_TRANSACTION_ATTEMPTS = 5
+
+    def __init__(self):
+        super().__init__()
+        self._games: Dict[str, _MemoryGame] = {}
+        self._lock = threading.RLock()
+        self._watchers: List[tuple] = []
+        self._child_watchers: List[tuple] = []
+
+    def get(self, game_id: str, field_paths: Optional[List[str]] = None) -> Optional[dict]:
+        self._count("reads")
+        with self._lock:
+            game = self._games.get(game_id)
+            return _mask(game.data, field_paths) if game else None
+
+    def create(self, game_data: dict) -> str:
+        game_id = uuid.uuid4().hex[:20]
+        self._count("writes")
+        with self._lock:
+            self._games[game_id] = _MemoryGame(_resolve_sentinels(game_data))
+        return game_id
+
+    def run_transaction(self, game_id: str, fn: Callable[[GameTransaction], Any]) -> Any:
+        for attempt in range(self.MAX_TRANSACTION_ATTEMPTS):
+            txn = InMemoryGameTransaction(self, game_id)
+            result = fn(txn)
+            with self._lock:
+                game = self._games.get(game_id)
+                if txn.read_version is not None and txn.read_version != (game.version if game else 0):
+                    continue  # 読み取り後に他のトランザクションが書き込んだため再実行
+                added, changed = self._commit(game_id, game, txn.writes)
+            self._count("transactions")
+            self._count("transaction_retries", attempt)
+            self._count("writes", len(txn.writes))
+            self._notify(game_id, added)
+            self._notify_child(game_id, changed)
+            return result
+        raise TransactionConflictError(game_id)
+
+    def _commit(self, game_id: str, game: Optional[_MemoryGame], writes: List[tuple]) -> Tuple[List[tuple], List[tuple]]:
+        # 検証（存在しないゲームへの update）を先に済ませ、書き込みは全件まとめて反映する
+        if game is None and any(kind in ("update", "update_child") for kind, _ in writes):
+            raise GameNotFoundError(game_id)
+        for kind, payload in writes:
+            # Firestoreの update と同じく、存在しないサブコレクションのドキュメントは更新できない
+            if kind == "update_child" and payload[1] not in game.children.get(payload[0], {}):
+                raise KeyError(f"{payload[0]}/{payload[1]}")
+        added, changed = [], []
+        for kind, payload in writes:
+            if kind == "update":
+                _apply_update(game.data, payload)
+                game.version += 1
+            elif kind == "update_child":
+                collection, doc_id, updates = payload
+                _apply_update(game.children[collection][doc_id], updates)
+                changed.append((collection, doc_id, game.children[collection][doc_id]))
+            else:
+                collection, doc_id, data = payload
+                if game is None:
+                    game = self._games[game_id] = _MemoryGame({})
+                game.children.setdefault(collection, {})[doc_id] = data
+                added.append((collection, data))
+                changed.append((collection, doc_id, data))
+        return added, changed
+
+    def _notify(self, game_id: str, added: List[tuple]):
+        if not added:
+            return
+        with self._lock:
+            watchers = [watcher for watcher in self._watchers if watcher[0] == game_id]
+        for _, collection, field, after, callback in watchers:
+            matched = [copy.deepcopy(data) for child_collection, data in added
+                       if child_collection == collection and _OPERATORS[">"](data.get(field), after)]
+            if matched:
+                self._count("listener_reads", len(matched))
+                callback(sorted(matched, key=lambda data: data[field]))
+
+    def _notify_child(self, game_id: str, changed: List[tuple]):
+        if not changed:
+            return
+        with self._lock:
+            watchers = [watcher for watcher in self._child_watchers if watcher[0] == game_id]
+            matched = [(callback, copy.deepcopy(data)) for _, collection, doc_id, callback in watchers
+                       for child_collection, child_id, data in changed if (child_collection, child_id) == (collection, doc_id)]
+        for callback, data in matched:
+            self._count("listener_reads")
+            callback(data)
+
+    def query_children(self, game_id: str, collection: str, filters: Iterable[Filter] = (), order_by: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+        with self._lock:
+            game = self._games.get(game_id)
+            docs = [copy.deepcopy(data) for _, data in sorted(game.children.get(collection, {}).items())] if game else []
+        for field, op, value in filters:
+            docs = [data for data in docs if _OPERATORS[op](data.get(field), value)]
+        if order_by:
+            docs.sort(key=lambda data: data.get(order_by))
+        docs = docs[:limit] if limit else docs
+        self._count_query(len(docs))
+        return docs
+
+    def find_by_room_id(self, room_id: str) -> List[Tuple[str, dict]]:
+        with self._lock:
+            games = [(game_id, copy.deepcopy(game.data)) for game_id, game in self._games.items() if game.data.get('roomId') == room_id]
+        self._count_query(len(games))
+        return games
+
+    def watch_children(self, game_id: str, collection: str, field: str, after: Any, callback: Callable[[List[dict]], None]) -> Callable[[], None]:
+        watcher = (game_id, collection, field, after, callback)
+        with self._lock:
+            self._watchers.append(watcher)
+            existing = self.query_children(game_id, collection, [(field, ">", after)], order_by=field)
+        if existing:
+            callback(existing)
+
+        def unsubscribe():
+            with self._lock:
+                if watcher in self._watchers:
+                    self._watchers.remove(watcher)
+
+        return unsubscribe
+
+    def watch_child(self, game_id: str, collection: str, doc_id: str, callback: Callable[[Optional[dict]], None]) -> Callable[[], None]:
+        watcher = (game_id, collection, doc_id, callback)
+        with self._lock:
+            self._child_watchers.append(watcher)
+            game = self._games.get(game_id)
+            current = copy.deepcopy(game.children.get(collection, {}).get(doc_id)) if game else None
+        self._count("listener_reads")
+        callback(current)
+
+        def unsubscribe():
+            with self._lock:
+                if watcher in self._child_watchers:
+                    self._child_watchers.remove(watcher)
+
+        return unsubscribe
+
+
+def create_game_store(db=None) -> Optional[GameStore]:
+    """GAME_STORE_BACKEND（firestore / memory）に応じた保存先を作る"""
+    if GAME_STORE_BACKEND == "memory":
+        return InMemoryGameStore()
+    if db is None:
+        return None
+    return FirestoreGameStore(db)
@@ -0,0 +1,143 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from metrics import record_cache_hit, record_cache_lookup
+
+# GMチャットの応答キャッシュ。
+# 「能力値修正とは？」のようなルールの質問は、ゲームの状況に依らず同じ答えになる。
+# 手元の分類器で状況に依らない質問だけを選び、それらには物語の履歴を含まない短いプロンプトで答え、
+# (正規化した質問, シナリオID, 大まかな進行段階) をキーにTTL付きのLRUでキャッシュする。
+
+GM_CHAT_CACHE_SIZE = int(os.getenv("GM_CHAT_CACHE_SIZE", "512"))
+GM_CHAT_CACHE_TTL_SECONDS = float(os.getenv("GM_CHAT_CACHE_TTL_SECONDS", "3600"))
+
+CACHE_NAME = "gm_chat"
+MAX_CACHEABLE_LENGTH = 120  # これより長い質問は状況の説明を含みがちなのでキャッシュしない
+
+# ルール・用語についての質問であることを示す語
+# 英単語は前後が英字でない場合だけ一致させる（"character" の "cha" などを拾わない）
+_RULE_PATTERN = re.compile(
+    r"ルール|判定|能力値|修正値?|ダイス|サイコロ|\d*d\d+|有利|不利|目標値|難易度|成功率|クリティカル|ファンブル|"
+    r"筋力|敏捷|耐久|知力|判断力|魅力|ターン|行動|アクション|エピローグ|gmチャット|遊び方|仕組み|"
+    r"(?<![a-z])(dc|str|dex|con|int|wis|cha|rules?|modifiers?|advantage|disadvantage|roll)(?![a-z])"
+)
+# 質問の形（〜とは、どうやって、など）
+_QUESTION_PATTERN = re.compile(r"とは|って(何|なに|どう)|どうやって|どうなる|どういう|意味|仕組み|教えて|何ですか|なんですか|how|what|\?|？")
+# 今の状況・自分のキャラクター・物語の中身に触れている（答えが状況に依る）ことを示す語
+_STATE_PATTERN = re.compile(
+    r"今|いま|さっき|先ほど|次に|これから|この後|どこ|誰|だれ|ヒント|どうすれば|何をすれば|"
+    r"私|わたし|僕|ぼく|俺|おれ|自分|うち|我々|仲間|パーティ|キャラ|"
+    r"敵|扉|部屋|村|宝|謎|犯人|ボス|目標|シナリオ|物語|ストーリー|結末|"
+    r"(?<![a-z])(my|our|we|now|next|where|who)(?![a-z])"
+)
+_PUNCTUATION_PATTERN = re.compile(r"[\s、。，．,.!！?？「」『』（）()・…~〜]+")
+
+
+def normalize_question(message: str) -> str:
+    """表記ゆれ（全角半角、大文字小文字、句読点・空白）を吸収したキー用の文字列"""
+    normalized = unicodedata.normalize("NFKC", message or "").lower()
+    return _PUNCTUATION_PATTERN.sub("", normalized)
+
+
+def classify_question(message: str) -> Tuple[bool, str]:
+    """
+    質問が状況に依らず答えられる（キャッシュできる）かを判定する。
+    (キャッシュできるか, 理由) を返す。迷う場合はキャッシュしない側に倒す。
+    """
+    normalized = unicodedata.normalize("NFKC", message or "").lower().strip()
+    if not normalized:
+        return False, "empty"
+    if len(normalized) > MAX_CACHEABLE_LENGTH:
+        return False, "long"
+    if _STATE_PATTERN.search(normalized):
+        return False, "state"
+    if not _RULE_PATTERN.search(normalized):
+        return False, "not_rules"
+    if not _QUESTION_PATTERN.search(normalized):
+        return False, "not_question"
+    return True, "rules"
+
+
+def phase_bucket(game_data: dict) -> str:
+    """大まかな進行段階（ゲーム状態 + 序盤・中盤・終盤）"""
+    status = game_data.get("gameStatus") or ""
+    if status != "playing":
+        return status
+    max_turns = int((game_data.get("endConditions") or {}).get("max_turns") or 50)
+    progress = (game_data.get("currentTurn") or 1) / max(max_turns, 1)
+    return f"playing:{'early' if progress < 1 / 3 else 'mid' if progress < 2 / 3 else 'late'}"
+
+
+class TTLCache:
+    """有効期限付きのLRUキャッシュ（スレッドセーフ）。値と一緒に生成にかかった秒数を持つ"""
+
+    def __init__(self, name: str, max_entries: int, ttl_seconds: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is None:
+            record_cache_lookup(self.name, "miss")
+            return None
+        record_cache_lookup(self.name, "hit")
+        record_cache_hit(self.name, entry[2])
+        return entry[1]
+
+    def put(self, key, value, cost_seconds: float = 0.0):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value, cost_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+gm_chat_cache = TTLCache(CACHE_NAME, GM_CHAT_CACHE_SIZE, GM_CHAT_CACHE_TTL_SECONDS)
+
+
+def cache_key(message: str, game_data: dict) -> tuple:
+    return (normalize_question(message), game_data.get("decidedScenarioId") or "", phase_bucket(game_data))
+
+
+def rules_prompt(message: str, scenario_title: str) -> str:
+    """キャッシュできる質問用のプロンプト（キャラクター名や物語の履歴を含めない）"""
+    return f"""
+        あなたはTRPGの熟練ゲームマスターです。
+        プレイヤーからのルールや用語についての質問に、親切に分かりやすく答えてください。
+
+        # ゲームの基本
+        シナリオ: {scenario_title}
+        - 行動の成否は主に1d20 + 能力値修正で判定し、目標値（難易度）以上なら成功します
+        - 能力値修正は (能力値 - 10) / 2 の切り捨てです
+        - 有利なら2回振って高い方、不利なら低い方を使います
+
+        # プレイヤーからの質問
+        {message}
+
+        # 応答ガイドライン
+        - 特定のキャラクターや物語の展開には触れず、誰が聞いても同じになる一般的な説明をする
+        - 300文字以内で簡潔に回答する
+
+        GMとして応答してください:
+        """
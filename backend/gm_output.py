@@ -0,0 +1,274 @@
+import json
+import re
+import time
+from typing import List, Optional
+
+from turn_stream import NarrationStreamExtractor
+
+# GM応答（{"narration", "imagePrompt", "achievedObjectives", "scenarioStatus"} のJSON）の解析。
+# JSONモード（response_schema）で生成できる呼び出しでは常に正しいJSONが返るが、
+# 関数呼び出しと併用する通常のGMターンでは、コードブロックで囲まれる、前置きの文が付く、
+# 末尾のカンマ、出力上限での途中切れ、といった小さな崩れが起こる。
+# 再生成を依頼せずに済むよう、ここで一度だけ寛容に解析する。
+
+GM_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "narration": {"type": "string", "description": "物語の状況描写（日本語）"},
+        "imagePrompt": {"type": "string", "nullable": True, "description": "情景画像生成用の英語プロンプト"},
+        "achievedObjectives": {"type": "array", "items": {"type": "string"}, "description": "今回達成された主要目標"},
+        "scenarioStatus": {"type": "string", "enum": ["ongoing", "completed", "failed"]},
+    },
+    "required": ["narration"],
+}
+
+NARRATION_KEYS = ("narration", "gm_narration", "text")
+IMAGE_PROMPT_KEYS = ("imagePrompt", "image_prompt", "imageUrl")
+
+# 解析結果の種類: json（そのまま解析できた）/ repaired（崩れを補修して解析した）/
+# partial（ナレーションだけ取り出せた）/ text（JSONではない）/ empty（空）
+PARSE_FORMATS = ("json", "repaired", "partial", "text", "empty")
+
+_LEADING_JUNK = re.compile(r"^[﻿\x00-\x1f\x7f-\x9f\s]+")
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+_IMAGE_PROMPT_PATTERN = re.compile(r'"(?:imagePrompt|image_prompt)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_DECODER = json.JSONDecoder(strict=False)  # 文字列中の生の改行を許容する
+
+
+def _strip_wrapping(text: str) -> str:
+    """BOM・制御文字とコードブロックの囲みを取り除く"""
+    text = _LEADING_JUNK.sub("", text).strip()
+    fence = _FENCE.search(text)
+    if fence and "{" in fence.group(1):
+        text = fence.group(1).strip()
+    return text
+
+
+def _repair(candidate: str) -> str:
+    """
+    文字列の内外を追跡しながら、末尾のカンマを除き、途中で切れた文字列・配列・オブジェクトを閉じる。
+    モデルの出力上限で途中切れした応答も、それまでの内容で解析できるようにする。
+    """
+    output: List[str] = []
+    closers: List[str] = []
+    in_string = False
+    escaped = False
+    for char in candidate:
+        if in_string:
+            output.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+        elif char in "}]":
+            while output and output[-1].isspace():
+                output.pop()
+            if output and output[-1] == ",":
+                output.pop()
+            if closers:
+                closers.pop()
+        output.append(char)
+        if not closers and char in "}]":
+            break  # 最初の値の終わり（後ろの文は捨てる）
+    if in_string:
+        if escaped:
+            output.pop()
+        output.append('"')
+    text = "".join(output).rstrip()
+    if text.endswith(","):
+        text = text[:-1]
+    elif text.endswith(":"):
+        text += "null"
+    return text + "".join(reversed(closers))
+
+
+def _as_object(value) -> Optional[dict]:
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        return value[0]
+    return None
+
+
+def _first_text(data: dict, keys: tuple) -> Optional[str]:
+    for key in keys:
+        value = data.get(key)
+        if isinstance(value, str) and value.strip():
+            return value.strip()
+    return None
+
+
+def _result(narration: str, image_prompt: Optional[str], hints: dict, parse_format: str) -> dict:
+    return {"narration": narration, "imagePrompt": image_prompt, "hints": hints, "format": parse_format}
+
+
+def parse_gm_output(text: Optional[str]) -> dict:
+    """
+    GM応答のテキストを解析し、{"narration", "imagePrompt", "hints"（JSON全体）, "format"} を返す。
+    JSONとして読めない場合もナレーションを切り詰めずに返す。
+    """
+    raw = (text or "").strip()
+    if not raw:
+        return _result("", None, {}, "empty")
+    cleaned = _strip_wrapping(raw)
+    start = cleaned.find("{")
+    if start == -1:
+        return _result(raw, None, {}, "text")
+    candidate = cleaned[start:]
+
+    for parse_format, source in (("json", candidate), ("repaired", None)):
+        try:
+            value, _ = _DECODER.raw_decode(source if source is not None else _repair(candidate))
+        except ValueError:
+            continue
+        data = _as_object(value)
+        if data is None:
+            break
+        narration = _first_text(data, NARRATION_KEYS)
+        if narration is None:
+            break
+        if parse_format == "json" and start > 0:
+            parse_format = "repaired"  # 前置きの文などが付いていた
+        return _result(narration, _first_text(data, IMAGE_PROMPT_KEYS), data, parse_format)
+
+    # JSONとしては読めないが、ナレーションの値だけは取り出せる場合
+    extractor = NarrationStreamExtractor()
+    narration = extractor.feed(candidate).strip()
+    if narration:
+        image_match = _IMAGE_PROMPT_PATTERN.search(candidate)
+        image_prompt = _DECODER.decode(f'"{image_match.group(1)}"') if image_match else None
+        return _result(narration, image_prompt, {}, "partial")
+    return _result(raw, None, {}, "text")
+
+
+class GMOutputParser:
+    """
+    ストリーミング中は narration の値だけを逐次取り出し（SSE配信用）、
+    受信完了後に全体を parse_gm_output で解析する。
+    """
+
+    def __init__(self):
+        self._extractor = NarrationStreamExtractor()
+        self._chunks: List[str] = []
+
+    def feed(self, chunk: str) -> str:
+        """断片を追加し、新たに確定したナレーションのテキストを返す"""
+        self._chunks.append(chunk)
+        return self._extractor.feed(chunk)
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    def result(self) -> dict:
+        return parse_gm_output(self.text)
+
+
+# --- ベンチマーク ---
+# python gm_output.py で、よくある崩れ方を含む応答のコーパスに対する解析成功率と1件あたりの時間を、
+# 従来の解析（```json の除去 + json.loads）と比較する。
+
+_CORPUS_NARRATION = "一行は霧深い森に足を踏み入れた。\n遠くで狼の遠吠えが響き、「気をつけろ」とリーダーが囁く。" * 4
+_CORPUS_PAYLOAD = {
+    "narration": _CORPUS_NARRATION,
+    "imagePrompt": "a misty forest at night, cinematic lighting",
+    "achievedObjectives": [],
+    "scenarioStatus": "ongoing",
+}
+
+
+def benchmark_corpus() -> List[tuple]:
+    """(種類, 応答テキスト, 期待するナレーション) のリスト"""
+    clean = json.dumps(_CORPUS_PAYLOAD, ensure_ascii=False)
+    pretty = json.dumps(_CORPUS_PAYLOAD, ensure_ascii=False, indent=2)
+    raw_newlines = clean.replace("\\n", "\n")
+    trailing_comma = pretty.replace('"ongoing"\n}', '"ongoing",\n}').replace("[]", '["森を抜ける",]')
+    expected = _CORPUS_NARRATION
+    return [
+        ("clean", clean, expected),
+        ("pretty", pretty, expected),
+        ("fenced", f"```json\n{pretty}\n```", expected),
+        ("fenced_no_lang", f"```\n{pretty}\n```", expected),
+        ("bom", "﻿" + clean, expected),
+        ("preamble", f"以下が応答です。\n{pretty}", expected),
+        ("trailing_text", f"{pretty}\n以上です。", expected),
+        ("raw_newlines", raw_newlines, expected),
+        ("trailing_comma", trailing_comma, expected),
+        ("truncated_after_narration", pretty[:pretty.index('"imagePrompt"') + 20], expected),
+        ("truncated_in_narration", pretty[:pretty.index('"narration"') + 80], None),
+        ("alt_key", clean.replace('"narration"', '"gm_narration"'), expected),
+        ("list_wrapped", f"[{clean}]", expected),
+        ("plain_text", _CORPUS_NARRATION, _CORPUS_NARRATION),
+    ]
+
+
+def _legacy_parse(text: str) -> str:
+    """従来の解析（JSONとして読めなければ応答全体を1000文字で切ってナレーションにする）"""
+    cleaned = text.strip()
+    if cleaned.startswith("```json"):
+        cleaned = cleaned[7:]
+    if cleaned.endswith("```"):
+        cleaned = cleaned[:-3]
+    try:
+        data = json.loads(cleaned.strip())
+    except json.JSONDecodeError:
+        return text if len(text) < 1000 else text[:1000] + "..."
+    if not isinstance(data, dict):
+        return text
+    return data.get("narration") or data.get("gm_narration") or data.get("text") or text
+
+
+def benchmark(repeat: int = 2000) -> List[dict]:
+    """コーパスの種類ごとの解析結果と1件あたりの時間（µs）"""
+    rows = []
+    for kind, text, expected in benchmark_corpus():
+        started = time.perf_counter()
+        for _ in range(repeat):
+            legacy = _legacy_parse(text)
+        legacy_us = (time.perf_counter() - started) / repeat * 1e6
+        started = time.perf_counter()
+        for _ in range(repeat):
+            parsed = parse_gm_output(text)
+        parse_us = (time.perf_counter() - started) / repeat * 1e6
+        if expected is None:
+            # 途中切れ：切れた位置までのナレーションが取り出せれば成功
+            ok = parsed["narration"] and _CORPUS_NARRATION.startswith(parsed["narration"])
+        else:
+            ok = parsed["narration"] == expected
+        rows.append({
+            "kind": kind,
+            "format": parsed["format"],
+            "ok": bool(ok),
+            "legacyOk": legacy == expected,
+            "parseUs": parse_us,
+            "legacyUs": legacy_us,
+        })
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="GM応答の解析をコーパスで検証し、従来の解析と速度を比較する")
+    parser.add_argument("--check", action="store_true", help="時間を測らずに、全ての応答を期待どおりに解析できるかだけを確かめる")
+    args = parser.parse_args()
+
+    results = benchmark(repeat=1 if args.check else 2000)
+    if not args.check:
+        print(f"{'kind':28} {'format':9} {'ok':>4} {'legacy':>7} {'parse µs':>10} {'legacy µs':>10}")
+        for row in results:
+            print(f"{row['kind']:28} {row['format']:9} {str(row['ok']):>4} {str(row['legacyOk']):>7} {row['parseUs']:10.1f} {row['legacyUs']:10.1f}")
+    total = len(results)
+    print(f"成功率: {sum(row['ok'] for row in results)}/{total}（従来 {sum(row['legacyOk'] for row in results)}/{total}）")
+    failed = [row["kind"] for row in results if not row["ok"]]
+    if failed:
+        print(f"❌ 期待どおりに解析できなかった応答: {', '.join(failed)}")
+        sys.exit(1)
@@ -0,0 +1,104 @@
+import os
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from conversation import format_conversation
+
+# GMプロンプトに含める「これまでの物語」を管理する。
+# 直近Kターンは会話差分をそのまま載せ、それより古いターンは要約(historySummary)に畳み込む。
+# 要約の更新はターン確定後に行うため、GM応答生成のクリティカルパスには乗らない。
+
+GM_HISTORY_VERBATIM_TURNS = int(os.getenv("GM_HISTORY_VERBATIM_TURNS", "4"))
+GM_PROMPT_TOKEN_BUDGET = int(os.getenv("GM_PROMPT_TOKEN_BUDGET", "8000"))
+GM_SUMMARY_MAX_CHARS = int(os.getenv("GM_SUMMARY_MAX_CHARS", "1200"))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数を概算する。
+    ASCIIはおよそ4文字で1トークン、日本語などの非ASCII文字は1文字1トークンとして数える。
+    """
+    if not text:
+        return 0
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+class HistoryManager:
+    """要約 + 直近ターンの逐語履歴からプロンプト用の履歴テキストを組み立てる"""
+
+    def __init__(self, verbatim_turns: int = GM_HISTORY_VERBATIM_TURNS, token_budget: int = GM_PROMPT_TOKEN_BUDGET, summary_max_chars: int = GM_SUMMARY_MAX_CHARS):
+        self.verbatim_turns = max(1, verbatim_turns)
+        self.token_budget = token_budget
+        self.summary_max_chars = summary_max_chars
+
+    def split(self, conversation: Optional[List[dict]], current_turn: int) -> Tuple[List[dict], List[dict]]:
+        """会話差分を (要約に畳み込む対象, 逐語で残す対象) に分ける"""
+        deltas = sorted(conversation or [], key=lambda delta: delta.get("turn", 0))
+        boundary = current_turn - self.verbatim_turns
+        older = [delta for delta in deltas if delta.get("turn", 0) < boundary]
+        recent = [delta for delta in deltas if delta.get("turn", 0) >= boundary]
+        return older, recent
+
+    def pending_fold(self, game_data: dict) -> List[dict]:
+        """まだ要約に反映されていない、逐語ウィンドウから外れたターンを返す"""
+        summary = game_data.get("historySummary") or {}
+        through_turn = summary.get("throughTurn", 0)
+        older, _ = self.split(game_data.get("conversation"), game_data.get("currentTurn", 1))
+        return [delta for delta in older if delta.get("turn", 0) > through_turn]
+
+    def build_history(self, game_data: dict, opening_narration: str = "", reserved_tokens: int = 0) -> str:
+        """
+        プロンプトの他の部分で reserved_tokens を使う前提で、予算内に収まる履歴テキストを返す。
+        予算を超える場合は古い逐語ターンから落とし、最後に要約の先頭を切り詰める。
+        """
+        available = max(0, self.token_budget - reserved_tokens)
+        summary = game_data.get("historySummary") or {}
+        summary_text = summary.get("text") or opening_narration or ""
+        through_turn = summary.get("throughTurn", 0)
+
+        older, recent = self.split(game_data.get("conversation"), game_data.get("currentTurn", 1))
+        # 要約がまだ追いついていないターンも逐語側に残す
+        recent = [delta for delta in older if delta.get("turn", 0) > through_turn] + recent
+
+        summary_block = f"## これまでのあらすじ\n{summary_text}" if summary_text else ""
+        while True:
+            recent_block = format_conversation(recent)
+            history = "\n\n".join(block for block in (summary_block, recent_block) if block)
+            if estimate_tokens(history) <= available or not recent:
+                break
+            recent = recent[1:]
+
+        if estimate_tokens(history) > available and summary_block:
+            # 逐語ターンをすべて落としても収まらない場合は要約の末尾（新しい側）を優先して残す
+            # 非ASCII文字は1文字1トークンで数えているため、文字数で切れば予算を超えない
+            history = summary_text[-available:] if available else ""
+        return history
+
+    def build_summary_prompt(self, current_summary: str, deltas: List[dict]) -> str:
+        """既存の要約に新しいターンを畳み込むためのプロンプト"""
+        return f"""あなたはTRPGの記録係です。
+これまでのあらすじに、新しく起きた出来事を統合して、更新されたあらすじを作成してください。
+
+# これまでのあらすじ
+{current_summary or "（まだありません）"}
+
+# 新しく起きた出来事
+{format_conversation(deltas)}
+
+# 要件
+- {self.summary_max_chars}文字以内の日本語で書く
+- 登場人物の名前、重要な発見、入手したアイテム、未解決の謎、達成した目標は必ず残す
+- ダイスの細かい数値は省略し、成功・失敗の結果だけを残す
+- あらすじの本文のみを出力する"""
+
+    def summary_update(self, summary_text: str, through_turn: int) -> dict:
+        """Firestoreに保存する historySummary フィールドを作る"""
+        return {
+            "text": summary_text[:self.summary_max_chars * 2],
+            "throughTurn": through_turn,
+            "updatedAt": datetime.utcnow().isoformat(),
+        }
+
+
+history_manager = HistoryManager()
@@ -0,0 +1,392 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, List, NamedTuple, Optional
+
+# 永続ジョブキュー。
+# GM応答生成や動画生成のような時間のかかる処理をリクエストやプロセスの寿命から切り離し、
+# ワーカー（worker.py、またはWebプロセス内のワーカースレッド）が取り出して実行する。
+# 本番はFirestore（jobs コレクション）、ローカル開発やテストではSQLiteを使う。
+
+JOB_COLLECTION = "jobs"
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "firestore")
+JOB_QUEUE_SQLITE_PATH = os.getenv("JOB_QUEUE_SQLITE_PATH", "jobs.sqlite3")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# 実行中のワーカーが落ちた場合、この秒数を過ぎたジョブは別のワーカーが引き取る
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "600"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "300"))
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+# ジョブ状態APIで返すフィールド
+PUBLIC_JOB_FIELDS = ("id", "type", "status", "gameId", "attempts", "maxAttempts", "lastError", "result", "createdAt", "updatedAt")
+
+
+class Reschedule(NamedTuple):
+    """
+    ジョブのハンドラーが返すと、同じジョブを delay_seconds 後に再実行する（完了にしない）。
+    ポーリングのように同じ処理を繰り返すジョブが、1回ごとに新しいジョブを作らずに済むようにする。
+    """
+    delay_seconds: float
+    result: Any = None
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def retry_delay(attempts: int) -> float:
+    """attempts 回目の失敗後、再実行までの待ち秒数（指数バックオフ + ジッター）"""
+    delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def public_job(job: dict) -> dict:
+    return {key: job.get(key) for key in PUBLIC_JOB_FIELDS}
+
+
+class JobQueue:
+    """ジョブキューの共通インターフェース"""
+
+    def enqueue(self, job_type: str, payload: dict, game_id: Optional[str] = None, job_id: Optional[str] = None, max_attempts: int = JOB_MAX_ATTEMPTS,
+                delay_seconds: float = 0) -> str:
+        """
+        ジョブを登録してIDを返す。
+        job_id を指定した場合、同じIDのジョブが既にあれば新たに登録せずそのIDを返す。
+        delay_seconds を指定した場合、その秒数が過ぎるまで取り出されない（ポーリングの間隔など）。
+        """
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def claim(self, job_type: str, worker_id: str, limit: int) -> List[dict]:
+        """実行可能なジョブ（待機中、または実行者のリースが切れたもの）を最大 limit 件取り出す"""
+        raise NotImplementedError
+
+    def complete(self, job_id: str, worker_id: str, result: Any = None) -> bool:
+        raise NotImplementedError
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        """失敗を記録する。試行回数が残っていればバックオフ後に再実行されるよう待機中に戻す"""
+        raise NotImplementedError
+
+    def reschedule(self, job_id: str, worker_id: str, delay_seconds: float, result: Any = None) -> bool:
+        """実行中のジョブを待機中に戻し、delay_seconds 後に再実行させる（試行回数は数え直す）"""
+        raise NotImplementedError
+
+    def cancel(self, job_id: str) -> bool:
+        """待機中のジョブを取り消す。実行中・終了済みのジョブは取り消せない（False を返す）"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _new_job(job_id: str, job_type: str, payload: dict, game_id: Optional[str], max_attempts: int, delay_seconds: float = 0) -> dict:
+        now = _now()
+        return {
+            "id": job_id,
+            "type": job_type,
+            "status": STATUS_QUEUED,
+            "payload": payload,
+            "gameId": game_id,
+            "attempts": 0,
+            "maxAttempts": max_attempts,
+            "runAfter": now + timedelta(seconds=max(0.0, delay_seconds)),
+            "leaseExpiresAt": None,
+            "workerId": None,
+            "lastError": None,
+            "result": None,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+
+    @staticmethod
+    def _is_claimable(job: dict, now: datetime) -> bool:
+        if job.get("status") == STATUS_QUEUED:
+            return job.get("runAfter") is None or job["runAfter"] <= now
+        if job.get("status") == STATUS_RUNNING:
+            return job.get("leaseExpiresAt") is not None and job["leaseExpiresAt"] <= now
+        return False
+
+    @staticmethod
+    def _claim_update(job: dict, worker_id: str, now: datetime) -> dict:
+        return {
+            "status": STATUS_RUNNING,
+            "workerId": worker_id,
+            "attempts": (job.get("attempts") or 0) + 1,
+            "leaseExpiresAt": now + timedelta(seconds=JOB_LEASE_SECONDS),
+            "updatedAt": now,
+        }
+
+    @staticmethod
+    def _reschedule_update(result: Any, delay_seconds: float, now: datetime) -> dict:
+        # 正常に1回終えているので、次の実行で失敗した場合の再試行回数は最初から数える
+        return {
+            "status": STATUS_QUEUED, "result": result, "attempts": 0, "lastError": None, "workerId": None, "leaseExpiresAt": None,
+            "runAfter": now + timedelta(seconds=max(0.0, delay_seconds)), "updatedAt": now,
+        }
+
+    @staticmethod
+    def _failure_update(job: dict, error: str, now: datetime) -> dict:
+        attempts = job.get("attempts") or 0
+        update = {"lastError": error[:1000], "workerId": None, "leaseExpiresAt": None, "updatedAt": now}
+        if attempts >= (job.get("maxAttempts") or JOB_MAX_ATTEMPTS):
+            update["status"] = STATUS_FAILED
+        else:
+            update["status"] = STATUS_QUEUED
+            update["runAfter"] = now + timedelta(seconds=retry_delay(attempts))
+        return update
+
+
+class FirestoreJobQueue(JobQueue):
+    """Firestoreの jobs コレクションを使うジョブキュー（取り出しはトランザクションで排他する）"""
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.collection(JOB_COLLECTION)
+
+    def enqueue(self, job_type: str, payload: dict, game_id: Optional[str] = None, job_id: Optional[str] = None, max_attempts: int = JOB_MAX_ATTEMPTS,
+                delay_seconds: float = 0) -> str:
+        from google.api_core.exceptions import AlreadyExists
+
+        job_id = job_id or uuid.uuid4().hex
+        try:
+            self.collection.document(job_id).create(self._new_job(job_id, job_type, payload, game_id, max_attempts, delay_seconds))
+        except AlreadyExists:
+            pass
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        snapshot = self.collection.document(job_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def claim(self, job_type: str, worker_id: str, limit: int) -> List[dict]:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        now = _now()
+        queued = (self.collection.where(filter=FieldFilter("type", "==", job_type))
+                  .where(filter=FieldFilter("status", "==", STATUS_QUEUED))
+                  .where(filter=FieldFilter("runAfter", "<=", now))
+                  .order_by("runAfter").limit(limit).get())
+        stale = (self.collection.where(filter=FieldFilter("type", "==", job_type))
+                 .where(filter=FieldFilter("status", "==", STATUS_RUNNING))
+                 .where(filter=FieldFilter("leaseExpiresAt", "<=", now))
+                 .limit(limit).get())
+
+        claimed = []
+        for doc in list(stale) + list(queued):
+            if len(claimed) >= limit:
+                break
+            job = self._claim_one(doc.reference, worker_id)
+            if job:
+                claimed.append(job)
+        return claimed
+
+    def _claim_one(self, job_ref, worker_id: str) -> Optional[dict]:
+        from firebase_admin import firestore
+
+        @firestore.transactional
+        def claim_in_transaction(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return None
+            job = snapshot.to_dict()
+            now = _now()
+            # 他のワーカーが先に取り出していれば何もしない
+            if not self._is_claimable(job, now):
+                return None
+            update = self._claim_update(job, worker_id, now)
+            transaction.update(job_ref, update)
+            job.update(update)
+            return job
+
+        return claim_in_transaction(self.db.transaction())
+
+    def _finish(self, job_id: str, worker_id: str, build_update) -> bool:
+        from firebase_admin import firestore
+
+        job_ref = self.collection.document(job_id)
+
+        @firestore.transactional
+        def finish_in_transaction(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return False
+            job = snapshot.to_dict()
+            # リース切れで別のワーカーに引き取られていれば結果を書き込まない
+            if job.get("status") != STATUS_RUNNING or job.get("workerId") != worker_id:
+                return False
+            transaction.update(job_ref, build_update(job, _now()))
+            return True
+
+        return finish_in_transaction(self.db.transaction())
+
+    def complete(self, job_id: str, worker_id: str, result: Any = None) -> bool:
+        return self._finish(job_id, worker_id, lambda job, now: {
+            "status": STATUS_SUCCEEDED, "result": result, "leaseExpiresAt": None, "updatedAt": now,
+        })
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        return self._finish(job_id, worker_id, lambda job, now: self._failure_update(job, error, now))
+
+    def reschedule(self, job_id: str, worker_id: str, delay_seconds: float, result: Any = None) -> bool:
+        return self._finish(job_id, worker_id, lambda job, now: self._reschedule_update(result, delay_seconds, now))
+
+    def cancel(self, job_id: str) -> bool:
+        from firebase_admin import firestore
+
+        job_ref = self.collection.document(job_id)
+
+        @firestore.transactional
+        def cancel_in_transaction(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            if not snapshot.exists or snapshot.to_dict().get("status") != STATUS_QUEUED:
+                return False
+            transaction.update(job_ref, {"status": STATUS_CANCELLED, "updatedAt": _now()})
+            return True
+
+        return cancel_in_transaction(self.db.transaction())
+
+
+class SQLiteJobQueue(JobQueue):
+    """ローカル開発・テスト用のSQLiteジョブキュー（同一ファイルを共有すれば複数プロセスからも使える）"""
+
+    _COLUMNS = {
+        "id": "id", "type": "type", "status": "status", "payload": "payload", "gameId": "game_id",
+        "attempts": "attempts", "maxAttempts": "max_attempts", "runAfter": "run_after",
+        "leaseExpiresAt": "lease_expires_at", "workerId": "worker_id", "lastError": "last_error",
+        "result": "result", "createdAt": "created_at", "updatedAt": "updated_at",
+    }
+    _JSON_FIELDS = {"payload", "result"}
+    _TIME_FIELDS = {"runAfter", "leaseExpiresAt", "createdAt", "updatedAt"}
+
+    def __init__(self, path: str = JOB_QUEUE_SQLITE_PATH):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, type TEXT NOT NULL, status TEXT NOT NULL, payload TEXT,
+                    game_id TEXT, attempts INTEGER NOT NULL, max_attempts INTEGER NOT NULL,
+                    run_after REAL, lease_expires_at REAL, worker_id TEXT, last_error TEXT,
+                    result TEXT, created_at REAL, updated_at REAL
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (type, status, run_after)")
+
+    def _to_row(self, fields: dict) -> dict:
+        row = {}
+        for key, value in fields.items():
+            if key in self._JSON_FIELDS:
+                value = json.dumps(value, ensure_ascii=False, default=str) if value is not None else None
+            elif key in self._TIME_FIELDS and value is not None:
+                value = value.timestamp()
+            row[self._COLUMNS[key]] = value
+        return row
+
+    def _from_row(self, row) -> dict:
+        job = {}
+        for key, column in self._COLUMNS.items():
+            value = row[column]
+            if key in self._JSON_FIELDS and value is not None:
+                value = json.loads(value)
+            elif key in self._TIME_FIELDS and value is not None:
+                value = datetime.fromtimestamp(value, timezone.utc)
+            job[key] = value
+        return job
+
+    def _update(self, job_id: str, fields: dict):
+        row = self._to_row(fields)
+        assignments = ", ".join(f"{column} = ?" for column in row)
+        self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*row.values(), job_id))
+
+    def enqueue(self, job_type: str, payload: dict, game_id: Optional[str] = None, job_id: Optional[str] = None, max_attempts: int = JOB_MAX_ATTEMPTS,
+                delay_seconds: float = 0) -> str:
+        job_id = job_id or uuid.uuid4().hex
+        row = self._to_row(self._new_job(job_id, job_type, payload, game_id, max_attempts, delay_seconds))
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR IGNORE INTO jobs ({', '.join(row)}) VALUES ({', '.join('?' for _ in row)})",
+                tuple(row.values()),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._from_row(row) if row else None
+
+    def claim(self, job_type: str, worker_id: str, limit: int) -> List[dict]:
+        now = _now()
+        claimed = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    """SELECT * FROM jobs WHERE type = ? AND (
+                           (status = ? AND run_after <= ?) OR (status = ? AND lease_expires_at <= ?)
+                       ) ORDER BY run_after LIMIT ?""",
+                    (job_type, STATUS_QUEUED, now.timestamp(), STATUS_RUNNING, now.timestamp(), limit),
+                ).fetchall()
+                for row in rows:
+                    job = self._from_row(row)
+                    update = self._claim_update(job, worker_id, now)
+                    self._update(job["id"], update)
+                    job.update(update)
+                    claimed.append(job)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return claimed
+
+    def _finish(self, job_id: str, worker_id: str, build_update) -> bool:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                job = self._from_row(row) if row else None
+                finished = bool(job) and job["status"] == STATUS_RUNNING and job["workerId"] == worker_id
+                if finished:
+                    self._update(job_id, build_update(job, _now()))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return finished
+
+    def complete(self, job_id: str, worker_id: str, result: Any = None) -> bool:
+        return self._finish(job_id, worker_id, lambda job, now: {
+            "status": STATUS_SUCCEEDED, "result": result, "leaseExpiresAt": None, "updatedAt": now,
+        })
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        return self._finish(job_id, worker_id, lambda job, now: self._failure_update(job, error, now))
+
+    def reschedule(self, job_id: str, worker_id: str, delay_seconds: float, result: Any = None) -> bool:
+        return self._finish(job_id, worker_id, lambda job, now: self._reschedule_update(result, delay_seconds, now))
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (STATUS_CANCELLED, _now().timestamp(), job_id, STATUS_QUEUED),
+            )
+        return cursor.rowcount > 0
+
+
+def create_job_queue(db=None) -> Optional[JobQueue]:
+    """JOB_QUEUE_BACKEND（firestore / sqlite）に応じたジョブキューを作る"""
+    if JOB_QUEUE_BACKEND == "sqlite":
+        return SQLiteJobQueue(JOB_QUEUE_SQLITE_PATH)
+    if db is None:
+        return None
+    return FirestoreJobQueue(db)
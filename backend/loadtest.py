@@ -0,0 +1,453 @@
+"""
+ターン処理パイプラインの負荷試験ハーネス。
+
+4人部屋を N 個同時に、ロビーからエピローグまでアプリ内（ASGI直接呼び出し）で進行させ、
+ターン/秒、エンドポイントごとの p50/p95/p99 レイテンシ、ストアの操作回数を集計する。
+モデルはフェイク（fake_models.py）、ゲームはインメモリ、ジョブキューはSQLiteを使うため、
+課金されるAPIやFirestoreには一切アクセスしない。
+
+    python loadtest.py --rooms 20
+    FAKE_LLM_LATENCY=lognormal:3.0,0.5 FAKE_ERROR_RATE=0.02 python loadtest.py --rooms 50 --json result.json
+
+--scenario ready-under-gm-chat では、GMチャットを常に --gm-chats 件処理中にしたまま
+POST /games/{id}/ready を繰り返し、そのレイテンシ（イベントループが塞がれていないか）を測る。
+--blocking-gm-chat を付けると、GMチャットのモデル呼び出しを同期版に差し替えて従来（イベントループ上で待つ）の挙動を再現する。
+
+    python loadtest.py --scenario ready-under-gm-chat --gm-chats 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+# main をインポートする前に、外部サービスを使わない構成を既定にする
+os.environ.setdefault("MODEL_PROVIDER", "fake")
+os.environ.setdefault("GAME_STORE_BACKEND", "memory")
+os.environ.setdefault("JOB_QUEUE_BACKEND", "sqlite")
+os.environ.setdefault("JOB_QUEUE_SQLITE_PATH", ":memory:")
+os.environ.setdefault("JOB_RETRY_BASE_SECONDS", "1")
+os.environ.setdefault("DICE_SEED_SECRET", "loadtest")
+# 動画生成オペレーションの完了確認を短い間隔で行う
+os.environ.setdefault("VIDEO_POLL_INITIAL_SECONDS", "0.5")
+os.environ.setdefault("VIDEO_POLL_MAX_SECONDS", "2")
+
+from fastapi import Header  # noqa: E402
+
+from fake_models import FakeStorageBucket  # noqa: E402
+from main import JOB_HANDLERS, app, get_current_user_uid, get_stream_user_uid, model_registry, prime_scenario_pool, startup_initialization  # noqa: E402
+from worker import JobWorker  # noqa: E402
+from scenario_pool import SCENARIO_POOL_SIZE  # noqa: E402
+
+PLAYERS_PER_ROOM = 4
+TURN_TIMEOUT_SECONDS = float(os.getenv("LOADTEST_TURN_TIMEOUT_SECONDS", "300"))
+# 最後の1人が他の全員より遅れて投票するまでの秒数（投票中に結果が確定した時点での動画の先行生成を測る）
+LAST_VOTE_DELAY_SECONDS = float(os.getenv("LOADTEST_LAST_VOTE_DELAY_SECONDS", "0"))
+# 5xx（フェイクの注入エラーなど）を受けたときにリクエストをやり直す回数
+REQUEST_RETRIES = 3
+
+
+async def loadtest_uid(authorization: str = Header(...)) -> str:
+    """テスト用認証: "Bearer <uid>" の uid をそのまま使う"""
+    return authorization.split("Bearer ", 1)[1]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """最近接順位法によるパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.turn_latencies: List[float] = []
+        self.turns = 0
+        self.rooms_finished = 0
+        self.rooms_failed: List[str] = []
+        self.scene_images: Dict[str, int] = defaultdict(int)  # 情景画像の最終状態ごとの件数
+        self.videos: Dict[str, int] = defaultdict(int)  # "opening:ready" のような動画の最終状態ごとの件数
+        self.opening_video_waits: List[float] = []  # 最後の投票からオープニング動画の完成までの秒数
+
+    def summary(self, elapsed: float, op_counts: Dict[str, int]) -> dict:
+        def distribution(values: List[float]) -> dict:
+            ordered = sorted(values)
+            return {
+                "count": len(ordered),
+                "p50_ms": round(percentile(ordered, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(ordered, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(ordered, 0.99) * 1000, 1),
+            }
+
+        endpoints = {}
+        for name in sorted(self.latencies):
+            endpoints[name] = distribution(self.latencies[name])
+            endpoints[name]["errors"] = self.errors.get(name, 0)
+        return {
+            "elapsedSeconds": round(elapsed, 2),
+            "roomsFinished": self.rooms_finished,
+            "roomsFailed": self.rooms_failed,
+            "turns": self.turns,
+            "turnsPerSecond": round(self.turns / elapsed, 3) if elapsed > 0 else 0.0,
+            "turnResolution": distribution(self.turn_latencies),
+            "openingVideoWait": distribution(self.opening_video_waits),
+            "endpoints": endpoints,
+            "storeOps": op_counts,
+            "storeOpsPerTurn": {op: round(count / self.turns, 1) for op, count in op_counts.items()} if self.turns else {},
+            "sceneImages": dict(self.scene_images),
+            "videos": dict(self.videos),
+        }
+
+
+class Client:
+    """ASGIアプリを直接呼び出す最小限のHTTPクライアント"""
+
+    def __init__(self, stats: Stats):
+        self.stats = stats
+
+    async def _send(self, method: str, path: str, uid: str, body: Optional[dict]) -> Tuple[int, dict]:
+        payload = json.dumps(body or {}).encode("utf-8") if method != "GET" else b""
+        path_only, _, query = path.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path_only,
+            "raw_path": path_only.encode("utf-8"),
+            "query_string": query.encode("utf-8"),
+            "root_path": "",
+            "headers": [
+                (b"authorization", f"Bearer {uid}".encode("utf-8")),
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(payload)).encode("utf-8")),
+            ],
+            "client": ("loadtest", 0),
+            "server": ("loadtest", 80),
+        }
+        sent = False
+        status_code = 500
+        chunks = []
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": payload, "more_body": False}
+            await asyncio.Event().wait()  # 切断は通知しない
+
+        async def send(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await app(scope, receive, send)
+        raw = b"".join(chunks)
+        try:
+            return status_code, json.loads(raw) if raw else {}
+        except ValueError:
+            return status_code, {"raw": raw.decode("utf-8", "replace")}
+
+    async def call(self, name: str, method: str, path: str, uid: str, body: Optional[dict] = None) -> dict:
+        """リクエストを送り、レイテンシを endpoint 名ごとに記録する。5xxは数回やり直す"""
+        for attempt in range(REQUEST_RETRIES + 1):
+            started = time.perf_counter()
+            status_code, data = await self._send(method, path, uid, body)
+            self.stats.latencies[name].append(time.perf_counter() - started)
+            if status_code < 400:
+                return data
+            self.stats.errors[name] += 1
+            if status_code < 500 or attempt == REQUEST_RETRIES:
+                raise RuntimeError(f"{name} -> {status_code}: {data}")
+            await asyncio.sleep(0.5 * (attempt + 1))
+
+
+class RoomObserver:
+    """クライアントと同じく events サブコレクションの差分から部屋の状態を追跡する"""
+
+    def __init__(self, store, game_id: str):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.current_turn = 0
+        self.game_status = "lobby"
+        self.portraits = set()  # キャラクター画像の生成が終わったプレイヤー
+        self.image_statuses: Dict[int, str] = {}  # gm_response の連番 -> 情景画像の状態
+        self.video_statuses: Dict[str, str] = {}  # "opening" / "epilogue" -> 動画の状態
+        self.unsubscribe = store.watch_children(game_id, "events", "version", 0, self._on_events)
+
+    def _on_events(self, events: List[dict]):
+        self.loop.call_soon_threadsafe(self._apply, events)
+
+    def _apply(self, events: List[dict]):
+        for event in events:
+            data = event.get("data") or {}
+            if event.get("type") == "status_changed":
+                self.game_status = data.get("gameStatus")
+            elif event.get("type") == "log_appended":
+                entry = data.get("entry") or {}
+                if entry.get("imageStatus"):
+                    self.image_statuses[entry.get("seq")] = entry["imageStatus"]
+            elif event.get("type") == "log_updated":
+                status = (data.get("changes") or {}).get("imageStatus")
+                if status:
+                    self.image_statuses[data.get("seq")] = status
+            elif event.get("type") == "player_updated":
+                if (data.get("changes") or {}).get("characterImageUrl"):
+                    self.portraits.add(data.get("playerId"))
+            elif event.get("type") == "fields_updated":
+                fields = data.get("fields") or {}
+                if "currentTurn" in fields:
+                    self.current_turn = fields["currentTurn"]
+                if "gameStatus" in fields:
+                    self.game_status = fields["gameStatus"]
+                if isinstance(fields.get("openingVideo"), dict):
+                    self.video_statuses["opening"] = fields["openingVideo"].get("status")
+                for target, path in (("opening", "openingVideo.status"), ("epilogue", "epilogue.video_status")):
+                    if path in fields:
+                        self.video_statuses[target] = fields[path]
+        self.changed.set()
+
+    async def wait_for(self, predicate, timeout: float):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"state did not change (turn={self.current_turn}, status={self.game_status})")
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def seconds_until(observer: "RoomObserver", predicate, started: float) -> float:
+    await observer.wait_for(predicate, TURN_TIMEOUT_SECONDS)
+    return time.perf_counter() - started
+
+
+async def run_room(client: Client, stats: Stats, index: int, max_turns: int):
+    store = app.state.game_store
+    players = [f"loadtest-{index}-{number}" for number in range(PLAYERS_PER_ROOM)]
+    host = players[0]
+
+    created = await client.call("POST /games", "POST", "/games", host)
+    game_id = created["gameId"]
+    observer = RoomObserver(store, game_id)
+    try:
+        await asyncio.gather(*[
+            client.call("POST /games/{room_id}/join", "POST", f"/games/{created['roomId']}/join", uid) for uid in players[1:]
+        ])
+        voting = await client.call("POST /games/{game_id}/start-voting", "POST", f"/games/{game_id}/start-voting", host,
+                                   {"difficulty": "normal", "opening_video_enabled": True})
+        scenario_id = voting["scenarios"][0]["id"]
+        await asyncio.gather(*[
+            client.call("POST /games/{game_id}/vote", "POST", f"/games/{game_id}/vote", uid, {"scenarioId": scenario_id}) for uid in players[:-1]
+        ])
+        await asyncio.sleep(LAST_VOTE_DELAY_SECONDS)
+        await client.call("POST /games/{game_id}/vote", "POST", f"/games/{game_id}/vote", players[-1], {"scenarioId": scenario_id})
+        opening_video_wait = asyncio.ensure_future(seconds_until(
+            observer, lambda: observer.video_statuses.get("opening") in ("ready", "failed"), time.perf_counter()))
+        await asyncio.gather(*[
+            client.call("POST /games/{game_id}/create-character", "POST", f"/games/{game_id}/create-character", uid,
+                        {"characterName": f"勇者{uid[-1]}", "characterDescription": "負荷試験用の冒険者"})
+            for uid in players
+        ])
+        # キャラクター画像はジョブで生成されるので、全員分が揃うのを待つ
+        await observer.wait_for(lambda: observer.portraits >= set(players), TURN_TIMEOUT_SECONDS)
+        await client.call("POST /games/{game_id}/proceed-to-ready", "POST", f"/games/{game_id}/proceed-to-ready", host)
+        await client.call("POST /games/{game_id}/start-game", "POST", f"/games/{game_id}/start-game", host)
+        await observer.wait_for(lambda: observer.game_status == "playing", TURN_TIMEOUT_SECONDS)
+
+        for turn in range(1, max_turns + 1):
+            await asyncio.gather(*[
+                client.call("POST /games/{game_id}/action", "POST", f"/games/{game_id}/action", uid, {"actionText": f"ターン{turn}の行動"})
+                for uid in players
+            ])
+            submitted = time.perf_counter()
+            await observer.wait_for(lambda: observer.current_turn > turn or observer.game_status != "playing", TURN_TIMEOUT_SECONDS)
+            stats.turn_latencies.append(time.perf_counter() - submitted)
+            stats.turns += 1
+            if observer.game_status != "playing":
+                break
+        else:
+            await client.call("POST /games/{game_id}/manual-complete", "POST", f"/games/{game_id}/manual-complete", host)
+
+        await client.call("POST /games/{game_id}/generate-epilogue", "POST", f"/games/{game_id}/generate-epilogue", host)
+        # 動画はオペレーションとして生成されるので、オープニングとエピローグの両方が終わるのを待つ
+        await client.call("POST /games/{game_id}/generate-epilogue-video", "POST", f"/games/{game_id}/generate-epilogue-video", host)
+        await observer.wait_for(
+            lambda: all(observer.video_statuses.get(target) in ("ready", "failed") for target in ("opening", "epilogue")), TURN_TIMEOUT_SECONDS)
+        stats.opening_video_waits.append(await opening_video_wait)
+        await client.call("GET /games/{game_id}/log", "GET", f"/games/{game_id}/log", host)
+        stats.rooms_finished += 1
+    except Exception as e:
+        print(f"🚨 部屋{index}が失敗: {e}")
+        stats.rooms_failed.append(f"{index}: {e}")
+    finally:
+        observer.unsubscribe()
+        for status in observer.image_statuses.values():
+            stats.scene_images[status] += 1
+        for target, status in observer.video_statuses.items():
+            stats.videos[f"{target}:{status}"] += 1
+
+
+def print_report(result: dict):
+    print("\n=== 負荷試験結果 ===")
+    scenario = result.get("scenario")
+    if scenario:
+        mode = "同期呼び出し（従来）" if scenario["blockingGmChat"] else "非同期呼び出し"
+        print(f"シナリオ: {scenario['name']}  GMチャット同時 {scenario['gmChats']}件（{mode}） / ready {scenario['readyCalls']}回  経過 {result['elapsedSeconds']}s")
+    else:
+        print(f"部屋: 完了 {result['roomsFinished']} / 失敗 {len(result['roomsFailed'])}  経過 {result['elapsedSeconds']}s")
+        print(f"ターン: {result['turns']}  ({result['turnsPerSecond']} turns/sec)")
+        resolution = result["turnResolution"]
+        print(f"ターン解決（最後の行動→次ターン）: p50 {resolution['p50_ms']}ms / p95 {resolution['p95_ms']}ms / p99 {resolution['p99_ms']}ms")
+        opening = result["openingVideoWait"]
+        print(f"オープニング動画（最後の投票→完成）: p50 {opening['p50_ms']}ms / p95 {opening['p95_ms']}ms / p99 {opening['p99_ms']}ms")
+    print(f"\n{'endpoint':<42}{'count':>7}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in result["endpoints"].items():
+        print(f"{name:<42}{row['count']:>7}{row['errors']:>5}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    if result["sceneImages"]:
+        print("情景画像: " + " / ".join(f"{status} {count}" for status, count in sorted(result["sceneImages"].items())))
+    if result["videos"]:
+        print("動画: " + " / ".join(f"{status} {count}" for status, count in sorted(result["videos"].items())))
+    print("\nストア操作回数（合計 / 1ターンあたり）:")
+    for op, count in sorted(result["storeOps"].items()):
+        print(f"  {op:<22}{count:>9}{result['storeOpsPerTurn'].get(op, 0):>10}")
+
+
+async def start_app():
+    app.dependency_overrides[get_current_user_uid] = loadtest_uid
+    app.dependency_overrides[get_stream_user_uid] = loadtest_uid
+    startup_initialization(app)
+    # フェイク画像は本物のCloud Storageへ上げず、メモリ上のフェイクバケットに置く
+    app.state.storage_client = None
+    app.state.storage_bucket = FakeStorageBucket()
+    app.state.job_worker = JobWorker(app.state.job_queue, JOB_HANDLERS)
+    app.state.job_worker.start()
+
+
+async def run(rooms: int, max_turns: int) -> dict:
+    await start_app()
+    # 本番の起動時と同じくシナリオ候補のプールを補充し、最初の部屋の投票開始までに間に合わせる
+    prime_scenario_pool()
+    pool = app.state.scenario_pool
+    deadline = time.perf_counter() + 30
+    while pool and pool.count("normal") < SCENARIO_POOL_SIZE and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+
+    stats = Stats()
+    client = Client(stats)
+    app.state.game_store.reset_op_counts()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[run_room(client, stats, index, max_turns) for index in range(rooms)])
+    finally:
+        app.state.job_worker.stop()
+    return stats.summary(time.perf_counter() - started, app.state.game_store.op_counts())
+
+
+def loadtest_game(players: List[str], game_status: str) -> dict:
+    """エンドポイント単体の計測用に、ロビーからの進行を省いたゲームを作る"""
+    scenario = {"id": "loadtest-scenario", "title": "負荷試験の迷宮", "summary": "負荷試験用のシナリオ"}
+    return {
+        "roomId": f"loadtest-{players[0]}",
+        "hostId": players[0],
+        "gameStatus": game_status,
+        "players": {uid: {"name": uid, "characterName": f"勇者{uid[-1]}", "isReady": False} for uid in players},
+        "scenarioOptions": [scenario],
+        "decidedScenarioId": scenario["id"],
+        "currentTurn": 1,
+        "openingVideo": {"status": "generating"},
+    }
+
+
+def use_blocking_gm_chat():
+    """GMチャットのモデル呼び出しを、イベントループ上で同期的に待つ従来の呼び出し方に戻す（比較用）"""
+    for name in ("gemini", "gemini_lite"):
+        model = model_registry.get(name)
+        if model is None:
+            continue
+
+        async def generate_content_blocking(contents, _model=model, **kwargs):
+            return _model.generate_content(contents, **kwargs)
+
+        model.generate_content_async = generate_content_blocking
+
+
+async def run_ready_under_gm_chat(gm_chats: int, ready_calls: int, blocking: bool) -> dict:
+    """GMチャットを常に gm_chats 件処理中にしたまま POST /games/{id}/ready を ready_calls 回送る"""
+    await start_app()
+    if blocking:
+        use_blocking_gm_chat()
+    store = app.state.game_store
+    chat_players = [f"chat-{number}" for number in range(PLAYERS_PER_ROOM)]
+    ready_players = [f"ready-{number}" for number in range(PLAYERS_PER_ROOM)]
+    chat_game_id = store.create(loadtest_game(chat_players, "playing"))
+    ready_game_id = store.create(loadtest_game(ready_players, "ready"))
+
+    stats = Stats()
+    client = Client(stats)
+    done = asyncio.Event()
+
+    async def chat_loop(number: int):
+        uid = chat_players[number % PLAYERS_PER_ROOM]
+        count = 0
+        while not done.is_set():
+            count += 1
+            # 状況を尋ねる質問はキャッシュされないので、毎回モデルを呼ぶ
+            await client.call("POST /games/{game_id}/gm-chat", "POST", f"/games/{chat_game_id}/gm-chat", uid,
+                              {"message": f"{number}番目の通路の先には今何がいる？（{count}回目）"})
+
+    async def ready_loop():
+        # GMチャットが処理中になるのを待ってから計測を始める
+        await asyncio.sleep(0.5 if gm_chats else 0)
+        for number in range(ready_calls):
+            await client.call("POST /games/{game_id}/ready", "POST", f"/games/{ready_game_id}/ready", ready_players[number % PLAYERS_PER_ROOM])
+            await asyncio.sleep(0.01)
+        done.set()
+
+    started = time.perf_counter()
+    chats = [asyncio.ensure_future(chat_loop(number)) for number in range(gm_chats)]
+    try:
+        await ready_loop()
+        await asyncio.gather(*chats)
+    finally:
+        app.state.job_worker.stop()
+    result = stats.summary(time.perf_counter() - started, store.op_counts())
+    result["scenario"] = {"name": "ready-under-gm-chat", "gmChats": gm_chats, "readyCalls": ready_calls, "blockingGmChat": blocking}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TRPGターン処理パイプラインの負荷試験")
+    parser.add_argument("--rooms", type=int, default=10, help="同時に進行させる4人部屋の数")
+    parser.add_argument("--max-turns", type=int, default=20, help="これを超えたら手動完了させるターン数")
+    parser.add_argument("--json", help="結果をJSONで書き出すパス")
+    parser.add_argument("--scenario", choices=["rooms", "ready-under-gm-chat"], default="rooms", help="実行するシナリオ")
+    parser.add_argument("--gm-chats", type=int, default=20, help="ready-under-gm-chat: 常に処理中にしておくGMチャットの数")
+    parser.add_argument("--ready-calls", type=int, default=200, help="ready-under-gm-chat: POST /ready を送る回数")
+    parser.add_argument("--blocking-gm-chat", action="store_true", help="ready-under-gm-chat: GMチャットのモデル呼び出しを同期版に差し替える（従来の挙動との比較用）")
+    args = parser.parse_args()
+
+    if args.scenario == "ready-under-gm-chat":
+        result = asyncio.run(run_ready_under_gm_chat(args.gm_chats, args.ready_calls, args.blocking_gm_chat))
+    else:
+        result = asyncio.run(run(args.rooms, args.max_turns))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n📄 結果を書き出しました: {args.json}")
+
+
+if __name__ == "__main__":
+    main()
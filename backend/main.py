@@ -1,37 +1,55 @@
 import os
 import random
 import string
-import json
 import uuid
-import base64
-import io
+import threading
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from collections import Counter
 from datetime import datetime
+from typing import Optional
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, status, Header, Body, BackgroundTasks, Request, Query
+from fastapi import FastAPI, HTTPException, Depends, status, Header, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
 import uvicorn
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
-from google.cloud.firestore_v1.transaction import Transaction
-from google.cloud.firestore_v1.base_query import FieldFilter
 from google.cloud import storage
 
 import vertexai
 from vertexai.generative_models import GenerativeModel, GenerationConfig, HarmCategory, HarmBlockThreshold, Tool, FunctionDeclaration, Part
 from vertexai.preview.vision_models import ImageGenerationModel
-import google.generativeai as genai
-try:
-    # Vertex AI認証でgoogle.generativeaiを使用
-    GOOGLE_GENAI_AVAILABLE = True
-    print("✅ google.generativeai ライブラリが利用可能です")
-except ImportError:
-    GOOGLE_GENAI_AVAILABLE = False
-    print("⚠️ google.generativeai ライブラリが利用できません。pip install google-generativeai を実行してください。")
 
-from models import Game, Player, ScenarioOption, GameLog
+from models import GameLog
+from game_log import stage_log_entries, LOG_PAGE_SIZE, MAX_LOG_PAGE_SIZE
+from game_events import stage_game_events, events_for_update, client_snapshot, EVENT_COLLECTION
+from game_store import GameTransaction, create_game_store
+from conversation import build_turn_delta, append_turn_delta
+from history import history_manager, estimate_tokens
+from model_registry import model_registry, VeoHandle
+from fake_models import register_fake_models
+from turn_stream import TURN_STREAM_COLLECTION, TURN_STREAM_DOC_ID, RelayedStreamReader, turn_stream_hub, format_sse
+from gm_output import GM_RESPONSE_SCHEMA, GMOutputParser, parse_gm_output
+from job_queue import Reschedule, create_job_queue, public_job
+from worker import JobWorker
+from scenario_pool import DIFFICULTY_SETTINGS, SCENARIO_POOL_REFILL_WINDOW_SECONDS, SCENARIO_POOL_SIZE, create_scenario_pool, normalize_difficulty, parse_scenario_ideas, scenario_prompt, with_new_ids
+from objectives import PROGRESS_FIELD, ending_type_for, objective_matcher, progress_prompt_line, track_objectives
+from dice_odds import odds_summary, success_probability, warm_probability_tables
+from dice import DiceError, dice_rng, format_roll, game_dice_rng, parse_dice_expression, roll_expression
+from metrics import MetricsMiddleware, PROMETHEUS_AVAILABLE, StageTimer, observe_stage, record_cache_lookup, record_fallback, render_metrics, stage_timer
+from media_cache import create_media_cache
+from video_operations import (OPERATION_FAILED, OPERATION_RUNNING, OPERATION_SUCCEEDED, VideoOperationStatus, build_genai_video_operations,
+                              is_timed_out, new_operation_record, next_poll_delay, operation_elapsed_seconds, operation_job_id, polled_record,
+                              public_storage_url, split_gcs_uri)
+from scene_images import IMAGE_FAILED, IMAGE_PENDING, IMAGE_READY, IMAGE_SKIPPED, SCENE_IMAGES_ENABLED, SCENE_IMAGE_RECOVERY_SECONDS, scene_image_scheduler
+from gm_chat_cache import CACHE_NAME as GM_CHAT_CACHE_NAME, cache_key, classify_question, gm_chat_cache, rules_prompt
+from usage import BUDGET_FIELD, UsageTracker, budget_exceeded, game_usage_report, usage_totals
+from turn_lease import TurnLeaseLost, acquire_turn_lease, lease_guard, lease_is_active, lease_update, new_lease_owner, release_turn_lease, release_update, turn_ready_to_resolve, verify_lease
 
 # --- 能力値修正計算関数 ---
 def calculate_ability_modifier(ability_score: int) -> int:
@@ -41,7 +59,9 @@ def calculate_ability_modifier(ability_score: int) -> int:
 def get_player_ability_modifier(game_data: dict, player_id: str, ability_name: str) -> int:
     """プレイヤーの指定された能力値の修正値を取得"""
     try:
-        player = game_data.get('players', {}).get(player_id, {})
+        players = game_data.get('players', {})
+        # GMモデルはプレイヤーIDを知らないため、キャラクター名での指定も受け付ける
+        player = players.get(player_id) or next((p for p in players.values() if p.get('characterName') == player_id), {})
         abilities = player.get('abilities', {})
         ability_score = abilities.get(ability_name, 10)  # デフォルト値10
         return calculate_ability_modifier(ability_score)
@@ -49,10 +69,10 @@ def get_player_ability_modifier(game_data: dict, player_id: str, ability_name: s
         return 0  # エラー時は修正値0
 
 # --- ダイスロール関数の定義 ---
-def roll_dice(num_dice: int, num_sides: int, game_data: dict = None, player_id: str = None, ability_name: str = None) -> dict:
+def roll_dice(num_dice: int = None, num_sides: int = None, game_data: dict = None, player_id: str = None, ability_name: str = None, expression: str = None, dc: int = None, rng=None) -> dict:
     """
-    指定された数のダイスを振り、それぞれの出目を返します。
-    能力値修正も適用可能です。
+    ダイス式（例: 2d6+dex, 4d6kh3, 1d20 adv, exploding d6）を振り、出目と合計値を返します。
+    式が無い場合は num_dice / num_sides（と ability_name）から式を組み立てます。
     例: 2d6 (num_dice=2, num_sides=6)
 
     Args:
@@ -61,44 +81,66 @@ def roll_dice(num_dice: int, num_sides: int, game_data: dict = None, player_id:
         game_data: ゲームデータ（能力値修正のため）
         player_id: プレイヤーID（能力値修正のため）
         ability_name: 能力値名（strength, dexterity等）
+        expression: ダイス式
+        dc: 目標値（指定すると成否と、振る前の成功率も返す）
+        rng: 乱数生成器（dice.game_dice_rng で作ったもの。省略時はランダム）
 
     Returns:
         各ダイスの出目のリストと合計値を含む辞書。
-        例: {"rolls": [3, 5], "total": 8, "modifier": 2, "final_total": 10}
+        例: {"expression": "2d6+dexterity", "rolls": [3, 5], "total": 8, "modifier": 2, "final_total": 10}
     """
-    if not (isinstance(num_dice, int) and num_dice > 0):
-        return {"error": "振るダイスの数 (num_dice) は1以上の整数である必要があります。"}
-    if not (isinstance(num_sides, int) and num_sides > 0):
-        return {"error": "ダイスの面数 (num_sides) は1以上の整数である必要があります。"}
-    
-    rolls = [random.randint(1, num_sides) for _ in range(num_dice)]
-    total = sum(rolls)
-    
-    # 能力値修正を計算
-    modifier = 0
-    if game_data and player_id and ability_name:
-        modifier = get_player_ability_modifier(game_data, player_id, ability_name)
-    
-    final_total = total + modifier
-    
-    modifier_text = f" + {modifier}" if modifier > 0 else f" {modifier}" if modifier < 0 else ""
-    print(f"🎲 ダイスロール実行: {num_dice}d{num_sides}{modifier_text} -> {rolls} (ダイス計: {total}, 修正: {modifier}, 最終: {final_total})")
-    
-    result = {"rolls": rolls, "total": total, "final_total": final_total}
-    if modifier != 0:
-        result["modifier"] = modifier
-        result["ability_used"] = ability_name
-    
+    if not expression:
+        # Function Callingの引数は数値がfloatで渡ることがある
+        if isinstance(num_dice, float) and num_dice.is_integer(): num_dice = int(num_dice)
+        if isinstance(num_sides, float) and num_sides.is_integer(): num_sides = int(num_sides)
+        if not (isinstance(num_dice, int) and num_dice > 0):
+            return {"error": "振るダイスの数 (num_dice) は1以上の整数である必要があります。"}
+        if not (isinstance(num_sides, int) and num_sides > 0):
+            return {"error": "ダイスの面数 (num_sides) は1以上の整数である必要があります。"}
+        expression = f"{num_dice}d{num_sides}" + (f"+{ability_name}" if ability_name else "")
+
+    try:
+        parsed = parse_dice_expression(expression)
+    except DiceError as e:
+        return {"error": str(e)}
+
+    ability_modifier = None
+    if game_data and player_id:
+        ability_modifier = lambda ability: get_player_ability_modifier(game_data, player_id, ability)
+    result = roll_expression(parsed, rng or dice_rng(random.random()), ability_modifier)
+    if dc is not None:
+        dc = int(dc)
+        result["dc"] = dc
+        result["success"] = result["final_total"] >= dc
+        result["success_probability"] = round(success_probability(parsed, dc, result.get("modifier", 0)), 4)
     return result
 
+def check_dice_odds(expression: str, dc: int = None, game_data: dict = None, player_id: str = None) -> dict:
+    """
+    ダイス式の成功率を、実際には振らずに確率表から返す（モデルの呼び出しは発生しない）。
+    dc を省略した場合は代表的な目標値ごとの成功率の一覧を返す。
+    """
+    try:
+        parsed = parse_dice_expression(expression)
+    except DiceError as e:
+        return {"error": str(e)}
+    ability_modifier = None
+    if game_data and player_id:
+        ability_modifier = lambda ability: get_player_ability_modifier(game_data, player_id, ability)
+    return odds_summary(parsed, parsed.modifier(ability_modifier), None if dc is None else int(dc))
+
 # --- Function Declaration（Geminiにツールとして認識させるため） ---
 # 最新のVertex AI SDK用に修正
 roll_dice_declaration = FunctionDeclaration(
     name="roll_dice",
-    description="指定された数と種類のダイスを振り、出目と合計値を返します。プレイヤーの行動が成功したか失敗したかを判定するために使います。能力値判定の場合は該当する能力値名を指定すると修正値が自動適用されます。例: 鍵開け判定なら1d20+dexterity、ダメージなら2d6など。",
+    description="ダイスを振り、出目と合計値を返します。プレイヤーの行動が成功したか失敗したかを判定するために使います。expression にダイス式を指定してください（能力値名を含めると該当プレイヤーの修正値が自動適用されます）。例: 鍵開け判定なら1d20+dex、有利なら1d20+dex adv、ダメージなら2d6+3など。",
     parameters={
         "type": "object",
         "properties": {
+            "expression": {
+                "type": "string",
+                "description": "ダイス式。NdS、固定値、能力値（str/dex/con/int/wis/cha）を+/-でつなぐ。4d6kh3（大きい3個を保持）、1d20 adv / dis（有利・不利）、exploding d6 または 1d6!（最大値で振り足し）に対応"
+            },
             "num_dice": {
                 "type": "integer", 
                 "description": "振るダイスの数 (例: 2d6の'2')"
@@ -109,7 +151,11 @@ roll_dice_declaration = FunctionDeclaration(
             },
             "player_id": {
                 "type": "string",
-                "description": "判定を行うプレイヤーのID（能力値修正を適用する場合）"
+                "description": "判定を行うプレイヤーのキャラクター名（能力値修正を適用する場合）"
+            },
+            "dc": {
+                "type": "integer",
+                "description": "目標値（難易度）。指定すると成否と振る前の成功率が返ります"
             },
             "ability_name": {
                 "type": "string",
@@ -117,7 +163,7 @@ roll_dice_declaration = FunctionDeclaration(
                 "enum": ["strength", "dexterity", "constitution", "intelligence", "wisdom", "charisma"]
             }
         },
-        "required": ["num_dice", "num_sides"]
+        "required": []
     }
 )
 
@@ -139,12 +185,14 @@ def check_scenario_completion(current_situation: str, completed_objectives: str,
         
         # 完了率の計算（プロンプトから指定されるか、従来方式でフォールバック）
         if completion_percentage is None:
-            # フォールバック：従来のキーワードマッチング方式
+            # フォールバック：達成済みの文言を主要目標とあいまい照合する
             if not primary_list:
                 return {"error": "主要目標が設定されていません"}
             
+            matched = objective_matcher(tuple(primary_list)).match_claims(completed_list)
+            completed_list = [primary_list[index] for index in matched]
             completion_percentage = len(completed_list) / len(primary_list) * 100.0
-            print(f"⚠️ フォールバック：キーワードマッチング完了率 {completion_percentage:.1f}%")
+            print(f"⚠️ フォールバック：目標照合による完了率 {completion_percentage:.1f}%")
         else:
             print(f"✅ プロンプトベース完了率: {completion_percentage:.1f}%")
         
@@ -157,21 +205,7 @@ def check_scenario_completion(current_situation: str, completed_objectives: str,
             print(f"✅ プロンプトベース完了判定: {is_completed}")
         
         # 終了タイプ判定
-        if force_ending:
-            if completion_percentage >= 50.0:
-                ending_type = "tragic_success"  # 悲劇的成功（目標は達成したが代償が大きい）
-            else:
-                ending_type = "disaster"  # 完全な失敗
-        else:
-            # 通常の成功判定
-            if completion_percentage >= 95.0:
-                ending_type = "great_success"
-            elif completion_percentage >= 75.0:
-                ending_type = "success"
-            elif completion_percentage >= 50.0:
-                ending_type = "failure"
-            else:
-                ending_type = "disaster"
+        ending_type = ending_type_for(completion_percentage, force_ending)
         
         # 残り目標を計算
         remaining_objectives = [obj for obj in primary_list if obj not in completed_list]
@@ -230,15 +264,177 @@ check_completion_declaration = FunctionDeclaration(
 )
 
 # ツール定義（ダイスロールと終了判定）
-scenario_tools = Tool(function_declarations=[roll_dice_declaration, check_completion_declaration])
+check_dice_odds_declaration = FunctionDeclaration(
+    name="check_dice_odds",
+    description="ダイスを振らずに、判定の成功率（合計が目標値以上になる確率）を返します。難易度を決めるときや、プレイヤーにとってどのくらい難しい判定かを確かめるときに使います。",
+    parameters={
+        "type": "object",
+        "properties": {
+            "expression": {
+                "type": "string",
+                "description": "ダイス式（roll_dice と同じ書式。例: 1d20+dex adv）"
+            },
+            "dc": {
+                "type": "integer",
+                "description": "目標値。省略すると代表的な目標値ごとの成功率の一覧を返します"
+            },
+            "player_id": {
+                "type": "string",
+                "description": "判定を行うプレイヤーのキャラクター名（能力値修正を適用する場合）"
+            }
+        },
+        "required": ["expression"]
+    }
+)
+
+# シナリオの完了はターンごとにサーバー側で追跡するため、モデルによる終了判定ツールは任意（既定では提供しない）
+SCENARIO_COMPLETION_TOOL_ENABLED = os.getenv("SCENARIO_COMPLETION_TOOL_ENABLED", "false").lower() == "true"
+scenario_tools = Tool(function_declarations=[roll_dice_declaration, check_dice_odds_declaration] + ([check_completion_declaration] if SCENARIO_COMPLETION_TOOL_ENABLED else []))
+
+# --- GMターンの関数呼び出しの実行 ---
+# 1回の応答に含まれる関数呼び出しは互いに独立しているので並列に実行し、結果をまとめてモデルに返す。
+# 攻撃→ダメージのような連続した判定のため、この往復を GM_MAX_TOOL_ROUNDS 回まで繰り返す。
+# ダイスロールのログは溜めておき、ターン確定の書き込みで一度に保存する。
+GM_MAX_TOOL_ROUNDS = int(os.getenv("GM_MAX_TOOL_ROUNDS", "3"))
+GM_TOOL_WORKERS = int(os.getenv("GM_TOOL_WORKERS", "4"))
+# GMターン自体が blocking_executor 上で動くことがあるため、待ち合わせで詰まらないよう別のプールを使う
+gm_tool_executor = ThreadPoolExecutor(max_workers=GM_TOOL_WORKERS, thread_name_prefix="gm-tool")
+TOOL_LIMIT_MESSAGE = "このターンの関数呼び出しの上限に達しました。ここまでの結果を踏まえて、指定のJSON形式で応答してください。"
+
+def execute_gm_tool_call(name: str, args: dict, game_data: dict, rng=None) -> dict:
+    """
+    関数呼び出しを1件実行する。
+    {"name", "response"（モデルに返す内容）, "log"（ダイスロールのログ）, "tool_result"（会話差分に残す要約）, "completion"} を返す。
+    """
+    outcome = {"name": name, "response": None, "log": None, "tool_result": None, "completion": None}
+    try:
+        if name == "roll_dice":
+            dice_results = roll_dice(**args, game_data=game_data, rng=rng)
+            if dice_results.get('error'):
+                log_content = f"ダイスロールエラー: {dice_results.get('error')}"
+            else:
+                log_content = format_roll(dice_results)
+            print(f"🎲 {log_content}")
+            outcome.update(response=dice_results, log=log_content, tool_result=log_content)
+        elif name == "check_dice_odds":
+            # 確率表を引くだけなので、ログには残さずモデルに返す
+            odds = check_dice_odds(game_data=game_data, **args)
+            print(f"📐 成功率: {odds.get('expression')} DC{odds.get('dc', '-')} -> {odds.get('probability', odds.get('error'))}")
+            outcome["response"] = odds
+        elif name == "check_scenario_completion":
+            print(f"🎯 終了判定実行中...")
+            completion_result = check_scenario_completion(**args)
+            print(f"📊 終了判定結果: {completion_result}")
+            if not completion_result.get('error'):
+                outcome["tool_result"] = f"{completion_result.get('completion_percentage', 0):.0f}% ({completion_result.get('ending_type')})"
+            if completion_result.get('is_completed'):
+                if completion_result.get('error'):
+                    # エラーがあってもis_completedがtrueなら完了とする
+                    print(f"⚠️ エラーがありますが、is_completed=trueのため完了処理を実行")
+                outcome["completion"] = {**completion_result, "end_reason": "tool"}
+            # Function Response はシンプルな形式で返す
+            outcome["response"] = {
+                "completion_percentage": completion_result.get("completion_percentage", 0),
+                "is_completed": completion_result.get("is_completed", False),
+                "ending_type": completion_result.get("ending_type", "ongoing")
+            }
+        else:
+            print(f"⚠️ 未知の関数呼び出し: {name}")
+            outcome["response"] = {"error": f"Unknown function: {name}"}
+    except Exception as e:
+        print(f"🚨 関数 {name} の実行エラー: {e}")
+        outcome["response"] = {"error": str(e)}
+    return outcome
+
+def run_gm_tool_round(function_calls: list, game_id: str, game_data: dict, turn: int, dice_roll_index: int) -> list:
+    """
+    1往復分の関数呼び出しを並列に実行し、呼び出し順の結果を返す。
+    ダイスの乱数は実行順に依らないよう呼び出し順にあらかじめ割り当てる（同じターンの再実行で同じ出目）。
+    """
+    tasks = []
+    for function_call in function_calls:
+        rng = None
+        if function_call.name == "roll_dice":
+            rng = game_dice_rng(game_id, "turn", turn, dice_roll_index)
+            dice_roll_index += 1
+        tasks.append((function_call.name, dict(function_call.args), game_data, rng))
+    if len(tasks) == 1:
+        return [execute_gm_tool_call(*tasks[0])]
+    return list(gm_tool_executor.map(lambda task: execute_gm_tool_call(*task), tasks))
+
+# --- モデルレジストリへの登録 ---
+# vertex: Vertex AI / fake: 負荷試験用のフェイクモデル（fake_models.py）
+MODEL_PROVIDER = os.getenv("MODEL_PROVIDER", "vertex")
+# 管理API（トークン使用量の確認、予算設定）を使えるユーザーのUID（カンマ区切り）
+ADMIN_UIDS = {admin_uid.strip() for admin_uid in os.getenv("ADMIN_UIDS", "").split(",") if admin_uid.strip()}
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+# ゲームの予算超過時に使う安価なモデル
+GEMINI_LITE_MODEL_NAME = os.getenv("GEMINI_LITE_MODEL_NAME", "gemini-2.5-flash-lite")
+IMAGEN_MODEL_NAME = "imagen-4.0-fast-generate-001"
+VEO_OPERATIONS_MODEL_NAME = "veo-3.0-generate-001"
+
+def build_veo_handle() -> VeoHandle:
+    """Veo 3.0を優先し、利用できない場合はVeo 1にフォールバックする"""
+    try:
+        from vertexai.preview.generative_models import GenerativeModel as PreviewGenerativeModel
+        return VeoHandle(PreviewGenerativeModel("veo-3.0-generate-001"), "veo-3.0-generate-001")
+    except ImportError as veo_import_error:
+        print(f"⚠️ Veo 3.0インポートエラー: {veo_import_error}")
+        from vertexai.preview.vision_models import VideoGenerationModel
+        return VeoHandle(VideoGenerationModel.from_pretrained("veo-001"), "veo-001")
+
+def register_models(project_id: str, location: str):
+    """vertexai.init() 済みのプロセスで使うモデルのファクトリを登録する"""
+    model_registry.register("gemini", lambda: GenerativeModel(GEMINI_MODEL_NAME))
+    # Function Callingツール付き（ダイスロールと終了判定）
+    model_registry.register("gemini_tools", lambda: GenerativeModel(GEMINI_MODEL_NAME, tools=[scenario_tools]))
+    model_registry.register("gemini_lite", lambda: GenerativeModel(GEMINI_LITE_MODEL_NAME))
+    model_registry.register("gemini_tools_lite", lambda: GenerativeModel(GEMINI_LITE_MODEL_NAME, tools=[scenario_tools]))
+    model_registry.register("imagen", lambda: ImageGenerationModel.from_pretrained(IMAGEN_MODEL_NAME))
+    model_registry.register("veo", build_veo_handle)
+    # 動画生成を長時間実行オペレーションとして依頼・確認するクライアント（google-genai が無ければ同期生成のみ）
+    model_registry.register("veo_operations", lambda: build_genai_video_operations(project_id, location, VEO_OPERATIONS_MODEL_NAME))
+
+def select_text_model(game_data: Optional[dict], tools: bool = False, phase: str = "") -> tuple:
+    """
+    ゲームに使うテキストモデルとモデル名を返す。
+    予算を超過したゲームは安価なモデルに切り替える（使えなければ通常のモデルのまま）。
+    """
+    name = "gemini_tools" if tools else "gemini"
+    if budget_exceeded(game_data):
+        lite_model = model_registry.get(f"{name}_lite")
+        if lite_model is not None:
+            record_fallback("budget_exceeded", phase)
+            return lite_model, GEMINI_LITE_MODEL_NAME
+    return model_registry.get(name), GEMINI_MODEL_NAME
+
+def warm_up_models():
+    """最初のターンでコールドスタートの待ち時間が発生しないよう、軽いリクエストを送っておく"""
+    elapsed = model_registry.warm_up(
+        "gemini_tools",
+        lambda model: model.generate_content("ping", generation_config=GenerationConfig(max_output_tokens=1))
+    )
+    if elapsed is not None:
+        print(f"🔥 Geminiウォームアップ完了: {elapsed * 1000:.0f}ms")
+
+JOB_WORKER_IN_PROCESS = os.getenv("JOB_WORKER_IN_PROCESS", "true").lower() == "true"
 
 # --- アプリケーションのライフサイクルイベント ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     startup_initialization(app)
+    print(f"🎲 ダイスの確率表を準備しました: {warm_probability_tables() * 1000:.1f}ms")
+    # 別プロセスのワーカー（worker.py）を使わない構成では、このプロセス内でジョブを処理する
+    app.state.job_worker = None
+    if JOB_WORKER_IN_PROCESS and app.state.job_queue:
+        app.state.job_worker = JobWorker(app.state.job_queue, JOB_HANDLERS)
+        app.state.job_worker.start()
+    prime_scenario_pool()
     yield
-    # Shutdown (何も必要なければ空)
+    # Shutdown
+    if app.state.job_worker:
+        app.state.job_worker.stop()
 
 def startup_initialization(app: FastAPI):
     """アプリケーション起動時の初期化処理"""
@@ -252,6 +448,10 @@ def startup_initialization(app: FastAPI):
             firebase_admin.initialize_app(cred)
             print("Firebase Admin SDKを新規に初期化しました")
         app.state.db = firestore.client()
+        app.state.game_store = create_game_store(app.state.db)
+        app.state.job_queue = create_job_queue(app.state.db)
+        app.state.scenario_pool = create_scenario_pool(app.state.db)
+        app.state.media_cache = create_media_cache(app.state.db)
         
         # Cloud Storageクライアントの初期化
         try:
@@ -265,60 +465,65 @@ def startup_initialization(app: FastAPI):
             app.state.storage_bucket = None
             print(f"警告: Cloud Storageの初期化に失敗しました: {e}")
         
-        if PROJECT_ID and LOCATION:
-            try:
-                vertexai.init(project=PROJECT_ID, location=LOCATION)
-                app.state.gemini_model = GenerativeModel("gemini-2.5-flash")
-                print("✅ Gemini 2.5 Flash初期化完了")
-            except Exception as e:
-                print(f"❌ Gemini初期化失敗: {e}")
-                app.state.gemini_model = None
-            # --- Imagenモデルの初期化 (新しいモデルに変更) ---
-            try:
-                app.state.imagen_model = ImageGenerationModel.from_pretrained("imagen-4.0-fast-generate-001")
-                print("Imagen 4.0モデルの初期化完了")
-            except Exception as e:
-                app.state.imagen_model = None
-                import traceback
-                print(f"警告: Imagenモデルの初期化に失敗しました: {type(e).__name__}: {e}")
-                print(f"🔍 初期化エラーのスタックトレース: {traceback.format_exc()}")
-            
-            # --- Veoモデルの初期化 ---
-            try:
-                # 最新のVertex AI Veo実装方法（GenerativeModel使用）
-                if GOOGLE_GENAI_AVAILABLE:
-                    import google.generativeai as genai
-                    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-                    # Veo 2モデルを使用
-                    app.state.veo_client = genai.GenerativeModel("publishers/google/models/veo-2.0-generate-001")
-                    app.state.veo_model_name = "veo-2.0-generate-001"
-                    app.state.veo_model = None  # 互換性のため
-                    print("✅ Vertex AI Veo 2初期化成功")
-                else:
-                    raise ImportError("google.generativeai が利用できません")
-            except Exception as e:
-                print(f"⚠️ Veo初期化失敗: {e}")
-                print("Veoは限定プレビューのため利用できない可能性があります")
-                app.state.veo_model = None
-                app.state.veo_client = None
-                app.state.veo_model_name = None
-            # ----------------------------------------
-            print("Vertex AI SDKの初期化完了")
-        else:
-            app.state.gemini_model = None
-            app.state.imagen_model = None
-            app.state.veo_client = None
-            app.state.veo_model = None
-            app.state.veo_model_name = None
-            print("警告: Vertex AIは初期化されません。")
     except Exception as e:
         print(f"初期化中にエラー: {e}")
         app.state.db = None
+        app.state.game_store = create_game_store()
+        app.state.job_queue = create_job_queue()
+        app.state.scenario_pool = create_scenario_pool()
+        app.state.media_cache = create_media_cache()
+        app.state.storage_client = None
+        app.state.storage_bucket = None
+    # 生成途中のナレーションを、SSEの接続先が別のプロセスでも届くよう保存先経由で中継する
+    turn_stream_hub.relay = relay_turn_stream if app.state.game_store else None
+    initialize_models(app, PROJECT_ID, LOCATION)
+
+def initialize_models(app: FastAPI, project_id: Optional[str], location: Optional[str]):
+    """モデルレジストリを初期化し、起動時に共有するハンドルを app.state に載せる"""
+    if MODEL_PROVIDER == "fake":
+        # 負荷試験用: 課金されるAPIを呼ばないフェイクモデルを本番と同じ名前で登録する
+        register_fake_models(GEMINI_MODEL_NAME, GEMINI_LITE_MODEL_NAME, completion_tool=SCENARIO_COMPLETION_TOOL_ENABLED)
+        print("🧪 フェイクモデルプロバイダーを使用します（MODEL_PROVIDER=fake）")
+    elif project_id and location:
+        # vertexai.init() とモデル生成はプロセスで一度だけ行い、以降はレジストリのハンドルを共有する
+        try:
+            vertexai.init(project=project_id, location=location)
+            register_models(project_id, location)
+        except Exception as e:
+            print(f"❌ Vertex AI初期化失敗: {e}")
+    else:
         app.state.gemini_model = None
         app.state.imagen_model = None
         app.state.veo_client = None
         app.state.veo_model = None
         app.state.veo_model_name = None
+        print("警告: Vertex AIは初期化されません。")
+        return
+
+    build_results = model_registry.build_all()
+    print(f"✅ モデルレジストリ初期化: {build_results}")
+
+    app.state.gemini_model = model_registry.get("gemini")
+    app.state.imagen_model = model_registry.get("imagen")
+    if not app.state.imagen_model:
+        print(f"警告: Imagenモデルの初期化に失敗しました: {model_registry.error('imagen')}")
+
+    veo_handle = model_registry.get("veo")
+    if veo_handle:
+        app.state.veo_client = veo_handle.client
+        app.state.veo_model_name = veo_handle.model_name
+        app.state.veo_model = True
+        print(f"✅ Vertex AI Veo初期化成功: {veo_handle.model_name}")
+    else:
+        print(f"⚠️ Veo初期化失敗: {model_registry.error('veo')}")
+        print("Veoは限定プレビューのため利用できない可能性があります")
+        app.state.veo_model = None
+        app.state.veo_client = None
+        app.state.veo_model_name = None
+
+    # ウォームアップは起動をブロックしないよう別スレッドで実行
+    threading.Thread(target=warm_up_models, daemon=True).start()
+    print("Vertex AI SDKの初期化完了")
 
 # FastAPIアプリケーションの初期化
 app = FastAPI(lifespan=lifespan)
@@ -340,6 +545,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 全エンドポイントの処理時間を計測する（/metrics で公開）
+app.add_middleware(MetricsMiddleware)
 
 # --- リクエストボディモデル ---
 class VoteRequest(BaseModel): scenarioId: str
@@ -350,8 +557,10 @@ class CreateCharacterRequest(BaseModel):
 class ActionRequest(BaseModel): actionText: str
 
 class ManualDiceRequest(BaseModel):
-    num_dice: int
-    num_sides: int
+    num_dice: int = 1
+    num_sides: int = 20
+    expression: Optional[str] = None  # ダイス式（例: "2d6+dex", "1d20 adv"）。指定時は num_dice / num_sides より優先
+    dc: Optional[int] = None  # 目標値（指定すると成否と成功率も返す）
     description: str = ""  # ダイスロールの説明（例: "鍵開け判定", "攻撃ロール"）
 
 class GMChatRequest(BaseModel):
@@ -364,26 +573,51 @@ class StartVotingRequest(BaseModel):
     opening_video_enabled: bool = True  # オープニング動画の有効/無効
     epilogue_video_enabled: bool = False  # エピローグ動画の有効/無効
 
+class UsageBudgetRequest(BaseModel):
+    maxTokens: int = 0  # 0は無制限
+    maxCostUsd: float = 0.0  # 0は無制限
+
 # --- 認証ヘルパー ---
 async def get_current_user_uid(authorization: str = Header(...)):
     try: return auth.verify_id_token(authorization.split("Bearer ")[1])['uid']
     except Exception as e: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Invalid token: {e}")
 
+# SSE用: EventSourceはヘッダーを付けられないため、クエリパラメータのトークンも受け付ける
+async def get_stream_user_uid(authorization: Optional[str] = Header(None), token: Optional[str] = Query(None)):
+    id_token = authorization.split("Bearer ")[1] if authorization and "Bearer " in authorization else token
+    if not id_token: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing token")
+    try: return auth.verify_id_token(id_token)['uid']
+    except Exception as e: raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f"Invalid token: {e}")
+
+async def require_admin_uid(uid: str = Depends(get_current_user_uid)):
+    if uid not in ADMIN_UIDS: raise HTTPException(status_code=403, detail="Admin only")
+    return uid
+
 # テスト用認証バイパス
 async def get_test_user_uid():
     return "test_player_1"
 
 # --- ヘルパー関数 ---
+# 同期APIしか持たないクライアント（Firestore、Cloud Storage、Imagen、Veo）を
+# イベントループの外で実行するための上限付きスレッドプール
+BLOCKING_IO_WORKERS = int(os.getenv("BLOCKING_IO_WORKERS", "32"))
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+
+async def run_blocking(func, *args, **kwargs):
+    """同期呼び出しを専用スレッドプールで実行し、イベントループを止めずに結果を待つ"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
 def generate_room_id():
     return ''.join(random.choices(string.digits, k=6))
 
-def upload_image_to_storage(image_bytes: bytes, storage_bucket, filename: str) -> str:
+def upload_image_to_storage(image_bytes: bytes, storage_bucket, filename: str, content_type: str = 'image/png') -> str:
     """
-    画像データをCloud Storageにアップロードし、公開URLを返す
+    画像（または動画）データをCloud Storageにアップロードし、公開URLを返す
     """
     try:
         blob = storage_bucket.blob(filename)
-        blob.upload_from_string(image_bytes, content_type='image/png')
+        blob.upload_from_string(image_bytes, content_type=content_type)
         
         # ブロブを公開可能にする
         blob.make_public()
@@ -395,124 +629,109 @@ def upload_image_to_storage(image_bytes: bytes, storage_bucket, filename: str) -
         print(f"Cloud Storageアップロードエラー: {e}")
         raise e
 
-# --- ヘルパー関数：Veo動画生成 ---
-import asyncio
-async def generate_epilogue_video(scenario_title: str, ending_type: str, player_highlights: list, completion_percentage: float, game_id: str) -> str:
+def publish_storage_uri(uri: str) -> str:
     """
-    エピローグのハイライト動画を生成し、Cloud Storage URLを返す
+    Veoが書き出した gs:// の動画を公開し、フロントエンドで再生できる公開URLを返す。
+    公開に失敗した場合（別プロジェクトのバケットなど）は、公開済みであることを前提にURLだけ変換する。
     """
-    try:
-        # 環境変数から取得
-        PROJECT_ID = os.getenv("PROJECT_ID")
-        LOCATION = os.getenv("LOCATION")
-        
-        # Veo クライアント初期化
-        veo_model = None
-        veo_client = None
-        veo_model_name = None
-        
+    parts = split_gcs_uri(uri)
+    if not parts:
+        return uri
+    storage_client = getattr(app.state, 'storage_client', None)
+    if storage_client:
         try:
-            if PROJECT_ID and LOCATION:
-                # Vertex AI Veo初期化
-                vertexai.init(project=PROJECT_ID, location=LOCATION)
-                
-                # Veo 3.0を最優先で試行（成功していた方法）
-                try:
-                    from vertexai.preview.generative_models import GenerativeModel
-                    veo_client = GenerativeModel("veo-3.0-generate-001")  # モデル名のみ3.0に変更
-                    veo_model_name = "veo-3.0-generate-001"
-                    veo_model = True
-                    print("✅ エピローグ動画用 Vertex AI Veo 3.0初期化成功")
-                except ImportError:
-                    # フォールバック: Veo 1
-                    from vertexai.preview.vision_models import VideoGenerationModel
-                    veo_client = VideoGenerationModel.from_pretrained("veo-001")
-                    veo_model_name = "veo-001"
-                    veo_model = True
-                    print("✅ エピローグ動画用 Vertex AI Veo 1初期化成功 (フォールバック)")
-            else:
-                raise ImportError("PROJECT_ID または LOCATION が設定されていません")
+            blob = storage_client.bucket(parts[0]).blob(parts[1])
+            blob.make_public()
+            return blob.public_url
         except Exception as e:
-            print(f"❌ エピローグ Veo初期化エラー: {e}")
-            print("Veoは限定プレビューのため利用できない可能性があります")
-            return None
-            
-        if not veo_model and not veo_client:
-            print("Veoモデルまたはクライアントが利用できません")
-            return None
-            
-        # 日本語と英語混合プロンプトでより具体的に
-        highlights_text = ", ".join(player_highlights[:3])  # 最大3つのハイライト
-        
-        ending_descriptions = {
-            "great_success": "triumphant victory with heroes celebrating",
-            "success": "successful completion with heroes proud", 
-            "failure": "bittersweet ending with lessons learned",
-            "disaster": "dramatic failure with heroes reflecting"
-        }
-        
-        ending_desc = ending_descriptions.get(ending_type, "epic conclusion")
-        
-        prompt = f"""
+            print(f"⚠️ 動画の公開に失敗: {uri}: {e}")
+    return public_storage_url(uri)
+
+# --- ヘルパー関数：Veo動画生成 ---
+VEO_VIDEO_PARAMS = {"aspect_ratio": "16:9"}
+OPENING_PLACEHOLDER_VIDEO_URL = "https://storage.googleapis.com/gtv-videos-bucket/sample/ForBiggerFun.mp4"
+
+def render_veo_video(veo_client, veo_model_name: str, prompt: str, stage: str, phase: str) -> Optional[str]:
+    """Veoで動画を生成し、保存先のURIを返す（レスポンスが無効なら None）"""
+    stages = StageTimer(phase, veo_model_name)
+    # Veo 3.0とVeo 1で異なる呼び出し方法
+    if veo_model_name == "veo-3.0-generate-001":
+        # Veo 3.0の場合（成功していた2.0と同じ方法）
+        response = veo_client.generate_content(
+            contents=[prompt],
+            generation_config={
+                "max_output_tokens": 1,
+                "temperature": 0.7
+            }
+        )
+    else:
+        # Veo 1の場合
+        response = veo_client.generate_video(prompt=prompt, **VEO_VIDEO_PARAMS)
+    stages.lap(stage)
+    print(f"🎬 Veo動画生成リクエスト送信完了")
+
+    # レスポンスから動画データを取得
+    if response and hasattr(response, 'uri'):
+        return publish_storage_uri(response.uri)
+    if response and hasattr(response, 'gcs_uri'):
+        return publish_storage_uri(response.gcs_uri)
+    return None
+
+def generate_cached_video(veo_client, veo_model_name: str, prompt: str, stage: str, phase: str) -> Optional[str]:
+    """同じプロンプトの動画がキャッシュにあればそのURLを返し、無ければ生成して登録する"""
+    render = functools.partial(render_veo_video, veo_client, veo_model_name, prompt, stage, phase)
+    media_cache = app.state.media_cache
+    if not media_cache:
+        return render()
+    video_url, _ = media_cache.get_or_create("video", veo_model_name, prompt, VEO_VIDEO_PARAMS, render)
+    return video_url
+
+def epilogue_video_prompt(scenario_title: str, ending_type: str, player_highlights: list, completion_percentage: float) -> str:
+    """エピローグのハイライト動画のプロンプト（日本語と英語混合でより具体的に）"""
+    highlights_text = ", ".join(player_highlights[:3])  # 最大3つのハイライト
+
+    ending_descriptions = {
+        "great_success": "triumphant victory with heroes celebrating",
+        "success": "successful completion with heroes proud", 
+        "failure": "bittersweet ending with lessons learned",
+        "disaster": "dramatic failure with heroes reflecting"
+    }
+
+    ending_desc = ending_descriptions.get(ending_type, "epic conclusion")
+
+    return f"""
 Epic fantasy TRPG adventure finale: {scenario_title}
 {ending_desc} ({completion_percentage:.0f}% completion)
 Key heroic moments: {highlights_text}
 Cinematic fantasy style, dramatic lighting, medieval fantasy setting
 High quality animation, 4 seconds duration
 """
-        
-        print(f"🎬 動画生成開始 - プロンプト: {prompt[:100]}...")
-        
-        # Vertex AI Veoで動画生成
-        if veo_model and veo_client:
-            print("🎬 Vertex AI Veoを使用してエピローグ動画生成")
-            try:
-                print(f"🎬 Veo動画生成開始...")
-                
-                # 動画生成リクエスト（Veo 3.0 vs Veo 1の分岐）
-                if veo_model_name == "veo-3.0-generate-001":
-                    # Veo 3.0の場合（成功していた2.0と同じ方法）
-                    response = veo_client.generate_content(
-                        contents=[prompt],
-                        generation_config={
-                            "max_output_tokens": 1,
-                            "temperature": 0.7
-                        }
-                    )
-                else:
-                    # Veo 1の場合
-                    response = veo_client.generate_video(
-                        prompt=prompt,
-                        aspect_ratio="16:9"
-                    )
-                
-                print(f"🎬 Veo動画生成リクエスト送信完了")
-                
-                # レスポンスから動画データを取得
-                if response and hasattr(response, 'uri'):
-                    video_url = response.uri
-                    print(f"✅ Veoエピローグ動画生成完了: {video_url}")
-                    return video_url
-                elif response and hasattr(response, 'gcs_uri'):
-                    video_url = response.gcs_uri
-                    print(f"✅ Veoエピローグ動画生成完了: {video_url}")
-                    return video_url
-                else:
-                    print("❌ 動画生成レスポンスが無効です")
-                    return None
-                    
-            except Exception as e:
-                print(f"❌ Veo生成エラー: {e}")
-                import traceback
-                print(f"🔍 Veoエラーのスタックトレース: {traceback.format_exc()}")
-                return None
-        else:
-            print("❌ 利用可能なVeoサービスがありません")
-            return None
+
+def generate_epilogue_video(prompt: str) -> Optional[str]:
+    """
+    エピローグのハイライト動画を同期で生成し、Cloud Storage URLを返す
+    （オペレーションのAPIが使えない場合のフォールバック。ジョブのワーカーで実行する）
+    """
+    # 起動時に初期化済みのVeoハンドルを使う
+    veo_handle = model_registry.get("veo")
+    if not veo_handle:
+        print("Veoモデルまたはクライアントが利用できません")
+        print("Veoは限定プレビューのため利用できない可能性があります")
+        return None
+    veo_client, veo_model_name = veo_handle
+
+    print(f"🎬 動画生成開始 - プロンプト: {prompt[:100]}...")
+    try:
+        video_url = generate_cached_video(veo_client, veo_model_name, prompt, "epilogue_video_generate", "epilogue")
+        if video_url:
+            print(f"✅ Veoエピローグ動画生成完了: {video_url}")
+            return video_url
+        print("❌ 動画生成レスポンスが無効です")
+        return None
     except Exception as e:
-        print(f"❌ 動画生成エラー: {e}")
+        print(f"❌ Veo生成エラー: {e}")
         import traceback
-        print(f"🔍 動画生成エラーのスタックトレース: {traceback.format_exc()}")
+        print(f"🔍 Veoエラーのスタックトレース: {traceback.format_exc()}")
         return None
 
 # --- APIエンドポイント ---
@@ -522,18 +741,52 @@ async def read_root():
     """ルートエンドポイント"""
     return {"message": "AI TRPG Backend API", "status": "running"}
 
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus形式のメトリクス（段階ごとの処理時間、エンドポイントのレイテンシ、フォールバック回数）"""
+    if not PROMETHEUS_AVAILABLE:
+        raise HTTPException(status_code=503, detail="prometheus_client is not installed")
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+@app.get("/admin/usage")
+async def get_usage_totals(uid: str = Depends(require_admin_uid)):
+    """プロセス起動以降の呼び出し箇所・モデルごとのトークン使用量と推定コスト"""
+    return usage_totals.snapshot()
+
+@app.get("/admin/usage/games/{game_id}")
+async def get_game_usage(request: Request, game_id: str, uid: str = Depends(require_admin_uid)):
+    """ゲームごとのトークン使用量（呼び出し箇所ごとの内訳付き）と予算"""
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
+    game_data = await run_blocking(store.get, game_id, field_paths=['gameStatus', 'usage', BUDGET_FIELD])
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
+    return game_usage_report(game_id, game_data)
+
+@app.put("/admin/usage/games/{game_id}/budget")
+async def set_game_usage_budget(request: Request, game_id: str, req: UsageBudgetRequest, uid: str = Depends(require_admin_uid)):
+    """ゲームの予算を設定する。超過後のモデル呼び出しは安価なモデルに切り替わる"""
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
+    if req.maxTokens < 0 or req.maxCostUsd < 0: raise HTTPException(status_code=400, detail="Budget must not be negative")
+    game_data = await run_blocking(store.get, game_id, field_paths=['gameStatus'])
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
+    await run_blocking(store.update, game_id, {BUDGET_FIELD: {"maxTokens": req.maxTokens, "maxCostUsd": req.maxCostUsd}})
+    game_data = await run_blocking(store.get, game_id, field_paths=['gameStatus', 'usage', BUDGET_FIELD])
+    return game_usage_report(game_id, game_data)
+
 @app.post("/games")
 async def create_game(request: Request, uid: str = Depends(get_current_user_uid)):
-    db = request.app.state.db
-    if not db: raise HTTPException(status_code=503, detail="DB service not available")
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
     
     try:
         room_id = generate_room_id()
         # 重複チェック
-        existing_games = db.collection('games').where(filter=FieldFilter('roomId', '==', room_id)).get()
+        existing_games = await run_blocking(store.find_by_room_id, room_id)
         while len(existing_games) > 0:
             room_id = generate_room_id()
-            existing_games = db.collection('games').where(filter=FieldFilter('roomId', '==', room_id)).get()
+            existing_games = await run_blocking(store.find_by_room_id, room_id)
         
         # 新しいゲームドキュメントを作成
         game_data = {
@@ -553,25 +806,24 @@ async def create_game(request: Request, uid: str = Depends(get_current_user_uid)
             }
         }
         
-        doc_ref = db.collection('games').add(game_data)[1]
-        return {"gameId": doc_ref.id, "roomId": room_id}
+        game_id = await run_blocking(store.create, game_data)
+        return {"gameId": game_id, "roomId": room_id}
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create game session: {e}")
 
 @app.post("/games/{room_id}/join")
 async def join_game(request: Request, room_id: str, uid: str = Depends(get_current_user_uid)):
-    db = request.app.state.db
-    if not db: raise HTTPException(status_code=503, detail="DB service not available")
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
     
     try:
         # roomIdでゲームを検索
-        games = db.collection('games').where(filter=FieldFilter('roomId', '==', room_id)).get()
+        games = await run_blocking(store.find_by_room_id, room_id)
         if len(games) == 0:
             raise HTTPException(status_code=404, detail="Room not found")
         
-        game_doc = games[0]
-        game_data = game_doc.to_dict()
+        game_id, game_data = games[0]
         
         # ゲーム状態確認
         if game_data.get('gameStatus') != 'lobby':
@@ -583,7 +835,7 @@ async def join_game(request: Request, room_id: str, uid: str = Depends(get_curre
         
         # 既に参加しているかチェック
         if uid in game_data.get('players', {}):
-            return {"gameId": game_doc.id}
+            return {"gameId": game_id}
         
         # プレイヤーを追加
         player_data = {
@@ -595,8 +847,8 @@ async def join_game(request: Request, room_id: str, uid: str = Depends(get_curre
             'joinedAt': firestore.SERVER_TIMESTAMP
         }
         
-        game_doc.reference.update({f'players.{uid}': player_data})
-        return {"gameId": game_doc.id}
+        await run_blocking(store.update, game_id, {f'players.{uid}': player_data})
+        return {"gameId": game_id}
         
     except HTTPException as e:
         raise e
@@ -605,15 +857,13 @@ async def join_game(request: Request, room_id: str, uid: str = Depends(get_curre
 
 @app.post("/games/{game_id}/start-voting")
 async def start_voting(request: Request, game_id: str, req: StartVotingRequest, uid: str = Depends(get_current_user_uid)):
-    db = request.app.state.db
-    gemini_model = request.app.state.gemini_model
-    if not db or not gemini_model: raise HTTPException(status_code=503, detail="Service not available")
+    store = request.app.state.game_store
+    if not store or not request.app.state.gemini_model: raise HTTPException(status_code=503, detail="Service not available")
     
     try:
-        game_ref = db.collection('games').document(game_id)
-        game_doc = game_ref.get()
-        if not game_doc.exists: raise HTTPException(status_code=404, detail="Game not found")
-        game_data = game_doc.to_dict()
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
+        gemini_model, model_name = select_text_model(game_data, phase="voting")
         
         # ホスト権限確認
         if game_data.get('hostId') != uid:
@@ -625,71 +875,38 @@ async def start_voting(request: Request, game_id: str, req: StartVotingRequest,
         
         print(f"🎬 動画設定受信: オープニング={req.opening_video_enabled}, エピローグ={req.epilogue_video_enabled}")
         
-        # 難易度に応じた設定
-        difficulty_settings = {
-            "easy": {"max_turns": 40, "threshold": 0.6, "complexity": "簡単で分かりやすい"},
-            "normal": {"max_turns": 30, "threshold": 0.75, "complexity": "適度な難易度の"},
-            "hard": {"max_turns": 25, "threshold": 0.8, "complexity": "挑戦的で複雑な"},
-            "extreme": {"max_turns": 20, "threshold": 0.9, "complexity": "非常に困難で複合的な"}
-        }
-        
-        settings = difficulty_settings.get(req.difficulty, difficulty_settings["normal"])
-        keywords_text = f"必須キーワード: {', '.join(req.keywords)}" if req.keywords else ""
-        theme_text = f"テーマ: {req.theme_preference}" if req.theme_preference else ""
-        
-        # Geminiでシナリオ候補と終了条件を生成
-        prompt = f"""
-        あなたはTRPGのシナリオ作成の専門家です。
-        以下の条件で3つの異なる{settings['complexity']}シナリオ案を作成してください：
-        
-        # 基本設定
-        - 難易度: {req.difficulty} ({settings['complexity']})
-        - {keywords_text}
-        - {theme_text}
-        
-        # シナリオタイプ
-        1. ファンタジー系
-        2. SF系  
-        3. 現代系（ホラー、ミステリー、アクションなど）
-        
-        各シナリオには以下を含めてください：
-        - title: 魅力的なタイトル（15文字以内）
-        - summary: 簡潔なあらすじ（100文字程度）
-        - endConditions: 終了条件（各シナリオの完了判定に必要な情報）
-          - primary_objectives: メイン目標のリスト（3-5個）
-          - success_criteria: 成功条件のリスト
-          - failure_criteria: 失敗条件のリスト
-          - completion_threshold: 完了判定の閾値（{settings['threshold']}）
-          - max_turns: 最大ターン数（{settings['max_turns']}）
-        
-        JSON配列形式で出力してください。例：
-        [
-          {{
-            "title": "失われた魔法の森",
-            "summary": "古い魔法の森で消えた村人たちを探す冒険。邪悪な魔法使いの呪いを解く必要がある。",
-            "endConditions": {{
-              "primary_objectives": ["村人の行方を突き止める", "邪悪な魔法使いを発見する", "呪いの謎を解明する", "呪いを解除する"],
-              "success_criteria": ["全ての村人を救出", "魔法使いを倒すか説得", "森の平和を回復"],
-              "failure_criteria": ["パーティ全滅", "村人の半数以上が犠牲", "呪いが拡散"],
-              "completion_threshold": 0.75,
-              "max_turns": 30
-            }}
-          }}
-        ]
-        """
-        
-        response = gemini_model.generate_content([prompt], generation_config=GenerationConfig(response_mime_type="application/json"))
-        scenario_ideas = json.loads(response.text)
-        scenario_options = [ScenarioOption(id=str(uuid.uuid4()), **idea) for idea in scenario_ideas]
+        # キーワード・テーマの指定が無ければ、事前生成したシナリオ候補のプールから取り出す
+        difficulty = normalize_difficulty(req.difficulty)
+        usage = UsageTracker()
+        scenario_ideas = None
+        use_pool = request.app.state.scenario_pool is not None and not req.keywords and not req.theme_preference
+        if use_pool:
+            scenario_ideas = await run_blocking(request.app.state.scenario_pool.take, difficulty)
+            if scenario_ideas is None:
+                record_fallback("scenario_pool_empty", "voting")
+            # 取り出した分（空の場合は不足分）をバックグラウンドで補充する
+            await run_blocking(request_scenario_pool_refill, difficulty)
+
+        if scenario_ideas is None:
+            # Geminiでシナリオ候補と終了条件を生成
+            prompt = scenario_prompt(difficulty, req.keywords, req.theme_preference)
+            with stage_timer("scenario_generation", "voting", model_name):
+                response = await gemini_model.generate_content_async([prompt], generation_config=GenerationConfig(response_mime_type="application/json"))
+            usage.record("start_voting", model_name, response)
+            scenario_ideas = parse_scenario_ideas(response.text)
+        else:
+            print(f"📦 シナリオ候補をプールから使用: {difficulty}")
+        scenario_options = with_new_ids(scenario_ideas)
         
-        game_ref.update({
+        await run_blocking(store.update, game_id, {
             "scenarioOptions": [opt.model_dump() for opt in scenario_options], 
             "gameStatus": "voting",
             "votes": {},
             "videoSettings": {
                 "openingVideoEnabled": req.opening_video_enabled,
                 "epilogueVideoEnabled": req.epilogue_video_enabled
-            }
+            },
+            **usage.updates()
         })
         
         return {"message": "Voting started.", "scenarios": [opt.model_dump() for opt in scenario_options]}
@@ -698,120 +915,65 @@ async def start_voting(request: Request, game_id: str, req: StartVotingRequest,
         raise HTTPException(status_code=500, detail=f"Failed to start voting: {e}")
 
 # --- バックグラウンドタスク ---
-def generate_opening_video_task(game_id: str, scenario_title: str, scenario_summary: str):
-    import asyncio
-    asyncio.run(generate_opening_video_async(game_id, scenario_title, scenario_summary))
+def opening_video_prompt(scenario_title: str, scenario_summary: str) -> str:
+    return f"""
+Epic fantasy TRPG adventure opening: {scenario_title}
+{scenario_summary}
+Cinematic fantasy style, dramatic atmosphere, medieval setting
+High quality animation, 4 seconds duration
+"""
 
-async def generate_opening_video_async(game_id: str, scenario_title: str, scenario_summary: str):
-    db_client = firestore.client()
-    game_ref = db_client.collection('games').document(game_id)
-    
+def generate_opening_video_task(game_id: str, scenario_title: str, scenario_summary: str, request_id: Optional[str] = None):
+    """
+    オープニング動画を生成する。request_id（openingVideo.requestId）が指定された場合、
+    投票の変更で依頼が取り消されていれば何もせず、生成中に取り消された結果も書き込まない。
+    """
     try:
-        # 環境変数から取得
-        PROJECT_ID = os.getenv("PROJECT_ID")
-        LOCATION = os.getenv("LOCATION")
-        
-        # Vertex AI Veoモデルとクライアントの取得
+        if not opening_video_request_is_current(game_id, request_id):
+            print(f"⏭️ 取り消されたオープニング動画の依頼をスキップ: {game_id}")
+            return {"state": "cancelled"}
+        prompt = opening_video_prompt(scenario_title, scenario_summary)
+        # オペレーションとして依頼できれば、完了の確認は video_operation ジョブに任せてすぐに戻る
+        try:
+            if start_video_generation(game_id, "opening", prompt, request_id):
+                print(f"🎬 オープニング動画生成を依頼: {scenario_title}")
+                return
+        except Exception as e:
+            print(f"⚠️ Veoオペレーションの依頼に失敗したため同期生成に切り替え: {e}")
+
+        # 起動時に初期化済みのVeoハンドルを使う
         veo_model = None
         veo_client = None
         veo_model_name = None
-        
-        # Vertex AI Veo初期化（最新仕様対応）
-        try:
-            if PROJECT_ID and LOCATION:
-                # Veo 2の正しい実装
-                vertexai.init(project=PROJECT_ID, location=LOCATION)
-                
-                # 方法1: Vertex AI Veo 2（成功していた実装）
-                try:
-                    from vertexai.preview.generative_models import GenerativeModel
-                    veo_client = GenerativeModel("veo-3.0-generate-001")  # モデル名のみ3.0に変更
-                    veo_model_name = "veo-3.0-generate-001"
-                    veo_model = True
-                    print("✅ Vertex AI Veo 3.0初期化成功")
-                except ImportError as veo_import_error:
-                    print(f"⚠️ Veo 3.0インポートエラー: {veo_import_error}")
-                    
-                    # 方法2: 従来のVeo 1
-                    try:
-                        from vertexai.preview.vision_models import VideoGenerationModel
-                        veo_client = VideoGenerationModel.from_pretrained("veo-001")
-                        veo_model_name = "veo-001"
-                        veo_model = True
-                        print("✅ Vertex AI Veo 1初期化成功")
-                    except Exception as veo1_error:
-                        print(f"⚠️ Veo 1初期化エラー: {veo1_error}")
-                        raise veo1_error
-            else:
-                raise ImportError(f"PROJECT_ID または LOCATION が設定されていません")
-        except Exception as e:
-            print(f"❌ Veo初期化エラー: {e}")
-            if "quota" in str(e).lower() or "429" in str(e):
-                print("⚠️ Veo APIクォータ上限に達しています。プレースホルダー動画を使用します。")
-            else:
-                print("⚠️ Veoは限定プレビューのため利用できない可能性があります")
-            veo_model = None
-            veo_client = None
-            veo_model_name = None
+        veo_handle = model_registry.get("veo")
+        if veo_handle:
+            veo_client, veo_model_name = veo_handle
+            veo_model = True
+        else:
+            print(f"❌ Veo初期化エラー: {model_registry.error('veo')}")
             
         if not veo_model and not veo_client:
             print("⚠️ Veoが利用できないため、プレースホルダー動画を使用")
-            video_url = "https://storage.googleapis.com/gtv-videos-bucket/sample/ForBiggerFun.mp4"
-            game_ref.update({
-                "openingVideo.status": "ready",
-                "openingVideo.url": video_url
-            })
+            record_fallback("placeholder_video", "creating_char")
+            video_url = OPENING_PLACEHOLDER_VIDEO_URL
+            write_video_fields(game_id, "opening", video_fields("opening", status="ready", url=video_url), request_id)
             return
             
-        # 実際のVeo動画生成
-        prompt = f"""
-Epic fantasy TRPG adventure opening: {scenario_title}
-{scenario_summary}
-Cinematic fantasy style, dramatic atmosphere, medieval setting
-High quality animation, 4 seconds duration
-"""
-        
         print(f"🎬 オープニング動画生成開始: {scenario_title}")
         
-        # Vertex AI Veoで動画生成
+        # Vertex AI Veoで動画生成（同じシナリオの動画がキャッシュにあればそれを使う）
         if veo_model and veo_client:
             try:
                 print(f"🎬 Vertex AI Veo({veo_model_name})でオープニング動画生成")
-                
-                # Veo 3.0とVeo 1で異なる呼び出し方法
-                if veo_model_name == "veo-3.0-generate-001":
-                    # Veo 3.0の場合（成功していた2.0と同じ方法）
-                    response = veo_client.generate_content(
-                        contents=[prompt],
-                        generation_config={
-                            "max_output_tokens": 1,
-                            "temperature": 0.7
-                        }
-                    )
-                else:
-                    # Veo 1の場合
-                    response = veo_client.generate_video(
-                        prompt=prompt,
-                        aspect_ratio="16:9"
-                    )
-                
-                print(f"🎬 Veo動画生成リクエスト送信完了")
-                
-                # レスポンスから動画データを取得
-                if response and hasattr(response, 'uri'):
-                    video_url = response.uri
-                    print(f"✅ Veoオープニング動画生成完了: {video_url}")
-                elif response and hasattr(response, 'gcs_uri'):
-                    video_url = response.gcs_uri
+                video_url = generate_cached_video(veo_client, veo_model_name, prompt, "opening_video_generate", "creating_char")
+                if video_url:
                     print(f"✅ Veoオープニング動画生成完了: {video_url}")
                 else:
                     print("❌ 動画生成レスポンスが無効です")
-                    video_url = "https://storage.googleapis.com/gtv-videos-bucket/sample/ForBiggerFun.mp4"
+                    record_fallback("placeholder_video", "creating_char")
+                    video_url = OPENING_PLACEHOLDER_VIDEO_URL
                         
-                game_ref.update({
-                    "openingVideo.status": "ready",
-                    "openingVideo.url": video_url
-                })
+                write_video_fields(game_id, "opening", video_fields("opening", status="ready", url=video_url), request_id)
                 return
                     
             except Exception as e:
@@ -819,30 +981,362 @@ High quality animation, 4 seconds duration
                 import traceback
                 print(f"🔍 詳細エラー: {traceback.format_exc()}")
                 # エラー時はダミー動画を使用
-                video_url = "https://storage.googleapis.com/gtv-videos-bucket/sample/ForBiggerFun.mp4"
-                game_ref.update({
-                    "openingVideo.status": "ready",
-                    "openingVideo.url": video_url
-                })
+                record_fallback("placeholder_video", "creating_char")
+                video_url = OPENING_PLACEHOLDER_VIDEO_URL
+                write_video_fields(game_id, "opening", video_fields("opening", status="ready", url=video_url), request_id)
                 return
         
         # Veoが利用できない場合はプレースホルダー動画を使用
         print("❌ Veoが利用できません、プレースホルダー動画を使用")
-        video_url = "https://storage.googleapis.com/gtv-videos-bucket/sample/ForBiggerFun.mp4"
-        game_ref.update({
-            "openingVideo.status": "ready",
-            "openingVideo.url": video_url
-        })
+        record_fallback("placeholder_video", "creating_char")
+        video_url = OPENING_PLACEHOLDER_VIDEO_URL
+        write_video_fields(game_id, "opening", video_fields("opening", status="ready", url=video_url), request_id)
         print(f"オープニング動画準備完了: {game_id}")
 
     except Exception as e:
         print(f"オープニング動画生成に失敗: {e}")
         # フォールバックとしてプレースホルダーを使用
-        video_url = "https://storage.googleapis.com/gtv-videos-bucket/sample/ForBiggerFun.mp4"
-        game_ref.update({
-            "openingVideo.status": "ready",
-            "openingVideo.url": video_url
-        })
+        record_fallback("placeholder_video", "creating_char")
+        video_url = OPENING_PLACEHOLDER_VIDEO_URL
+        write_video_fields(game_id, "opening", video_fields("opening", status="ready", url=video_url), request_id)
+
+# --- 動画生成オペレーション ---
+# Veoの動画生成は数分かかるため、オペレーションとして依頼してオペレーション名をゲームに記録し、
+# 完了の確認は video_operation ジョブがバックオフしながら1回ずつ行う（確認の合間はどのスレッドも占有しない）。
+# 進捗は openingVideo.operation / epilogue.video_operation の progress としてゲームのイベントで配信する。
+
+# 動画の書き込み先（オープニングは openingVideo、エピローグは既存の epilogue ドキュメントの命名に合わせる）
+VIDEO_TARGETS = {
+    "opening": {"field": "openingVideo", "status": "status", "url": "url", "operation": "operation", "phase": "creating_char"},
+    "epilogue": {"field": "epilogue", "status": "video_status", "url": "video_url", "operation": "video_operation", "phase": "epilogue"},
+}
+
+def video_fields(target: str, **values) -> dict:
+    """{"status": ..., "url": ...} を対象のフィールドパスに変換する"""
+    spec = VIDEO_TARGETS[target]
+    return {f"{spec['field']}.{spec[key]}": value for key, value in values.items()}
+
+def opening_video_request_is_current(game_id: str, request_id: Optional[str]) -> bool:
+    if request_id is None:
+        return True
+    game_data = app.state.game_store.get(game_id, ["openingVideo.requestId"]) or {}
+    return (game_data.get('openingVideo') or {}).get('requestId') == request_id
+
+def write_video_fields(game_id: str, target: str, updates: dict, request_id: Optional[str] = None) -> bool:
+    """request_id を指定した場合、その依頼がまだ有効（requestId が一致する）ときだけ書き込む"""
+    if request_id is None:
+        app.state.game_store.update(game_id, updates)
+        return True
+    request_path = f"{VIDEO_TARGETS[target]['field']}.requestId"
+
+    def apply(txn: GameTransaction) -> bool:
+        game_data = txn.get([request_path, "eventVersion"])
+        if game_data is None:
+            return False
+        if (game_data.get(VIDEO_TARGETS[target]['field']) or {}).get('requestId') != request_id:
+            return False
+        game_updates = dict(updates)
+        game_updates.update(stage_game_events(txn, game_data, events_for_update(updates)))
+        txn.update(game_updates)
+        return True
+
+    written = app.state.game_store.run_transaction(game_id, apply)
+    if not written:
+        print(f"⏭️ 取り消された動画の依頼のため結果を破棄: {game_id} {target}")
+    return written
+
+def start_video_generation(game_id: str, target: str, prompt: str, request_id: Optional[str] = None) -> bool:
+    """
+    オペレーションとして動画の生成を依頼し、確認ジョブを登録する。キャッシュにあればすぐに完了として書き込む。
+    オペレーションのAPIが使えない場合は False を返す（呼び出し元で同期生成する）。
+    """
+    operations = model_registry.get("veo_operations")
+    if not operations:
+        return False
+    spec = VIDEO_TARGETS[target]
+    media_cache = app.state.media_cache
+    cached_url = media_cache.get("video", operations.model_name, prompt, VEO_VIDEO_PARAMS) if media_cache else None
+    if cached_url:
+        print(f"♻️ メディアキャッシュ: {target} video")
+        write_video_fields(game_id, target, video_fields(target, status="ready", url=cached_url), request_id)
+        return True
+    with stage_timer(f"{target}_video_submit", spec["phase"], operations.model_name):
+        operation_name = operations.submit(prompt, VEO_VIDEO_PARAMS)
+    record = new_operation_record(operation_name, operations.model_name, prompt)
+    if write_video_fields(game_id, target, video_fields(target, status="generating", operation=record), request_id):
+        enqueue_video_operation_poll(game_id, target, operation_name)
+    return True
+
+def enqueue_video_operation_poll(game_id: str, target: str, operation_name: str) -> str:
+    """オペレーションの確認ジョブを登録する（以降の確認は poll_video_operation が同じジョブを再実行させる）"""
+    return enqueue_job(
+        "video_operation",
+        {"gameId": game_id, "target": target, "operationName": operation_name},
+        game_id,
+        operation_job_id(game_id, target, operation_name),
+        delay_seconds=next_poll_delay(0),
+    )
+
+def write_video_operation(game_id: str, target: str, operation_name: str, updates: dict) -> bool:
+    """記録中のオペレーションがまだ operation_name で実行中の場合だけ書き込む（依頼し直された古い結果は捨てる）"""
+    spec = VIDEO_TARGETS[target]
+    operation_path = f"{spec['field']}.{spec['operation']}"
+
+    def apply(txn: GameTransaction) -> bool:
+        game_data = txn.get([operation_path, "eventVersion"])
+        if game_data is None:
+            return False
+        record = (game_data.get(spec['field']) or {}).get(spec['operation']) or {}
+        if record.get('name') != operation_name or record.get('state') != OPERATION_RUNNING:
+            return False
+        game_updates = dict(updates)
+        game_updates.update(stage_game_events(txn, game_data, events_for_update(updates)))
+        txn.update(game_updates)
+        return True
+
+    return app.state.game_store.run_transaction(game_id, apply)
+
+def failed_video_fields(target: str, **values) -> dict:
+    """生成できなかった場合の書き込み（オープニングはプレースホルダー動画で進め、エピローグは失敗として再試行できるようにする）"""
+    if target == "opening":
+        record_fallback("placeholder_video", "creating_char")
+        return video_fields(target, status="ready", url=OPENING_PLACEHOLDER_VIDEO_URL, **values)
+    record_fallback("epilogue_video_failed", "epilogue")
+    return video_fields(target, status="failed", **values)
+
+def publish_operation_video(game_id: str, target: str, status: VideoOperationStatus) -> Optional[str]:
+    """完了したオペレーションの動画の公開URLを返す（動画が無ければ None）"""
+    if status.uri:
+        return publish_storage_uri(status.uri)
+    if not status.video_bytes:
+        return None
+    if not app.state.storage_bucket:
+        print(f"❌ 動画データをアップロードするCloud Storageが利用できません（VEO_OUTPUT_GCS_URI を設定してください）: {game_id} {target}")
+        return None
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return upload_image_to_storage(status.video_bytes, app.state.storage_bucket, f"videos/{game_id}/{target}_{timestamp}.mp4", content_type='video/mp4')
+
+def poll_video_operation(game_id: str, target: str, operation_name: str):
+    """
+    オペレーションの状態を1回確認し、完了していれば結果を書き込む。
+    未完了なら Reschedule を返し、同じ確認ジョブを次の間隔の後に再実行させる。
+    """
+    spec = VIDEO_TARGETS[target]
+    game_data = app.state.game_store.get(game_id, [f"{spec['field']}.{spec['operation']}"]) or {}
+    record = (game_data.get(spec['field']) or {}).get(spec['operation']) or {}
+    if record.get('name') != operation_name or record.get('state') != OPERATION_RUNNING:
+        return {"state": "stale"}
+
+    operations = model_registry.get("veo_operations")
+    try:
+        if not operations:
+            raise RuntimeError("Veo operations client not available")
+        status = operations.get(operation_name)
+    except Exception as e:
+        # 一時的なエラーは未完了として扱い、タイムアウトまで確認を続ける
+        print(f"⚠️ Veoオペレーションの確認に失敗: {operation_name}: {e}")
+        status = VideoOperationStatus(False, error=f"{type(e).__name__}: {e}")
+    record = polled_record(record)
+
+    # 保存先を指定しなかった場合は動画データで返るので、画像と同じようにアップロードする
+    # （アップロードに失敗した場合はジョブの再試行で確認からやり直す）
+    video_url = publish_operation_video(game_id, target, status) if status.done else None
+    if video_url:
+        elapsed = operation_elapsed_seconds(record)
+        observe_stage(f"{target}_video_generate", elapsed, spec['phase'], record.get('model'))
+        record.update({"state": OPERATION_SUCCEEDED, "progress": 100})
+        if write_video_operation(game_id, target, operation_name, video_fields(target, status="ready", url=video_url, operation=record)):
+            print(f"✅ Veo動画生成完了: {game_id} {target} ({elapsed:.0f}s, {record['polls']}回確認)")
+        if app.state.media_cache:
+            app.state.media_cache.put("video", record.get('model'), record.get('prompt') or "", VEO_VIDEO_PARAMS, video_url, elapsed)
+        return {"state": OPERATION_SUCCEEDED, "polls": record['polls']}
+
+    if status.done or is_timed_out(record):
+        error = status.error or ("video could not be stored" if status.done else "timed out")
+        print(f"❌ Veo動画生成失敗: {game_id} {target}: {error}")
+        record.update({"state": OPERATION_FAILED, "error": error[:500]})
+        write_video_operation(game_id, target, operation_name, failed_video_fields(target, operation=record))
+        return {"state": OPERATION_FAILED, "polls": record['polls']}
+
+    result = {"state": OPERATION_RUNNING, "polls": record['polls'], "progress": record['progress']}
+    if not write_video_operation(game_id, target, operation_name, video_fields(target, operation=record)):
+        return {"state": "stale"}
+    return Reschedule(next_poll_delay(record['polls']), result)
+
+def generate_epilogue_video_task(game_id: str, prompt: str):
+    """エピローグ動画をオペレーションとして依頼する（使えなければこのワーカーで同期生成する）"""
+    try:
+        if start_video_generation(game_id, "epilogue", prompt):
+            return {"state": "submitted"}
+    except Exception as e:
+        print(f"⚠️ Veoオペレーションの依頼に失敗したため同期生成に切り替え: {e}")
+    video_url = generate_epilogue_video(prompt)
+    updates = video_fields("epilogue", status="ready", url=video_url) if video_url else failed_video_fields("epilogue")
+    app.state.game_store.update(game_id, updates)
+    return {"state": "ready" if video_url else "failed"}
+
+# --- キャラクター画像生成（ジョブ） ---
+# Imagenでの生成とCloud Storageへのアップロードには数秒〜十数秒かかるため、
+# create-character は名前・能力値と characterImageStatus: generating だけを書き込んですぐに返し、
+# 画像は character_portrait ジョブ（プロセスごとの同時実行数は JOB_CONCURRENCY で制限）で生成する。
+# 結果はプレイヤーのフィールド単位で書き込み、フロントエンドはゲームのイベントで受け取る。
+PORTRAIT_PLACEHOLDER_URL = "https://picsum.photos/400/400?random={seed}"
+
+PORTRAIT_IMAGE_PARAMS = {"number_of_images": 1, "language": "ja"}  # 日本語プロンプト（公式ドキュメント準拠）
+
+def generate_character_image(prompt: str, game_id: str, uid: str) -> str:
+    """肖像画のURLを返す。同じプロンプトの画像がキャッシュにあればそれを使い、生成できなければプレースホルダー"""
+    if not app.state.imagen_model:
+        # Imagenモデルが利用できない場合のプレースホルダー
+        record_fallback("placeholder_image", "creating_char")
+        return PORTRAIT_PLACEHOLDER_URL.format(seed=3)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    image_url = generate_cached_image(prompt, PORTRAIT_IMAGE_PARAMS, f"characters/{game_id}/{uid}_{timestamp}.png", "character_image", "creating_char")
+    if image_url:
+        return image_url
+    record_fallback("placeholder_image", "creating_char")
+    return PORTRAIT_PLACEHOLDER_URL.format(seed=random.randint(10, 999))
+
+def generate_cached_image(prompt: str, params: dict, filename: str, stage: str, phase: str) -> Optional[str]:
+    """同じプロンプトの画像がキャッシュにあればそのURLを返し、無ければ生成して登録する（失敗時は None）"""
+    render = functools.partial(render_imagen_image, prompt, params, filename, stage, phase)
+    media_cache = app.state.media_cache
+    if not media_cache:
+        return render()
+    image_url, _ = media_cache.get_or_create("image", IMAGEN_MODEL_NAME, prompt, params, render)
+    return image_url
+
+def render_imagen_image(prompt: str, params: dict, filename: str, stage: str, phase: str) -> Optional[str]:
+    """Imagenで画像を生成してCloud Storageの filename に保存し、URLを返す（失敗時は None）"""
+    imagen_model = app.state.imagen_model
+    storage_bucket = app.state.storage_bucket
+    try:
+        print(f"🚀 Imagen APIを呼び出し中...")
+        with stage_timer(f"{stage}_generate", phase, IMAGEN_MODEL_NAME):
+            response = imagen_model.generate_images(prompt=prompt, **params)
+        if not (response and hasattr(response, 'images') and len(response.images) > 0):
+            print(f"❌ Imagen画像生成に失敗")
+            return None
+        generated_image = response.images[0]
+        print(f"✅ Imagen画像生成成功")
+    except Exception as e:
+        print(f"🚨 Imagen画像生成エラー詳細: {type(e).__name__}: {e}")
+        return None
+
+    try:
+        # 画像データを取得する方法を複数試行
+        image_data = None
+        if hasattr(generated_image, '_image_bytes'):
+            image_data = generated_image._image_bytes
+        elif hasattr(generated_image, 'data'):
+            image_data = generated_image.data
+        elif hasattr(generated_image, 'content'):
+            image_data = generated_image.content
+        else:
+            print(f"❌ 画像データの取得方法が見つかりません")
+
+        if image_data and storage_bucket:
+            with stage_timer(f"{stage}_upload", phase):
+                image_url = upload_image_to_storage(image_data, storage_bucket, filename)
+            print(f"🔗 Cloud Storage URL: {image_url}")
+            return image_url
+        # Cloud Storageが利用できない場合はプレースホルダー
+        print(f"⚠️ Cloud Storage利用不可、プレースホルダー使用")
+    except Exception as upload_err:
+        print(f"🚨 Cloud Storageアップロードエラー: {upload_err}")
+    return None
+
+def write_character_portrait(game_id: str, uid: str, request_id: str, image_url: Optional[str], image_status: str) -> bool:
+    """
+    生成結果をプレイヤーのフィールドだけに書き込む。
+    生成中にキャラクターが作り直されていれば（リクエストIDが変わっていれば）古い結果は捨てる。
+    """
+    store = app.state.game_store
+
+    def apply(txn: GameTransaction) -> bool:
+        game_data = txn.get([f"players.{uid}.characterImageRequestId", "eventVersion"])
+        if game_data is None:
+            return False
+        player = (game_data.get('players') or {}).get(uid) or {}
+        if player.get('characterImageRequestId') != request_id:
+            return False
+        updates = {
+            f'players.{uid}.characterImageUrl': image_url,
+            f'players.{uid}.characterImageStatus': image_status,
+        }
+        updates.update(stage_game_events(txn, game_data, events_for_update(updates)))
+        txn.update(updates)
+        return True
+
+    return store.run_transaction(game_id, apply)
+
+def generate_character_portrait_task(game_id: str, uid: str, request_id: str, prompt: str):
+    print(f"🎨 キャラクター画像生成開始: {game_id}/{uid}")
+    try:
+        image_url = generate_character_image(prompt, game_id, uid)
+        image_status = "ready"
+    except Exception as e:
+        print(f"🚨 キャラクター画像生成エラー: {e}")
+        record_fallback("placeholder_image", "creating_char")
+        image_url, image_status = PORTRAIT_PLACEHOLDER_URL.format(seed=1), "failed"
+    if write_character_portrait(game_id, uid, request_id, image_url, image_status):
+        print(f"✅ キャラクター画像生成完了: {game_id}/{uid} ({image_status})")
+    else:
+        print(f"⏭️ キャラクターが作り直されたため画像を破棄: {game_id}/{uid}")
+    return {"status": image_status}
+
+# --- 情景画像生成 ---
+# GM応答の imagePrompt から情景画像を生成する。ナレーションの確定（ターンの書き込み）には待たせず、
+# ターン確定後にバックグラウンドで生成し、できた画像で gm_response のログエントリを書き換える。
+# レート制限・ゲームごとの重複排除・見送りは scene_image_scheduler が行う。
+SCENE_IMAGE_PARAMS = {"number_of_images": 1, "aspect_ratio": "16:9"}
+SCENE_PLACEHOLDER_URL = "https://picsum.photos/600/400?random=scene"
+
+def reserve_scene_image(game_id: str, turn: int, image_prompt: Optional[str]) -> dict:
+    """
+    ターン確定前に、情景画像についてログエントリに書くフィールドを決める。
+    生成枠を確保できた場合は imageStatus: pending（確定後に start_scene_image で生成を始める）。
+    """
+    if not image_prompt:
+        return {}
+    if not app.state.imagen_model or not SCENE_IMAGES_ENABLED:
+        # Imagenが利用できない場合は従来どおりプレースホルダー
+        record_fallback("placeholder_image", "playing")
+        return {"imageUrl": SCENE_PLACEHOLDER_URL}
+    reason = scene_image_scheduler.reserve(game_id, turn)
+    if reason:
+        print(f"⏭️ 情景画像を見送り: {game_id} ターン{turn} ({reason})")
+        return {"imageStatus": IMAGE_SKIPPED}
+    return {"imageStatus": IMAGE_PENDING}
+
+def start_scene_image(game_id: str, turn: int, seq: int, image_prompt: str):
+    # 生成中にプロセスが止まっても pending のまま残らないよう、先に回収ジョブを登録しておく
+    try:
+        enqueue_job("scene_image_recovery", {"gameId": game_id, "turn": turn, "seq": seq}, game_id,
+                    f"scene_image_recovery-{game_id}-{turn}-{seq}", delay_seconds=SCENE_IMAGE_RECOVERY_SECONDS)
+    except Exception as e:
+        print(f"⚠️ 情景画像の回収ジョブの登録に失敗: {game_id} ターン{turn}: {e}")
+    scene_image_scheduler.start(game_id, functools.partial(generate_scene_image_task, game_id, turn, seq, image_prompt))
+
+def generate_scene_image_task(game_id: str, turn: int, seq: int, image_prompt: str):
+    started = time.perf_counter()
+    image_url = generate_cached_image(image_prompt, SCENE_IMAGE_PARAMS, f"scenes/{game_id}/{turn:04d}_{seq}.png", "scene_image", "playing")
+    changes = {"imageUrl": image_url, "imageStatus": IMAGE_READY} if image_url else {"imageStatus": IMAGE_FAILED}
+    if not image_url:
+        record_fallback("scene_image_failed", "playing")
+    app.state.game_store.patch_log(game_id, turn, seq, changes)
+    print(f"🖼️ 情景画像: {game_id} ターン{turn} {changes['imageStatus']} ({time.perf_counter() - started:.1f}s)")
+
+def recover_scene_image_task(game_id: str, turn: int, seq: int):
+    """生成を始めてから SCENE_IMAGE_RECOVERY_SECONDS 経っても pending のままの情景画像を failed にする"""
+    store = app.state.game_store
+    entry = store.find_log(game_id, turn, 'gm_response')
+    if not entry or entry.get('seq') != seq or entry.get('imageStatus') != IMAGE_PENDING:
+        return {"status": "done"}
+    store.patch_log(game_id, turn, seq, {"imageStatus": IMAGE_FAILED})
+    record_fallback("scene_image_lost", "playing")
+    print(f"♻️ 生成が失われた情景画像を失敗扱いに: {game_id} ターン{turn}")
+    return {"status": IMAGE_FAILED}
 
 # --- プレイ中動画生成機能（将来実装） ---
 # 注意: 現在は実装していません。理由：
@@ -859,31 +1353,128 @@ High quality animation, 4 seconds duration
 #     """重要なターンでのみ動画生成を実行する将来実装用関数"""
 #     pass
 
-def generate_gm_response_task(game_id: str):
-    try:
-        # グローバルなアプリインスタンスを取得
-        db_client = firestore.client()
-        gemini_model = None
-        
-        # 環境変数からVertex AI設定を取得してモデルを初期化
-        PROJECT_ID = os.getenv("PROJECT_ID")
-        LOCATION = os.getenv("LOCATION")
-        if PROJECT_ID and LOCATION:
+GM_HISTORY_PLACEHOLDER = "{{GAME_HISTORY}}"
+
+class StreamedChatResponse:
+    """ストリーミング応答を集約した結果（テキスト、関数呼び出し、トークン使用量のみ保持）"""
+    def __init__(self, text: str, function_calls: list, usage_metadata=None):
+        self.text = text
+        self.function_calls = function_calls
+        self.usage_metadata = usage_metadata
+
+def send_message_streaming(chat, content, game_id: str, turn: int, **kwargs) -> StreamedChatResponse:
+    """
+    チャットにメッセージをストリーミングで送り、生成途中のナレーションをSSE購読者へ中継する。
+    関数呼び出しを含む場合も、チャンクをすべて受け取ってから集約結果を返す。
+    """
+    parser = GMOutputParser()
+    function_calls = []
+    usage_metadata = None
+    for chunk in chat.send_message(content, stream=True, **kwargs):
+        # 使用量は最後のチャンクに累計で載る
+        if getattr(chunk, 'usage_metadata', None) is not None:
+            usage_metadata = chunk.usage_metadata
+        if not chunk.candidates:
+            continue
+        candidate = chunk.candidates[0]
+        function_calls.extend(candidate.function_calls)
+        for part in candidate.content.parts:
             try:
-                vertexai.init(project=PROJECT_ID, location=LOCATION)
-                # Function Callingツール付きでモデルを初期化（ダイスロールと終了判定）
-                gemini_model = GenerativeModel("gemini-2.5-flash", tools=[scenario_tools])
-            except Exception as e:
-                print(f"Geminiモデル初期化エラー: {e}")
-        
-        game_ref = db_client.collection('games').document(game_id)
-        game_data = game_ref.get().to_dict()
+                text = part.text
+            except (AttributeError, ValueError):
+                continue  # 関数呼び出しパート
+            if text:
+                turn_stream_hub.publish(game_id, turn, parser.feed(text))
+    return StreamedChatResponse(parser.text, function_calls, usage_metadata)
+
+# GM応答のJSONモード。現行のGeminiでは関数呼び出しと併用できないため、既定ではツール無しの生成でのみ使う。
+# 併用できるモデルでは GM_JSON_MODE_WITH_TOOLS=true で通常のGMターンにも適用する
+GM_JSON_CONFIG = GenerationConfig(response_mime_type="application/json", response_schema=GM_RESPONSE_SCHEMA)
+GM_JSON_MODE_WITH_TOOLS = os.getenv("GM_JSON_MODE_WITH_TOOLS", "false").lower() == "true"
+gm_json_kwargs = {"generation_config": GM_JSON_CONFIG} if GM_JSON_MODE_WITH_TOOLS else {}
+
+def generate_gm_json_response(prompt: str, tool_results: list, game_data: dict, usage: UsageTracker) -> str:
+    """関数の実行結果をプロンプトに含め、ツール無しのモデルでGM応答をスキーマどおりのJSONとして生成する"""
+    try:
+        json_model, json_model_name = select_text_model(game_data, phase="playing")
+        if not json_model:
+            return ""
+        results = "\n".join(f"- {result['name']}: {result['result']}" for result in tool_results) or "- なし"
+        response = json_model.generate_content(
+            prompt + "\n\n# 関数の実行結果\n" + results + "\n\n上記の結果を踏まえて、指定のJSON形式で応答してください。",
+            generation_config=GM_JSON_CONFIG
+        )
+        usage.record("gm_turn_follow_up", json_model_name, response)
+        return response.text.strip()
+    except Exception as e:
+        print(f"⚠️ JSONモードでのGM応答生成エラー: {e}")
+        return ""
+
+def refresh_history_summary(store, game_id: str):
+    """逐語ウィンドウから外れたターンをあらすじ(historySummary)に畳み込む"""
+    try:
+        game_data = store.get(game_id, field_paths=['conversation', 'historySummary', 'currentTurn', 'usage', BUDGET_FIELD]) or {}
+        pending = history_manager.pending_fold(game_data)
+        if not pending:
+            return
+
+        current_summary = (game_data.get('historySummary') or {}).get('text')
+        if not current_summary:
+            opening_logs = store.load_log(game_id, limit=1)
+            current_summary = opening_logs[0]['content'] if opening_logs else ""
+
+        summary_model, model_name = select_text_model(game_data, phase="playing")
+        if not summary_model:
+            return
+        response = summary_model.generate_content(history_manager.build_summary_prompt(current_summary, pending))
+        usage = UsageTracker()
+        usage.record("history_summary", model_name, response)
+        through_turn = pending[-1]['turn']
+        store.update(game_id, {"historySummary": history_manager.summary_update(response.text.strip(), through_turn), **usage.updates()})
+        print(f"📚 あらすじ更新完了: ターン{through_turn}まで")
+    except Exception as e:
+        print(f"⚠️ あらすじ更新に失敗: {e}")
+
+def generate_gm_response_task(game_id: str, turn: Optional[int] = None, lease_owner: Optional[str] = None, final_attempt: bool = True):
+    """
+    全員の行動が揃ったターンのGM応答を生成してターンを確定する。
+    lease_owner を省略した場合はここでターン解決のリースを取得し、取得できなければ何もしない。
+    final_attempt が False の場合、ターン確定前のモデル呼び出しや通信の失敗はリースを手放して例外のまま送出し、
+    ジョブの再試行に任せる（エラー時のナレーションでターンを進めるのは最後の試行だけ）。
+    """
+    usage = UsageTracker()
+    committed = None
+    try:
+        # グローバルなアプリインスタンスの保存先を使う
+        store = app.state.game_store
+
+        if lease_owner is None:
+            acquired = acquire_turn_lease(store, game_id, turn)
+            if not acquired:
+                print(f"⏭️ ターン解決のリースを取得できないためスキップ: {game_id}")
+                return
+            turn, lease_owner = acquired
+
+        stages = StageTimer("playing")
+        game_data = store.get(game_id)
+        verify_lease(game_data, turn, lease_owner)
+        # Function Callingツール付きモデル（起動時に生成済みのハンドルを共有）
+        gemini_model, model_name = select_text_model(game_data, tools=True, phase="playing")
+        stages.model = model_name
+        guard = lease_guard(turn, lease_owner)
+        turn_stream_hub.start(game_id, turn)
 
         scenario = next((s for s in game_data['scenarioOptions'] if s['id'] == game_data['decidedScenarioId']), None)
-        game_history = "\n".join([f"{log['type']} ({log.get('playerId', 'GM')}): {log['content']}" for log in game_data.get('gameLog', [])])
+        # あらすじが未作成の間はオープニングナレーションを物語の起点として使う
+        opening_narration = ""
+        if not (game_data.get('historySummary') or {}).get('text'):
+            opening_logs = store.load_log(game_id, game_data, limit=1)
+            opening_narration = opening_logs[0]['content'] if opening_logs else ""
+        stages.lap("gm_load_game", model="")
         
         # プレイヤーアクションの安全な構築
         player_actions_list = []
+        player_actions_by_name = {}
         for uid, action in game_data.get('playerActionsThisTurn', {}).items():
             try:
                 player_data = game_data.get('players', {}).get(uid, {})
@@ -896,9 +1487,11 @@ def generate_gm_response_task(game_id: str):
                     character_name = str(character_name) if character_name else f"プレイヤー{uid[:8]}"
                 
                 player_actions_list.append(f"- {character_name}: {action}")
+                player_actions_by_name[character_name] = action
             except Exception as e:
                 print(f"⚠️ プレイヤーアクション構築エラー (UID: {uid}): {e}")
                 player_actions_list.append(f"- プレイヤー{uid[:8]}: {action}")
+                player_actions_by_name[f"プレイヤー{uid[:8]}"] = action
         
         player_actions = "\n".join(player_actions_list)
         
@@ -914,20 +1507,12 @@ def generate_gm_response_task(game_id: str):
         primary_objectives_str = str(primary_objectives)
         current_turn_str = str(current_turn)
         max_turns_str = str(max_turns)
-        game_history_str = str(game_history)
         player_actions_str = str(player_actions)
-        
-        prompt = """あなたはTRPGの熟練ゲームマスターです。
-以下の状況に基づき、物語の次の展開を生成してください。
+        achieved_objectives_str = progress_prompt_line(end_conditions)
+        final_turn_note = "\n※ 最終ターンです。今回の描写で物語を締めくくってください。" if current_turn >= max_turns else ""
 
-# ルール
-- プレイヤーの行動が成功/失敗の判定を必要とする場合、必ず `roll_dice` 関数を使用してください。
-- 例: 「鍵のかかった扉を開けようとする」→ `roll_dice(num_dice=1, num_sides=20)` で判定
-- 例: 「剣で攻撃する」→ `roll_dice(num_dice=1, num_sides=20)` で命中判定、成功なら `roll_dice(num_dice=1, num_sides=8)` でダメージ
-- 例: 「魔法を唱える」→ `roll_dice(num_dice=1, num_sides=20)` で成功判定
-- ダイスロールの結果に基づいて、物語の展開を記述してください。
-- 判定が不要な行動（会話、移動など）はダイスロールを使わずに進めてください。
-- 重要な進展があった場合、必ず `check_scenario_completion` 関数を使用してシナリオの完了状況を確認してください。
+        if SCENARIO_COMPLETION_TOOL_ENABLED:
+            completion_rules = """- 重要な進展があった場合、必ず `check_scenario_completion` 関数を使用してシナリオの完了状況を確認してください。
 - `completion_percentage`は部分達成や進捗度合いを含めて総合的に判断してください：
   * 目標の半分が達成 → 50%
   * 重要な手がかりを発見したが解決に至らず → 25-40%
@@ -945,17 +1530,40 @@ def generate_gm_response_task(game_id: str):
   * 目標達成が不可能になった絶望的状況
   * プレイヤーが冒険を完全に諦めた場合
   * その他ゲームを続行できない状況
+"""
+            completion_task = "3. 重要な目標が達成されたり、大きな進展があった場合は `check_scenario_completion` を呼び出してください。"
+        else:
+            # 完了判定はサーバー側で行う。モデルにはJSONで達成した目標と状況を申告してもらう
+            completion_rules = """- 今回の描写で新たに達成された主要目標があれば、`achievedObjectives` に主要目標の文言のまま列挙してください。
+- 物語として一区切りついた場合は `scenarioStatus` を "completed"、全滅・行動不能などで続行できない場合は "failed"、それ以外は "ongoing" にしてください。
+"""
+            completion_task = "3. 達成された目標と物語の状況を、下のJSONの `achievedObjectives` と `scenarioStatus` で申告してください。"
+        
+        prompt = """あなたはTRPGの熟練ゲームマスターです。
+以下の状況に基づき、物語の次の展開を生成してください。
 
+# ルール
+- プレイヤーの行動が成功/失敗の判定を必要とする場合、必ず `roll_dice` 関数を使用してください。
+- 例: 「鍵のかかった扉を開けようとする」→ `roll_dice(expression="1d20+dex", player_id="キャラクター名")` で判定
+- 例: 「剣で攻撃する」→ `roll_dice(expression="1d20+str", player_id="キャラクター名")` で命中判定、成功なら `roll_dice(expression="1d8+str", player_id="キャラクター名")` でダメージ
+- 例: 「魔法を唱える」→ `roll_dice(expression="1d20+int", player_id="キャラクター名")` で成功判定
+- 有利な状況では `1d20+dex adv`、不利な状況では `1d20+dex dis` のように指定してください。
+- 判定には難易度 `dc`（簡単10、普通15、難しい20）を指定してください。結果に成否と振る前の成功率が含まれるので、成功率の低い判定に成功した場合は劇的に描写してください。
+- 難易度を決める前に成功率を確かめたい場合は `check_dice_odds` を使えます（ダイスは振られません）。
+- ダイスロールの結果に基づいて、物語の展開を記述してください。
+- 判定が不要な行動（会話、移動など）はダイスロールを使わずに進めてください。
+""" + completion_rules + """
 # 世界観
 シナリオ: """ + scenario_title + """
 あらすじ: """ + scenario_summary + """
 
 # シナリオ目標
 主要目標: """ + primary_objectives_str + """
-現在ターン: """ + current_turn_str + """/""" + max_turns_str + """
+達成済みの目標: """ + achieved_objectives_str + """
+現在ターン: """ + current_turn_str + """/""" + max_turns_str + final_turn_note + """
 
 # これまでの物語
-""" + game_history_str + """
+""" + GM_HISTORY_PLACEHOLDER + """
 
 # 今回のプレイヤーの行動
 """ + player_actions_str + """
@@ -963,406 +1571,155 @@ def generate_gm_response_task(game_id: str):
 # あなたのタスク
 1. 各プレイヤーの行動を評価し、必要に応じて `roll_dice` を呼び出してください。
 2. ダイスロールの結果を含めて、物語の次の状況を具体的に描写してください。
-3. 重要な目標が達成されたり、大きな進展があった場合は `check_scenario_completion` を呼び出してください。
+""" + completion_task + """
 4. 応答は必ずこの正確なJSON形式で出力してください（他の形式は使用しないでください）：
 {
   "narration": "物語の状況描写（日本語で詳細に）",
-  "imagePrompt": "情景画像生成用の英語プロンプト（null可）"
+  "imagePrompt": "情景画像生成用の英語プロンプト（null可）",
+  "achievedObjectives": ["今回達成された主要目標（無ければ空）"],
+  "scenarioStatus": "ongoing"
 }
 
 重要：フィールド名は「narration」と「imagePrompt」を必ず使用してください。「gm_narration」など他の名前は使用しないでください。"""
         
+        # 履歴以外の部分を差し引いたトークン予算の範囲で「これまでの物語」を埋め込む
+        game_history_str = history_manager.build_history(game_data, opening_narration, estimate_tokens(prompt))
+        prompt = prompt.replace(GM_HISTORY_PLACEHOLDER, game_history_str)
+        print(f"📏 GMプロンプト推定トークン数: {estimate_tokens(prompt)} / {history_manager.token_budget}")
+        stages.lap("gm_build_prompt", model="")
+        
         narration = "システムの準備中です。アクションを入力して冒険を開始してください。"
         image_prompt = None
+        tool_results = []  # 会話差分として保存するツール実行結果
+        dice_roll_index = 0  # ターン内のロール番号（同じターンを再実行しても同じ出目にする）
+        gm_hints = {}  # GMのJSON出力（達成した目標・物語の状況の申告）
+        pending_logs = []  # ターン確定の書き込みで一緒に保存するダイスロールのログ
+        turn_completion = None  # このターンでシナリオが完了した場合の completionResult
 
         if gemini_model:
             print(f"🤖 Geminiモデル利用可能 - GM応答生成開始")
             try:
-                # チャット履歴をFirestoreから取得（一時的に履歴復元を無効化して安定化）
-                chat_history = game_data.get('chatHistory', [])
-                
-                if chat_history:
-                    print(f"📚 {len(chat_history)}件のチャット履歴が存在（一時的に無効化中）")
-                    
-                    # デバッグ: チャット履歴の内容を詳細確認
-                    for i, entry in enumerate(chat_history):
-                        print(f"🔍 履歴エントリ{i}: {type(entry)}, キー: {entry.keys() if isinstance(entry, dict) else 'N/A'}")
-                        if isinstance(entry, dict):
-                            print(f"🔍 role: {entry.get('role', 'None')}, content型: {type(entry.get('content', 'None'))}")
-                            content_preview = str(entry.get('content', 'None'))[:50]
-                            print(f"🔍 content内容: {content_preview}...")
-                
-                # 常に新しいセッションを開始（履歴復元を一時的に無効化）
+                # プロンプトに物語の履歴を含めているため、毎ターン新しいセッションを開始する
                 try:
                     chat = gemini_model.start_chat()
-                    print(f"✅ 新しいチャットセッション開始成功（履歴復元一時無効）")
+                    print(f"✅ 新しいチャットセッション開始成功")
                 except Exception as start_chat_error:
                     print(f"🚨 start_chat()エラー: {start_chat_error}")
                     print(f"🔍 Geminiモデル型: {type(gemini_model)}")
                     print(f"🔍 Geminiモデル属性: {dir(gemini_model)}")
                     raise start_chat_error
                 
-                response = chat.send_message(prompt, tools=[scenario_tools], safety_settings={
+                response = send_message_streaming(chat, prompt, game_id, current_turn, tools=[scenario_tools], safety_settings={
                     HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
                     HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
                     HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
                     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                })
+                }, **gm_json_kwargs)
+                usage.record("gm_turn", model_name, response)
+                stages.lap("gm_send_message")
 
-                # Function Callingの処理 - 複数関数呼び出し対応
+                # Function Callingの処理：1回の応答に含まれる呼び出しは並列に実行し、結果をまとめて返す。
+                # 攻撃→ダメージのような連続した判定のため、最大 GM_MAX_TOOL_ROUNDS 往復まで繰り返す
                 function_responses = []
-                
-                if response.candidates and response.candidates[0].function_calls:
-                    print(f"🛠️ Function Call要求数: {len(response.candidates[0].function_calls)}")
-                    
-                    for function_call in response.candidates[0].function_calls:
-                        if hasattr(function_call, 'name') and hasattr(function_call, 'args'):
-                            
-                            if function_call.name == "roll_dice":
-                                try:
-                                    # ダイスロール実行（ゲームデータを含む）
-                                    args = dict(function_call.args)
-                                    args['game_data'] = game_data  # ゲームデータを追加
-                                    dice_results = roll_dice(**args)
-                                    print(f"🎲 ダイスロール実行: {function_call.args['num_dice']}d{function_call.args['num_sides']} -> {dice_results.get('rolls', [])} (合計: {dice_results.get('total', 'エラー')}, 最終: {dice_results.get('final_total', 'エラー')})")
-                                    
-                                    # ダイスロール結果をログに記録
-                                    if dice_results.get('error'):
-                                        log_content = f"ダイスロールエラー: {dice_results.get('error')}"
-                                    else:
-                                        # 能力値修正が適用されている場合の表示
-                                        dice_total = dice_results.get('total', 0)
-                                        final_total = dice_results.get('final_total', dice_total)
-                                        modifier = dice_results.get('modifier', 0)
-                                        ability_used = dice_results.get('ability_used', '')
-                                        
-                                        if modifier != 0:
-                                            modifier_text = f" + {modifier}" if modifier > 0 else f" {modifier}"
-                                            ability_text = f" ({ability_used})" if ability_used else ""
-                                            log_content = f"ダイスロール ({function_call.args['num_dice']}d{function_call.args['num_sides']}{modifier_text}{ability_text}): {dice_results.get('rolls', [])} (合計: {final_total})"
-                                        else:
-                                            log_content = f"ダイスロール ({function_call.args['num_dice']}d{function_call.args['num_sides']}): {dice_results.get('rolls', [])} (合計: {dice_total})"
-
-                                    dice_log_entry = GameLog(
-                                        turn=current_turn,
-                                        type='dice_roll',
-                                        content=log_content,
-                                        playerId='GM'
-                                    )
-                                    game_ref.update({"gameLog": firestore.ArrayUnion([dice_log_entry.model_dump()])})
-                                    
-                                    # Function Response作成
-                                    function_responses.append(
-                                        Part.from_function_response(
-                                            name="roll_dice",
-                                            response=dice_results
-                                        )
-                                    )
-
-                                except Exception as e:
-                                    print(f"🚨 ダイスロール関数の実行エラー: {e}")
-                                    function_responses.append(
-                                        Part.from_function_response(
-                                            name="roll_dice", 
-                                            response={"error": str(e)}
-                                        )
-                                    )
-                            
-                            elif function_call.name == "check_scenario_completion":
-                                try:
-                                    print(f"🎯 終了判定実行中...")
-                                    completion_result = check_scenario_completion(**function_call.args)
-                                    print(f"📊 終了判定結果: {completion_result}")
-                                    
-                                    # 終了判定結果をFirestoreに保存
-                                    print(f"🔍 終了判定結果チェック: error={completion_result.get('error')}, is_completed={completion_result.get('is_completed')}")
-                                    if not completion_result.get('error') and completion_result.get('is_completed'):
-                                        game_ref.update({
-                                            "completionResult": completion_result,
-                                            "gameStatus": "completed"
-                                        })
-                                        print(f"🏁 シナリオ完了！エピローグフェーズに移行: {game_id}")
-                                    elif completion_result.get('is_completed'):
-                                        # エラーがあってもis_completedがtrueなら完了とする
-                                        print(f"⚠️ エラーがありますが、is_completed=trueのため完了処理を実行")
-                                        game_ref.update({
-                                            "completionResult": completion_result,
-                                            "gameStatus": "completed"
-                                        })
-                                        print(f"🏁 シナリオ完了！エピローグフェーズに移行: {game_id}")
-                                    
-                                    # Function Response作成 - シンプルな形式
-                                    simple_result = {
-                                        "completion_percentage": completion_result.get("completion_percentage", 0),
-                                        "is_completed": completion_result.get("is_completed", False),
-                                        "ending_type": completion_result.get("ending_type", "ongoing")
-                                    }
-                                    function_responses.append(
-                                        Part.from_function_response(
-                                            name="check_scenario_completion",
-                                            response=simple_result
-                                        )
-                                    )
-
-                                except Exception as e:
-                                    print(f"🚨 終了判定関数の実行エラー: {e}")
-                                    function_responses.append(
-                                        Part.from_function_response(
-                                            name="check_scenario_completion", 
-                                            response={"error": str(e)}
-                                        )
-                                    )
-                            else:
-                                # 未知の関数の場合
-                                print(f"⚠️ 未知の関数呼び出し: {function_call.name}")
-                                function_responses.append(
-                                    Part.from_function_response(
-                                        name=function_call.name, 
-                                        response={"error": f"Unknown function: {function_call.name}"}
-                                    )
-                                )
-                        
-                    # すべてのFunction Responseを一度にGeminiに送信（最新仕様対応）
-                    if function_responses:
-                        try:
-                            print(f"📤 {len(function_responses)}個のFunction Response結果をGeminiに送信中...")
-                            from vertexai.generative_models import Content
-                            response_with_tool_result = chat.send_message(
-                                Content(
-                                    role="user",
-                                    parts=function_responses
-                                )
-                            )
-                            
-                            # より堅牢な応答テキスト抽出（修正版）
-                            response_text = ""
-                            
-                            try:
-                                # 最新のVertex AI SDK応答構造に対応した抽出方法
-                                print(f"🔍 response_with_tool_result型: {type(response_with_tool_result)}")
-                                
-                                # 方法1: 直接textプロパティからの取得
-                                if hasattr(response_with_tool_result, 'text') and response_with_tool_result.text:
-                                    response_text = response_with_tool_result.text.strip()
-                                    print(f"✅ 直接text取得成功: {len(response_text)}文字")
-                                
-                                # 方法2: candidatesからのテキスト抽出（フォールバック）
-                                elif (hasattr(response_with_tool_result, 'candidates') and 
-                                      response_with_tool_result.candidates and 
-                                      len(response_with_tool_result.candidates) > 0):
-                                    
-                                    candidate = response_with_tool_result.candidates[0]
-                                    
-                                    # candidateが直接textを持つ場合
-                                    if hasattr(candidate, 'text') and candidate.text:
-                                        response_text = candidate.text.strip()
-                                        print(f"✅ candidate.text取得成功: {len(response_text)}文字")
-                                    
-                                    # candidate.content.partsから抽出
-                                    elif (hasattr(candidate, 'content') and 
-                                          hasattr(candidate.content, 'parts') and 
-                                          candidate.content.parts):
-                                        
-                                        text_parts = []
-                                        for part in candidate.content.parts:
-                                            if hasattr(part, 'text') and part.text and part.text.strip():
-                                                text_parts.append(part.text.strip())
-                                        
-                                        if text_parts:
-                                            response_text = " ".join(text_parts)
-                                            print(f"✅ parts text取得成功: {len(text_parts)}パート, {len(response_text)}文字")
-                                
-                                # どちらの方法でも取得できない場合 - 追加応答生成を試行
-                                if not response_text:
-                                    print(f"⚠️ テキスト抽出失敗 - Function Call後の追加応答生成を試行")
-                                    try:
-                                        # Function Call完了後、追加でテキスト応答を要求
-                                        follow_up_prompt = "上記のFunction Call結果を踏まえて、ゲームマスターとして次の展開を日本語のナレーションで描写してください。JSON形式は不要で、直接的な物語の描写をお願いします。"
-                                        follow_up_response = chat.send_message(follow_up_prompt)
-                                        
-                                        if hasattr(follow_up_response, 'text') and follow_up_response.text:
-                                            response_text = follow_up_response.text.strip()
-                                            print(f"✅ 追加応答生成成功: {len(response_text)}文字")
-                                        elif (hasattr(follow_up_response, 'candidates') and 
-                                              follow_up_response.candidates and 
-                                              follow_up_response.candidates[0].content.parts):
-                                            text_parts = []
-                                            for part in follow_up_response.candidates[0].content.parts:
-                                                if hasattr(part, 'text') and part.text and part.text.strip():
-                                                    text_parts.append(part.text.strip())
-                                            if text_parts:
-                                                response_text = " ".join(text_parts)
-                                                print(f"✅ 追加応答parts取得成功: {len(response_text)}文字")
-                                    except Exception as follow_up_error:
-                                        print(f"⚠️ 追加応答生成エラー: {follow_up_error}")
-                                    
-                                    if not response_text:
-                                        print(f"⚠️ 全ての応答取得方法が失敗 - フォールバック処理へ")
-                                        
-                            except Exception as extraction_error:
-                                print(f"⚠️ 応答テキスト抽出エラー: {extraction_error}")
-                                import traceback
-                                print(f"🔍 抽出エラースタックトレース: {traceback.format_exc()}")
-                            
-                            # JSONパースとフォールバック処理
-                            if response_text:
-                                # まず、テキストがJSONかプレーンテキストかを判定
-                                response_text_cleaned = response_text.strip()
-                                
-                                # JSONの可能性があるかチェック
-                                looks_like_json = (response_text_cleaned.startswith('{') or 
-                                                 response_text_cleaned.startswith('```json') or 
-                                                 '"narration"' in response_text_cleaned or 
-                                                 '"imagePrompt"' in response_text_cleaned)
-                                
-                                if looks_like_json:
-                                    try:
-                                        # より厳密なテキストクリーニング
-                                        cleaned_text = response_text.strip()
-                                        
-                                        # BOMと制御文字を除去
-                                        import re
-                                        cleaned_text = re.sub(r'^\ufeff', '', cleaned_text)  # BOM除去
-                                        cleaned_text = re.sub(r'^[\x00-\x1f\x7f-\x9f]+', '', cleaned_text)  # 制御文字除去
-                                        
-                                        # マークダウンJSONブロックを削除
-                                        if cleaned_text.startswith('```json'):
-                                            cleaned_text = cleaned_text[7:]
-                                        if cleaned_text.endswith('```'):
-                                            cleaned_text = cleaned_text[:-3]
-                                        
-                                        # 先頭の余分な文字（クォート、カンマなど）を除去
-                                        cleaned_text = re.sub(r'^[",\s]*', '', cleaned_text)
-                                        
-                                        # JSONの開始を探して修正
-                                        if not cleaned_text.startswith('{'):
-                                            # JSONの開始を探す
-                                            json_start = cleaned_text.find('{')
-                                            if json_start != -1:
-                                                cleaned_text = cleaned_text[json_start:]
-                                        
-                                        cleaned_text = cleaned_text.strip()
-                                        print(f"🔍 クリーニング後のテキスト (最初の100文字): {cleaned_text[:100]}")
-                                        
-                                        gm_response = json.loads(cleaned_text)
-                                        # 複数の可能なフィールド名をチェック（寛容な処理）
-                                        if isinstance(gm_response, dict):
-                                            narration = (gm_response.get('narration') or 
-                                                       gm_response.get('gm_narration') or 
-                                                       gm_response.get('text') or 
-                                                       response_text)
-                                            image_prompt = (gm_response.get('imagePrompt') or 
-                                                          gm_response.get('image_prompt') or 
-                                                          gm_response.get('imageUrl'))
-                                        else:
-                                            narration = response_text
-                                            image_prompt = None
-                                        print(f"✅ JSON解析成功")
-                                    except json.JSONDecodeError as json_error:
-                                        print(f"⚠️ JSON解析失敗: {json_error}")
-                                        print(f"🔍 クリーニング前テキスト: {response_text[:100]}...")
-                                        print(f"🔍 クリーニング後テキスト: {cleaned_text[:100]}...")
-                                        
-                                        # JSON解析失敗時は画像プロンプトと思われる部分を除去してナレーションを抽出
-                                        if '"imagePrompt"' in response_text:
-                                            # imagePromptを含むJSONの可能性があるので、ナレーション部分だけ抽出を試みる
-                                            narration_match = re.search(r'"narration":\s*"([^"]*)"', response_text)
-                                            if narration_match:
-                                                narration = narration_match.group(1)
-                                            else:
-                                                narration = "応答の解析に失敗しました。もう一度アクションをお試しください。"
-                                            print(f"🔍 画像プロンプト付きJSON検出、ナレーション抽出: {narration[:50]}...")
-                                        else:
-                                            # 通常のテキスト応答として処理
-                                            narration = response_text if len(response_text) < 1000 else response_text[:1000] + "...(応答が長すぎます。別のアクションをお試しください。)"
-                                        
-                                        image_prompt = None
-                                else:
-                                    # プレーンテキストのナレーション（JSONではない）
-                                    print(f"✅ プレーンテキストナレーション検出: {len(response_text)}文字")
-                                    narration = response_text if len(response_text) < 2000 else response_text[:2000] + "..."
-                                    image_prompt = None
-                            else:
-                                print(f"⚠️ 有効な応答テキストが取得できませんでした")
-                                print(f"🔍 Function Call結果をデバッグ表示:")
-                                for i, func_resp in enumerate(function_responses):
-                                    print(f"  Response {i}: {func_resp}")
-                                
-                                # フォールバック: Function Call結果を基に応答を生成
-                                if function_responses:
-                                    try:
-                                        # Function Call結果の詳細から応答を構築
-                                        func_result = function_responses[0].function_response.response
-                                        if 'is_completed' in func_result and func_result['is_completed']:
-                                            narration = f"冒険は完了しました！完了率: {func_result.get('completion_percentage', 0):.1f}%"
-                                        else:
-                                            narration = "申し訳ありません。一時的な問題が発生しました。別のアクションで冒険を続けてみてください。"
-                                    except Exception as fallback_error:
-                                        print(f"⚠️ フォールバック応答生成エラー: {fallback_error}")
-                                        narration = "システムの調子が良くないようです。しばらく時間を置いてから、別のアクションをお試しください。"
-                                else:
-                                    narration = "処理中に問題が発生しました。別のアクションで物語を進めてみてください。"
-                                image_prompt = None
-                            
-                            print(f"✅ Function Calling後の応答取得: {len(response_text)}文字")
-                        except Exception as e:
-                            print(f"🚨 Function Response送信エラー: {e}")
-                            print(f"🔍 エラー詳細: {type(e).__name__}")
-                            import traceback
-                            print(f"🔍 スタックトレース: {traceback.format_exc()}")
-                            # エラー時でも基本的な応答を返す
-                            response_text = ""
-                    else:
-                        print("⚠️ 送信するFunction Responseがありません")
-                        response_text = ""
-                
-                else:
+                tool_round = 0
+                tool_round_failed = False
+                response_text = ""
+                try:
+                    while response.function_calls:
+                        function_calls = [fc for fc in response.function_calls if hasattr(fc, 'name') and hasattr(fc, 'args')]
+                        if not function_calls:
+                            print("⚠️ 送信するFunction Responseがありません")
+                            break
+                        tool_round += 1
+                        limit_reached = tool_round > GM_MAX_TOOL_ROUNDS
+                        print(f"🛠️ Function Call要求数: {len(function_calls)}（{tool_round}往復目）")
+                        if limit_reached:
+                            # 上限を超えた呼び出しは実行せず、最終応答を促す
+                            record_fallback("tool_round_limit", "playing")
+                            outcomes = [{"name": fc.name, "response": {"error": TOOL_LIMIT_MESSAGE}, "log": None, "tool_result": None, "completion": None} for fc in function_calls]
+                        else:
+                            outcomes = run_gm_tool_round(function_calls, game_id, game_data, current_turn, dice_roll_index)
+                            dice_roll_index += sum(1 for fc in function_calls if fc.name == "roll_dice")
+
+                        function_responses = []
+                        for outcome in outcomes:
+                            if outcome["log"]:
+                                pending_logs.append(GameLog(
+                                    turn=current_turn,
+                                    type='dice_roll',
+                                    content=outcome["log"],
+                                    playerId='GM'
+                                ))
+                            if outcome["tool_result"]:
+                                tool_results.append({"name": outcome["name"], "result": outcome["tool_result"]})
+                            if outcome["completion"]:
+                                turn_completion = outcome["completion"]
+                            function_responses.append(Part.from_function_response(name=outcome["name"], response=outcome["response"]))
+                        stages.lap("gm_tool_execution", model="")
+
+                        # すべてのFunction Responseを一度にGeminiに送信（最新仕様対応）
+                        print(f"📤 {len(function_responses)}個のFunction Response結果をGeminiに送信中...")
+                        from vertexai.generative_models import Content
+                        response = send_message_streaming(
+                            chat,
+                            Content(
+                                role="user",
+                                parts=function_responses
+                            ),
+                            game_id,
+                            current_turn,
+                            **gm_json_kwargs
+                        )
+                        usage.record("gm_turn_tool_result", model_name, response)
+                        stages.lap("gm_tool_result_send_message")
+                        if limit_reached:
+                            break
+                except Exception as e:
+                    if not final_attempt:
+                        raise
+                    tool_round_failed = True
+                    print(f"🚨 Function Response送信エラー: {e}")
+                    print(f"🔍 エラー詳細: {type(e).__name__}")
+                    import traceback
+                    print(f"🔍 スタックトレース: {traceback.format_exc()}")
+
+                if tool_round and not tool_round_failed:
+                    response_text = response.text.strip()
+                    if not response_text:
+                        # 関数の実行結果を受けても本文が返らなかった場合は、JSONモードで一度だけ生成し直す
+                        record_fallback("follow_up_prompt", "playing")
+                        print(f"⚠️ Function Call後の応答が空 - JSONモードで再生成")
+                        response_text = generate_gm_json_response(prompt, tool_results, game_data, usage)
+                        stages.lap("gm_follow_up_send_message")
+                elif not tool_round:
                     # Function Callingが不要の場合、直接レスポンステキストを処理
                     print(f"💬 通常応答（Function Calling不要）")
-                    response_text = ""
-                    if hasattr(response, 'text') and response.text:
-                        response_text = response.text.strip()
-                    elif response.candidates and response.candidates[0].content.parts:
-                        text_parts = []
-                        for part in response.candidates[0].content.parts:
-                            if hasattr(part, 'text') and part.text:
-                                text_parts.append(part.text.strip())
-                        response_text = " ".join(text_parts) if text_parts else ""
-                
-                # 最終レスポンス処理
-                if response_text:
-                    try:
-                        # マークダウンJSONブロックを削除
-                        cleaned_text = response_text.strip()
-                        if cleaned_text.startswith('```json'):
-                            cleaned_text = cleaned_text[7:]
-                        if cleaned_text.endswith('```'):
-                            cleaned_text = cleaned_text[:-3]
-                        cleaned_text = cleaned_text.strip()
-                        
-                        gm_response = json.loads(cleaned_text)
-                        # 複数の可能なフィールド名をチェック（寛容な処理）
-                        narration = (gm_response.get('narration') or 
-                                   gm_response.get('gm_narration') or 
-                                   gm_response.get('text') or 
-                                   response_text)
-                        image_prompt = (gm_response.get('imagePrompt') or 
-                                      gm_response.get('image_prompt') or 
-                                      gm_response.get('imageUrl'))
-                        print(f"✅ JSON解析成功")
-                    except json.JSONDecodeError as json_error:
-                        print(f"⚠️ JSON解析失敗: {json_error}")
-                        print(f"🔍 応答テキスト内容: {response_text[:200]}...")
-                        # JSONでない場合は直接ナレーションとして使用
-                        narration = response_text if len(response_text) < 1000 else response_text[:1000] + "...(テキストが長すぎます。別のアクションをお試しください。)"
-                        image_prompt = None
-                else:
+                    response_text = response.text.strip()
+
+                # 最終レスポンス処理（軽微な崩れは補修して解析し、再生成は依頼しない）
+                gm_output = parse_gm_output(response_text)
+                if gm_output["format"] == "empty":
+                    record_fallback("empty_response", "playing")
                     print(f"⚠️ 有効な応答テキストが取得できませんでした")
-                    narration = "申し訳ありません。応答の生成に失敗しました。もう一度アクションをお試しください。"
+                    if turn_completion:
+                        narration = f"冒険は完了しました！完了率: {turn_completion.get('completion_percentage', 0):.1f}%"
+                    else:
+                        narration = "申し訳ありません。応答の生成に失敗しました。もう一度アクションをお試しください。"
                     image_prompt = None
+                else:
+                    if gm_output["format"] != "json":
+                        record_fallback(f"gm_output_{gm_output['format']}", "playing")
+                    print(f"✅ GM応答解析: {gm_output['format']} ({len(gm_output['narration'])}文字)")
+                    narration = gm_output["narration"]
+                    image_prompt = gm_output["imagePrompt"]
+                    gm_hints = gm_output["hints"]
                 
 
             except Exception as e:
+                stages.lap("gm_model_error")
+                if not final_attempt:
+                    raise
+                record_fallback("model_error", "playing")
                 print(f"🚨 Gemini応答生成エラー: {e}")
                 import traceback
                 print(f"🔍 Gemini応答生成エラースタックトレース: {traceback.format_exc()}")
@@ -1370,75 +1727,262 @@ def generate_gm_response_task(game_id: str):
                 narration = "申し訳ありません。一時的な問題が発生しました。少し時間を置いてから、別のアクションで冒険を続けてみてください。"
                 image_prompt = None
 
-        # 画像生成（プレースホルダー）
-        image_url = None
-        if image_prompt:
-            # 実際にはImagen APIで画像を生成
-            image_url = "https://picsum.photos/600/400?random=scene"
+        stages.lap("gm_json_cleanup", model="")
 
-        # ゲームログに追加
+        # 目標の進捗をサーバー側で更新し、終了条件を満たせばこのターンでシナリオを終える
+        objective_progress, tracked_completion = track_objectives(
+            end_conditions, game_data.get('currentTurn', 1), narration, gm_hints if isinstance(gm_hints, dict) else {}
+        )
+        if turn_completion is None and tracked_completion:
+            turn_completion = tracked_completion
+            record_fallback(f"completion_{tracked_completion['end_reason']}", "playing")
+        print(f"🎯 目標進捗: {objective_progress['completion_percentage']}% {objective_progress['achieved_objectives']}")
+        stages.lap("gm_objective_tracking", model="")
+
+        # 情景画像はターン確定後にバックグラウンドで生成する（ここでは生成枠の確保だけ）
         current_turn = game_data.get('currentTurn', 1)
+        scene_image = reserve_scene_image(game_id, current_turn, image_prompt)
+        image_url = scene_image.get("imageUrl")
+
+        # ゲームログに追加
         log_entry = GameLog(
             turn=current_turn,
             type='gm_response',
             content=narration,
-            imageUrl=image_url
+            **scene_image
         )
 
-        # チャット履歴を更新（ユーザーメッセージと応答を保存）
-        current_chat_history = game_data.get('chatHistory', [])
-        current_chat_history.append({
-            'role': 'user',
-            'content': prompt,
-            'timestamp': datetime.utcnow().isoformat()
-        })
-        current_chat_history.append({
-            'role': 'model', 
-            'content': narration,
-            'timestamp': datetime.utcnow().isoformat()
-        })
+        # 会話履歴にはこのターンの差分だけを保存する（保持ターン数を超えた分のうち、あらすじに畳み込み済みの差分は破棄）
+        conversation = append_turn_delta(
+            game_data.get('conversation'),
+            build_turn_delta(current_turn, player_actions_by_name, tool_results, narration),
+            folded_through=(game_data.get('historySummary') or {}).get('throughTurn', 0)
+        )
         
         # ゲーム状態を更新
         update_data = {
-            "gameLog": firestore.ArrayUnion([log_entry.model_dump()]),
             "currentTurn": current_turn + 1,
             "playerActionsThisTurn": {},  # 次のターンのためにリセット
-            "chatHistory": current_chat_history  # チャット履歴を保存
+            "conversation": conversation,
+            "chatHistory": firestore.DELETE_FIELD,  # 旧形式の全文履歴は削除
+            PROGRESS_FIELD: objective_progress,
+            **release_update(),
+            **usage.updates()
         }
+        if turn_completion:
+            update_data["completionResult"] = turn_completion
+            update_data["gameStatus"] = "completed"
+            print(f"🏁 シナリオ完了（{turn_completion.get('end_reason')}）！エピローグフェーズに移行: {game_id}")
         
-        game_ref.update(update_data)
+        # リースを保持している場合のみターンを確定する（期限切れで奪われていれば破棄）
+        try:
+            committed = store.append_log(game_id, pending_logs + [log_entry], update_data, precondition=guard)
+        except Exception:
+            if scene_image.get("imageStatus") == IMAGE_PENDING:
+                scene_image_scheduler.release(game_id)
+            raise
+        stages.lap("gm_final_write", model="")
+        if scene_image.get("imageStatus") == IMAGE_PENDING:
+            start_scene_image(game_id, current_turn, committed["logSeq"], image_prompt)
+        turn_stream_hub.finish(game_id, current_turn, narration, image_url)
         print(f"✅ GM応答生成完了: {game_id}")
         print(f"📝 応答内容: {narration[:100]}...")
         print(f"🔄 ターン更新: {current_turn} -> {current_turn + 1}")
 
+        # ターン確定後にあらすじを更新（次のターンまでに間に合わなければ逐語履歴で補う）
+        refresh_history_summary(store, game_id)
+        stages.lap("gm_history_summary")
+
+    except TurnLeaseLost as e:
+        print(f"⏭️ ターン解決のリースを失ったため結果を破棄: {game_id} ({e})")
     except Exception as e:
         print(f"GM応答生成に失敗: {e}")
-        # エラー時もターンを進める
+        if lease_owner is None or committed is not None:
+            return
+        if not final_attempt:
+            # 再試行で取り直せるようにリースを手放し、ジョブの失敗として記録させる
+            try:
+                release_turn_lease(app.state.game_store, game_id, turn, lease_owner)
+            except Exception as release_error:
+                print(f"⚠️ ターン解決のリースの解放に失敗: {release_error}")
+            raise
+        # エラー時もターンを進める（リースを保持している場合のみ）
+        record_fallback("gm_turn_error", "playing")
         try:
-            error_db = firestore.client()
-            game_ref = error_db.collection('games').document(game_id)
-            game_data = game_ref.get().to_dict()
-            current_turn = game_data.get('currentTurn', 1)
+            store = app.state.game_store
             
             error_log_entry = GameLog(
-                turn=current_turn,
+                turn=turn,
                 type='gm_response',
                 content="申し訳ありません。ゲームマスターが一時的に考え込んでいます。少しお待ちください..."
             )
             
-            game_ref.update({
-                "gameLog": firestore.ArrayUnion([error_log_entry.model_dump()]),
-                "currentTurn": current_turn + 1,
-                "playerActionsThisTurn": {}
-            })
+            store.append_log(game_id, [error_log_entry], {
+                "currentTurn": turn + 1,
+                "playerActionsThisTurn": {},
+                **release_update(),
+                **usage.updates()
+            }, precondition=lease_guard(turn, lease_owner))
+            turn_stream_hub.finish(game_id, turn, error_log_entry.content)
         except Exception as inner_e:
             print(f"エラー処理中にさらにエラー: {inner_e}")
 
-@firestore.transactional
-def update_vote_in_transaction(transaction: Transaction, game_ref, uid: str, scenario_id: str, background_tasks: BackgroundTasks):
-    game_snapshot = game_ref.get(transaction=transaction)
-    if not game_snapshot.exists: raise HTTPException(status_code=404, detail="Game not found")
-    game_data = game_snapshot.to_dict()
+# --- ジョブキュー ---
+def run_gm_turn_job(job: dict):
+    payload = job['payload']
+    # 再試行（前回の実行者が落ちた場合を含む）ではターン解決のリースを取り直す
+    attempts = job.get('attempts', 1)
+    lease_owner = payload.get('leaseOwner') if attempts <= 1 else None
+    # キューを使わずに直接実行した場合（maxAttempts なし）は再試行されないので最後の試行として扱う
+    final_attempt = attempts >= (job.get('maxAttempts') or 1)
+    generate_gm_response_task(payload['gameId'], payload.get('turn'), lease_owner, final_attempt=final_attempt)
+
+def run_opening_video_job(job: dict):
+    return generate_opening_video_task(**job['payload'])
+
+def run_video_operation_job(job: dict):
+    payload = job['payload']
+    return poll_video_operation(payload['gameId'], payload['target'], payload['operationName'])
+
+def run_epilogue_video_job(job: dict):
+    payload = job['payload']
+    return generate_epilogue_video_task(payload['gameId'], payload['prompt'])
+
+def run_character_portrait_job(job: dict):
+    payload = job['payload']
+    return generate_character_portrait_task(payload['gameId'], payload['uid'], payload['requestId'], payload['prompt'])
+
+def run_scene_image_recovery_job(job: dict):
+    payload = job['payload']
+    return recover_scene_image_task(payload['gameId'], payload['turn'], payload['seq'])
+
+# このプロセスで補充中の難易度（キューを使わない直接実行では同時実行数の制限が無いため）
+scenario_pool_refilling = set()
+scenario_pool_refilling_lock = threading.Lock()
+
+def run_scenario_pool_refill_job(job: dict):
+    """シナリオ候補のプールを難易度ごとの目標数まで補充する"""
+    difficulty = job['payload']['difficulty']
+    pool = app.state.scenario_pool
+    scenario_model, model_name = select_text_model(None, phase="lobby")
+    if not pool or not scenario_model:
+        return {"added": 0}
+    with scenario_pool_refilling_lock:
+        if difficulty in scenario_pool_refilling:
+            return {"added": 0}
+        scenario_pool_refilling.add(difficulty)
+    try:
+        return refill_scenario_pool(pool, difficulty, scenario_model, model_name)
+    finally:
+        with scenario_pool_refilling_lock:
+            scenario_pool_refilling.discard(difficulty)
+
+def refill_scenario_pool(pool, difficulty: str, scenario_model, model_name: str) -> dict:
+    added = 0
+    while added < SCENARIO_POOL_SIZE and pool.count(difficulty) < SCENARIO_POOL_SIZE:
+        with stage_timer("scenario_generation", "scenario_pool", model_name):
+            response = scenario_model.generate_content([scenario_prompt(difficulty)], generation_config=GenerationConfig(response_mime_type="application/json"))
+        # ゲームに紐付かないので、使用量はプロセス全体の集計とメトリクスにだけ記録する
+        UsageTracker().record("scenario_pool", model_name, response)
+        pool.add(difficulty, parse_scenario_ideas(response.text))
+        added += 1
+    print(f"📦 シナリオ候補プール補充: {difficulty} +{added}")
+    return {"added": added}
+
+JOB_HANDLERS = {
+    "gm_turn": run_gm_turn_job,
+    "opening_video": run_opening_video_job,
+    "epilogue_video": run_epilogue_video_job,
+    "video_operation": run_video_operation_job,
+    "character_portrait": run_character_portrait_job,
+    "scene_image_recovery": run_scene_image_recovery_job,
+    "scenario_pool_refill": run_scenario_pool_refill_job,
+}
+
+def schedule_job_directly(job: dict, delay_seconds: float = 0):
+    """キューを使わずにこのプロセスのスレッドプールでジョブを実行する（delay_seconds 指定時はその秒数後）"""
+    if delay_seconds > 0:
+        timer = threading.Timer(delay_seconds, blocking_executor.submit, (run_job_directly, job))
+        timer.daemon = True
+        timer.start()
+    else:
+        blocking_executor.submit(run_job_directly, job)
+
+def run_job_directly(job: dict):
+    result = JOB_HANDLERS[job['type']](job)
+    if isinstance(result, Reschedule):
+        schedule_job_directly(job, result.delay_seconds)
+
+def enqueue_job(job_type: str, payload: dict, game_id: Optional[str] = None, job_id: Optional[str] = None, delay_seconds: float = 0) -> str:
+    """ジョブを登録し、プロセス内ワーカーがあればすぐに取り出させる（delay_seconds 指定時はその秒数後に実行する）"""
+    job_queue = app.state.job_queue
+    if not job_queue:
+        # キューが使えない場合はこのプロセスのスレッドプールで直接実行する
+        print(f"⚠️ ジョブキューが利用できないため直接実行: {job_type}")
+        schedule_job_directly({"id": job_id, "type": job_type, "payload": payload, "attempts": 1}, delay_seconds)
+        return job_id
+    job_id = job_queue.enqueue(job_type, payload, game_id=game_id, job_id=job_id, delay_seconds=delay_seconds)
+    if getattr(app.state, 'job_worker', None):
+        app.state.job_worker.wake()
+    return job_id
+
+def cancel_job(job_id: str) -> bool:
+    """待機中のジョブを取り消す（実行中のジョブは止めないので、ハンドラー側でも古い依頼でないかを確かめる）"""
+    job_queue = app.state.job_queue
+    return bool(job_queue) and job_queue.cancel(job_id)
+
+def request_scenario_pool_refill(difficulty: str) -> Optional[str]:
+    """
+    プールの補充ジョブを登録する。
+    ジョブIDを難易度と時間枠（SCENARIO_POOL_REFILL_WINDOW_SECONDS）から決めるので、投票開始や各インスタンスの起動が
+    同じ時間枠に重なっても補充は1件だけ登録され、複数のインスタンスが同じ難易度を同時に補充しない。
+    補充は目標数に達していれば何もしないので、作りすぎるのは時間枠の境目で2件の補充が重なった場合だけ。
+    """
+    if not app.state.scenario_pool:
+        return None
+    window = int(time.time() // max(SCENARIO_POOL_REFILL_WINDOW_SECONDS, 1.0))
+    return enqueue_job("scenario_pool_refill", {"difficulty": difficulty}, job_id=f"scenario_pool_refill-{difficulty}-{window}")
+
+def prime_scenario_pool():
+    """最初の投票開始に間に合うよう、全難易度のシナリオ候補のプールの補充を登録しておく"""
+    for difficulty in (DIFFICULTY_SETTINGS if app.state.scenario_pool else ()):
+        request_scenario_pool_refill(difficulty)
+
+def enqueue_gm_turn_job(game_id: str, turn: int, lease_owner: str) -> str:
+    return enqueue_job("gm_turn", {"gameId": game_id, "turn": turn, "leaseOwner": lease_owner}, game_id, f"gm_turn-{game_id}-{turn}-{lease_owner[:8]}")
+
+# 全員の投票を待たずに、結果が確定した時点でオープニング動画の生成を始めるか
+OPENING_VIDEO_EARLY_START = os.getenv("OPENING_VIDEO_EARLY_START", "true").lower() == "true"
+
+def predetermined_winner(votes: dict, num_players: int) -> Optional[str]:
+    """
+    未投票の人数分の票が全て2位の案に入っても1位が変わらない場合、その案のIDを返す。
+    同数での決着は投票マップの順序に依存するため、同数になり得るうちは決まったとみなさない。
+    """
+    counts = Counter({s_id: len(voters) for s_id, voters in votes.items() if voters})
+    if not counts:
+        return None
+    remaining = num_players - sum(counts.values())
+    (leader, leader_votes), *others = counts.most_common()
+    runner_up_votes = others[0][1] if others else 0
+    return leader if leader_votes > runner_up_votes + remaining else None
+
+def new_opening_video_request(scenario_id: str, early: bool) -> dict:
+    """オープニング動画の生成依頼（requestId が変われば、それより前のジョブの結果は書き込まれない）"""
+    return {"status": "generating", "prompt": "", "scenarioId": scenario_id, "requestId": uuid.uuid4().hex, "early": early}
+
+def opening_video_job_id(game_id: str, request_id: str) -> str:
+    return f"opening_video-{game_id}-{request_id[:8]}"
+
+def update_vote_in_transaction(txn: GameTransaction, game_id: str, uid: str, scenario_id: str) -> Optional[dict]:
+    """
+    投票を記録する。オープニング動画の生成を始める・取り消す必要がある場合は
+    {"job": ジョブの引数, "cancelJobId": 取り消すジョブのID} を返す。
+    全員の投票を待たずに結果が確定した時点で動画の生成を始め（OPENING_VIDEO_EARLY_START）、
+    その後の投票の変更で結果が変わり得るようになれば取り消す。投票自体は全員が投票するまで続く。
+    """
+    game_data = txn.get()
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
 
     if game_data.get('gameStatus') != 'voting': raise HTTPException(status_code=400, detail="Not in voting state")
     if uid not in game_data.get('players', {}): raise HTTPException(status_code=403, detail="Player not in game")
@@ -1455,7 +1999,15 @@ def update_vote_in_transaction(transaction: Transaction, game_ref, uid: str, sce
     if scenario_id not in votes: votes[scenario_id] = []
     votes[scenario_id].append(uid)
     
-    transaction.update(game_ref, {"votes": votes})
+    vote_updates = {"votes": votes}
+
+    # 動画設定を確認
+    video_settings = game_data.get("videoSettings", {"openingVideoEnabled": True})
+    opening_video_enabled = video_settings.get("openingVideoEnabled", True)
+    # 投票中に先行して始めたオープニング動画
+    current_video = game_data.get('openingVideo') or {}
+    video_scenario_id = current_video.get('requestId') and current_video.get('scenarioId')
+    opening_video = None  # 新しく始める動画の依頼
 
     # Check if all players have voted
     total_votes = sum(len(v) for v in votes.values())
@@ -1464,21 +2016,8 @@ def update_vote_in_transaction(transaction: Transaction, game_ref, uid: str, sce
         # Tally results
         vote_counts = Counter({s_id: len(v) for s_id, v in votes.items()})
         decided_scenario_id = vote_counts.most_common(1)[0][0]
-        
-        # 選択されたシナリオの情報を取得
-        scenario_title = ""
-        scenario_summary = ""
-        end_conditions = None
-        for opt in game_data.get('scenarioOptions', []):
-            if opt['id'] == decided_scenario_id:
-                scenario_title = opt['title']
-                scenario_summary = opt['summary']
-                end_conditions = opt.get('endConditions')
-                break
-        
-        # 動画設定を確認
-        video_settings = game_data.get("videoSettings", {"openingVideoEnabled": True})
-        opening_video_enabled = video_settings.get("openingVideoEnabled", True)
+        decided_scenario = find_scenario_option(game_data, decided_scenario_id)
+        scenario_title = decided_scenario.get('title', "")
         
         update_data = {
             "decidedScenarioId": decided_scenario_id,
@@ -1486,33 +2025,74 @@ def update_vote_in_transaction(transaction: Transaction, game_ref, uid: str, sce
         }
         
         # オープニング動画設定に応じて処理
-        if opening_video_enabled:
-            update_data["openingVideo"] = {"status": "generating", "prompt": ""}
-            print(f"🎬 オープニング動画有効: {scenario_title}")
-        else:
+        if not opening_video_enabled:
             update_data["openingVideo"] = {"status": "disabled", "url": None}
             print(f"🚫 オープニング動画無効: {scenario_title}")
+        elif video_scenario_id == decided_scenario_id:
+            print(f"🎬 投票中に開始したオープニング動画を使用: {scenario_title}")
+        else:
+            opening_video = new_opening_video_request(decided_scenario_id, early=False)
+            update_data["openingVideo"] = opening_video
+            print(f"🎬 オープニング動画有効: {scenario_title}")
         
         # 終了条件をゲームに設定
+        end_conditions = decided_scenario.get('endConditions')
         if end_conditions:
             update_data["endConditions"] = end_conditions
             
-        transaction.update(game_ref, update_data)
-        
-        # 動画有効時のみバックグラウンドタスクを実行
-        if opening_video_enabled:
-            background_tasks.add_task(generate_opening_video_task, game_ref.id, scenario_title, scenario_summary)
-        else:
-            print(f"⏭️ オープニング動画生成をスキップ: 設定により無効")
+        vote_updates.update(update_data)
+    elif opening_video_enabled and OPENING_VIDEO_EARLY_START:
+        winner = predetermined_winner(votes, num_players)
+        if winner != video_scenario_id:
+            if winner:
+                opening_video = new_opening_video_request(winner, early=True)
+                print(f"🎬 投票結果が確定したためオープニング動画を先行生成: {winner} ({total_votes}/{num_players}票)")
+            else:
+                print(f"↩️ 投票の変更で結果が未確定に戻ったためオープニング動画を取り消し: {video_scenario_id}")
+            vote_updates["openingVideo"] = opening_video
+
+    # 投票結果と差分イベントを同じトランザクションで書き込む
+    vote_updates.update(stage_game_events(txn, game_data, events_for_update(vote_updates)))
+    txn.update(vote_updates)
+
+    # ジョブの登録・取り消しはトランザクションの再試行で重複しないよう、コミット後に呼び出し元で行う
+    result = {}
+    if "openingVideo" in vote_updates and video_scenario_id:
+        result["cancelJobId"] = opening_video_job_id(game_id, current_video['requestId'])
+    if opening_video:
+        scenario = find_scenario_option(game_data, opening_video['scenarioId'])
+        result["job"] = {
+            "game_id": game_id,
+            "scenario_title": scenario.get('title', ""),
+            "scenario_summary": scenario.get('summary', ""),
+            "request_id": opening_video['requestId'],
+        }
+    elif total_votes == num_players and not opening_video_enabled:
+        print(f"⏭️ オープニング動画生成をスキップ: 設定により無効")
+    return result or None
+
+def find_scenario_option(game_data: dict, scenario_id: str) -> dict:
+    return next((opt for opt in game_data.get('scenarioOptions', []) if opt['id'] == scenario_id), {})
 
 @app.post("/games/{game_id}/vote")
-async def vote_for_scenario(request: Request, game_id: str, vote_req: VoteRequest, background_tasks: BackgroundTasks, uid: str = Depends(get_current_user_uid)):
-    db = request.app.state.db
-    if not db: raise HTTPException(status_code=503, detail="DB service not available")
+async def vote_for_scenario(request: Request, game_id: str, vote_req: VoteRequest, uid: str = Depends(get_current_user_uid)):
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
     try:
-        game_ref = db.collection('games').document(game_id)
-        transaction = db.transaction()
-        update_vote_in_transaction(transaction, game_ref, uid, vote_req.scenarioId, background_tasks)
+        opening_video_change = await run_blocking(
+            store.run_transaction, game_id,
+            lambda txn: update_vote_in_transaction(txn, game_id, uid, vote_req.scenarioId)
+        )
+        if not opening_video_change:
+            return {"message": "Vote cast successfully."}
+        if opening_video_change.get("cancelJobId"):
+            # 実行中のジョブは requestId の確認で結果を捨てる
+            await run_blocking(cancel_job, opening_video_change["cancelJobId"])
+        opening_video_job = opening_video_change.get("job")
+        if opening_video_job:
+            job_id = await run_blocking(enqueue_job, "opening_video", opening_video_job, game_id,
+                                        opening_video_job_id(game_id, opening_video_job["request_id"]))
+            return {"message": "Vote cast successfully.", "jobId": job_id}
         return {"message": "Vote cast successfully."}
     except HTTPException as e:
         raise e
@@ -1521,158 +2101,61 @@ async def vote_for_scenario(request: Request, game_id: str, vote_req: VoteReques
 
 @app.post("/games/{game_id}/create-character")
 async def create_character(request: Request, game_id: str, req: CreateCharacterRequest, uid: str = Depends(get_current_user_uid)):
-    db = request.app.state.db
-    imagen_model = request.app.state.imagen_model
-    storage_bucket = request.app.state.storage_bucket
-    if not db: raise HTTPException(status_code=503, detail="Service not initialized")
-    game_ref = db.collection('games').document(game_id)
-    game_doc = game_ref.get()
-    if not game_doc.exists: raise HTTPException(status_code=404, detail="Game not found")
-    game_data = game_doc.to_dict()
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="Service not initialized")
+    game_data = await run_blocking(store.get, game_id)
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
 
     if game_data.get('gameStatus') != 'creating_char':
         raise HTTPException(status_code=400, detail="Not in character creation state")
     if uid not in game_data.get('players', {}): raise HTTPException(status_code=403, detail="Player not in game")
 
-    scenario_title = "a fantasy world"
-    decided_scenario_id = game_data.get('decidedScenarioId')
-    if decided_scenario_id:
-        for opt in game_data.get('scenarioOptions', []):
-            if opt['id'] == decided_scenario_id:
-                scenario_title = opt['title']
-                break
-
     # 日本語プロンプトをシンプルに（公式ドキュメント準拠）
     prompt = f"{req.characterName}の肖像画、{req.characterDescription}、人物の顔と上半身"
     print(f"🎨 日本語プロンプト: {prompt}")
-    print(f"🗂️ Cloud Storageバケット: {app.state.storage_bucket.name if app.state.storage_bucket else 'None'}")
 
     try:
-        # --- Imagenでの画像生成 ---
-        print(f"🔍 Imagenモデル状態: {imagen_model is not None}")
-        print(f"🔍 生成プロンプト: {prompt}")
-        
-        if imagen_model:
-            try:
-                print(f"🚀 Imagen APIを呼び出し中...")
-                # 最小限のパラメータでテスト
-                response = imagen_model.generate_images(
-                    prompt=prompt,  # 日本語プロンプト
-                    number_of_images=1,
-                    language="ja"  # 日本語プロンプト（公式ドキュメント準拠）
-                )
-                print(f"📸 Imagen APIレスポンス受信: {type(response)}")
-                
-                # Imagen画像生成とCloud Storageアップロード
-                if response and hasattr(response, 'images') and len(response.images) > 0:
-                    generated_image = response.images[0]
-                    print(f"✅ Imagen画像生成成功")
-                    
-                    # 画像データを取得
-                    try:
-                        # 画像データを取得する方法を複数試行
-                        image_data = None
-                        print(f"🔍 画像オブジェクトの属性: {dir(generated_image)}")
-                        if hasattr(generated_image, '_image_bytes'):
-                            image_data = generated_image._image_bytes
-                            print(f"✅ _image_bytesから画像データ取得")
-                        elif hasattr(generated_image, 'data'):
-                            image_data = generated_image.data
-                            print(f"✅ dataから画像データ取得")
-                        elif hasattr(generated_image, 'content'):
-                            image_data = generated_image.content
-                            print(f"✅ contentから画像データ取得")
-                        else:
-                            print(f"❌ 画像データの取得方法が見つかりません")
-                            
-                        if image_data and storage_bucket:
-                            # Cloud Storageにアップロード
-                            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                            filename = f"characters/{game_id}/{uid}_{timestamp}.png"
-                            
-                            image_url = upload_image_to_storage(image_data, storage_bucket, filename)
-                            print(f"🔗 Cloud Storage URL: {image_url}")
-                        else:
-                            # Cloud Storageが利用できない場合はプレースホルダー
-                            image_url = f"https://picsum.photos/400/400?random={random.randint(10, 999)}"
-                            print(f"⚠️ Cloud Storage利用不可、プレースホルダー使用: {image_url}")
-                    
-                    except Exception as upload_err:
-                        print(f"🚨 Cloud Storageアップロードエラー: {upload_err}")
-                        image_url = f"https://picsum.photos/400/400?random={random.randint(10, 999)}"
-                        print(f"🖼️ エラー時プレースホルダー使用: {image_url}")
-                else:
-                    print(f"❌ Imagen画像生成に失敗")
-                    image_url = f"https://picsum.photos/400/400?random={random.randint(10, 999)}"
-            except Exception as e:
-                print(f"🚨 Imagen画像生成エラー詳細: {type(e).__name__}: {e}")
-                import traceback
-                print(f"🔍 スタックトレース: {traceback.format_exc()}")
-                # エラー時もプレースホルダーを使用
-                image_url = "https://picsum.photos/400/400?random=2"
-        else:
-            # Imagenモデルが利用できない場合のプレースホルダー
-            image_url = "https://picsum.photos/400/400?random=3"
-        
+        # 画像はジョブで生成し、ここでは生成中の状態だけを書き込んですぐに返す
+        request_id = uuid.uuid4().hex
         player_update = {
             f'players.{uid}.characterName': req.characterName,
             f'players.{uid}.characterDescription': req.characterDescription,
-            f'players.{uid}.characterImageUrl': image_url,
+            f'players.{uid}.characterImageUrl': None,
+            f'players.{uid}.characterImageStatus': "generating",
+            f'players.{uid}.characterImageRequestId': request_id,
         }
         
         # 能力値が提供されている場合は保存
         if req.abilities:
             player_update[f'players.{uid}.abilities'] = req.abilities
             print(f"🎲 プレイヤー {uid} の能力値を保存: {req.abilities}")
-        game_ref.update(player_update)
-
-        # キャラクター作成完了後、全員のキャラクター作成が完了したかチェック
-        updated_game_doc = game_ref.get()
-        updated_game_data = updated_game_doc.to_dict()
-        
-        print(f"🔍 キャラクター作成チェック: ゲーム {game_id}")
-        print(f"🔍 現在のプレイヤー数: {len(updated_game_data.get('players', {}))}")
-        
-        # 全プレイヤーがキャラクター名を設定済みかチェック
-        players = updated_game_data.get('players', {})
-        character_status = {}
-        for uid, player in players.items():
-            character_name = player.get('characterName')
-            character_status[uid] = character_name is not None
-            print(f"🔍 プレイヤー {uid}: キャラクター名='{character_name}', 完了={character_name is not None}")
-        
-        all_characters_created = all(character_status.values())
-        print(f"🔍 全員のキャラクター作成完了: {all_characters_created}")
-        
-        # 自動遷移は無効化 - ホストが手動で開始する方式に変更
-        # if all_characters_created:
-        #     print(f"✅ 状態遷移実行: {game_id} を ready_to_start に変更")
-        #     game_ref.update({"gameStatus": "ready_to_start"})
-        #     print(f"✅ 全員のキャラクター作成完了: ゲーム {game_id} が ready_to_start 状態に遷移")
+        await run_blocking(store.update, game_id, player_update)
 
-        return {"characterImageUrl": image_url}
-    except Exception as e: raise HTTPException(status_code=500, detail=f"Failed to generate character image: {e}")
+        job_id = await run_blocking(
+            enqueue_job, "character_portrait",
+            {"gameId": game_id, "uid": uid, "requestId": request_id, "prompt": prompt},
+            game_id, f"character_portrait-{game_id}-{uid}-{request_id[:8]}"
+        )
+        return {"characterImageUrl": None, "characterImageStatus": "generating", "jobId": job_id}
+    except Exception as e: raise HTTPException(status_code=500, detail=f"Failed to create character: {e}")
 
 @app.post("/games/{game_id}/ready")
 async def player_ready(request: Request, game_id: str, uid: str = Depends(get_current_user_uid)):
-    db = request.app.state.db
-    if not db: raise HTTPException(status_code=503, detail="DB service not available")
-    game_ref = db.collection('games').document(game_id)
-    game_doc = game_ref.get()
-    if not game_doc.exists: raise HTTPException(status_code=404, detail="Game not found")
-    game_data = game_doc.to_dict()
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
+    game_data = await run_blocking(store.get, game_id)
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
 
     if uid not in game_data.get('players', {}): raise HTTPException(status_code=403, detail="Player not in game")
 
-    game_ref.update({f'players.{uid}.isReady': True})
+    await run_blocking(store.update, game_id, {f'players.{uid}.isReady': True})
 
-    updated_game_doc = game_ref.get() 
-    updated_game_data = updated_game_doc.to_dict()
+    updated_game_data = await run_blocking(store.get, game_id)
     all_players_ready = all(p.get('isReady', False) for p in updated_game_data.get('players', {}).values())
     video_ready = updated_game_data.get('openingVideo', {}).get('status') == 'ready'
 
     if all_players_ready and video_ready:
-        game_ref.update({"gameStatus": "ready_to_start"})
+        await run_blocking(store.update, game_id, {"gameStatus": "ready_to_start"})
         return {"message": "Player is ready. All players are ready to start!"}
 
     return {"message": "Player is ready."}
@@ -1680,13 +2163,10 @@ async def player_ready(request: Request, game_id: str, uid: str = Depends(get_cu
 @app.post("/games/{game_id}/proceed-to-ready")
 async def proceed_to_ready(request: Request, game_id: str, uid: str = Depends(get_current_user_uid)):
     """ホストがキャラクター作成完了後に準備完了段階に進める"""
-    db = request.app.state.db
-    if not db: raise HTTPException(status_code=503, detail="DB service not available")
-    
-    game_ref = db.collection('games').document(game_id)
-    game_doc = game_ref.get()
-    if not game_doc.exists: raise HTTPException(status_code=404, detail="Game not found")
-    game_data = game_doc.to_dict()
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
+    game_data = await run_blocking(store.get, game_id)
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
     
     # ホスト権限確認
     if game_data.get('hostId') != uid:
@@ -1704,19 +2184,17 @@ async def proceed_to_ready(request: Request, game_id: str, uid: str = Depends(ge
         raise HTTPException(status_code=400, detail="Not all players have completed character creation")
     
     print(f"✅ ホストによる準備完了段階への移行: {game_id}")
-    game_ref.update({"gameStatus": "ready_to_start"})
+    await run_blocking(store.update, game_id, {"gameStatus": "ready_to_start"})
     
     return {"message": "Proceeding to ready phase"}
 
 @app.post("/games/{game_id}/start-game")
 async def start_game(request: Request, game_id: str, uid: str = Depends(get_current_user_uid)):
-    db = request.app.state.db
-    gemini_model = request.app.state.gemini_model
-    if not db or not gemini_model: raise HTTPException(status_code=503, detail="Service not available")
-    game_ref = db.collection('games').document(game_id)
-    game_doc = game_ref.get()
-    if not game_doc.exists: raise HTTPException(status_code=404, detail="Game not found")
-    game_data = game_doc.to_dict()
+    store = request.app.state.game_store
+    if not store or not request.app.state.gemini_model: raise HTTPException(status_code=503, detail="Service not available")
+    game_data = await run_blocking(store.get, game_id)
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
+    gemini_model, model_name = select_text_model(game_data, phase="ready_to_start")
 
     if game_data.get('hostId') != uid: raise HTTPException(status_code=403, detail="Only host can start the game")
     if game_data.get('gameStatus') != 'ready_to_start': raise HTTPException(status_code=400, detail="Game not ready to start")
@@ -1737,53 +2215,257 @@ async def start_game(request: Request, game_id: str, uid: str = Depends(get_curr
     出力はナレーションのテキストのみにしてください。
     """
     try:
-        response = gemini_model.generate_content(prompt)
+        with stage_timer("opening_narration", "ready_to_start", model_name):
+            response = await gemini_model.generate_content_async(prompt)
         narration = response.text
+        usage = UsageTracker()
+        usage.record("start_game", model_name, response)
 
         log_entry = GameLog(
             turn=0,
             type='gm_narration',
             content=narration
         )
-        game_ref.update({
+        await run_blocking(store.append_log, game_id, [log_entry], {
             "gameStatus": "playing",
             "currentTurn": 1,
-            "gameLog": firestore.ArrayUnion([log_entry.model_dump()])
+            **usage.updates()
         })
         return {"message": "Game started!", "initialNarration": narration}
     except Exception as e: raise HTTPException(status_code=500, detail=f"Failed to start game: {e}")
 
+@app.get("/games/{game_id}/log")
+async def get_game_log(request: Request, game_id: str, after: Optional[int] = Query(None, ge=0), limit: int = Query(LOG_PAGE_SIZE, ge=1, le=MAX_LOG_PAGE_SIZE), uid: str = Depends(get_current_user_uid)):
+    """ゲームログを連番カーソルでページング取得する（after=最後に受け取ったseq）"""
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
+    game_data = await run_blocking(store.get, game_id, field_paths=['players', 'logSeq', 'gameLog'])
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
+
+    if uid not in game_data.get('players', {}): raise HTTPException(status_code=403, detail="Player not in game")
+
+    # 1件多く取得して次ページの有無を判定する
+    entries = await run_blocking(store.load_log, game_id, game_data, after=after, limit=limit + 1)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    next_cursor = entries[-1]['seq'] if entries else after
+
+    return {"entries": entries, "nextCursor": next_cursor, "hasMore": has_more}
+
+TURN_STREAM_POLL_SECONDS = 1.0
+# 中継のリスナーとは別に、確定済みのナレーションを保存先から確かめる間隔（中継が無効・失敗した場合の予備）
+TURN_STREAM_FALLBACK_POLL_SECONDS = 5.0
+TURN_STREAM_TIMEOUT_SECONDS = 300
+TURN_STREAM_KEEPALIVE_SECONDS = 15
+TURN_LEASE_RECLAIM_CHECK_SECONDS = 15
+
+def reclaim_stale_turn(store, game_id: str, turn: int) -> bool:
+    """
+    行動が揃っているのにリースが期限切れ（ワーカー停止など）のターンを引き取り、GM応答生成を再実行する。
+    引き取った場合は True を返す。
+    """
+    acquired = acquire_turn_lease(store, game_id, turn)
+    if not acquired:
+        return False
+    print(f"♻️ 期限切れのターン解決リースを回収: {game_id} (ターン{turn})")
+    enqueue_gm_turn_job(game_id, *acquired)
+    return True
+
+def find_persisted_turn_narration(store, game_id: str, turn: int) -> Optional[dict]:
+    """指定ターンのGM応答が確定済みならその内容を返す"""
+    game_data = store.get(game_id, field_paths=['currentTurn', 'recentLog']) or {}
+    if game_data.get('currentTurn', 0) <= turn:
+        return None
+    for log in reversed(game_data.get('recentLog') or []):
+        if log.get('turn') == turn and log.get('type') == 'gm_response':
+            return {"narration": log.get('content'), "imageUrl": log.get('imageUrl')}
+    # 要約から外れた古いターン
+    log = store.find_log(game_id, turn, 'gm_response')
+    if log:
+        return {"narration": log.get('content'), "imageUrl": log.get('imageUrl')}
+    return None
+
+def relay_turn_stream(game_id: str, turn: int, stream_id: str, text: str, final: Optional[dict] = None):
+    """
+    生成途中のナレーションの全文を games/{id}/turnStreams/current に書き出す（TurnStreamHub から間引いて呼ばれる）。
+    確定時は確定したナレーションも書き出し、購読中の別プロセスのクライアントに done を送らせる。
+    """
+    def write(txn):
+        txn.set_child(TURN_STREAM_COLLECTION, TURN_STREAM_DOC_ID, {"turn": turn, "streamId": stream_id, "text": text, "final": final})
+    app.state.game_store.run_transaction(game_id, write)
+
+@app.get("/games/{game_id}/turns/{turn}/stream")
+async def stream_turn_narration(request: Request, game_id: str, turn: int, uid: str = Depends(get_stream_user_uid)):
+    """指定ターンのGMナレーションを生成途中からServer-Sent Eventsで配信する"""
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
+    game_data = await run_blocking(store.get, game_id, field_paths=['players'])
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
+    if uid not in game_data.get('players', {}): raise HTTPException(status_code=403, detail="Player not in game")
+
+    async def event_stream():
+        # このプロセスで生成中でなければ、別のプロセスが書き出す生成途中のナレーションと確定を待つ
+        deadline = time.monotonic() + TURN_STREAM_TIMEOUT_SECONDS
+        next_reclaim_check = time.monotonic() + TURN_LEASE_RECLAIM_CHECK_SECONDS
+        next_persisted_check = time.monotonic()
+        relayed = RelayedStreamReader()
+        queue = turn_stream_hub.subscribe(game_id, turn)
+        unsubscribe_relay = None
+        if queue is None:
+            # 中継はリスナーで受け取り（書き出されたときだけ読み取りが発生する）、保存先への問い合わせは確定の確認を低頻度で行うだけにする
+            loop = asyncio.get_running_loop()
+            relayed_updates: asyncio.Queue = asyncio.Queue()
+            unsubscribe_relay = store.watch_child(game_id, TURN_STREAM_COLLECTION, TURN_STREAM_DOC_ID,
+                                                  lambda data: loop.call_soon_threadsafe(relayed_updates.put_nowait, data))
+        try:
+            while queue is None:
+                if time.monotonic() >= next_persisted_check:
+                    next_persisted_check = time.monotonic() + TURN_STREAM_FALLBACK_POLL_SECONDS
+                    final = await run_blocking(find_persisted_turn_narration, store, game_id, turn)
+                    if final:
+                        yield format_sse("done", final)
+                        return
+                try:
+                    update = await asyncio.wait_for(relayed_updates.get(), timeout=TURN_STREAM_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    update = None
+                if update and update.get('turn') == turn:
+                    for event, data in relayed.read(update):
+                        yield format_sse(event, data)
+                        if event == "done":
+                            return
+                if time.monotonic() > next_reclaim_check:
+                    # 担当ワーカーが落ちていれば、待っているクライアントの接続先でターンを引き取る
+                    next_reclaim_check = time.monotonic() + TURN_LEASE_RECLAIM_CHECK_SECONDS
+                    asyncio.ensure_future(run_blocking(reclaim_stale_turn, store, game_id, turn))
+                if time.monotonic() > deadline or await request.is_disconnected():
+                    yield format_sse("timeout", {})
+                    return
+                queue = turn_stream_hub.subscribe(game_id, turn)
+        finally:
+            if unsubscribe_relay:
+                unsubscribe_relay()
+        if relayed.text:
+            # 中継で受け取った断片は、このプロセスのストリームが最初に送る全文と重なるので捨てさせる
+            yield format_sse("reset", {})
+
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=TURN_STREAM_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected() or time.monotonic() > deadline:
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(event, data)
+                if event == "done":
+                    return
+        finally:
+            turn_stream_hub.unsubscribe(game_id, turn, queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(request: Request, job_id: str, uid: str = Depends(get_current_user_uid)):
+    """バックグラウンドジョブの状態を返す（ゲームに紐づくジョブはそのゲームの参加者のみ参照できる）"""
+    job_queue = request.app.state.job_queue
+    if not job_queue: raise HTTPException(status_code=503, detail="Job queue not available")
+    job = await run_blocking(job_queue.get, job_id)
+    if not job: raise HTTPException(status_code=404, detail="Job not found")
+    if job.get('gameId'):
+        store = request.app.state.game_store
+        if not store: raise HTTPException(status_code=503, detail="DB service not available")
+        game_data = await run_blocking(store.get, job['gameId'], field_paths=['players'])
+        if game_data is None or uid not in game_data.get('players', {}):
+            raise HTTPException(status_code=403, detail="Player not in game")
+    return public_job(job)
+
+GAME_EVENTS_KEEPALIVE_SECONDS = 15
+
+@app.get("/games/{game_id}/events")
+async def stream_game_events(request: Request, game_id: str, since: Optional[int] = Query(None, ge=0), last_event_id: Optional[str] = Header(None), uid: str = Depends(get_stream_user_uid)):
+    """
+    ゲーム状態の差分をバージョン付きの型付きイベントとしてServer-Sent Eventsで配信する。
+    since（または再接続時の Last-Event-ID）を指定するとそのバージョンの次から再開し、
+    省略時は現在の状態のスナップショットを送ってから差分の配信を始める。
+    """
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
+    game_data = await run_blocking(store.get, game_id)
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
+    if uid not in game_data.get('players', {}): raise HTTPException(status_code=403, detail="Player not in game")
+    if since is None and last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def on_events(events):
+        # 保存先のリスナースレッドから呼ばれるため、イベントループへ受け渡す
+        for event in events:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    async def event_stream():
+        if since is None:
+            snapshot = client_snapshot(game_id, game_data)
+            version = snapshot['version']
+            yield format_sse("snapshot", snapshot, event_id=version)
+        else:
+            version = since
+
+        # 初回の読み込みで取りこぼし分が、以降は新しいイベントが届く
+        unsubscribe = store.watch_children(game_id, EVENT_COLLECTION, 'version', version, on_events)
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=GAME_EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                if event['version'] <= version:
+                    continue
+                version = event['version']
+                yield format_sse(event['type'], {"version": version, **event['data']}, event_id=version)
+        finally:
+            unsubscribe()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.post("/games/{game_id}/action")
-async def player_action(request: Request, game_id: str, req: ActionRequest, background_tasks: BackgroundTasks, uid: str = Depends(get_current_user_uid)):
-    db = request.app.state.db
-    if not db: raise HTTPException(status_code=503, detail="DB service not available")
-    game_ref = db.collection('games').document(game_id)
+async def player_action(request: Request, game_id: str, req: ActionRequest, uid: str = Depends(get_current_user_uid)):
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
     
-    @firestore.transactional
-    def update_action_in_transaction(transaction: Transaction):
-        game_snapshot = game_ref.get(transaction=transaction)
-        if not game_snapshot.exists: raise HTTPException(404, "Game not found")
-        game_data = game_snapshot.to_dict()
+    def update_action_in_transaction(txn: GameTransaction):
+        game_data = txn.get()
+        if game_data is None: raise HTTPException(404, "Game not found")
 
         if game_data.get('gameStatus') != 'playing': raise HTTPException(400, "Game not in playing state")
         if uid not in game_data.get('players', {}): raise HTTPException(403, detail="Player not in game")
         if uid in game_data.get('playerActionsThisTurn', {}): raise HTTPException(400, "You have already acted this turn")
 
-        log_entry = GameLog(turn=game_data['currentTurn'], type='player_action', content=req.actionText, playerId=uid)
-        transaction.update(game_ref, {
-            f"playerActionsThisTurn.{uid}": req.actionText,
-            "gameLog": firestore.ArrayUnion([log_entry.model_dump()])
-        })
-        return game_snapshot.to_dict() # Return data for post-transaction check
+        current_turn = game_data['currentTurn']
+        log_entry = GameLog(turn=current_turn, type='player_action', content=req.actionText, playerId=uid)
+        updates = {f"playerActionsThisTurn.{uid}": req.actionText}
+
+        # 最後の行動であれば、同じトランザクションでターン解決のリースを取得する
+        lease_owner = None
+        if turn_ready_to_resolve(game_data, pending_actions=1) and not lease_is_active(game_data, current_turn):
+            lease_owner = new_lease_owner()
+            updates.update(lease_update(current_turn, lease_owner))
+
+        txn.update(stage_log_entries(txn, game_data, [log_entry], updates))
+        return current_turn, lease_owner
 
     try:
-        updated_game_data = update_action_in_transaction(db.transaction())
-        
-        num_players = len(updated_game_data.get('players', {}))
-        num_actions = len(updated_game_data.get('playerActionsThisTurn', {})) + 1 
+        current_turn, lease_owner = await run_blocking(store.run_transaction, game_id, update_action_in_transaction)
 
-        if num_actions >= num_players:
-            background_tasks.add_task(generate_gm_response_task, game_id)
+        if lease_owner:
+            job_id = await run_blocking(enqueue_gm_turn_job, game_id, current_turn, lease_owner)
+            return {"message": "Action recorded.", "jobId": job_id}
 
         return {"message": "Action recorded."}
     except HTTPException as e:
@@ -1794,27 +2476,25 @@ async def player_action(request: Request, game_id: str, req: ActionRequest, back
 @app.post("/games/{game_id}/manual-dice")
 async def manual_dice_roll(request: Request, game_id: str, req: ManualDiceRequest, uid: str = Depends(get_current_user_uid)):
     """プレイヤーが手動でダイスを振る"""
-    db = request.app.state.db
-    if not db: raise HTTPException(status_code=503, detail="DB service not available")
-    game_ref = db.collection('games').document(game_id)
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
     
     try:
-        game_snapshot = game_ref.get()
-        if not game_snapshot.exists: raise HTTPException(404, "Game not found")
-        game_data = game_snapshot.to_dict()
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None: raise HTTPException(404, "Game not found")
 
         if game_data.get('gameStatus') != 'playing': raise HTTPException(400, "Game not in playing state")
         if uid not in game_data.get('players', {}): raise HTTPException(403, detail="Player not in game")
 
-        # ダイスロール実行
-        dice_result = roll_dice(req.num_dice, req.num_sides)
+        # ダイスロール実行（能力値は振ったプレイヤーのものを使う）
+        rng = game_dice_rng(game_id, "manual", uid, game_data['currentTurn'], game_data.get('logSeq', 0))
+        dice_result = roll_dice(req.num_dice, req.num_sides, game_data=game_data, player_id=uid, expression=req.expression, dc=req.dc, rng=rng)
         if "error" in dice_result:
             raise HTTPException(400, dice_result["error"])
 
         # ダイスロール結果をゲームログに追加
         player_name = game_data['players'][uid]['characterName']
-        description = f" ({req.description})" if req.description else ""
-        dice_content = f"ダイスロール{description} ({req.num_dice}d{req.num_sides}): {dice_result['rolls']} (合計: {dice_result['total']})"
+        dice_content = format_roll(dice_result, req.description)
         
         log_entry = GameLog(
             turn=game_data['currentTurn'], 
@@ -1823,9 +2503,7 @@ async def manual_dice_roll(request: Request, game_id: str, req: ManualDiceReques
             playerId=uid
         )
         
-        game_ref.update({
-            "gameLog": firestore.ArrayUnion([log_entry.model_dump()])
-        })
+        await run_blocking(store.append_log, game_id, [log_entry])
 
         return {
             "message": "Dice rolled successfully", 
@@ -1838,22 +2516,32 @@ async def manual_dice_roll(request: Request, game_id: str, req: ManualDiceReques
     except Exception as e:
         raise HTTPException(500, f"Failed to roll dice: {e}")
 
+@app.get("/games/{game_id}/dice-odds")
+async def get_dice_odds(request: Request, game_id: str, expression: str = Query(..., max_length=200), dc: Optional[int] = Query(None), uid: str = Depends(get_current_user_uid)):
+    """ダイス式の成功率（能力値は呼び出したプレイヤーのものを使う）"""
+    store = request.app.state.game_store
+    if not store: raise HTTPException(status_code=503, detail="DB service not available")
+    game_data = await run_blocking(store.get, game_id, field_paths=['players'])
+    if game_data is None: raise HTTPException(status_code=404, detail="Game not found")
+    if uid not in game_data.get('players', {}): raise HTTPException(status_code=403, detail="Player not in game")
+
+    # 初めての式は表の計算が入るため、イベントループの外で実行する
+    odds = await run_blocking(check_dice_odds, expression, dc, game_data, uid)
+    if "error" in odds: raise HTTPException(status_code=400, detail=odds["error"])
+    return odds
+
 @app.post("/games/{game_id}/gm-chat")
 async def gm_chat(request: Request, game_id: str, req: GMChatRequest, uid: str = Depends(get_current_user_uid)):
     """GMとのチャット機能 - プレイヤーがGMに質問や相談ができる"""
-    db = request.app.state.db
-    gemini_model = request.app.state.gemini_model
-    if not db or not gemini_model: 
+    store = request.app.state.game_store
+    if not store or not request.app.state.gemini_model: 
         raise HTTPException(status_code=503, detail="Service not available")
     
     try:
-        game_ref = db.collection('games').document(game_id)
-        game_doc = game_ref.get()
-        if not game_doc.exists: 
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None: 
             raise HTTPException(status_code=404, detail="Game not found")
         
-        game_data = game_doc.to_dict()
-        
         # ゲーム参加確認
         if uid not in game_data.get('players', {}):
             raise HTTPException(status_code=403, detail="Player not in game")
@@ -1872,7 +2560,7 @@ async def gm_chat(request: Request, game_id: str, req: GMChatRequest, uid: str =
         
         # ゲーム履歴取得（最新10件）
         game_history = "\n".join([f"ターン{log['turn']} {log['type']}: {log['content'][:100]}..." 
-                                 for log in game_data.get('gameLog', [])[-10:]])
+                                 for log in (game_data.get('recentLog') or game_data.get('gameLog', []))[-10:]])
         
         # GMチャット用プロンプト
         gm_prompt = f"""
@@ -1900,9 +2588,26 @@ async def gm_chat(request: Request, game_id: str, req: GMChatRequest, uid: str =
         GMとして応答してください:
         """
         
-        # Geminiで応答生成
-        response = gemini_model.generate_content(gm_prompt)
-        gm_response = response.text
+        # Geminiで応答生成（状況に依らないルールの質問は履歴を含まないプロンプトで答え、キャッシュする）
+        usage = UsageTracker()
+        cacheable, reason = classify_question(req.message)
+        key = cache_key(req.message, game_data) if cacheable else None
+        gm_response = gm_chat_cache.get(key) if cacheable else None
+        cache_hit = gm_response is not None
+        if not cacheable:
+            record_cache_lookup(GM_CHAT_CACHE_NAME, "bypass")
+        if not cache_hit:
+            if cacheable:
+                gm_prompt = rules_prompt(req.message, scenario['title'] if scenario else '不明')
+            gemini_model, model_name = select_text_model(game_data, phase="playing")
+            started = time.perf_counter()
+            with stage_timer("gm_chat", "playing", model_name):
+                response = await gemini_model.generate_content_async(gm_prompt)
+            gm_response = response.text
+            usage.record("gm_chat", model_name, response)
+            if cacheable:
+                gm_chat_cache.put(key, gm_response, time.perf_counter() - started)
+        print(f"💬 GMチャット: {reason}{'（キャッシュ）' if cache_hit else ''}")
         
         # チャット履歴をログに記録
         chat_log_entry = GameLog(
@@ -1912,15 +2617,14 @@ async def gm_chat(request: Request, game_id: str, req: GMChatRequest, uid: str =
             playerId=uid
         )
         
-        game_ref.update({
-            "gameLog": firestore.ArrayUnion([chat_log_entry.model_dump()])
-        })
+        await run_blocking(store.append_log, game_id, [chat_log_entry], usage.updates())
         
         return {
             "message": "GM chat response generated",
             "gm_response": gm_response,
             "player_message": req.message,
-            "character_name": character_name
+            "character_name": character_name,
+            "cached": cache_hit
         }
         
     except HTTPException as e:
@@ -1932,19 +2636,15 @@ async def gm_chat(request: Request, game_id: str, req: GMChatRequest, uid: str =
 @app.post("/games/{game_id}/generate-epilogue")
 async def generate_epilogue(request: Request, game_id: str, uid: str = Depends(get_current_user_uid)):
     """エピローグを生成し、冒険の振り返りデータを作成する"""
-    db = request.app.state.db
-    gemini_model = request.app.state.gemini_model
-    if not db or not gemini_model: 
+    store = request.app.state.game_store
+    if not store or not request.app.state.gemini_model: 
         raise HTTPException(status_code=503, detail="Service not available")
     
     try:
-        game_ref = db.collection('games').document(game_id)
-        game_doc = game_ref.get()
-        if not game_doc.exists: 
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None: 
             raise HTTPException(status_code=404, detail="Game not found")
         
-        game_data = game_doc.to_dict()
-        
         # ホスト権限確認
         if game_data.get('hostId') != uid:
             raise HTTPException(status_code=403, detail="Only host can generate epilogue")
@@ -1960,7 +2660,7 @@ async def generate_epilogue(request: Request, game_id: str, uid: str = Depends(g
         # 冒険データを分析
         scenario = next((s for s in game_data['scenarioOptions'] if s['id'] == game_data['decidedScenarioId']), None)
         completion_result = game_data.get('completionResult', {})
-        game_logs = game_data.get('gameLog', [])
+        game_logs = await run_blocking(store.load_log, game_id, game_data)
         players = game_data.get('players', {})
         total_turns = game_data.get('currentTurn', 1)
         
@@ -2019,8 +2719,12 @@ async def generate_epilogue(request: Request, game_id: str, uid: str = Depends(g
         出力はエピローグのナレーションテキストのみにしてください。
         """
         
-        response = gemini_model.generate_content(epilogue_prompt)
+        gemini_model, model_name = select_text_model(game_data, phase="epilogue")
+        with stage_timer("epilogue_narration", "epilogue", model_name):
+            response = await gemini_model.generate_content_async(epilogue_prompt)
         ending_narrative = response.text
+        usage = UsageTracker()
+        usage.record("epilogue", model_name, response)
         
         # エピローグデータを作成
         epilogue_data = {
@@ -2034,9 +2738,10 @@ async def generate_epilogue(request: Request, game_id: str, uid: str = Depends(g
         }
         
         # Firestoreに保存
-        game_ref.update({
+        await run_blocking(store.update, game_id, {
             "epilogue": epilogue_data,
-            "gameStatus": "finished"
+            "gameStatus": "finished",
+            **usage.updates()
         })
         
         print(f"📜 エピローグ生成完了: {game_id}")
@@ -2054,18 +2759,15 @@ async def generate_epilogue(request: Request, game_id: str, uid: str = Depends(g
 @app.post("/games/{game_id}/manual-complete")
 async def manual_complete_scenario(request: Request, game_id: str, uid: str = Depends(get_current_user_uid)):
     """手動でシナリオを完了状態にし、エピローグフェーズに移行する"""
-    db = request.app.state.db
-    if not db:
+    store = request.app.state.game_store
+    if not store:
         raise HTTPException(status_code=503, detail="Service not available")
     
     try:
-        game_ref = db.collection('games').document(game_id)
-        game_doc = game_ref.get()
-        if not game_doc.exists:
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None:
             raise HTTPException(status_code=404, detail="Game not found")
         
-        game_data = game_doc.to_dict()
-        
         # ホスト権限確認
         if game_data.get('hostId') != uid:
             raise HTTPException(status_code=403, detail="Only host can manually complete scenario")
@@ -2086,7 +2788,7 @@ async def manual_complete_scenario(request: Request, game_id: str, uid: str = De
         }
         
         # Firestoreを更新
-        game_ref.update({
+        await run_blocking(store.update, game_id, {
             "completionResult": manual_completion_result,
             "gameStatus": "completed"
         })
@@ -2109,17 +2811,12 @@ async def manual_complete_scenario(request: Request, game_id: str, uid: str = De
 async def test_generate_epilogue(request: Request, game_id: str):
     """テスト用: 認証なしでエピローグ強制生成"""
     try:
-        db = request.app.state.db
-        gemini_model = request.app.state.gemini_model
-        if not db: raise HTTPException(status_code=503, detail="Service not available")
-        
-        game_ref = db.collection('games').document(game_id)
-        game_doc = game_ref.get()
-        if not game_doc.exists: 
+        store = request.app.state.game_store
+        if not store: raise HTTPException(status_code=503, detail="Service not available")
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None: 
             raise HTTPException(status_code=404, detail="Game not found")
         
-        game_data = game_doc.to_dict()
-        
         # 強制的にエピローグ状態に遷移
         completion_result = {
             "completion_percentage": 85.0,
@@ -2129,7 +2826,7 @@ async def test_generate_epilogue(request: Request, game_id: str):
             "achieved_objectives": ["軌道ステーション避難", "全員の安全確保"]
         }
         
-        game_ref.update({
+        await run_blocking(store.update, game_id, {
             "gameStatus": "epilogue",
             "completionResult": completion_result
         })
@@ -2145,17 +2842,12 @@ async def test_generate_epilogue(request: Request, game_id: str):
 async def test_complete_epilogue(request: Request, game_id: str):
     """テスト用: 認証なしで完全なエピローグデータ生成"""
     try:
-        db = request.app.state.db
-        if not db: raise HTTPException(status_code=503, detail="Service not available")
-        
-        game_ref = db.collection('games').document(game_id)
-        game_doc = game_ref.get()
-        if not game_doc.exists: 
+        store = request.app.state.game_store
+        if not store: raise HTTPException(status_code=503, detail="Service not available")
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None: 
             raise HTTPException(status_code=404, detail="Game not found")
         
-        game_data = game_doc.to_dict()
-        scenario = next((s for s in game_data.get('scenarioOptions', []) if s['id'] == game_data.get('decidedScenarioId')), None)
-        
         # モックエピローグデータ
         epilogue_data = {
             "ending_narrative": "レイ・コートニーと仲間たちは、軌道ステーションXの危機を見事に乗り越えました。緊急避難システムの起動により、全クルーの安全を確保し、宇宙での冒険に新たな歴史を刻みました。この困難を通じて、チームワークと勇気の大切さを改めて実感した冒険者たちは、次なる挑戦への準備を整えています。",
@@ -2187,7 +2879,7 @@ async def test_complete_epilogue(request: Request, game_id: str):
         }
         
         # Firestoreに保存
-        game_ref.update({
+        await run_blocking(store.update, game_id, {
             "epilogue": epilogue_data,
             "gameStatus": "finished",
             "completionResult": completion_result
@@ -2204,20 +2896,16 @@ async def test_complete_epilogue(request: Request, game_id: str):
 @app.post("/test-games/{game_id}/force-epilogue")
 async def force_epilogue(request: Request, game_id: str, new_host_uid: str = Query(None)):
     """テスト用: ゲームステータスを強制的にエピローグに変更"""
-    db = request.app.state.db
-    if not db: 
+    store = request.app.state.game_store
+    if not store: 
         raise HTTPException(status_code=503, detail="Service not available")
     
     try:
         print(f"🔍 デバッグ: new_host_uid = {new_host_uid}")
-        game_ref = db.collection('games').document(game_id)
-        game_doc = game_ref.get()
-        if not game_doc.exists: 
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None: 
             raise HTTPException(status_code=404, detail="Game not found")
-        
-        game_data = game_doc.to_dict()
         print(f"🔍 現在のhostId: {game_data.get('hostId')}")
-        game_logs = game_data.get('gameLog', [])
         total_turns = game_data.get('currentTurn', 1)
         
         # 簡易的な終了判定（5ターン以上で自動成功）
@@ -2244,7 +2932,7 @@ async def force_epilogue(request: Request, game_id: str, new_host_uid: str = Que
             print(f"🔧 ホストID更新: {game_data.get('hostId')} -> {new_host_uid}")
         
         # ゲームステータスを強制的にエピローグに変更
-        game_ref.update(update_data)
+        await run_blocking(store.update, game_id, update_data)
         
         print(f"🧪 テスト: {game_id} を強制的にエピローグ状態に遷移")
         print(f"📝 更新データ: {update_data}")
@@ -2253,28 +2941,41 @@ async def force_epilogue(request: Request, game_id: str, new_host_uid: str = Que
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to force epilogue: {e}")
 
+def claim_epilogue_video(txn: GameTransaction) -> Optional[dict]:
+    """
+    エピローグ動画の生成を始めてよければ video_status を generating にして None を返す。
+    既に動画がある、または生成中の場合は何も書き込まずエピローグデータを返す（二重の依頼を防ぐ）。
+    """
+    game_data = txn.get(["epilogue.video_url", "epilogue.video_status", "epilogue.video_operation", "eventVersion"])
+    if game_data is None:
+        raise HTTPException(status_code=404, detail="Game not found")
+    epilogue_data = game_data.get('epilogue') or {}
+    if epilogue_data.get('video_url') or epilogue_data.get('video_status') == "generating":
+        return epilogue_data
+    updates = video_fields("epilogue", status="generating", operation=None)
+    updates.update(stage_game_events(txn, game_data, events_for_update(updates)))
+    txn.update(updates)
+    return None
+
 @app.post("/games/{game_id}/generate-epilogue-video")
 async def generate_epilogue_video_endpoint(request: Request, game_id: str, uid: str = Depends(get_current_user_uid)):
-    """エピローグのハイライト動画を生成する（トグルスイッチ対応）"""
-    db = request.app.state.db
-    veo_model = request.app.state.veo_model
-    veo_client = request.app.state.veo_client
-    veo_model_name = request.app.state.veo_model_name
+    """
+    エピローグのハイライト動画の生成を開始する（トグルスイッチ対応）。
+    生成はジョブで行い、結果は epilogue.video_status / epilogue.video_url としてゲームのイベントで届く。
+    """
+    store = request.app.state.game_store
     
-    if not db:
+    if not store:
         raise HTTPException(status_code=503, detail="Database service not available")
     
-    if not veo_model and not veo_client:
+    if not model_registry.get("veo_operations") and not model_registry.get("veo"):
         raise HTTPException(status_code=503, detail="Veo video generation service not available")
     
     try:
-        game_ref = db.collection('games').document(game_id)
-        game_doc = game_ref.get()
-        if not game_doc.exists:
+        game_data = await run_blocking(store.get, game_id)
+        if game_data is None:
             raise HTTPException(status_code=404, detail="Game not found")
         
-        game_data = game_doc.to_dict()
-        
         # ホスト権限確認
         if game_data.get('hostId') != uid:
             raise HTTPException(status_code=403, detail="Only host can generate epilogue video")
@@ -2288,10 +2989,6 @@ async def generate_epilogue_video_endpoint(request: Request, game_id: str, uid:
         if not epilogue_data:
             raise HTTPException(status_code=400, detail="Epilogue not generated yet")
         
-        # 既に動画が生成されている場合は既存URLを返す
-        if epilogue_data.get('video_url'):
-            return {"message": "Video already exists", "video_url": epilogue_data['video_url']}
-        
         # シナリオとエピローグ情報を取得
         scenario = next((s for s in game_data.get('scenarioOptions', []) if s['id'] == game_data.get('decidedScenarioId')), {})
         scenario_title = scenario.get('title', 'Unknown Adventure')
@@ -2309,27 +3006,23 @@ async def generate_epilogue_video_endpoint(request: Request, game_id: str, uid:
         if not player_highlights:
             player_highlights = ["Epic adventure completion"]
         
-        print(f"🎬 エピローグ動画生成開始 - シナリオ: {scenario_title}")
-        
-        # 動画生成（時間がかかるため非同期処理）
-        video_url = await generate_epilogue_video(
-            scenario_title=scenario_title, 
-            ending_type=ending_type,
-            player_highlights=player_highlights,
-            completion_percentage=completion_percentage,
-            game_id=game_id
-        )
+        # 既に動画がある場合は既存URLを、生成中の場合はその状態を返す
+        existing = await run_blocking(store.run_transaction, game_id, claim_epilogue_video)
+        if existing is not None:
+            if existing.get('video_url'):
+                return {"message": "Video already exists", "video_url": existing['video_url'], "status": "ready"}
+            operation = existing.get('video_operation') or {}
+            return {"message": "Video generation in progress", "status": "generating", "progress": operation.get('progress', 0)}
         
-        if video_url:
-            # 動画URLをエピローグデータに保存
-            epilogue_data['video_url'] = video_url
-            game_ref.update({"epilogue": epilogue_data})
-            
-            print(f"✅ エピローグ動画生成完了: {video_url}")
-            return {"message": "Epilogue video generated successfully", "video_url": video_url}
-        else:
-            print("❌ エピローグ動画生成に失敗しました")
-            raise HTTPException(status_code=500, detail="Failed to generate epilogue video")
+        print(f"🎬 エピローグ動画生成開始 - シナリオ: {scenario_title}")
+        prompt = epilogue_video_prompt(scenario_title, ending_type, player_highlights, completion_percentage)
+        # 依頼し直せるよう、ジョブIDは依頼ごとに変える
+        try:
+            job_id = await run_blocking(enqueue_job, "epilogue_video", {"gameId": game_id, "prompt": prompt}, game_id, f"epilogue_video-{game_id}-{uuid.uuid4().hex[:8]}")
+        except Exception:
+            await run_blocking(store.update, game_id, video_fields("epilogue", status="failed"))
+            raise
+        return {"message": "Epilogue video generation started", "status": "generating", "jobId": job_id}
         
     except HTTPException:
         raise
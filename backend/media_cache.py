@@ -0,0 +1,287 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+from game_store import GAME_STORE_BACKEND
+from metrics import record_cache_hit, record_cache_lookup
+
+# 生成した画像・動画のキャッシュ。
+# (モデル, 正規化したプロンプト, 生成パラメータ) のハッシュをキーに、保存済みのメディア（Cloud StorageのURL）を引く。
+# 同じシナリオのオープニング動画や、同じ説明で作り直したキャラクター画像はモデルを呼ばずにURLを返す。
+# 同じキーの生成が同時に要求された場合は、プロセス内で1回だけ生成して結果を共有する（single-flight）。
+# 追い出しは索引（URLへの対応）だけを消し、メディア本体はそれを参照するゲームと一緒に管理する。
+# バケットのライフサイクルでメディアを削除する場合は、MEDIA_CACHE_RETENTION_DAYS をそれより短くすること。
+
+MEDIA_CACHE_COLLECTION = "mediaCache"
+MEDIA_CACHE_ENABLED = os.getenv("MEDIA_CACHE_ENABLED", "true").lower() == "true"
+# 索引の最大件数（超えた分は最後に使われたのが古い順に追い出す）
+MEDIA_CACHE_MAX_ENTRIES = int(os.getenv("MEDIA_CACHE_MAX_ENTRIES", "5000"))
+# 最後に使われてからこの日数を過ぎた索引は使わずに追い出す
+MEDIA_CACHE_RETENTION_DAYS = float(os.getenv("MEDIA_CACHE_RETENTION_DAYS", "30"))
+# 何回の登録ごとに追い出しを行うか
+MEDIA_CACHE_EVICT_EVERY = int(os.getenv("MEDIA_CACHE_EVICT_EVERY", "100"))
+# 同じキーの生成を待つ秒数（過ぎたら待つのをやめて自分で生成する）
+MEDIA_CACHE_WAIT_SECONDS = float(os.getenv("MEDIA_CACHE_WAIT_SECONDS", "300"))
+
+
+def normalize_prompt(prompt: str) -> str:
+    """全角半角と空白・改行の違いを吸収する（大文字小文字は生成結果に影響し得るので区別する）"""
+    return " ".join(unicodedata.normalize("NFKC", prompt or "").split())
+
+
+def media_cache_key(model: str, prompt: str, params: Optional[dict] = None) -> str:
+    payload = json.dumps([model or "", normalize_prompt(prompt), params or {}], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MediaCache:
+    """メディアキャッシュの共通処理（single-flight と追い出しの間隔）。索引の保存先は実装ごと"""
+
+    def __init__(self, max_entries: int = MEDIA_CACHE_MAX_ENTRIES, retention_days: float = MEDIA_CACHE_RETENTION_DAYS,
+                 evict_every: int = MEDIA_CACHE_EVICT_EVERY, wait_seconds: float = MEDIA_CACHE_WAIT_SECONDS):
+        self.max_entries = max_entries
+        self.retention = timedelta(days=retention_days)
+        self.evict_every = max(1, evict_every)
+        self.wait_seconds = wait_seconds
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    # --- 実装ごと ---
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """有効な索引があれば返し、最終利用日時を更新する"""
+        raise NotImplementedError
+
+    def store(self, key: str, entry: dict):
+        raise NotImplementedError
+
+    def evict(self) -> int:
+        """保持期間を過ぎた索引と、最大件数を超えた古い索引を消し、消した件数を返す"""
+        raise NotImplementedError
+
+    # --- 共通 ---
+
+    def get_or_create(self, kind: str, model: str, prompt: str, params: Optional[dict],
+                      generate: Callable[[], Optional[str]]) -> Tuple[Optional[str], bool]:
+        """
+        キャッシュにあればそのURLを、無ければ generate() で生成して登録したURLを返す。
+        generate() が None を返した場合（プレースホルダーを使う失敗時など）は登録しない。
+        索引の読み取りに失敗した場合はキャッシュに無いものとして生成する。
+        (URL, モデルを呼ばずに済んだか) を返す。
+        """
+        name = f"media_{kind}"
+        key = media_cache_key(model, prompt, params)
+        entry = self._lookup_or_miss(key)
+        if entry and entry.get("url"):
+            return self._hit(name, kind, key, entry), True
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            # 同じ生成が進行中なので、その結果を待って共有する
+            record_cache_lookup(name, "shared")
+            try:
+                return future.result(timeout=self.wait_seconds), True
+            except FutureTimeoutError:
+                print(f"⚠️ メディアキャッシュ: 進行中の生成を{self.wait_seconds:g}秒待っても終わらないため自分で生成します: {kind} {key[:12]}")
+                return self._generate(name, kind, model, key, generate), False
+
+        # 進行中の印を付けたら、どんな結果でも必ず外して待っている要求に結果を渡す
+        url, error = None, None
+        try:
+            # 確認してから先行の生成が登録を終えた場合に備えて、もう一度引く
+            entry = self._lookup_or_miss(key)
+            if entry and entry.get("url"):
+                url = self._hit(name, kind, key, entry)
+                return url, True
+            url = self._generate(name, kind, model, key, generate)
+            return url, False
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            # 登録してから進行中の印を外す（外した直後に来た要求がキャッシュを引けるように）
+            self._finish(key, future, result=url, error=error)
+
+    def get(self, kind: str, model: str, prompt: str, params: Optional[dict]) -> Optional[str]:
+        """キャッシュ済みのURLを返す（生成はしない。オペレーションとして非同期に生成する動画用）"""
+        name = f"media_{kind}"
+        key = media_cache_key(model, prompt, params)
+        entry = self._lookup_or_miss(key)
+        if not entry or not entry.get("url"):
+            record_cache_lookup(name, "miss")
+            return None
+        return self._hit(name, kind, key, entry)
+
+    def put(self, kind: str, model: str, prompt: str, params: Optional[dict], url: str, generation_seconds: float = 0.0):
+        """get() で見つからずに別途生成したメディアを登録する"""
+        self._store_and_maybe_evict(media_cache_key(model, prompt, params), {
+            "url": url,
+            "kind": kind,
+            "model": model or "",
+            "generationSeconds": round(generation_seconds, 3),
+        })
+
+    def _lookup_or_miss(self, key: str) -> Optional[dict]:
+        try:
+            return self.lookup(key)
+        except Exception as e:
+            # 索引が読めなくても生成はできるので、キャッシュに無いものとして扱う
+            print(f"⚠️ メディアキャッシュの読み取りに失敗: {e}")
+            return None
+
+    def _hit(self, name: str, kind: str, key: str, entry: dict) -> str:
+        record_cache_lookup(name, "hit")
+        record_cache_hit(name, entry.get("generationSeconds") or 0.0)
+        print(f"♻️ メディアキャッシュ: {kind} {key[:12]}")
+        return entry["url"]
+
+    def _generate(self, name: str, kind: str, model: str, key: str, generate: Callable[[], Optional[str]]) -> Optional[str]:
+        record_cache_lookup(name, "miss")
+        started = time.perf_counter()
+        url = generate()
+        if url:
+            self._store_and_maybe_evict(key, {
+                "url": url,
+                "kind": kind,
+                "model": model or "",
+                "generationSeconds": round(time.perf_counter() - started, 3),
+            })
+        return url
+
+    def _finish(self, key: str, future: Future, result: Optional[str] = None, error: Optional[BaseException] = None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _store_and_maybe_evict(self, key: str, entry: dict):
+        try:
+            self.store(key, entry)
+            with self._lock:
+                self._puts += 1
+                due = self._puts % self.evict_every == 0
+            if due:
+                evicted = self.evict()
+                if evicted:
+                    print(f"🧹 メディアキャッシュの追い出し: {evicted}件")
+        except Exception as e:
+            # キャッシュへの登録に失敗しても生成結果はそのまま使う
+            print(f"⚠️ メディアキャッシュの登録に失敗: {e}")
+
+
+class FirestoreMediaCache(MediaCache):
+    """Firestoreの mediaCache コレクションに索引を置く（複数のプロセスで共有される）"""
+
+    EVICT_BATCH = 200
+
+    def __init__(self, db, **kwargs):
+        super().__init__(**kwargs)
+        self.db = db
+        self.collection = db.collection(MEDIA_CACHE_COLLECTION)
+
+    def lookup(self, key: str) -> Optional[dict]:
+        from firebase_admin import firestore
+
+        ref = self.collection.document(key)
+        snapshot = ref.get()
+        if not snapshot.exists:
+            return None
+        entry = snapshot.to_dict()
+        now = datetime.now(timezone.utc)
+        last_used = entry.get("lastUsedAt")
+        if last_used and last_used < now - self.retention:
+            return None
+        ref.update({"lastUsedAt": now, "hits": firestore.Increment(1)})
+        return entry
+
+    def store(self, key: str, entry: dict):
+        now = datetime.now(timezone.utc)
+        self.collection.document(key).set({**entry, "createdAt": now, "lastUsedAt": now, "hits": 0})
+
+    def evict(self) -> int:
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        cutoff = datetime.now(timezone.utc) - self.retention
+        refs = [doc.reference for doc in self.collection.where(filter=FieldFilter("lastUsedAt", "<", cutoff)).limit(self.EVICT_BATCH).get()]
+        excess = self.collection.count().get()[0][0].value - len(refs) - self.max_entries
+        if excess > 0:
+            oldest = self.collection.order_by("lastUsedAt").limit(min(excess + len(refs), self.EVICT_BATCH)).get()
+            known = {ref.id for ref in refs}
+            refs.extend(doc.reference for doc in oldest if doc.id not in known)
+        batch = self.db.batch()
+        for ref in refs:
+            batch.delete(ref)
+        if refs:
+            batch.commit()
+        return len(refs)
+
+
+class InMemoryMediaCache(MediaCache):
+    """プロセス内の索引（GAME_STORE_BACKEND=memory の負荷試験・プロファイリング用）"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._entries_lock = threading.Lock()
+
+    def lookup(self, key: str) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        with self._entries_lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["lastUsedAt"] < now - self.retention:
+                del self._entries[key]
+                return None
+            entry["lastUsedAt"] = now
+            entry["hits"] += 1
+            self._entries.move_to_end(key)
+            return dict(entry)
+
+    def store(self, key: str, entry: dict):
+        now = datetime.now(timezone.utc)
+        with self._entries_lock:
+            self._entries[key] = {**entry, "createdAt": now, "lastUsedAt": now, "hits": 0}
+            self._entries.move_to_end(key)
+
+    def evict(self) -> int:
+        cutoff = datetime.now(timezone.utc) - self.retention
+        evicted = 0
+        with self._entries_lock:
+            for key in [key for key, entry in self._entries.items() if entry["lastUsedAt"] < cutoff]:
+                del self._entries[key]
+                evicted += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        return evicted
+
+    def __len__(self) -> int:
+        with self._entries_lock:
+            return len(self._entries)
+
+
+def create_media_cache(db=None) -> Optional[MediaCache]:
+    """ゲームデータの保存先（GAME_STORE_BACKEND）に合わせたメディアキャッシュを作る"""
+    if not MEDIA_CACHE_ENABLED:
+        return None
+    if GAME_STORE_BACKEND == "memory":
+        return InMemoryMediaCache()
+    if db is None:
+        return None
+    return FirestoreMediaCache(db)
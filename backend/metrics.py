@@ -0,0 +1,139 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+# レイテンシ計測とPrometheus形式でのメトリクス公開。
+# GM応答生成や動画・画像生成の各段階、全エンドポイントの処理時間をヒストグラムに記録し、
+# フォールバック（プレースホルダー使用、JSON解析失敗など）の発生回数をカウンターに記録する。
+# prometheus_client が無い環境では計測は何もせず、/metrics は無効になる。
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+    PROMETHEUS_AVAILABLE = True
+except ImportError:
+    PROMETHEUS_AVAILABLE = False
+    print("⚠️ prometheus_client ライブラリが利用できません。pip install prometheus-client を実行してください。")
+
+# 数ms（Firestoreの読み取り）から数分（動画生成）までを扱う
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+if PROMETHEUS_AVAILABLE:
+    STAGE_SECONDS = Histogram(
+        "trpg_stage_seconds", "処理段階ごとの所要時間",
+        ["stage", "phase", "model"], buckets=STAGE_BUCKETS,
+    )
+    REQUEST_SECONDS = Histogram(
+        "trpg_http_request_seconds", "エンドポイントごとのレスポンス開始までの時間",
+        ["method", "route", "status"], buckets=REQUEST_BUCKETS,
+    )
+    FALLBACK_TOTAL = Counter(
+        "trpg_fallback_total", "フォールバック処理の発生回数",
+        ["kind", "phase"],
+    )
+    LLM_TOKENS_TOTAL = Counter(
+        "trpg_llm_tokens_total", "モデル呼び出しのトークン数",
+        ["call_site", "model", "kind"],
+    )
+    LLM_COST_TOTAL = Counter(
+        "trpg_llm_cost_usd_total", "モデル呼び出しの推定コスト（USD）",
+        ["call_site", "model"],
+    )
+    CACHE_LOOKUPS_TOTAL = Counter(
+        "trpg_cache_lookups_total", "キャッシュの参照回数（hit / miss / bypass）",
+        ["cache", "result"],
+    )
+    CACHE_SAVED_SECONDS_TOTAL = Counter(
+        "trpg_cache_saved_seconds_total", "キャッシュのヒットで省いた生成時間（生成時の所要時間の合計）",
+        ["cache"],
+    )
+
+
+def observe_stage(stage: str, seconds: float, phase: str = "", model: str = ""):
+    if PROMETHEUS_AVAILABLE:
+        STAGE_SECONDS.labels(stage, phase, model or "").observe(seconds)
+
+
+@contextmanager
+def stage_timer(stage: str, phase: str = "", model: str = ""):
+    """with ブロックの所要時間を記録する（例外で抜けた場合も記録する）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started, phase, model)
+
+
+class StageTimer:
+    """
+    入れ子の深い処理を字下げし直さずに計測するためのラップタイマー。
+    lap(stage) を呼ぶたびに、前回の lap（または生成）からの経過時間を stage として記録する。
+    """
+
+    def __init__(self, phase: str, model: str = ""):
+        self.phase = phase
+        self.model = model
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str, model: Optional[str] = None):
+        now = time.perf_counter()
+        observe_stage(stage, now - self._last, self.phase, self.model if model is None else model)
+        self._last = now
+
+
+def record_fallback(kind: str, phase: str = ""):
+    if PROMETHEUS_AVAILABLE:
+        FALLBACK_TOTAL.labels(kind, phase).inc()
+
+
+def record_tokens(call_site: str, model: str, usage: Dict[str, int], cost: float):
+    if PROMETHEUS_AVAILABLE:
+        LLM_TOKENS_TOTAL.labels(call_site, model, "prompt").inc(usage["promptTokens"])
+        LLM_TOKENS_TOTAL.labels(call_site, model, "output").inc(usage["outputTokens"])
+        LLM_TOKENS_TOTAL.labels(call_site, model, "cached").inc(usage["cachedTokens"])
+        LLM_COST_TOTAL.labels(call_site, model).inc(cost)
+
+
+def record_cache_lookup(cache: str, result: str):
+    if PROMETHEUS_AVAILABLE:
+        CACHE_LOOKUPS_TOTAL.labels(cache, result).inc()
+
+
+def record_cache_hit(cache: str, saved_seconds: float):
+    if PROMETHEUS_AVAILABLE:
+        CACHE_SAVED_SECONDS_TOTAL.labels(cache).inc(saved_seconds)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Prometheusのテキスト形式でメトリクスを返す"""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    """
+    全エンドポイントの処理時間を記録するASGIミドルウェア。
+    SSEのような長時間のストリーミング応答も扱えるよう、レスポンス開始（ヘッダー送信）までの時間を計る。
+    ラベルには実際のパスではなくルートのテンプレート（/games/{game_id}/action など）を使う。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not PROMETHEUS_AVAILABLE:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                route = scope.get("route")
+                REQUEST_SECONDS.labels(
+                    scope["method"],
+                    getattr(route, "path", "unmatched"),
+                    str(message["status"]),
+                ).observe(time.perf_counter() - started)
+            await send(message)
+
+        await self.app(scope, receive, send_with_metrics)
@@ -0,0 +1,151 @@
+import threading
+import time
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+# プロセス全体で共有するモデルハンドルのレジストリ。
+# vertexai.init() とモデル生成は起動時に一度だけ行い、
+# リクエストやバックグラウンドタスクは毎回ここから取得した同じハンドルを使う。
+
+
+class VeoHandle(NamedTuple):
+    client: Any
+    model_name: str
+
+
+class ModelRegistry:
+    """名前付きファクトリからモデルを遅延生成し、スレッドセーフにキャッシュする"""
+
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._models: Dict[str, Any] = {}
+        self._failed: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory: Callable[[], Any]):
+        """モデルのファクトリを登録する（既存のハンドルは破棄される）"""
+        with self._lock:
+            self._factories[name] = factory
+            self._models.pop(name, None)
+            self._failed.pop(name, None)
+
+    def get(self, name: str) -> Optional[Any]:
+        """
+        モデルハンドルを返す。初回呼び出し時にファクトリで生成する。
+        未登録、または生成に失敗したモデルは None を返す（失敗は再試行しない）。
+        """
+        model = self._models.get(name)
+        if model is not None:
+            return model
+        with self._lock:
+            if name in self._models:
+                return self._models[name]
+            if name in self._failed or name not in self._factories:
+                return None
+            try:
+                model = self._factories[name]()
+            except Exception as e:
+                self._failed[name] = f"{type(e).__name__}: {e}"
+                print(f"⚠️ モデル初期化失敗 ({name}): {e}")
+                return None
+            self._models[name] = model
+            return model
+
+    def build_all(self) -> Dict[str, bool]:
+        """登録済みの全モデルを生成し、名前ごとの成否を返す"""
+        return {name: self.get(name) is not None for name in list(self._factories)}
+
+    def error(self, name: str) -> Optional[str]:
+        return self._failed.get(name)
+
+    def warm_up(self, name: str, warm_up_call: Callable[[Any], Any]) -> Optional[float]:
+        """
+        モデルに軽いリクエストを一度送り、接続確立や認証トークン取得を済ませておく。
+        所要時間（秒）を返す。モデルが無い場合や失敗した場合は None。
+        """
+        model = self.get(name)
+        if model is None:
+            return None
+        started = time.perf_counter()
+        try:
+            warm_up_call(model)
+        except Exception as e:
+            print(f"⚠️ ウォームアップ失敗 ({name}): {e}")
+            return None
+        return time.perf_counter() - started
+
+
+model_registry = ModelRegistry()
+
+
+def benchmark(iterations: int = 200, project: str = "benchmark", location: str = "us-central1", call: bool = False) -> Dict[str, dict]:
+    """
+    1ターンあたりのモデル準備のオーバーヘッドを比較する。
+    - per_turn_init: 従来の方式（毎ターン vertexai.init() とツール付き GenerativeModel の生成、APIクライアントの生成）
+    - registry: レジストリから起動時に生成済みのハンドルを取り出す
+    call=True の場合は双方で1トークンのリクエストも送る（認証情報とネットワークが必要。接続確立の差も含めて測る）。
+    call=False の場合は認証不要の匿名クレデンシャルで、ネットワークを使わない部分だけを測る。
+    """
+    import statistics
+
+    import vertexai
+    from vertexai.generative_models import GenerationConfig, GenerativeModel
+
+    from main import GEMINI_MODEL_NAME, scenario_tools
+
+    credentials = None
+    if not call:
+        from google.auth.credentials import AnonymousCredentials
+        credentials = AnonymousCredentials()
+
+    def prepare(model):
+        if call:
+            model.generate_content("ping", generation_config=GenerationConfig(max_output_tokens=1))
+        else:
+            model._prediction_client  # 初回リクエスト時に行われるAPIクライアントの生成
+
+    def per_turn_init():
+        vertexai.init(project=project, location=location, credentials=credentials)
+        prepare(GenerativeModel(GEMINI_MODEL_NAME, tools=[scenario_tools]))
+
+    registry = ModelRegistry()
+    vertexai.init(project=project, location=location, credentials=credentials)
+    registry.register("gemini_tools", lambda: GenerativeModel(GEMINI_MODEL_NAME, tools=[scenario_tools]))
+    prepare(registry.get("gemini_tools"))
+
+    def registry_lookup():
+        model = registry.get("gemini_tools")
+        if call:
+            prepare(model)
+
+    results = {}
+    for name, func in (("per_turn_init", per_turn_init), ("registry", registry_lookup)):
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            func()
+            samples.append((time.perf_counter() - started) * 1e6)
+        samples.sort()
+        results[name] = {
+            "mean_us": statistics.fmean(samples),
+            "p50_us": samples[len(samples) // 2],
+            "p95_us": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        }
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import warnings
+
+    parser = argparse.ArgumentParser(description="毎ターンのモデル初期化とレジストリ参照のオーバーヘッドを比較する")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--call", action="store_true", help="1トークンのリクエストも送る（PROJECT_ID / LOCATION と認証情報が必要）")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    results = benchmark(args.iterations, os.getenv("PROJECT_ID", "benchmark"), os.getenv("LOCATION", "us-central1"), args.call)
+    print(f"{'path':15} {'mean µs':>12} {'p50 µs':>12} {'p95 µs':>12}")
+    for name, row in results.items():
+        print(f"{name:15} {row['mean_us']:12.1f} {row['p50_us']:12.1f} {row['p95_us']:12.1f}")
+    print(f"1ターンあたりの削減: {results['per_turn_init']['mean_us'] - results['registry']['mean_us']:.1f} µs")
@@ -18,16 +18,24 @@ class Player(BaseModel):
     characterName: Optional[str] = None
     characterDescription: Optional[str] = None
     characterImageUrl: Optional[str] = None
+    characterImageStatus: Optional[Literal['generating', 'ready', 'failed']] = None  # 画像生成ジョブの状態
     abilities: Optional[CharacterAbilities] = Field(default_factory=CharacterAbilities)
     isReady: bool = False
     joinedAt: datetime = Field(default_factory=datetime.utcnow)
 
+class ObjectiveProgress(BaseModel):
+    achieved_objectives: List[str] = []  # 達成済みの主要目標
+    completion_percentage: float = 0.0
+    updated_turn: int = 0                # 最後に更新したターン
+    sources: Dict[str, str] = {}         # 目標ごとの判定の根拠 ("hint" = GMの申告, "narration" = 描写)
+
 class ScenarioEndConditions(BaseModel):
     primary_objectives: List[str]  # メイン目標
     success_criteria: List[str]    # 成功条件
     failure_criteria: List[str]    # 失敗条件  
     completion_threshold: float = 0.8  # 終了判定の閾値 (0.8 = 80%完了)
     max_turns: int = 50           # 最大ターン数
+    progress: Optional[ObjectiveProgress] = None  # サーバー側で毎ターン更新する進捗
 
 class ScenarioOption(BaseModel):
     id: str
@@ -42,18 +50,21 @@ class OpeningVideo(BaseModel):
 
 class GameLog(BaseModel):
     turn: int
-    type: Literal['gm_narration', 'player_action', 'gm_response', 'image_generation', 'dice_roll']
+    type: Literal['gm_narration', 'player_action', 'gm_response', 'image_generation', 'dice_roll', 'gm_chat']
     content: str
     imageUrl: Optional[str] = None
+    imageStatus: Optional[Literal['pending', 'ready', 'skipped', 'failed']] = None  # 情景画像の生成状態（生成後に書き換わる）
     playerId: Optional[str] = None
     timestamp: datetime = Field(default_factory=datetime.utcnow)
+    seq: Optional[int] = None  # ゲーム内の通し番号（logsサブコレクションのソートキー）
 
 class CompletionResult(BaseModel):
     completion_percentage: float
     is_completed: bool
-    ending_type: Literal['great_success', 'success', 'failure', 'disaster']
+    ending_type: Literal['great_success', 'success', 'failure', 'disaster', 'tragic_success']
     remaining_objectives: List[str]
     achieved_objectives: List[str]
+    end_reason: Optional[str] = None  # objectives / max_turns / gm_judgement / gm_failure / tool
 
 class PlayerContribution(BaseModel):
     player_id: str
@@ -82,7 +93,8 @@ class Game(BaseModel):
     votes: Optional[Dict[str, List[str]]] = None # { scenarioId: [uid1, uid2] }
     decidedScenarioId: Optional[str] = None
     openingVideo: Optional[OpeningVideo] = None
-    gameLog: Optional[List[GameLog]] = []
+    recentLog: Optional[List[GameLog]] = []  # 直近N件のみ。全履歴は games/{id}/logs サブコレクション
+    logSeq: int = 0  # 最後に発行したログ通し番号
     currentTurn: int = 0
     playerActionsThisTurn: Optional[Dict[str, str]] = {}
     endConditions: Optional[ScenarioEndConditions] = None
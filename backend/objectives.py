@@ -0,0 +1,191 @@
+import functools
+import math
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional
+
+# シナリオ目標の進捗をサーバー側で追跡する。
+# 毎ターン、GMのJSON出力に含まれる達成済み目標の申告と、ナレーション中の達成描写を目標と照合して進捗を更新し、
+# 完了率が閾値に達した場合や最大ターン数に達した場合は、モデルの追加呼び出し無しで決定的にシナリオを終える。
+# 照合は目標の内容語（漢字・カタカナ・英数字の連なり）の重み付き包含率で行い、目標ごとの語と重みは事前に計算しておく。
+
+PROGRESS_FIELD = "endConditions.progress"
+
+DEFAULT_COMPLETION_THRESHOLD = 0.8
+DEFAULT_MAX_TURNS = 50
+
+HINT_MATCH_THRESHOLD = 0.5  # GMが申告した目標の文言との一致度
+NARRATION_MATCH_THRESHOLD = 0.75  # ナレーションの一文との一致度（達成を表す語も必要）
+
+_TOKEN_PATTERN = re.compile(r"[一-龥々〆ヵヶ]+|[ァ-ヴー]+|[a-z0-9]+")
+_SENTENCE_PATTERN = re.compile(r"[^。！？!?\n]+")
+# 「〜した」「〜された」のような完了の描写（意図や予定の文は数えない）
+_ACHIEVED_PATTERN = re.compile(r"(達成|解決|解明|突き止め|見つけ|発見|倒|救出|救い出|解除|手に入れ|果た|取り戻|封印|脱出|阻止|撃退|完了)(し|さ|され|させ)?た")
+_NEGATED_PATTERN = re.compile(r"(なかった|できず|られず|失敗した|ならなかった)")
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", str(text or "")).lower().strip()
+
+
+def _tokens(text: str) -> set:
+    normalized = _normalize(text)
+    tokens = set(_TOKEN_PATTERN.findall(normalized))
+    # 内容語が無い（ひらがなだけの）目標は文字列全体を1語として扱う
+    return tokens or ({normalized} if normalized else set())
+
+
+def ending_type_for(completion_percentage: float, force_ending: bool = False) -> str:
+    """完了率から終了タイプを決める（check_scenario_completion と同じ基準）"""
+    if force_ending:
+        # 悲劇的成功（目標は達成したが代償が大きい）か完全な失敗
+        return "tragic_success" if completion_percentage >= 50.0 else "disaster"
+    if completion_percentage >= 95.0:
+        return "great_success"
+    if completion_percentage >= 75.0:
+        return "success"
+    if completion_percentage >= 50.0:
+        return "failure"
+    return "disaster"
+
+
+class ObjectiveMatcher:
+    """
+    シナリオの主要目標との照合器。
+    目標ごとの内容語に「長さ × その目標群の中での珍しさ」の重みを付け、
+    テキストがその目標の語をどれだけ含むか（重み付き包含率）で一致度を測る。
+    全目標に共通する語（「目標」など）は重みが小さくなり、目標同士を取り違えにくい。
+    """
+
+    def __init__(self, objectives: Iterable[str]):
+        self.objectives = [str(objective) for objective in objectives]
+        self._normalized = [_normalize(objective) for objective in self.objectives]
+        token_sets = [_tokens(objective) for objective in self.objectives]
+        document_frequency: Dict[str, int] = {}
+        for tokens in token_sets:
+            for token in tokens:
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        count = len(token_sets)
+        self._weights = [
+            {token: len(token) * math.log((count + 1) / document_frequency[token]) for token in tokens}
+            for tokens in token_sets
+        ]
+        self._totals = [sum(weights.values()) for weights in self._weights]
+
+    def _score(self, index: int, tokens: set) -> float:
+        total = self._totals[index]
+        if not total:
+            return 0.0
+        return sum(weight for token, weight in self._weights[index].items() if token in tokens) / total
+
+    def best_match(self, text: str) -> tuple:
+        """最も一致する目標の (インデックス, 一致度)。目標が無ければ (-1, 0.0)"""
+        normalized = _normalize(text)
+        if normalized in self._normalized:
+            return self._normalized.index(normalized), 1.0
+        tokens = _tokens(text)
+        best_index, best_score = -1, 0.0
+        for index in range(len(self.objectives)):
+            score = self._score(index, tokens)
+            if score > best_score:
+                best_index, best_score = index, score
+        return best_index, best_score
+
+    def match_claims(self, claims: Iterable[str]) -> List[int]:
+        """GMが達成を申告した文言を目標に対応付ける"""
+        matched = []
+        for claim in claims:
+            index, score = self.best_match(claim)
+            if index >= 0 and score >= HINT_MATCH_THRESHOLD and index not in matched:
+                matched.append(index)
+        return matched
+
+    def achieved_in_narration(self, narration: str) -> List[int]:
+        """ナレーション中で達成が描写された目標（達成を表す語を含み、否定されていない文のみ）"""
+        matched = []
+        for sentence in _SENTENCE_PATTERN.findall(_normalize(narration)):
+            if not _ACHIEVED_PATTERN.search(sentence) or _NEGATED_PATTERN.search(sentence):
+                continue
+            tokens = _tokens(sentence)
+            for index in range(len(self.objectives)):
+                if index not in matched and self._score(index, tokens) >= NARRATION_MATCH_THRESHOLD:
+                    matched.append(index)
+        return matched
+
+
+@functools.lru_cache(maxsize=256)
+def objective_matcher(objectives: tuple) -> ObjectiveMatcher:
+    """シナリオの目標ごとの照合器（同じ目標の組は使い回す）"""
+    return ObjectiveMatcher(objectives)
+
+
+def _claims_from_hints(hints: dict) -> List[str]:
+    claims = hints.get("achievedObjectives") or hints.get("achieved_objectives") or []
+    if isinstance(claims, str):
+        claims = claims.split(",")
+    return [str(claim).strip() for claim in claims if str(claim).strip()]
+
+
+def track_objectives(end_conditions: Optional[dict], turn: int, narration: str, hints: Optional[dict] = None) -> tuple:
+    """
+    このターンの結果で進捗を更新する。
+    (endConditions.progress に書き込む進捗, 終了する場合は completionResult / 続ける場合は None) を返す。
+    """
+    end_conditions = end_conditions or {}
+    hints = hints or {}
+    objectives = tuple(end_conditions.get("primary_objectives") or [])
+    progress = dict(end_conditions.get("progress") or {})
+    achieved = list(progress.get("achieved_objectives") or [])
+    sources = dict(progress.get("sources") or {})
+
+    if objectives:
+        matcher = objective_matcher(objectives)
+        for source, indices in (("hint", matcher.match_claims(_claims_from_hints(hints))),
+                                ("narration", matcher.achieved_in_narration(narration))):
+            for index in indices:
+                objective = objectives[index]
+                if objective not in achieved:
+                    achieved.append(objective)
+                    sources[objective] = source
+        completion_percentage = len(achieved) / len(objectives) * 100.0
+    else:
+        completion_percentage = 0.0
+
+    progress = {
+        "achieved_objectives": achieved,
+        "completion_percentage": round(completion_percentage, 1),
+        "updated_turn": turn,
+        "sources": sources,
+    }
+
+    threshold = float(end_conditions.get("completion_threshold") or DEFAULT_COMPLETION_THRESHOLD)
+    max_turns = int(end_conditions.get("max_turns") or DEFAULT_MAX_TURNS)
+    status = str(hints.get("scenarioStatus") or "").lower()
+    force_ending = status == "failed"
+    if force_ending:
+        end_reason = "gm_failure"
+    elif status == "completed":
+        end_reason = "gm_judgement"
+    elif objectives and completion_percentage >= threshold * 100.0:
+        end_reason = "objectives"
+    elif turn >= max_turns:
+        end_reason = "max_turns"
+    else:
+        return progress, None
+
+    completion_result = {
+        "completion_percentage": progress["completion_percentage"],
+        "is_completed": True,
+        "ending_type": ending_type_for(completion_percentage, force_ending),
+        "remaining_objectives": [objective for objective in objectives if objective not in achieved],
+        "achieved_objectives": achieved,
+        "force_ending": force_ending,
+        "end_reason": end_reason,
+    }
+    return progress, completion_result
+
+
+def progress_prompt_line(end_conditions: Optional[dict]) -> str:
+    """GMプロンプトに載せる達成済み目標の一覧"""
+    achieved = ((end_conditions or {}).get("progress") or {}).get("achieved_objectives") or []
+    return ", ".join(achieved) if achieved else "なし"
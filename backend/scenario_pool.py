@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from game_store import GAME_STORE_BACKEND
+from models import ScenarioOption
+
+# 投票開始用のシナリオ候補のプール。
+# キーワードやテーマの指定が無い投票開始では、難易度ごとに事前生成しておいた3案のセットを
+# 1つ取り出して使い（ホストのリクエストはFirestoreの読み書きだけで済む）、減った分はワーカーが補充する。
+# セットの取り出しはトランザクションで行い、同じセットが2つのゲームに使われることはない。
+
+SCENARIO_POOL_COLLECTION = "scenarioPool"
+# 難易度ごとに用意しておくセット数（0でプールを使わない）
+SCENARIO_POOL_SIZE = int(os.getenv("SCENARIO_POOL_SIZE", "2"))
+# 補充ジョブの重複排除の時間枠（秒）。同じ難易度の補充はこの時間枠ごとに1件だけ登録される
+SCENARIO_POOL_REFILL_WINDOW_SECONDS = float(os.getenv("SCENARIO_POOL_REFILL_WINDOW_SECONDS", "60"))
+
+# 難易度に応じた設定
+DIFFICULTY_SETTINGS = {
+    "easy": {"max_turns": 40, "threshold": 0.6, "complexity": "簡単で分かりやすい"},
+    "normal": {"max_turns": 30, "threshold": 0.75, "complexity": "適度な難易度の"},
+    "hard": {"max_turns": 25, "threshold": 0.8, "complexity": "挑戦的で複雑な"},
+    "extreme": {"max_turns": 20, "threshold": 0.9, "complexity": "非常に困難で複合的な"}
+}
+
+
+def normalize_difficulty(difficulty: Optional[str]) -> str:
+    return difficulty if difficulty in DIFFICULTY_SETTINGS else "normal"
+
+
+def scenario_prompt(difficulty: str, keywords: Optional[List[str]] = None, theme_preference: str = "") -> str:
+    """シナリオ候補3案と終了条件を生成するプロンプト"""
+    settings = DIFFICULTY_SETTINGS[normalize_difficulty(difficulty)]
+    keywords_text = f"必須キーワード: {', '.join(keywords)}" if keywords else ""
+    theme_text = f"テーマ: {theme_preference}" if theme_preference else ""
+    return f"""
+        あなたはTRPGのシナリオ作成の専門家です。
+        以下の条件で3つの異なる{settings['complexity']}シナリオ案を作成してください：
+
+        # 基本設定
+        - 難易度: {difficulty} ({settings['complexity']})
+        - {keywords_text}
+        - {theme_text}
+
+        # シナリオタイプ
+        1. ファンタジー系
+        2. SF系
+        3. 現代系（ホラー、ミステリー、アクションなど）
+
+        各シナリオには以下を含めてください：
+        - title: 魅力的なタイトル（15文字以内）
+        - summary: 簡潔なあらすじ（100文字程度）
+        - endConditions: 終了条件（各シナリオの完了判定に必要な情報）
+          - primary_objectives: メイン目標のリスト（3-5個）
+          - success_criteria: 成功条件のリスト
+          - failure_criteria: 失敗条件のリスト
+          - completion_threshold: 完了判定の閾値（{settings['threshold']}）
+          - max_turns: 最大ターン数（{settings['max_turns']}）
+
+        JSON配列形式で出力してください。例：
+        [
+          {{
+            "title": "失われた魔法の森",
+            "summary": "古い魔法の森で消えた村人たちを探す冒険。邪悪な魔法使いの呪いを解く必要がある。",
+            "endConditions": {{
+              "primary_objectives": ["村人の行方を突き止める", "邪悪な魔法使いを発見する", "呪いの謎を解明する", "呪いを解除する"],
+              "success_criteria": ["全ての村人を救出", "魔法使いを倒すか説得", "森の平和を回復"],
+              "failure_criteria": ["パーティ全滅", "村人の半数以上が犠牲", "呪いが拡散"],
+              "completion_threshold": 0.75,
+              "max_turns": 30
+            }}
+          }}
+        ]
+        """
+
+
+def parse_scenario_ideas(text: str) -> List[dict]:
+    """モデルの応答（JSON配列）を検証し、IDを除いたシナリオ候補のリストにする"""
+    ideas = json.loads(text)
+    return [ScenarioOption(id="", **idea).model_dump(exclude={"id"}) for idea in ideas]
+
+
+def with_new_ids(ideas: List[dict]) -> List[ScenarioOption]:
+    """ゲームで使うシナリオ候補（ゲームごとに新しいIDを振る）"""
+    return [ScenarioOption(id=str(uuid.uuid4()), **idea) for idea in ideas]
+
+
+class ScenarioPool:
+    """シナリオ候補プールの共通インターフェース"""
+
+    def add(self, difficulty: str, ideas: List[dict]):
+        raise NotImplementedError
+
+    def take(self, difficulty: str) -> Optional[List[dict]]:
+        """難易度のセットを1つ取り除いて返す。空なら None"""
+        raise NotImplementedError
+
+    def count(self, difficulty: str, limit: int = SCENARIO_POOL_SIZE) -> int:
+        """難易度のセット数（limit 件まで数える）"""
+        raise NotImplementedError
+
+
+class FirestoreScenarioPool(ScenarioPool):
+    """Firestoreの scenarioPool コレクションを使うプール（取り出しはトランザクションで排他する）"""
+
+    # 取り出しで競合した場合に試す候補の数
+    TAKE_CANDIDATES = 3
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.collection(SCENARIO_POOL_COLLECTION)
+
+    def _bucket(self, difficulty: str):
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        return self.collection.where(filter=FieldFilter("difficulty", "==", difficulty))
+
+    def add(self, difficulty: str, ideas: List[dict]):
+        self.collection.document(uuid.uuid4().hex).set({
+            "difficulty": difficulty,
+            "options": ideas,
+            "createdAt": datetime.now(timezone.utc),
+        })
+
+    def take(self, difficulty: str) -> Optional[List[dict]]:
+        for doc in self._bucket(difficulty).limit(self.TAKE_CANDIDATES).get():
+            ideas = self._take_one(doc.reference)
+            if ideas:
+                return ideas
+        return None
+
+    def _take_one(self, ref) -> Optional[List[dict]]:
+        from firebase_admin import firestore
+
+        @firestore.transactional
+        def take_in_transaction(transaction):
+            snapshot = ref.get(transaction=transaction)
+            # 他のリクエストが先に取り出していれば次の候補へ
+            if not snapshot.exists:
+                return None
+            transaction.delete(ref)
+            return snapshot.to_dict().get("options")
+
+        return take_in_transaction(self.db.transaction())
+
+    def count(self, difficulty: str, limit: int = SCENARIO_POOL_SIZE) -> int:
+        return len(self._bucket(difficulty).limit(max(1, limit)).get())
+
+
+class InMemoryScenarioPool(ScenarioPool):
+    """プロセス内のプール（GAME_STORE_BACKEND=memory の負荷試験・プロファイリング用）"""
+
+    def __init__(self):
+        self._buckets: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def add(self, difficulty: str, ideas: List[dict]):
+        with self._lock:
+            self._buckets.setdefault(difficulty, deque()).append(ideas)
+
+    def take(self, difficulty: str) -> Optional[List[dict]]:
+        with self._lock:
+            bucket = self._buckets.get(difficulty)
+            return bucket.popleft() if bucket else None
+
+    def count(self, difficulty: str, limit: int = SCENARIO_POOL_SIZE) -> int:
+        with self._lock:
+            return min(len(self._buckets.get(difficulty) or ()), limit)
+
+
+def create_scenario_pool(db=None) -> Optional[ScenarioPool]:
+    """ゲームデータの保存先（GAME_STORE_BACKEND）に合わせたプールを作る"""
+    if SCENARIO_POOL_SIZE <= 0:
+        return None
+    if GAME_STORE_BACKEND == "memory":
+        return InMemoryScenarioPool()
+    if db is None:
+        return None
+    return FirestoreScenarioPool(db)
@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from metrics import record_fallback
+
+# GMターンの情景画像の生成。
+# ナレーションを確定したあとで生成を始め、できた画像でログエントリ（gm_response）の imageUrl を書き換える。
+# 画像生成はターンより遅く高価なので、プロセス内で次のように制限する:
+# - レート制限: 1分あたり SCENE_IMAGE_RATE_PER_MINUTE 件（トークンバケット。足りなければ待たずに見送る）
+# - ゲームごとの重複排除: 同じゲームで生成中の画像があれば新しい依頼は見送る
+# - 見送り: プロセス全体の生成中・待ちの件数が SCENE_IMAGE_MAX_PENDING に達していれば見送る
+# 見送った画像は遅れて届いても古い場面になるだけなので、溜めずに捨てる。
+# 生成はプロセス内で行うため、生成中にプロセスが止まると imageStatus: pending のまま残る。
+# そのため生成を始めるときに永続化した回収ジョブを SCENE_IMAGE_RECOVERY_SECONDS 後に登録しておき、
+# その時点でまだ pending のエントリは failed に書き換える（止まったプロセスの代わりに別のワーカーが実行する）。
+
+SCENE_IMAGES_ENABLED = os.getenv("SCENE_IMAGES_ENABLED", "true").lower() == "true"
+SCENE_IMAGE_RATE_PER_MINUTE = float(os.getenv("SCENE_IMAGE_RATE_PER_MINUTE", "30"))
+SCENE_IMAGE_MAX_PENDING = int(os.getenv("SCENE_IMAGE_MAX_PENDING", "8"))
+SCENE_IMAGE_WORKERS = int(os.getenv("SCENE_IMAGE_WORKERS", "4"))
+# 生成を始めてからこの秒数を過ぎても pending のままなら、生成が失われたとみなす
+SCENE_IMAGE_RECOVERY_SECONDS = float(os.getenv("SCENE_IMAGE_RECOVERY_SECONDS", "600"))
+
+# ログエントリの imageStatus
+IMAGE_PENDING = "pending"
+IMAGE_READY = "ready"
+IMAGE_SKIPPED = "skipped"
+IMAGE_FAILED = "failed"
+
+
+class TokenBucket:
+    """1分あたり rate_per_minute 件、最大 burst 件まで連続で許可するレート制限"""
+
+    def __init__(self, rate_per_minute: float, burst: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, burst if burst is not None else rate_per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+
+class SceneImageScheduler:
+    """情景画像の生成をバックグラウンドで実行する（レート制限・ゲームごとの重複排除・見送り）"""
+
+    def __init__(self, rate_per_minute: float = SCENE_IMAGE_RATE_PER_MINUTE, max_pending: int = SCENE_IMAGE_MAX_PENDING,
+                 workers: int = SCENE_IMAGE_WORKERS):
+        self.bucket = TokenBucket(rate_per_minute)
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="scene-image")
+        self._pending: Dict[str, int] = {}  # ゲームID -> 生成中のターン
+        self._lock = threading.Lock()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def reserve(self, game_id: str, turn: int) -> Optional[str]:
+        """
+        ターンの確定前に生成枠を確保する（ログエントリを「生成中」で書くか決めるため）。
+        確保できた場合は None、見送る場合はその理由（"game_pending" / "too_many_pending" / "rate_limited"）を返す。
+        確保した枠は start() で生成を始めるか、ターンを確定できなかった場合は release() で返す。
+        """
+        with self._lock:
+            if game_id in self._pending:
+                reason = "game_pending"
+            elif len(self._pending) >= self.max_pending:
+                reason = "too_many_pending"
+            elif not self.bucket.try_acquire():
+                reason = "rate_limited"
+            else:
+                reason = None
+                self._pending[game_id] = turn
+        if reason:
+            record_fallback(f"scene_image_skipped_{reason}", "playing")
+        return reason
+
+    def start(self, game_id: str, task: Callable[[], None]):
+        self._executor.submit(self._run, game_id, task)
+
+    def release(self, game_id: str):
+        with self._lock:
+            self._pending.pop(game_id, None)
+
+    def _run(self, game_id: str, task: Callable[[], None]):
+        try:
+            task()
+        except Exception as e:
+            print(f"🚨 情景画像の生成に失敗: {game_id}: {e}")
+        finally:
+            self.release(game_id)
+
+
+scene_image_scheduler = SceneImageScheduler()
@@ -0,0 +1,125 @@
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from firebase_admin import firestore
+
+# ターン解決のリース。
+# 全員の行動が揃ったターンのGM応答生成は、turnResolution フィールドのリースを取得した1つのワーカーだけが行う。
+# リースは行動を記録するのと同じトランザクションで取得し、ターン確定の書き込み時に保持者を検証して解放する。
+# ワーカーが途中で落ちた場合は期限切れのリースを別のワーカーが奪い直す。
+
+TURN_LEASE_FIELD = "turnResolution"
+TURN_LEASE_SECONDS = int(os.getenv("TURN_LEASE_SECONDS", "180"))
+
+
+class TurnLeaseLost(Exception):
+    """リースを失った（期限切れで他のワーカーに奪われた、またはターンが既に確定した）"""
+
+
+def new_lease_owner() -> str:
+    return uuid.uuid4().hex
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _as_aware(value) -> Optional[datetime]:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime) and value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def lease_is_active(game_data: dict, turn: int) -> bool:
+    """指定ターンについて期限内のリースが存在するか"""
+    lease = game_data.get(TURN_LEASE_FIELD) or {}
+    if lease.get("state") != "resolving" or lease.get("turn") != turn:
+        return False
+    expires_at = _as_aware(lease.get("expiresAt"))
+    return expires_at is not None and expires_at > _now()
+
+
+def turn_ready_to_resolve(game_data: dict, pending_actions: int = 0) -> bool:
+    """プレイ中で、全プレイヤーの行動が揃っているか（pending_actions は同じトランザクションで追加する行動数）"""
+    if game_data.get("gameStatus") != "playing":
+        return False
+    num_players = len(game_data.get("players", {}))
+    num_actions = len(game_data.get("playerActionsThisTurn", {})) + pending_actions
+    return num_players > 0 and num_actions >= num_players
+
+
+def lease_update(turn: int, owner: str) -> dict:
+    """リース取得時にゲームドキュメントへ書き込む更新内容"""
+    return {
+        TURN_LEASE_FIELD: {
+            "state": "resolving",
+            "owner": owner,
+            "turn": turn,
+            "expiresAt": _now() + timedelta(seconds=TURN_LEASE_SECONDS),
+        }
+    }
+
+
+def release_update() -> dict:
+    """ターン確定時にリースを解放する更新内容"""
+    return {TURN_LEASE_FIELD: firestore.DELETE_FIELD}
+
+
+def verify_lease(game_data: dict, turn: int, owner: str):
+    """トランザクション内で読み取ったゲームデータに対し、まだリースを保持しているか検証する"""
+    lease = game_data.get(TURN_LEASE_FIELD) or {}
+    if game_data.get("currentTurn") != turn or lease.get("owner") != owner or lease.get("turn") != turn:
+        raise TurnLeaseLost(f"turn {turn} lease is no longer held by {owner}")
+
+
+def acquire_turn_lease(store, game_id: str, turn: Optional[int] = None) -> Optional[tuple]:
+    """
+    行動が揃っていて有効なリースが無い（または期限切れの）ターンのリースを取得する。
+    取得できた場合は (ターン番号, 保持者ID) を、できなかった場合は None を返す。
+    """
+    owner = new_lease_owner()
+
+    def acquire_in_transaction(txn):
+        game_data = txn.get()
+        if game_data is None:
+            return None
+        current_turn = game_data.get("currentTurn", 1)
+        if turn is not None and current_turn != turn:
+            return None
+        if not turn_ready_to_resolve(game_data) or lease_is_active(game_data, current_turn):
+            return None
+        txn.update(lease_update(current_turn, owner))
+        return current_turn, owner
+
+    return store.run_transaction(game_id, acquire_in_transaction)
+
+
+def release_turn_lease(store, game_id: str, turn: int, owner: str) -> bool:
+    """
+    ターンを確定せずにリースを手放す（GM応答生成をジョブの再試行に任せる場合）。
+    まだ自分が保持している場合のみ解放し、解放した場合は True を返す。
+    """
+
+    def release_in_transaction(txn):
+        game_data = txn.get(["currentTurn", TURN_LEASE_FIELD])
+        if game_data is None:
+            return False
+        try:
+            verify_lease(game_data, turn, owner)
+        except TurnLeaseLost:
+            return False
+        txn.update(release_update())
+        return True
+
+    return store.run_transaction(game_id, release_in_transaction)
+
+
+def lease_guard(turn: int, owner: str):
+    """GameStore.append_log の precondition に渡す検証関数を作る"""
+    def guard(game_data: dict):
+        verify_lease(game_data, turn, owner)
+    return guard
@@ -0,0 +1,258 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+# GM応答のストリーミング配信。
+# GM応答生成タスク（スレッドプール上で実行）が生成途中のナレーションを publish し、
+# SSEエンドポイント（イベントループ上）が subscribe して逐次クライアントへ送る。
+# 最終的なログの永続化は従来どおり生成完了時に一度だけ行う。
+# 生成したプロセスとSSEの接続先が異なる場合（ワーカーを別サービスにした場合や、Webサーバーが複数インスタンスの場合）に備えて、
+# 生成途中のナレーションを一定間隔で（確定したナレーションは確定時に）games/{id}/turnStreams/current に書き出し、
+# 接続先のプロセスはそのドキュメントをリスナーで購読して中継する。
+
+# 完了したストリームを保持しておく秒数（遅れて接続したクライアント向け）
+FINISHED_STREAM_TTL_SECONDS = 120
+# 生成途中のナレーションを保存先へ書き出す間隔（秒）。0 で書き出さない（生成と同じプロセスに接続したクライアントにだけ配信する）
+TURN_STREAM_RELAY_SECONDS = float(os.getenv("TURN_STREAM_RELAY_SECONDS", "1.0"))
+TURN_STREAM_COLLECTION = "turnStreams"
+TURN_STREAM_DOC_ID = "current"
+
+
+class NarrationStreamExtractor:
+    """
+    GMの出力（{"narration": "...", "imagePrompt": ...} 形式のJSON）を断片ごとに受け取り、
+    narration の値だけをデコード済みテキストとして逐次取り出す。
+    JSONではないプレーンテキストの応答はそのまま通す。
+    """
+
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self._buffer = ""
+        self._position = 0
+        self._mode = None  # None: 判定前, "json": JSON, "text": プレーンテキスト
+        self._in_narration = False
+        self._finished = False
+
+    def feed(self, chunk: str) -> str:
+        """断片を追加し、新たに確定したナレーションのテキストを返す"""
+        self._buffer += chunk
+        if self._mode is None:
+            stripped = self._buffer.lstrip().lstrip("\ufeff")
+            if not stripped:
+                return ""
+            self._mode = "json" if stripped[0] in "{`" else "text"
+        if self._mode == "text":
+            text = self._buffer[self._position:]
+            self._position = len(self._buffer)
+            return text
+        return self._extract_json_narration()
+
+    def _extract_json_narration(self) -> str:
+        if self._finished:
+            return ""
+        if not self._in_narration:
+            key_index = self._buffer.find('"narration"', self._position)
+            if key_index == -1:
+                return ""
+            colon_index = self._buffer.find(':', key_index + len('"narration"'))
+            if colon_index == -1:
+                return ""
+            quote_index = self._buffer.find('"', colon_index + 1)
+            if quote_index == -1:
+                return ""
+            self._position = quote_index + 1
+            self._in_narration = True
+
+        output = []
+        buffer = self._buffer
+        index = self._position
+        while index < len(buffer):
+            char = buffer[index]
+            if char == '"':
+                self._finished = True
+                index += 1
+                break
+            if char == '\\':
+                if index + 1 >= len(buffer):
+                    break  # エスケープの続きが未着
+                escape = buffer[index + 1]
+                if escape == 'u':
+                    if index + 6 > len(buffer):
+                        break
+                    try:
+                        output.append(chr(int(buffer[index + 2:index + 6], 16)))
+                    except ValueError:
+                        pass
+                    index += 6
+                    continue
+                output.append(self._ESCAPES.get(escape, escape))
+                index += 2
+                continue
+            output.append(char)
+            index += 1
+        self._position = index
+        return "".join(output)
+
+
+class TurnStream:
+    """1ターン分のナレーション配信状態"""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex  # 再試行で生成し直した場合に、中継先が断片を破棄できるように区別する
+        self.chunks: List[str] = []
+        self.final: Optional[dict] = None
+        self.finished_at: Optional[float] = None
+        self.relayed_at = 0.0
+        self.subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+
+
+class TurnStreamHub:
+    """プロセス内のターンごとのナレーションストリームを管理する"""
+
+    def __init__(self, relay_seconds: float = TURN_STREAM_RELAY_SECONDS):
+        self._streams: Dict[Tuple[str, int], TurnStream] = {}
+        self._lock = threading.Lock()
+        self.relay_seconds = relay_seconds
+        # 他のプロセスへの中継（game_id, turn, ストリームID, これまでの全文, 確定したナレーション）。起動時に設定する
+        self.relay: Optional[Callable[[str, int, str, str, Optional[dict]], None]] = None
+
+    def _cleanup_locked(self):
+        now = time.monotonic()
+        expired = [key for key, stream in self._streams.items()
+                   if stream.finished_at is not None and now - stream.finished_at > FINISHED_STREAM_TTL_SECONDS]
+        for key in expired:
+            del self._streams[key]
+
+    def start(self, game_id: str, turn: int):
+        """
+        GM応答生成の開始時に呼ぶ（以前の同一ターンのストリームは破棄する）。
+        失敗した生成を再試行する場合は、購読中のクライアントを引き継いで reset を送る（表示中の断片を消させる）。
+        """
+        stream = TurnStream()
+        with self._lock:
+            self._cleanup_locked()
+            previous = self._streams.get((game_id, turn))
+            if previous is not None and previous.final is None:
+                stream.subscribers = previous.subscribers
+            self._streams[(game_id, turn)] = stream
+            subscribers = list(stream.subscribers)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, ("reset", {}))
+
+    def publish(self, game_id: str, turn: int, text: str):
+        """生成途中のナレーション断片を配信する"""
+        if not text:
+            return
+        relayed = None
+        with self._lock:
+            stream = self._streams.get((game_id, turn))
+            if stream is None or stream.final is not None:
+                return
+            stream.chunks.append(text)
+            subscribers = list(stream.subscribers)
+            now = time.monotonic()
+            if self.relay and self.relay_seconds > 0 and now - stream.relayed_at >= self.relay_seconds:
+                stream.relayed_at = now
+                relayed = (stream.id, "".join(stream.chunks))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, ("delta", {"text": text}))
+        if relayed:
+            self._relay(game_id, turn, *relayed)
+
+    def _relay(self, game_id: str, turn: int, stream_id: str, text: str, final: Optional[dict] = None):
+        try:
+            self.relay(game_id, turn, stream_id, text, final)
+        except Exception as e:
+            # 中継できなくても生成は続ける（別プロセスのクライアントには確定後のナレーションが届く）
+            print(f"⚠️ ナレーションの中継に失敗: {e}")
+
+    def finish(self, game_id: str, turn: int, narration: str, image_url: Optional[str] = None):
+        """確定したナレーションを配信し、ストリームを閉じる"""
+        final = {"narration": narration, "imageUrl": image_url}
+        with self._lock:
+            stream = self._streams.setdefault((game_id, turn), TurnStream())
+            stream.final = final
+            stream.finished_at = time.monotonic()
+            subscribers = list(stream.subscribers)
+            stream.subscribers.clear()
+            relayed = (stream.id, "".join(stream.chunks)) if self.relay and self.relay_seconds > 0 else None
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, ("done", final))
+        if relayed:
+            self._relay(game_id, turn, *relayed, final)
+
+    def is_active(self, game_id: str, turn: int) -> bool:
+        with self._lock:
+            return (game_id, turn) in self._streams
+
+    def subscribe(self, game_id: str, turn: int) -> Optional[asyncio.Queue]:
+        """
+        ストリームを購読する。これまでに配信済みの断片は最初にまとめて積まれる。
+        このプロセスでそのターンを生成していない場合は None を返す。
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            stream = self._streams.get((game_id, turn))
+            if stream is None:
+                return None
+            if stream.chunks:
+                queue.put_nowait(("delta", {"text": "".join(stream.chunks)}))
+            if stream.final is not None:
+                queue.put_nowait(("done", stream.final))
+            else:
+                stream.subscribers.append((loop, queue))
+        return queue
+
+    def unsubscribe(self, game_id: str, turn: int, queue: asyncio.Queue):
+        with self._lock:
+            stream = self._streams.get((game_id, turn))
+            if stream is not None:
+                stream.subscribers = [(loop, q) for loop, q in stream.subscribers if q is not queue]
+
+
+class RelayedStreamReader:
+    """
+    別のプロセスが書き出したナレーションの全文を、前回からの差分（delta）と再試行時の reset に変換する。
+    確定したナレーションが書き出されていれば最後に done を返す。
+    """
+
+    def __init__(self):
+        self.stream_id: Optional[str] = None
+        self.text = ""
+
+    def read(self, relayed: Optional[dict]) -> List[Tuple[str, dict]]:
+        if not relayed or not relayed.get("streamId"):
+            return []
+        events = []
+        text = relayed.get("text") or ""
+        if relayed["streamId"] != self.stream_id:
+            if self.text:
+                events.append(("reset", {}))
+            self.stream_id, self.text = relayed["streamId"], ""
+        if len(text) > len(self.text):
+            events.append(("delta", {"text": text[len(self.text):]}))
+            self.text = text
+        if relayed.get("final"):
+            events.append(("done", relayed["final"]))
+        return events
+
+
+def _json_default(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def format_sse(event: str, data: dict, event_id: Optional[int] = None) -> str:
+    """Server-Sent Events の1イベント分の文字列を作る"""
+    id_line = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{id_line}event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=_json_default)}\n\n"
+
+
+turn_stream_hub = TurnStreamHub()
@@ -0,0 +1,150 @@
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from firebase_admin import firestore
+
+from metrics import record_tokens
+
+# Geminiのトークン使用量とコストの集計。
+# 各呼び出しの usage_metadata から入力・出力・キャッシュのトークン数を取り出し、
+# ゲームドキュメントの usage フィールド（呼び出し箇所ごとの内訳付き）に加算する。
+# 加算はその処理が元々行う書き込みに Increment として相乗りさせ、書き込み回数を増やさない。
+# ゲームごとの予算を超えた場合は、安価なモデルを使う節約モードに切り替える。
+
+USAGE_FIELD = "usage"
+BUDGET_FIELD = "usageBudget"
+
+# ゲームごとの既定の予算（0は無制限）。管理APIでゲーム単位に上書きできる
+GAME_TOKEN_BUDGET = int(os.getenv("GAME_TOKEN_BUDGET", "0"))
+GAME_COST_BUDGET_USD = float(os.getenv("GAME_COST_BUDGET_USD", "0"))
+
+# 100万トークンあたりの料金（USD）: (入力, 出力, キャッシュ済み入力)。コストは概算
+MODEL_PRICES_PER_MTOK = {
+    "gemini-2.5-flash": (0.30, 2.50, 0.075),
+    "gemini-2.5-flash-lite": (0.10, 0.40, 0.025),
+}
+DEFAULT_PRICES_PER_MTOK = (
+    float(os.getenv("LLM_INPUT_PRICE_PER_MTOK", "0.30")),
+    float(os.getenv("LLM_OUTPUT_PRICE_PER_MTOK", "2.50")),
+    float(os.getenv("LLM_CACHED_PRICE_PER_MTOK", "0.075")),
+)
+
+TOKEN_KEYS = ("promptTokens", "outputTokens", "cachedTokens", "totalTokens")
+
+
+def extract_usage(response: Any) -> Dict[str, int]:
+    """Geminiの応答（またはストリーミングの最終チャンク）からトークン数を取り出す"""
+    metadata = getattr(response, "usage_metadata", None)
+    prompt_tokens = int(getattr(metadata, "prompt_token_count", 0) or 0)
+    output_tokens = int(getattr(metadata, "candidates_token_count", 0) or 0)
+    cached_tokens = int(getattr(metadata, "cached_content_token_count", 0) or 0)
+    total_tokens = int(getattr(metadata, "total_token_count", 0) or 0) or prompt_tokens + output_tokens
+    return {
+        "promptTokens": prompt_tokens,
+        "outputTokens": output_tokens,
+        "cachedTokens": cached_tokens,
+        "totalTokens": total_tokens,
+    }
+
+
+def estimate_cost(model_name: str, usage: Dict[str, int]) -> float:
+    input_price, output_price, cached_price = MODEL_PRICES_PER_MTOK.get(model_name, DEFAULT_PRICES_PER_MTOK)
+    uncached_prompt = max(0, usage["promptTokens"] - usage["cachedTokens"])
+    return (uncached_prompt * input_price + usage["cachedTokens"] * cached_price + usage["outputTokens"] * output_price) / 1_000_000
+
+
+def _empty_totals() -> dict:
+    totals = {key: 0 for key in TOKEN_KEYS + ("calls",)}
+    totals["costUsd"] = 0.0
+    return totals
+
+
+class UsageAggregator:
+    """プロセス起動以降の呼び出し箇所・モデルごとの合計（管理APIで返す）"""
+
+    def __init__(self):
+        self._totals: Dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+
+    def add(self, call_site: str, model_name: str, usage: Dict[str, int], cost: float):
+        with self._lock:
+            totals = self._totals.setdefault((call_site, model_name), _empty_totals())
+            for key in TOKEN_KEYS:
+                totals[key] += usage[key]
+            totals["calls"] += 1
+            totals["costUsd"] += cost
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            by_call_site = [{"callSite": call_site, "model": model_name, **totals} for (call_site, model_name), totals in sorted(self._totals.items())]
+        overall = {key: sum(row[key] for row in by_call_site) for key in TOKEN_KEYS + ("calls", "costUsd")}
+        return {"totals": overall, "byCallSite": by_call_site}
+
+
+usage_totals = UsageAggregator()
+
+
+class UsageTracker:
+    """
+    1回の処理（1ターン、1リクエスト）の中でのモデル呼び出しを記録し、
+    ゲームドキュメントへ加算する更新内容をまとめて作る。
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, dict] = {}
+
+    def record(self, call_site: str, model_name: str, response: Any) -> Dict[str, int]:
+        usage = extract_usage(response)
+        cost = estimate_cost(model_name, usage)
+        pending = self._pending.setdefault(call_site, _empty_totals())
+        for key in TOKEN_KEYS:
+            pending[key] += usage[key]
+        pending["calls"] += 1
+        pending["costUsd"] += cost
+        usage_totals.add(call_site, model_name, usage, cost)
+        record_tokens(call_site, model_name, usage, cost)
+        return usage
+
+    def updates(self) -> dict:
+        """ゲームドキュメントの usage に加算する Increment の更新内容"""
+        updates = {}
+        for call_site, pending in self._pending.items():
+            for key, value in pending.items():
+                if not value:
+                    continue
+                updates[f"{USAGE_FIELD}.{key}"] = updates.get(f"{USAGE_FIELD}.{key}", 0) + value
+                updates[f"{USAGE_FIELD}.byCallSite.{call_site}.{key}"] = value
+        return {path: firestore.Increment(value) for path, value in updates.items()}
+
+
+def budget_limits(game_data: Optional[dict]) -> dict:
+    """ゲームに適用される予算（ゲーム単位の設定があればそれを優先）"""
+    budget = (game_data or {}).get(BUDGET_FIELD) or {}
+    return {
+        "maxTokens": int(budget.get("maxTokens", GAME_TOKEN_BUDGET) or 0),
+        "maxCostUsd": float(budget.get("maxCostUsd", GAME_COST_BUDGET_USD) or 0),
+    }
+
+
+def budget_exceeded(game_data: Optional[dict]) -> bool:
+    """予算を使い切ったか（節約モードに切り替えるか）"""
+    limits = budget_limits(game_data)
+    usage = (game_data or {}).get(USAGE_FIELD) or {}
+    if limits["maxTokens"] and usage.get("totalTokens", 0) >= limits["maxTokens"]:
+        return True
+    if limits["maxCostUsd"] and usage.get("costUsd", 0) >= limits["maxCostUsd"]:
+        return True
+    return False
+
+
+def game_usage_report(game_id: str, game_data: dict) -> dict:
+    usage = game_data.get(USAGE_FIELD) or {}
+    return {
+        "gameId": game_id,
+        "gameStatus": game_data.get("gameStatus"),
+        "usage": usage,
+        "budget": budget_limits(game_data),
+        "budgetExceeded": budget_exceeded(game_data),
+    }
+
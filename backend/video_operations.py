@@ -0,0 +1,160 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+from typing import Any, NamedTuple, Optional
+
+try:
+    from google import genai
+    from google.genai import types as genai_types
+    GENAI_AVAILABLE = True
+except ImportError:
+    GENAI_AVAILABLE = False
+
+# Veoの動画生成を長時間実行オペレーション（LRO）として扱う。
+# 生成の依頼（submit）はすぐに返るオペレーション名だけを受け取り、ゲームの openingVideo.operation /
+# epilogue.video_operation に記録する。完了の確認は video_operation ジョブが間隔を空けて1回ずつ行い、
+# 未完了なら同じジョブをバックオフ付きの遅延で再実行させる（確認のたびにジョブを作らない）。
+# オペレーション名とポーリングのジョブはどちらも永続化されるので、プロセスが再起動しても確認を続けられる。
+
+# 最初の確認までの秒数と、確認間隔の上限（間隔は確認のたびに1.5倍に延ばす）
+VIDEO_POLL_INITIAL_SECONDS = float(os.getenv("VIDEO_POLL_INITIAL_SECONDS", "10"))
+VIDEO_POLL_MAX_SECONDS = float(os.getenv("VIDEO_POLL_MAX_SECONDS", "60"))
+# 依頼からこの秒数を過ぎても完了しなければ諦めて失敗扱いにする
+VIDEO_OPERATION_TIMEOUT_SECONDS = float(os.getenv("VIDEO_OPERATION_TIMEOUT_SECONDS", "900"))
+# 進捗（progress）の見積もりに使う、生成にかかる秒数の目安
+VIDEO_EXPECTED_SECONDS = float(os.getenv("VIDEO_EXPECTED_SECONDS", "120"))
+# 生成した動画の保存先（Vertex AIでは gs://バケット/パス を指定する。空なら動画データがレスポンスに含まれ、
+# 完了を確認したワーカーが STORAGE_BUCKET にアップロードする）
+VEO_OUTPUT_GCS_URI = os.getenv("VEO_OUTPUT_GCS_URI", "")
+GCS_PUBLIC_URL_BASE = "https://storage.googleapis.com"
+
+# オペレーションの記録の state
+OPERATION_RUNNING = "running"
+OPERATION_SUCCEEDED = "succeeded"
+OPERATION_FAILED = "failed"
+
+
+class VideoOperationStatus(NamedTuple):
+    done: bool
+    uri: Optional[str] = None
+    error: Optional[str] = None
+    video_bytes: Optional[bytes] = None  # 保存先を指定しなかった場合の動画データ
+
+
+class VideoOperations:
+    """動画生成オペレーションのクライアントの共通インターフェース"""
+
+    model_name: str
+
+    def submit(self, prompt: str, params: dict) -> str:
+        """生成を依頼し、オペレーション名を返す（完了を待たない）"""
+        raise NotImplementedError
+
+    def get(self, operation_name: str) -> VideoOperationStatus:
+        """オペレーションの状態を1回だけ確認する"""
+        raise NotImplementedError
+
+
+class GenAIVideoOperations(VideoOperations):
+    """google-genai の generate_videos / operations.get を使うクライアント"""
+
+    def __init__(self, client: Any, model_name: str, output_gcs_uri: str = VEO_OUTPUT_GCS_URI):
+        self.client = client
+        self.model_name = model_name
+        self.output_gcs_uri = output_gcs_uri
+
+    def submit(self, prompt: str, params: dict) -> str:
+        config = genai_types.GenerateVideosConfig(number_of_videos=1, output_gcs_uri=self.output_gcs_uri or None, **params)
+        operation = self.client.models.generate_videos(model=self.model_name, prompt=prompt, config=config)
+        return operation.name
+
+    def get(self, operation_name: str) -> VideoOperationStatus:
+        operation = self.client.operations.get(genai_types.GenerateVideosOperation(name=operation_name))
+        if not operation.done:
+            return VideoOperationStatus(False)
+        if operation.error:
+            return VideoOperationStatus(True, error=str(operation.error))
+        response = operation.response or operation.result
+        videos = (response.generated_videos if response else None) or []
+        video = videos[0].video if videos else None
+        uri = video.uri if video else None
+        video_bytes = None if uri or not video else video.video_bytes
+        return VideoOperationStatus(True, uri=uri, video_bytes=video_bytes,
+                                    error=None if uri or video_bytes else "no video in operation response")
+
+
+def build_genai_video_operations(project_id: str, location: str, model_name: str) -> GenAIVideoOperations:
+    if not GENAI_AVAILABLE:
+        raise ImportError("google-genai is not installed")
+    client = genai.Client(vertexai=True, project=project_id, location=location)
+    return GenAIVideoOperations(client, model_name)
+
+
+def split_gcs_uri(uri: str) -> Optional[tuple]:
+    """gs://バケット/パス を (バケット, パス) に分ける（gs:// でなければ None）"""
+    if not uri or not uri.startswith("gs://"):
+        return None
+    bucket, _, path = uri[len("gs://"):].partition("/")
+    return (bucket, path) if bucket and path else None
+
+
+def public_storage_url(uri: str) -> str:
+    """gs:// のURIを公開URL（https://storage.googleapis.com/バケット/パス）に変換する。それ以外はそのまま返す"""
+    parts = split_gcs_uri(uri)
+    return f"{GCS_PUBLIC_URL_BASE}/{parts[0]}/{parts[1]}" if parts else uri
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def operation_elapsed_seconds(record: dict, now: Optional[datetime] = None) -> float:
+    """依頼からの経過秒数"""
+    try:
+        submitted = datetime.fromisoformat(record.get("submittedAt"))
+    except (TypeError, ValueError):
+        return 0.0
+    return max(0.0, ((now or _now()) - submitted).total_seconds())
+
+
+def next_poll_delay(polls: int) -> float:
+    """polls 回確認した後、次の確認までの秒数"""
+    return min(VIDEO_POLL_MAX_SECONDS, VIDEO_POLL_INITIAL_SECONDS * (1.5 ** polls))
+
+
+def operation_job_id(game_id: str, target: str, operation_name: str) -> str:
+    """
+    確認ジョブのID（1つのオペレーションにつき1つ。未完了の間は同じジョブを遅延付きで再実行する。
+    依頼し直した場合は別のIDになる）
+    """
+    digest = hashlib.sha256(operation_name.encode("utf-8")).hexdigest()[:12]
+    return f"video_operation-{game_id}-{target}-{digest}"
+
+
+def new_operation_record(name: str, model_name: str, prompt: str) -> dict:
+    """ゲームに記録するオペレーションの情報（prompt は完了時にメディアキャッシュへ登録するために持つ）"""
+    return {
+        "name": name,
+        "model": model_name,
+        "prompt": prompt,
+        "state": OPERATION_RUNNING,
+        "submittedAt": _now().isoformat(),
+        "polls": 0,
+        "progress": 0,
+    }
+
+
+def estimate_progress(record: dict, now: Optional[datetime] = None) -> int:
+    """経過時間から見積もった進捗（%）。完了を確認するまでは95%で止める"""
+    elapsed = operation_elapsed_seconds(record, now or _now())
+    return min(95, int(elapsed / max(VIDEO_EXPECTED_SECONDS, 1.0) * 100))
+
+
+def polled_record(record: dict, now: Optional[datetime] = None) -> dict:
+    """確認を1回行った後の記録"""
+    now = now or _now()
+    return {**record, "polls": (record.get("polls") or 0) + 1, "progress": estimate_progress(record, now), "lastPolledAt": now.isoformat()}
+
+
+def is_timed_out(record: dict, now: Optional[datetime] = None) -> bool:
+    return operation_elapsed_seconds(record, now or _now()) > VIDEO_OPERATION_TIMEOUT_SECONDS
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from job_queue import JobQueue, Reschedule
+
+# ジョブキューのワーカー。
+# Webプロセス内のスレッドとして動かすこともできるし（JOB_WORKER_IN_PROCESS=true）、
+# `python worker.py` で独立したプロセスとして動かすこともできる。
+
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1.0"))
+# ジョブ種別ごとの同時実行数（例: JOB_CONCURRENCY="gm_turn=8,opening_video=2"）
+DEFAULT_JOB_CONCURRENCY = {"gm_turn": 8, "opening_video": 2, "epilogue_video": 2, "video_operation": 4, "character_portrait": 4, "scene_image_recovery": 2, "scenario_pool_refill": 1}
+
+
+def parse_concurrency(value: Optional[str]) -> Dict[str, int]:
+    concurrency = dict(DEFAULT_JOB_CONCURRENCY)
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        job_type, limit = item.split("=", 1)
+        try:
+            concurrency[job_type.strip()] = max(1, int(limit))
+        except ValueError:
+            print(f"⚠️ JOB_CONCURRENCYの値が不正です: {item}")
+    return concurrency
+
+
+JOB_CONCURRENCY = parse_concurrency(os.getenv("JOB_CONCURRENCY"))
+
+
+class JobWorker:
+    """ジョブ種別ごとの同時実行数を守りながらキューからジョブを取り出して実行する"""
+
+    def __init__(self, queue: JobQueue, handlers: Dict[str, Callable[[dict], Any]], concurrency: Dict[str, int] = JOB_CONCURRENCY, poll_seconds: float = JOB_POLL_SECONDS):
+        self.queue = queue
+        self.handlers = handlers
+        self.concurrency = {job_type: concurrency.get(job_type, 1) for job_type in handlers}
+        self.poll_seconds = poll_seconds
+        self.worker_id = f"{os.getenv('HOSTNAME', 'local')}-{uuid.uuid4().hex[:8]}"
+        self._running = {job_type: 0 for job_type in handlers}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=sum(self.concurrency.values()), thread_name_prefix="job-worker")
+
+    def wake(self):
+        """新しいジョブを登録した直後など、ポーリング間隔を待たずにキューを確認させる"""
+        self._wake.set()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run_forever, name="job-worker-poller", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        self._executor.shutdown(wait=False)
+
+    def run_forever(self):
+        print(f"👷 ジョブワーカー起動: {self.worker_id} {self.concurrency}")
+        while not self._stopped.is_set():
+            try:
+                claimed = self.poll_once()
+            except Exception as e:
+                print(f"⚠️ ジョブの取り出しに失敗: {e}")
+                claimed = 0
+            if not claimed:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+    def poll_once(self) -> int:
+        """空きのある種別ごとにジョブを取り出して実行を開始し、開始した件数を返す"""
+        started = 0
+        for job_type, handler in self.handlers.items():
+            with self._lock:
+                free = self.concurrency[job_type] - self._running[job_type]
+            if free <= 0:
+                continue
+            for job in self.queue.claim(job_type, self.worker_id, free):
+                with self._lock:
+                    self._running[job_type] += 1
+                self._executor.submit(self._run, handler, job)
+                started += 1
+        return started
+
+    def _run(self, handler: Callable[[dict], Any], job: dict):
+        started = time.perf_counter()
+        try:
+            result = handler(job)
+            if isinstance(result, Reschedule):
+                self.queue.reschedule(job["id"], self.worker_id, result.delay_seconds, result.result)
+                print(f"⏳ ジョブ再実行待ち: {job['type']} {job['id']} ({result.delay_seconds:.1f}s後)")
+            else:
+                self.queue.complete(job["id"], self.worker_id, result)
+                print(f"✅ ジョブ完了: {job['type']} {job['id']} ({time.perf_counter() - started:.1f}s)")
+        except Exception as e:
+            print(f"🚨 ジョブ失敗: {job['type']} {job['id']} (試行{job.get('attempts')}回目): {e}")
+            self.queue.fail(job["id"], self.worker_id, f"{type(e).__name__}: {e}")
+        finally:
+            with self._lock:
+                self._running[job["type"]] -= 1
+            self.wake()
+
+
+def main():
+    # Webサーバーと同じ初期化（Firebase、Vertex AI、モデルレジストリ）を行ってからジョブを処理する
+    from main import JOB_HANDLERS, app, startup_initialization
+
+    startup_initialization(app)
+    if not app.state.job_queue:
+        raise SystemExit("ジョブキューを初期化できませんでした")
+    JobWorker(app.state.job_queue, JOB_HANDLERS).run_forever()
+
+
+if __name__ == "__main__":
+    main()
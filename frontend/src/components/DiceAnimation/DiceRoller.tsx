@@ -4,6 +4,7 @@ import { Box, Sphere, Text } from '@react-three/drei';
 import { motion } from 'framer-motion';
 import { Mesh } from 'three';
 import { Box as MuiBox, Typography, Button, FormControl, InputLabel, Select, MenuItem } from '@mui/material';
+import { getDiceOdds } from '../../services/api';
 
 interface DiceProps {
   result: number;
@@ -131,23 +132,57 @@ interface DiceRollerProps {
   diceType?: 'd20' | 'd6' | 'd8' | 'd10' | 'd12';
   disabled?: boolean;
   staticResult?: number; // 既に出た結果を静的表示する場合
+  gameId?: string; // 指定すると自分の能力値での成功率を表示する
 }
 
+const DC_OPTIONS = [5, 10, 12, 15, 18, 20, 25];
+const ABILITY_OPTIONS: { value: string; label: string }[] = [
+  { value: '', label: 'なし' },
+  { value: 'str', label: '筋力' },
+  { value: 'dex', label: '敏捷力' },
+  { value: 'con', label: '耐久力' },
+  { value: 'int', label: '知力' },
+  { value: 'wis', label: '判断力' },
+  { value: 'cha', label: '魅力' },
+];
+
 const DiceRoller: React.FC<DiceRollerProps> = ({ 
   onRoll, 
   diceType = 'd20', 
   disabled = false,
-  staticResult
+  staticResult,
+  gameId
 }) => {
   const [isRolling, setIsRolling] = useState(false);
   const [result, setResult] = useState<number | null>(staticResult || null);
   const [material, setMaterial] = useState<'wood' | 'metal' | 'crystal' | 'stone'>('wood');
   const [selectedDiceType, setSelectedDiceType] = useState(diceType);
   const [webglError, setWebglError] = useState(false);
+  const [dc, setDc] = useState(15);
+  const [ability, setAbility] = useState('');
+  const [successProbability, setSuccessProbability] = useState<number | null>(null);
 
   // 静的結果モードの場合は設定UIを隠す
   const isStaticMode = staticResult !== undefined;
 
+  // 成功率の取得（ダイス・目標値・能力値が変わるたび）
+  useEffect(() => {
+    if (!gameId || isStaticMode) return;
+    let cancelled = false;
+    const expression = `1${selectedDiceType}${ability ? `+${ability}` : ''}`;
+    getDiceOdds(gameId, expression, dc)
+      .then((odds) => {
+        if (!cancelled) setSuccessProbability(odds.probability ?? null);
+      })
+      .catch((error) => {
+        console.warn('成功率の取得に失敗しました:', error);
+        if (!cancelled) setSuccessProbability(null);
+      });
+    return () => {
+      cancelled = true;
+    };
+  }, [gameId, isStaticMode, selectedDiceType, dc, ability]);
+
   // WebGL Context Lost処理
   const handleWebGLError = () => {
     console.warn('WebGL Context Lost - falling back to 2D display');
@@ -226,6 +261,41 @@ const DiceRoller: React.FC<DiceRollerProps> = ({
           </MuiBox>
         )}
 
+        {/* 成功率（目標値と能力値を選ぶと、振る前に確率を表示） */}
+        {!isStaticMode && gameId && (
+          <MuiBox sx={{ display: 'flex', alignItems: 'center', gap: 2 }}>
+            <FormControl size="small" sx={{ minWidth: 90 }}>
+              <InputLabel sx={{ color: 'white' }}>目標値</InputLabel>
+              <Select
+                value={dc}
+                onChange={(e) => setDc(Number(e.target.value))}
+                sx={{ color: 'white', '& .MuiOutlinedInput-notchedOutline': { borderColor: 'rgba(255,255,255,0.3)' } }}
+              >
+                {DC_OPTIONS.map((option) => (
+                  <MenuItem key={option} value={option}>DC {option}</MenuItem>
+                ))}
+              </Select>
+            </FormControl>
+
+            <FormControl size="small" sx={{ minWidth: 100 }}>
+              <InputLabel sx={{ color: 'white' }}>能力値</InputLabel>
+              <Select
+                value={ability}
+                onChange={(e) => setAbility(e.target.value as string)}
+                sx={{ color: 'white', '& .MuiOutlinedInput-notchedOutline': { borderColor: 'rgba(255,255,255,0.3)' } }}
+              >
+                {ABILITY_OPTIONS.map((option) => (
+                  <MenuItem key={option.value} value={option.value}>{option.label}</MenuItem>
+                ))}
+              </Select>
+            </FormControl>
+
+            <Typography variant="body1" sx={{ color: '#FFD700', fontWeight: 'bold', minWidth: 110 }}>
+              成功率: {successProbability !== null ? `${Math.round(successProbability * 100)}%` : '-'}
+            </Typography>
+          </MuiBox>
+        )}
+
         {/* 3Dダイス表示 */}
         <MuiBox
           sx={{
@@ -1,7 +1,105 @@
 import { useEffect, useMemo } from 'react';
-import { doc, onSnapshot } from 'firebase/firestore';
+import { collection, doc, onSnapshot, orderBy, query } from 'firebase/firestore';
 import { db } from '../services/firebase';
+import { getGameLog, streamGameEvents } from '../services/api';
 import { useGameStore } from '../store/gameStore';
+import type { GameLog } from '../store/gameStore';
+
+// 'events': バックエンドの差分イベント(SSE)で同期する / 'firestore': ゲームドキュメントを直接購読する
+const GAME_SYNC_MODE = import.meta.env.VITE_GAME_SYNC_MODE || 'events';
+const RECONNECT_DELAY_MS = 2000;
+
+// ゲームドキュメントの内容をストアへ反映する
+const applyGameData = (gameId: string, gameData: any) => {
+  useGameStore.setState({
+    gameId,
+    roomId: gameData?.roomId || null,
+    hostId: gameData?.hostId || null,
+    gameStatus: gameData?.gameStatus || null,
+    players: gameData?.players || {},
+    scenarioOptions: gameData?.scenarioOptions || null,
+    votes: gameData?.votes || null,
+    decidedScenarioId: gameData?.decidedScenarioId || null,
+    openingVideo: gameData?.openingVideo || null,
+    videoSettings: gameData?.videoSettings || null,
+    currentTurn: gameData?.currentTurn || 1,
+    playerActionsThisTurn: gameData?.playerActionsThisTurn || {},
+    epilogue: gameData?.epilogue || null, // エピローグデータ
+    completionResult: gameData?.completionResult || null, // 完了結果
+    isLoading: false, // データが取得できたのでローディング終了
+    error: null, // エラーをクリア
+  });
+};
+
+// ネストしたフィールドを不変更新する
+const setPath = (target: any, path: string[], value: any): any => {
+  const [key, ...rest] = path;
+  const base = target && typeof target === 'object' ? target : {};
+  return { ...base, [key]: rest.length ? setPath(base[key], rest, value) : value };
+};
+
+// 通し番号で重複を除きつつログを結合する
+const mergeGameLog = (current: GameLog[], entries: GameLog[]) => {
+  const bySeq = new Map<number, GameLog>();
+  [...current, ...entries].forEach((entry) => bySeq.set(entry.seq ?? bySeq.size, entry));
+  return Array.from(bySeq.values()).sort((a, b) => (a.seq ?? 0) - (b.seq ?? 0));
+};
+
+// スナップショット受信後、ログ全件をページ単位で取得する
+const loadFullGameLog = async (gameId: string) => {
+  let after: number | undefined = undefined;
+  while (true) {
+    const page = await getGameLog(gameId, after);
+    useGameStore.setState((state) => ({ gameLog: mergeGameLog(state.gameLog, page.entries) }));
+    if (!page.hasMore || page.nextCursor === null) return;
+    after = page.nextCursor;
+  }
+};
+
+// 差分イベントをストアへ適用する
+const applyGameEvent = (gameId: string, type: string, data: any) => {
+  switch (type) {
+    case 'snapshot':
+      useGameStore.setState({ gameLog: [] });
+      applyGameData(gameId, data.state);
+      loadFullGameLog(gameId).catch((error) => console.error('ゲームログの取得エラー:', error));
+      break;
+    case 'log_appended':
+      useGameStore.setState((state) => ({ gameLog: mergeGameLog(state.gameLog, [data.entry]) }));
+      break;
+    case 'log_updated':
+      // 追記済みのエントリの書き換え（情景画像の生成完了など）
+      useGameStore.setState((state) => ({
+        gameLog: state.gameLog.map((entry) => (entry.seq === data.seq ? { ...entry, ...data.changes } : entry)),
+      }));
+      break;
+    case 'player_updated':
+      useGameStore.setState((state) => {
+        let player = data.player ?? state.players[data.playerId];
+        if (!data.player) {
+          Object.entries(data.changes || {}).forEach(([path, value]) => {
+            player = setPath(player, path.split('.'), value);
+          });
+        }
+        return { players: { ...state.players, [data.playerId]: player } };
+      });
+      break;
+    case 'status_changed':
+      useGameStore.setState({ gameStatus: data.gameStatus });
+      break;
+    case 'fields_updated':
+      useGameStore.setState((state) => {
+        const updates: Record<string, any> = {};
+        Object.entries(data.fields || {}).forEach(([path, value]) => {
+          const [field, ...rest] = path.split('.');
+          const current = field in updates ? updates[field] : (state as any)[field];
+          updates[field] = rest.length ? setPath(current, rest, value) : value;
+        });
+        return updates;
+      });
+      break;
+  }
+};
 
 export const useGameSession = (gameId: string | undefined) => {
   const setError = useGameStore((state) => state.setError); // setErrorのみ個別に取得
@@ -30,30 +128,55 @@ export const useGameSession = (gameId: string | undefined) => {
       return;
     }
 
+    if (GAME_SYNC_MODE !== 'firestore') {
+      // スナップショットを一度受け取った後は差分だけを受信し、切断時は最後のバージョンから再開する
+      const controller = new AbortController();
+      let version: number | null = null;
+      const run = async () => {
+        while (!controller.signal.aborted) {
+          try {
+            await streamGameEvents(gameId, version, (type, data) => {
+              if (typeof data.version === 'number') version = data.version;
+              applyGameEvent(gameId, type, data);
+            }, controller.signal);
+          } catch (error) {
+            if (controller.signal.aborted) return;
+            console.error('差分イベントの受信エラー:', error);
+            if (version === null) {
+              setError('ゲーム情報の取得中にエラーが発生しました。');
+              useGameStore.setState({ isLoading: false });
+            }
+          }
+          await new Promise((resolve) => setTimeout(resolve, RECONNECT_DELAY_MS));
+        }
+      };
+      run();
+      return () => controller.abort();
+    }
+
     const gameRef = doc(db, 'games', gameId);
 
+    // サブコレクション移行前のゲームはドキュメント内のgameLog配列（連番 1..N）を持ち、移行後に追記された
+    // エントリはサブコレクションに N より後ろの連番で入る。2つの購読の到着順に依らないよう、それぞれの最新を保持して結合する
+    let legacyLog: GameLog[] | null = null;
+    let subcollectionLog: GameLog[] = [];
+    const publishGameLog = () => {
+      const legacy = legacyLog ?? [];
+      useGameStore.setState({
+        gameLog: [...legacy, ...subcollectionLog.filter((entry) => (entry.seq ?? 0) > legacy.length)],
+      });
+    };
+
     const unsubscribe = onSnapshot(gameRef, (docSnapshot) => {
       if (docSnapshot.exists()) {
         const gameData = docSnapshot.data();
-        // Zustandストアを直接更新
-        useGameStore.setState({
-          gameId: docSnapshot.id,
-          roomId: gameData?.roomId || null,
-          hostId: gameData?.hostId || null,
-          gameStatus: gameData?.gameStatus || null,
-          players: gameData?.players || {},
-          scenarioOptions: gameData?.scenarioOptions || null,
-          votes: gameData?.votes || null,
-          decidedScenarioId: gameData?.decidedScenarioId || null,
-          openingVideo: gameData?.openingVideo || null,
-          gameLog: gameData?.gameLog || [],
-          currentTurn: gameData?.currentTurn || 1,
-          playerActionsThisTurn: gameData?.playerActionsThisTurn || {},
-          epilogue: gameData?.epilogue || null, // エピローグデータ
-          completionResult: gameData?.completionResult || null, // 完了結果
-          isLoading: false, // データが取得できたのでローディング終了
-          error: null, // エラーをクリア
-        });
+        applyGameData(docSnapshot.id, gameData);
+        const documentLog: any[] = gameData?.gameLog || [];
+        // gameLog配列が変わったときだけ結合し直す（ドキュメントの他のフィールドの更新では再描画しない）
+        if (legacyLog === null || documentLog.length !== legacyLog.length) {
+          legacyLog = documentLog.map((entry, index) => ({ ...entry, seq: index + 1 }));
+          publishGameLog();
+        }
       } else {
         setError('ゲームが見つかりません。');
         useGameStore.getState().clearGame();
@@ -65,8 +188,20 @@ export const useGameSession = (gameId: string | undefined) => {
       useGameStore.setState({ isLoading: false }); // エラー時もローディング終了
     });
 
+    // ゲームログはサブコレクションを購読する（初回以降は追加分のみが配信される）
+    const logQuery = query(collection(db, 'games', gameId, 'logs'), orderBy('seq'));
+    const unsubscribeLog = onSnapshot(logQuery, (logSnapshot) => {
+      subcollectionLog = logSnapshot.docs.map((logDoc) => logDoc.data() as GameLog);
+      publishGameLog();
+    }, (error) => {
+      console.error('ゲームログの監視エラー:', error);
+    });
+
     // コンポーネントがアンマウントされるときに監視を停止
-    return () => unsubscribe();
+    return () => {
+      unsubscribe();
+      unsubscribeLog();
+    };
   }, [gameId, setError]); // 依存配列から個々のアクションを削除
   
   // フック戻り値をメモ化
@@ -73,7 +73,9 @@ export const CharacterCreationPage: React.FC = () => {
 
   // 現在のプレイヤーのキャラクター作成状況を確認
   const currentPlayer = uid ? players[uid] : null;
-  const hasCharacter = currentPlayer?.characterName && currentPlayer?.characterImageUrl;
+  // 画像はサーバーのジョブで生成され、完了するとイベントで characterImageUrl が届く
+  const isPortraitGenerating = currentPlayer?.characterImageStatus === 'generating';
+  const hasCharacter = currentPlayer?.characterName && (currentPlayer?.characterImageUrl || isPortraitGenerating);
 
   // 決定されたシナリオの情報を取得
   const selectedScenario = scenarioOptions?.find(s => s.id === decidedScenarioId);
@@ -92,7 +94,7 @@ export const CharacterCreationPage: React.FC = () => {
     if (hasCharacter) {
       setCharacterName(currentPlayer.characterName);
       setCharacterDescription(currentPlayer.characterDescription);
-      setGeneratedImageUrl(currentPlayer.characterImageUrl);
+      setGeneratedImageUrl(currentPlayer.characterImageUrl ?? null);
       setHasSubmitted(true);
     }
   }, [hasCharacter, currentPlayer]);
@@ -123,7 +125,7 @@ export const CharacterCreationPage: React.FC = () => {
       };
       
       const result = await createCharacter(storedGameId, characterName, characterDescription, abilitiesData);
-      setGeneratedImageUrl(result.characterImageUrl);
+      setGeneratedImageUrl(result.characterImageUrl ?? null);
       setHasSubmitted(true);
     } catch (err: any) {
       const message = err.response?.data?.detail || 'キャラクター画像の生成に失敗しました。';
@@ -472,7 +474,7 @@ export const CharacterCreationPage: React.FC = () => {
               mb: 2,
               overflow: 'hidden'
             }}>
-              {isGenerating ? (
+              {isGenerating || isPortraitGenerating ? (
                 <Box sx={{ 
                   textAlign: 'center',
                   p: 3,
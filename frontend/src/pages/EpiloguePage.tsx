@@ -48,6 +48,9 @@ interface EpilogueData {
   completion_percentage: number;
   generated_at: any;
   video_url?: string;
+  // 動画生成の状態（生成はバックグラウンドで行われ、結果はゲームのイベントで届く）
+  video_status?: 'generating' | 'ready' | 'failed';
+  video_operation?: { progress?: number } | null;
 }
 
 const EpiloguePage: React.FC = () => {
@@ -57,7 +60,7 @@ const EpiloguePage: React.FC = () => {
   const gameSession = useGameSession(gameId || '');
   const { gameData, loading, error } = gameSession || { gameData: null, loading: true, error: null };
   const [isGeneratingEpilogue, setIsGeneratingEpilogue] = useState(false);
-  const [isGeneratingVideo, setIsGeneratingVideo] = useState(false);
+  const [isRequestingVideo, setIsRequestingVideo] = useState(false);
   const [videoError, setVideoError] = useState<string | null>(null);
 
   console.log('EpiloguePage Debug:', {
@@ -72,6 +75,8 @@ const EpiloguePage: React.FC = () => {
   const currentUid = useGameStore.getState().uid;
   const epilogue = gameData?.epilogue as EpilogueData | undefined;
   const isHost = gameData?.hostId === currentUid;
+  const isGeneratingVideo = isRequestingVideo || epilogue?.video_status === 'generating';
+  const videoProgress = epilogue?.video_operation?.progress ?? 0;
   
   console.log('Host Debug:', {
     gameDataHostId: gameData?.hostId,
@@ -129,24 +134,21 @@ const EpiloguePage: React.FC = () => {
     navigate('/');
   };
 
-  // エピローグ動画生成
+  // エピローグ動画生成（完了はゲームのイベントで epilogue.video_url として届く）
   const handleGenerateVideo = async () => {
     if (!gameId || !idToken) return;
 
-    setIsGeneratingVideo(true);
+    setIsRequestingVideo(true);
     setVideoError(null);
     
     try {
       const response = await generateEpilogueVideo(gameId);
-      console.log('動画生成完了:', response);
-      
-      // ページを再読み込みして最新のエピローグデータ（video_url付き）を取得
-      window.location.reload();
+      console.log('動画生成開始:', response);
     } catch (err: any) {
       console.error('動画生成エラー:', err);
       setVideoError(err.response?.data?.detail || '動画の生成に失敗しました。もう一度お試しください。');
     } finally {
-      setIsGeneratingVideo(false);
+      setIsRequestingVideo(false);
     }
   };
 
@@ -468,7 +470,7 @@ const EpiloguePage: React.FC = () => {
                 {isGeneratingVideo ? (
                   <>
                     <CircularProgress size={20} color="inherit" sx={{ mr: 1 }} />
-                    動画生成中...（最大10分）
+                    動画生成中...（{videoProgress}%）
                   </>
                 ) : (
                   'ハイライト動画を生成'
@@ -508,9 +510,9 @@ const EpiloguePage: React.FC = () => {
           </Box>
           
           {/* 動画生成エラー表示 */}
-          {videoError && (
+          {(videoError || epilogue.video_status === 'failed') && (
             <Alert severity="error" sx={{ mt: 2 }}>
-              {videoError}
+              {videoError || '動画の生成に失敗しました。もう一度お試しください。'}
             </Alert>
           )}
         </Grid>
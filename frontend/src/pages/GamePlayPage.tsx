@@ -30,7 +30,7 @@ import {
 } from '@mui/icons-material';
 import { useGameStore } from '../store/gameStore';
 import { useGameSession } from '../hooks/useGameSession';
-import { submitPlayerAction } from '../services/api';
+import { submitPlayerAction, streamTurnNarration } from '../services/api';
 import { BookStyleContainer } from '../components/BookStyleContainer';
 import DiceRoller from '../components/DiceAnimation/DiceRoller';
 import { CharacterList } from '../components/CharacterList';
@@ -59,6 +59,7 @@ export const GamePlayPage: React.FC = () => {
   const [playerAction, setPlayerAction] = useState('');
   const [isSubmitting, setIsSubmitting] = useState(false);
   const [isAIThinking, setIsAIThinking] = useState(false);
+  const [streamingNarration, setStreamingNarration] = useState('');
   const [selectedPlayerForDetail, setSelectedPlayerForDetail] = useState<string | null>(null);
   const [isManualCompleting, setIsManualCompleting] = useState(false);
 
@@ -333,6 +334,21 @@ export const GamePlayPage: React.FC = () => {
     }
   }, [gameLog]);
 
+  // GM応答待ちの間、生成途中のナレーションをストリーミングで表示
+  useEffect(() => {
+    if (!isAIThinking || !gameId) return;
+    const controller = new AbortController();
+    setStreamingNarration('');
+    streamTurnNarration(gameId, currentTurn, (text) => {
+      setStreamingNarration((previous) => previous + text);
+    }, controller.signal, () => setStreamingNarration('')).catch((err) => {
+      if (err.name !== 'AbortError') {
+        console.error('ナレーションのストリーミング受信エラー:', err);
+      }
+    });
+    return () => controller.abort();
+  }, [isAIThinking, gameId, currentTurn]);
+
   // 手動シナリオ完了処理
   const handleManualComplete = async () => {
     if (!gameId || !isHost) return;
@@ -480,12 +496,18 @@ export const GamePlayPage: React.FC = () => {
                       borderRadius: 2,
                       textAlign: 'center'
                     }}>
-                      <Box sx={{ display: 'flex', alignItems: 'center', justifyContent: 'center', gap: 2 }}>
-                        <CircularProgress size={20} sx={{ color: '#8B4513' }} />
-                        <Typography sx={{ color: '#8B4513', fontStyle: 'italic' }}>
-                          ゲームマスターが考えています...
+                      {streamingNarration ? (
+                        <Typography sx={{ color: '#2D1B0E', textAlign: 'left', whiteSpace: 'pre-wrap', lineHeight: 1.8 }}>
+                          {streamingNarration}
                         </Typography>
-                      </Box>
+                      ) : (
+                        <Box sx={{ display: 'flex', alignItems: 'center', justifyContent: 'center', gap: 2 }}>
+                          <CircularProgress size={20} sx={{ color: '#8B4513' }} />
+                          <Typography sx={{ color: '#8B4513', fontStyle: 'italic' }}>
+                            ゲームマスターが考えています...
+                          </Typography>
+                        </Box>
+                      )}
                     </Paper>
                   </ListItem>
                 )}
@@ -614,6 +636,7 @@ export const GamePlayPage: React.FC = () => {
               onRoll={(result) => console.log('Dice rolled:', result)}
               diceType="d20"
               disabled={false}
+              gameId={gameId}
             />
           </Box>
 
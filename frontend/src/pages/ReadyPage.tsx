@@ -356,12 +356,16 @@ export const ReadyPage: React.FC = () => {
 
               {videoStatus === 'generating' && (
                 <Box sx={{ mt: 2 }}>
-                  <LinearProgress sx={{
-                    backgroundColor: 'rgba(139, 69, 19, 0.2)',
-                    '& .MuiLinearProgress-bar': {
-                      background: 'linear-gradient(45deg, #D69E2E, #FF8C00)'
-                    }
-                  }} />
+                  <LinearProgress
+                    variant={openingVideo?.operation ? 'determinate' : 'indeterminate'}
+                    value={openingVideo?.operation?.progress ?? 0}
+                    sx={{
+                      backgroundColor: 'rgba(139, 69, 19, 0.2)',
+                      '& .MuiLinearProgress-bar': {
+                        background: 'linear-gradient(45deg, #D69E2E, #FF8C00)'
+                      }
+                    }}
+                  />
                   <Typography variant="caption" sx={{ 
                     mt: 1, 
                     display: 'block', 
@@ -92,9 +92,11 @@ export const startVoting = async (gameId: string, options?: {
 
 /**
  * シナリオに投票する
+ * 残りの票で結果が変わらなくなった時点で、投票中でもオープニング動画の生成が始まる（openingVideo.early）。
+ * その後の投票の変更で結果が未確定に戻った場合、openingVideo は null に戻る。
  * @param gameId ゲームID
  * @param scenarioId シナリオID
- * @returns { message: string }
+ * @returns { message: string, jobId?: string }
  */
 export const voteForScenario = async (gameId: string, scenarioId: string) => {
   return callApi(`/games/${gameId}/vote`, 'POST', { scenarioId });
@@ -106,7 +108,8 @@ export const voteForScenario = async (gameId: string, scenarioId: string) => {
  * @param characterName キャラクター名
  * @param characterDescription キャラクターの説明
  * @param abilities キャラクターの能力値
- * @returns { characterImageUrl: string }
+ * 画像はサーバー側のジョブで生成され、完了するとプレイヤーの characterImageUrl / characterImageStatus が更新される
+ * @returns { characterImageUrl: null, characterImageStatus: 'generating', jobId: string }
  */
 export const createCharacter = async (gameId: string, characterName: string, characterDescription: string, abilities?: any) => {
   return callApi(`/games/${gameId}/create-character`, 'POST', { 
@@ -153,22 +156,149 @@ export const submitPlayerAction = async (gameId: string, actionText: string) =>
   return callApi(`/games/${gameId}/action`, 'POST', { actionText });
 };
 
+/**
+ * ゲームログをページング取得する
+ * @param gameId ゲームID
+ * @param after 最後に受け取ったログの通し番号（省略時は先頭から）
+ * @param limit 取得件数
+ * @returns { entries: GameLog[], nextCursor: number | null, hasMore: boolean }
+ */
+export const getGameLog = async (gameId: string, after?: number, limit?: number) => {
+  const params = new URLSearchParams();
+  if (after !== undefined) params.set('after', String(after));
+  if (limit !== undefined) params.set('limit', String(limit));
+  const queryString = params.toString();
+  return callApi(`/games/${gameId}/log${queryString ? `?${queryString}` : ''}`, 'GET');
+};
+
+type ServerSentEvent = { event: string; data: any; id: string | null };
+
+/**
+ * Server-Sent Eventsのエンドポイントに接続し、受信したイベントを順に渡す
+ * onEventがtrueを返すか、ストリームが終了すると戻る
+ */
+const readEventStream = async (
+  endpoint: string,
+  onEvent: (event: ServerSentEvent) => boolean | void,
+  signal?: AbortSignal
+): Promise<void> => {
+  const { auth } = await import('./firebase');
+  const idToken = auth.currentUser ? await auth.currentUser.getIdToken() : useGameStore.getState().idToken;
+
+  const response = await fetch(`${API_BASE_URL}${endpoint}`, {
+    headers: idToken ? { 'Authorization': `Bearer ${idToken}` } : {},
+    signal,
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Stream failed with status ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) return;
+    buffer += decoder.decode(value, { stream: true });
+
+    // イベントは空行で区切られる（":"で始まる行はキープアライブ）
+    let separatorIndex;
+    while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+      const rawEvent = buffer.slice(0, separatorIndex);
+      buffer = buffer.slice(separatorIndex + 2);
+      let eventName = 'message';
+      let eventId: string | null = null;
+      let data = '';
+      for (const line of rawEvent.split('\n')) {
+        if (line.startsWith('event: ')) eventName = line.slice(7);
+        else if (line.startsWith('id: ')) eventId = line.slice(4);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+      }
+      if (!data) continue;
+      if (onEvent({ event: eventName, data: JSON.parse(data), id: eventId })) {
+        reader.cancel();
+        return;
+      }
+    }
+  }
+};
+
+/**
+ * 指定ターンのGMナレーションをServer-Sent Eventsで受信する
+ * @param gameId ゲームID
+ * @param turn ターン番号
+ * @param onText 生成途中のナレーション断片を受け取るコールバック
+ * @param signal 受信を中断するためのAbortSignal
+ * @param onReset 生成が失敗して再試行された時のコールバック（受信済みの断片を破棄する）
+ * @returns 確定したナレーション（タイムアウト時はnull）
+ */
+export const streamTurnNarration = async (
+  gameId: string,
+  turn: number,
+  onText: (text: string) => void,
+  signal?: AbortSignal,
+  onReset?: () => void
+): Promise<{ narration: string; imageUrl?: string | null } | null> => {
+  let result: { narration: string; imageUrl?: string | null } | null = null;
+  await readEventStream(`/games/${gameId}/turns/${turn}/stream`, ({ event, data }) => {
+    if (event === 'delta') onText(data.text);
+    else if (event === 'reset') onReset?.();
+    else if (event === 'done') result = data;
+    return event === 'done' || event === 'timeout';
+  }, signal);
+  return result;
+};
+
+/**
+ * ゲーム状態の差分イベントをServer-Sent Eventsで受信する
+ * @param gameId ゲームID
+ * @param since 最後に受け取ったイベントのバージョン（nullの場合は最初にスナップショットを受け取る）
+ * @param onEvent イベント種別（snapshot / log_appended / log_updated / player_updated / status_changed / fields_updated）とデータを受け取るコールバック
+ * @param signal 受信を中断するためのAbortSignal
+ */
+export const streamGameEvents = (
+  gameId: string,
+  since: number | null,
+  onEvent: (type: string, data: any) => void,
+  signal?: AbortSignal
+): Promise<void> => {
+  const queryString = since !== null ? `?since=${since}` : '';
+  return readEventStream(`/games/${gameId}/events${queryString}`, ({ event, data }) => {
+    onEvent(event, data);
+  }, signal);
+};
+
 /**
  * 手動でダイスを振る
  * @param gameId ゲームID
  * @param numDice ダイスの数
  * @param numSides ダイスの面数
  * @param description ダイスロールの説明（任意）
- * @returns { message: string, result: { rolls: number[], total: number }, player_name: string }
+ * @param expression ダイス式（任意。例: "2d6+dex", "1d20 adv"。指定時はダイスの数・面数より優先）
+ * @returns { message: string, result: { expression: string, rolls: number[], total: number, final_total: number }, player_name: string }
  */
-export const rollManualDice = async (gameId: string, numDice: number, numSides: number, description?: string) => {
+export const rollManualDice = async (gameId: string, numDice: number, numSides: number, description?: string, expression?: string) => {
   return callApi(`/games/${gameId}/manual-dice`, 'POST', { 
     num_dice: numDice, 
     num_sides: numSides, 
-    description: description || "" 
+    description: description || "",
+    ...(expression ? { expression } : {})
   });
 };
 
+/**
+ * ダイス式の成功率を取得する（能力値は自分のキャラクターのものが使われる）
+ * @param gameId ゲームID
+ * @param expression ダイス式（例: "1d20+dex", "1d20 adv"）
+ * @param dc 目標値（任意）
+ * @returns { expression: string, modifier: number, mean: number, probability?: number, table: { dc: number, probability: number }[] }
+ */
+export const getDiceOdds = async (gameId: string, expression: string, dc?: number) => {
+  const params = new URLSearchParams({ expression });
+  if (dc !== undefined) params.set('dc', String(dc));
+  return callApi(`/games/${gameId}/dice-odds?${params.toString()}`, 'GET');
+};
+
 /**
  * GMとチャットする
  * @param gameId ゲームID
@@ -180,9 +310,11 @@ export const sendGMChat = async (gameId: string, message: string) => {
 };
 
 /**
- * エピローグのハイライト動画を生成する
+ * エピローグのハイライト動画の生成を開始する
+ * 生成はバックグラウンドで行われ、進捗（epilogue.video_operation.progress）と結果（epilogue.video_status / video_url）は
+ * ゲームのイベント（fields_updated）で届く。
  * @param gameId ゲームID
- * @returns { message: string, video_url: string }
+ * @returns { message: string, status: 'generating' | 'ready', video_url?: string, jobId?: string, progress?: number }
  */
 export const generateEpilogueVideo = async (gameId: string) => {
   return callApi(`/games/${gameId}/generate-epilogue-video`, 'POST');
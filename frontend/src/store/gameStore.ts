@@ -12,17 +12,29 @@ interface OpeningVideo {
   status: 'generating' | 'ready' | 'error' | 'disabled';
   url?: string;
   prompt?: string;
+  scenarioId?: string;
+  requestId?: string;
+  early?: boolean; // 全員の投票を待たずに結果が確定した時点で生成を始めた
+  // Veoの長時間実行オペレーション（進捗は経過時間からの見積もり）
+  operation?: {
+    name: string;
+    state: 'running' | 'succeeded' | 'failed';
+    progress: number;
+    polls: number;
+  };
 }
 
 // ゲームログエントリ
-interface GameLog {
+export interface GameLog {
   turn: number;
-  type: 'gm_narration' | 'initial_narration' | 'player_action' | 'gm_response' | 'dice_roll';
+  type: 'gm_narration' | 'initial_narration' | 'player_action' | 'gm_response' | 'dice_roll' | 'gm_chat';
   content: string;
   playerId?: string;
   imageUrl?: string;
+  imageStatus?: 'pending' | 'ready' | 'skipped' | 'failed'; // 情景画像の生成状態（生成後に log_updated で書き換わる）
   timestamp?: any; // Firestore timestamp
   text?: string; // 代替フィールド
+  seq?: number; // ゲーム内の通し番号
 }
 
 // アプリケーション全体で共有する状態の型を定義